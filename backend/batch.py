@@ -0,0 +1,258 @@
+"""
+批量问答
+
+测试和离线分诊任务一次提交成百上千个问题。这里把一批问题交给回答函数（smart_answer）并发处理，
+每完成一个就产出一条结果，由接口以 NDJSON 流式返回：
+- 并发度和速率可以按批次设置，所有批次同时处理的问题数还受全局上限 BATCH_CONCURRENCY 限制
+- 单个问题出错只记录在该条结果中，不影响其他问题；回答函数在无法生成回答时抛出异常（不返回后备回答），
+  该问题记为 error，不作为已完成结果保存
+- 已成功的结果按批次 ID 保存一段时间；同一批次再次提交（例如连接中断后重试）时直接返回已有结果，
+  只处理剩下的问题。未指定批次 ID 时由问题内容计算，重新提交同一份文件即可续跑；
+  保存的结果带问题和历史的摘要，同一批次 ID 下问题或历史变了的项会重新回答
+
+输入可以是问题字符串，也可以是 {"id": ..., "question": ..., "chat_history": [...]}；
+文件支持 JSON 数组、JSON Lines 和每行一个问题的纯文本。
+"""
+import asyncio
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Sequence
+
+from config import BATCH_CONCURRENCY, BATCH_MAX_ITEMS, BATCH_RATE_LIMIT, BATCH_RESULT_TTL, BATCH_STORE_SIZE
+from logger import get_logger
+from resilience import TokenBucket
+
+logger = get_logger("batch")
+
+
+class BatchInputError(ValueError):
+    """批量输入无法解析或超出限制"""
+
+
+class BatchItem:
+    """批次中的一个问题"""
+
+    __slots__ = ("id", "index", "question", "chat_history")
+
+    def __init__(self, id: str, index: int, question: str, chat_history: List[Dict[str, Any]]):
+        self.id = id
+        self.index = index
+        self.question = question
+        self.chat_history = chat_history
+
+    def fingerprint(self) -> str:
+        """问题和历史的摘要，续跑时只直接返回摘要相同的已保存结果"""
+        payload = json.dumps([self.question, self.chat_history], ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+
+def parse_items(raw_items: Sequence[Any], max_items: int = BATCH_MAX_ITEMS) -> List[BatchItem]:
+    """把字符串或字典列表解析成 BatchItem，没有 id 时以序号作为 id"""
+    if not raw_items:
+        raise BatchInputError("批次中没有问题")
+    if len(raw_items) > max_items:
+        raise BatchInputError(f"批次最多 {max_items} 个问题，实际 {len(raw_items)} 个")
+    items, seen = [], set()
+    for index, raw in enumerate(raw_items):
+        if isinstance(raw, str):
+            raw = {"question": raw}
+        if not isinstance(raw, dict):
+            raise BatchInputError(f"第 {index + 1} 项既不是字符串也不是对象")
+        question = raw.get("question") or raw.get("message")
+        if not isinstance(question, str) or not question.strip():
+            raise BatchInputError(f"第 {index + 1} 项缺少问题文本")
+        history = raw.get("chat_history") or []
+        if not isinstance(history, list) or not all(
+                isinstance(m, dict) and "role" in m and "content" in m for m in history):
+            raise BatchInputError(f"第 {index + 1} 项的 chat_history 格式不正确")
+        item_id = str(raw.get("id", index))
+        if item_id in seen:
+            raise BatchInputError(f"问题 id 重复: {item_id}")
+        seen.add(item_id)
+        items.append(BatchItem(item_id, index, question.strip(), history))
+    return items
+
+
+def parse_file(filename: str, data: bytes, max_items: int = BATCH_MAX_ITEMS) -> List[BatchItem]:
+    """解析上传的问题文件：.json（数组或 {"items": [...]}）、.jsonl / .ndjson 或纯文本"""
+    try:
+        text = data.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        raise BatchInputError("文件不是 UTF-8 编码")
+    name = (filename or "").lower()
+    try:
+        if name.endswith(".json"):
+            payload = json.loads(text)
+            raw_items = payload.get("items", []) if isinstance(payload, dict) else payload
+        elif name.endswith((".jsonl", ".ndjson")):
+            raw_items = [json.loads(line) for line in text.splitlines() if line.strip()]
+        else:
+            raw_items = [line.strip() for line in text.splitlines() if line.strip()]
+    except ValueError as e:
+        raise BatchInputError(f"无法解析 {filename}: {e}")
+    if not isinstance(raw_items, list):
+        raise BatchInputError("JSON 文件应为问题数组或包含 items 数组的对象")
+    return parse_items(raw_items, max_items)
+
+
+def batch_id_for(items: Sequence[BatchItem]) -> str:
+    """由问题内容计算批次 ID，同样的输入得到同样的 ID"""
+    digest = hashlib.sha256()
+    for item in items:
+        digest.update(json.dumps([item.id, item.question, item.chat_history], ensure_ascii=False).encode("utf-8"))
+    return digest.hexdigest()[:16]
+
+
+class BatchStore:
+    """
+    按批次 ID 保存已成功的结果，超过 ttl 秒未访问或批次数超过上限时淘汰最久未用的批次
+
+    每个批次是 问题 id -> {"fingerprint": 问题和历史的摘要, "result": 结果} 的字典。
+    """
+
+    def __init__(self, max_batches: int = BATCH_STORE_SIZE, ttl: float = BATCH_RESULT_TTL):
+        self.max_batches = max_batches
+        self.ttl = ttl
+        self._batches: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+
+    def _evict(self) -> None:
+        now = time.monotonic()
+        for batch_id in [b for b, entry in self._batches.items() if now - entry["touched"] > self.ttl]:
+            del self._batches[batch_id]
+        while len(self._batches) > self.max_batches:
+            self._batches.popitem(last=False)
+
+    def completed(self, batch_id: str) -> Dict[str, Dict[str, Any]]:
+        self._evict()
+        entry = self._batches.get(batch_id)
+        if entry is None:
+            entry = self._batches[batch_id] = {"results": {}, "touched": time.monotonic()}
+        entry["touched"] = time.monotonic()
+        self._batches.move_to_end(batch_id)
+        return entry["results"]
+
+    def __len__(self) -> int:
+        return len(self._batches)
+
+
+class BatchRunner:
+    """执行批量问答，记录运行状态"""
+
+    def __init__(self, max_concurrency: int = BATCH_CONCURRENCY, max_rate: float = BATCH_RATE_LIMIT,
+                 store: Optional[BatchStore] = None):
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_rate = max_rate
+        self.store = store or BatchStore()
+        self._slots = asyncio.Semaphore(self.max_concurrency)
+        self.running_batches = 0
+        self.active_items = 0
+        self.completed_items = 0
+        self.failed_items = 0
+        self.replayed_items = 0
+
+    def limits(self, concurrency: Optional[int], rate: Optional[float]) -> Dict[str, float]:
+        """请求的并发度和速率（每秒问题数）不超过全局配置；rate 为 0 表示不限速"""
+        concurrency = min(self.max_concurrency, concurrency or self.max_concurrency)
+        if self.max_rate > 0:
+            rate = min(self.max_rate, rate) if rate else self.max_rate
+        return {"concurrency": max(1, concurrency), "rate": max(0.0, rate or 0.0)}
+
+    async def run(self, batch_id: str, items: Sequence[BatchItem],
+                  answer: Callable[[BatchItem], Awaitable[str]],
+                  concurrency: Optional[int] = None, rate: Optional[float] = None) -> AsyncIterator[Dict[str, Any]]:
+        """
+        依次产出 start、每个问题的 item 和最后的 summary 记录
+
+        调用方停止迭代时（客户端断开）取消尚未完成的问题，已完成的结果保留在 BatchStore 中。
+        """
+        limits = self.limits(concurrency, rate)
+        completed = self.store.completed(batch_id)
+        fingerprints = {item.id: item.fingerprint() for item in items}
+
+        def replayable(item: BatchItem) -> bool:
+            entry = completed.get(item.id)
+            return entry is not None and entry["fingerprint"] == fingerprints[item.id]
+
+        replayed = [item for item in items if replayable(item)]
+        pending = [item for item in items if not replayable(item)]
+        start = time.perf_counter()
+        counts = {"ok": 0, "error": 0, "replayed": 0}
+        yield {"type": "start", "batch_id": batch_id, "total": len(items), "pending": len(pending), **limits}
+
+        for item in replayed:
+            counts["replayed"] += 1
+            self.replayed_items += 1
+            yield {**completed[item.id]["result"], "replayed": True}
+
+        bucket = TokenBucket(limits["rate"], 1) if limits["rate"] > 0 else None
+        queue: "asyncio.Queue[BatchItem]" = asyncio.Queue()
+        for item in pending:
+            queue.put_nowait(item)
+        results: "asyncio.Queue[Dict[str, Any]]" = asyncio.Queue()
+
+        async def worker() -> None:
+            while True:
+                try:
+                    item = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                if bucket is not None:
+                    await bucket.acquire(float("inf"))
+                async with self._slots:
+                    await results.put(await self._answer_one(item, answer))
+
+        self.running_batches += 1
+        workers = [asyncio.create_task(worker()) for _ in range(min(int(limits["concurrency"]), len(pending)))]
+        try:
+            for _ in range(len(pending)):
+                result = await results.get()
+                counts[result["status"]] += 1
+                if result["status"] == "ok":
+                    completed[result["id"]] = {"fingerprint": fingerprints[result["id"]], "result": result}
+                yield result
+        finally:
+            self.running_batches -= 1
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+        seconds = time.perf_counter() - start
+        logger.info("批量问答完成", batch_id=batch_id, total=len(items), ok=counts["ok"],
+                    error=counts["error"], replayed=counts["replayed"], seconds=round(seconds, 3))
+        yield {"type": "summary", "batch_id": batch_id, "total": len(items), **counts, "seconds": round(seconds, 3)}
+
+    async def _answer_one(self, item: BatchItem, answer: Callable[[BatchItem], Awaitable[str]]) -> Dict[str, Any]:
+        result: Dict[str, Any] = {"type": "item", "id": item.id, "index": item.index, "question": item.question}
+        self.active_items += 1
+        start = time.perf_counter()
+        try:
+            result.update(status="ok", answer=await answer(item))
+            self.completed_items += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # 单个问题失败只记录在它自己的结果中
+            logger.warning("批量问答单项失败", item_id=item.id, error=str(e))
+            result.update(status="error", error=f"{type(e).__name__}: {e}")
+            self.failed_items += 1
+        finally:
+            self.active_items -= 1
+        result["seconds"] = round(time.perf_counter() - start, 3)
+        return result
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "max_concurrency": self.max_concurrency,
+            "max_rate": self.max_rate,
+            "running_batches": self.running_batches,
+            "active_items": self.active_items,
+            "completed_items": self.completed_items,
+            "failed_items": self.failed_items,
+            "replayed_items": self.replayed_items,
+            "stored_batches": len(self.store),
+        }
+
+
+batch_runner = BatchRunner()
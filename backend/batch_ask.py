@@ -0,0 +1,111 @@
+"""
+批量问答命令行工具
+
+把问题文件提交给 /api/chat/batch 接口，边接收边把每个问题的结果追加到输出文件（JSON Lines）。
+中断后用同样的参数再次运行即可续跑：输出文件中已成功的问题会被跳过，只提交剩下的问题；
+连接中断时按 --retries 自动重试。
+
+问题文件格式与上传接口相同：JSON 数组、JSON Lines 或每行一个问题的纯文本。
+
+用法（在 backend 目录下，服务需已启动）:
+    python batch_ask.py questions.txt -o answers.jsonl
+    python batch_ask.py questions.jsonl -o answers.jsonl --concurrency 8 --rate 2
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from typing import Dict, List
+
+import requests
+
+from batch import BatchInputError, BatchItem, batch_id_for, parse_file
+
+
+def load_done(path: str) -> Dict[str, dict]:
+    """读取已有输出文件中成功的结果，最后一行可能因中断而不完整，直接忽略"""
+    done: Dict[str, dict] = {}
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get("status") == "ok":
+                done[str(record["id"])] = record
+    return done
+
+
+def submit(url: str, batch_id: str, items: List[BatchItem], args: argparse.Namespace, output) -> Dict[str, int]:
+    payload = {
+        "batch_id": batch_id,
+        "items": [{"id": item.id, "question": item.question, "chat_history": item.chat_history} for item in items],
+        "concurrency": args.concurrency,
+        "rate": args.rate,
+    }
+    counts = {"ok": 0, "error": 0}
+    with requests.post(url, json=payload, stream=True, timeout=(10, args.timeout)) as response:
+        if response.status_code != 200:
+            raise SystemExit(f"批量问答请求失败: {response.status_code} {response.text}")
+        for line in response.iter_lines(decode_unicode=True):
+            if not line:
+                continue
+            record = json.loads(line)
+            if record.get("type") != "item":
+                continue
+            output.write(json.dumps(record, ensure_ascii=False) + "\n")
+            output.flush()
+            counts[record["status"]] += 1
+            print(f"[{counts['ok'] + counts['error']}/{len(items)}] {record['id']} {record['status']}"
+                  f" {record.get('seconds', 0)}s", file=sys.stderr)
+    return counts
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="批量问答命令行工具")
+    parser.add_argument("input", help="问题文件（.json、.jsonl 或纯文本）")
+    parser.add_argument("-o", "--output", required=True, help="结果文件（JSON Lines，追加写入）")
+    parser.add_argument("--url", default="http://localhost:8000/api/chat/batch")
+    parser.add_argument("--concurrency", type=int, default=None, help="并发度，不超过服务端 BATCH_CONCURRENCY")
+    parser.add_argument("--rate", type=float, default=None, help="每秒处理的问题数上限")
+    parser.add_argument("--retries", type=int, default=3, help="连接中断后的重试次数")
+    parser.add_argument("--chunk-size", type=int, default=1000, help="每次请求提交的问题数")
+    parser.add_argument("--timeout", type=float, default=600.0, help="两行结果之间的最长等待时间（秒）")
+    args = parser.parse_args()
+
+    with open(args.input, "rb") as f:
+        try:
+            items = parse_file(args.input, f.read(), max_items=sys.maxsize)
+        except BatchInputError as e:
+            raise SystemExit(str(e))
+    # 批次 ID 由完整的输入计算，续跑时服务端可以复用已保存的结果
+    batch_id = batch_id_for(items)
+
+    for attempt in range(args.retries + 1):
+        done = load_done(args.output)
+        pending = [item for item in items if item.id not in done]
+        print(f"批次 {batch_id}：共 {len(items)} 个问题，已完成 {len(items) - len(pending)} 个", file=sys.stderr)
+        if not pending:
+            return
+        try:
+            counts = {"ok": 0, "error": 0}
+            with open(args.output, "a", encoding="utf-8") as output:
+                # 超过服务端单批次上限的输入分段提交，各段使用同一个批次 ID
+                for start in range(0, len(pending), args.chunk_size):
+                    part = submit(args.url, batch_id, pending[start:start + args.chunk_size], args, output)
+                    counts = {k: counts[k] + part[k] for k in counts}
+            print(f"本轮成功 {counts['ok']} 个，失败 {counts['error']} 个", file=sys.stderr)
+            if counts["error"] == 0 or attempt == args.retries:
+                return
+        except requests.RequestException as e:
+            print(f"连接中断: {e}", file=sys.stderr)
+            if attempt == args.retries:
+                raise SystemExit(1)
+        time.sleep(min(2 ** attempt, 30))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+"""
+RAG 上下文组装基准
+
+比较检索结果拼接成提示之前的几种处理方式：
+- raw: 取前 k 个分块直接拼接（原来的做法）
+- dedup: 前 k 个分块去掉重叠文字后拼接
+- mmr: 先取 fetch_k 个候选，用 MMR 选出 k 个相关且互不重复的分块，再去重拼接
+- mmr+budget: 在 mmr 的基础上按 token 预算装入分块
+
+指标：上下文字符数和估计 token 数（决定模型预填充的耗时）、标注原文仍然完整出现在上下文中的问题比例、
+检索加组装的延迟。加上 --llm 时把每个问题的完整提示流式发送给对话模型，记录首个 token 延迟和总耗时
+（需要 DASHSCOPE_API_KEY，会产生费用）。
+
+用法（在 backend 目录下）:
+    python bench/bench_context.py
+    python bench/bench_context.py --chunker recursive:800:100 --k 5 --fetch-k 12 --budgets 1000,2000
+    python bench/bench_context.py --llm --questions 10
+"""
+import argparse
+import json
+import os
+import re
+import statistics
+import time
+from typing import Any, Callable, Dict, List
+
+from bench_retrieval import (BACKEND_DIR, CHUNKERS, CORPUS_PATH, QUESTIONS_PATH, _build_artifact, _ms_percentile,
+                             make_embeddings, parse_chunker)
+
+import rag  # noqa: E402
+from context import assemble_context, estimate_tokens  # noqa: E402
+
+_SPACES = re.compile(r"\s+")
+
+
+def _covered(context: str, phrases: List[str]) -> bool:
+    """标注原文是否完整出现在上下文中（忽略空白差异，截断或去重误删都会导致不命中）"""
+    flat = _SPACES.sub("", context)
+    return any(_SPACES.sub("", phrase) in flat for phrase in phrases)
+
+
+def _raw(docs, budget: int) -> str:
+    return "\n\n".join(doc.page_content for doc in docs)
+
+
+def _assembled(docs, budget: int) -> str:
+    return assemble_context(docs, budget)[0]
+
+
+def _stream_llm(prompt: str, model: str) -> Dict[str, float]:
+    """流式调用对话模型，返回首个 token 延迟和总耗时（秒）"""
+    from dashscope import Generation
+    start = time.perf_counter()
+    first = None
+    for response in Generation.call(model=model, prompt=prompt, stream=True, incremental_output=True,
+                                    max_tokens=64):
+        if response.status_code != 200:
+            raise RuntimeError(f"模型调用失败: {response.code} {response.message}")
+        if first is None:
+            first = time.perf_counter() - start
+    return {"ttft": first if first is not None else time.perf_counter() - start,
+            "total": time.perf_counter() - start}
+
+
+def evaluate(name: str, retriever, assemble: Callable, budget: int, questions: List[Dict[str, Any]],
+             args: argparse.Namespace) -> Dict[str, Any]:
+    chars, tokens, latencies, ttft, totals = [], [], [], [], []
+    covered = 0
+    for question in questions:
+        start = time.perf_counter()
+        context = assemble(retriever.invoke(question["question"]), budget)
+        latencies.append(time.perf_counter() - start)
+        chars.append(len(context))
+        tokens.append(estimate_tokens(context))
+        covered += _covered(context, question["relevant"])
+        if args.llm:
+            prompt = f"请基于以下参考信息回答用户的问题。\n\n参考信息:\n{context}\n\n用户问题: {question['question']}"
+            timing = _stream_llm(prompt, args.model)
+            ttft.append(timing["ttft"])
+            totals.append(timing["total"])
+    result = {
+        "name": name,
+        "context_chars": {"mean": round(statistics.fmean(chars), 1), "max": max(chars)},
+        "context_tokens": {"mean": round(statistics.fmean(tokens), 1), "max": max(tokens)},
+        "coverage": round(covered / len(questions), 4),
+        "latency_ms": {"p50": _ms_percentile(latencies, 0.5), "p95": _ms_percentile(latencies, 0.95)},
+    }
+    if args.llm:
+        result["llm_ms"] = {
+            "ttft_p50": _ms_percentile(ttft, 0.5), "ttft_p95": _ms_percentile(ttft, 0.95),
+            "total_p50": _ms_percentile(totals, 0.5),
+        }
+    line = (f"{name:<18}chars={result['context_chars']['mean']:<9}tokens={result['context_tokens']['mean']:<9}"
+            f"coverage={result['coverage']:<8}p50={result['latency_ms']['p50']}ms")
+    if args.llm:
+        line += f" ttft_p50={result['llm_ms']['ttft_p50']}ms total_p50={result['llm_ms']['total_p50']}ms"
+    print(line)
+    return result
+
+
+def run(args: argparse.Namespace) -> Dict[str, Any]:
+    with open(CORPUS_PATH, encoding="utf-8") as f:
+        text = f.read()
+    with open(QUESTIONS_PATH, encoding="utf-8") as f:
+        questions = json.load(f)
+    if args.questions:
+        questions = questions[:args.questions]
+    embeddings = make_embeddings(args.embeddings)
+    name, size, overlap = parse_chunker(args.chunker)
+    docs = CHUNKERS[name](text, size, overlap)
+    dim = len(embeddings.embed_query(docs[0].page_content))
+    index = _build_artifact("float32")(docs, embeddings, dim)
+    vector_index = index.make_retriever(args.k).index
+    plain = rag.IndexRetriever(index=vector_index, embeddings=embeddings, k=args.k)
+    mmr = rag.IndexRetriever(index=vector_index, embeddings=embeddings, k=args.k, fetch_k=args.fetch_k,
+                             lambda_mult=args.mmr_lambda)
+
+    results = []
+    try:
+        results.append(evaluate("raw", plain, _raw, 0, questions, args))
+        results.append(evaluate("dedup", plain, _assembled, 0, questions, args))
+        results.append(evaluate("mmr", mmr, _assembled, 0, questions, args))
+        for budget in args.budgets:
+            results.append(evaluate(f"mmr+budget{budget}", mmr, _assembled, budget, questions, args))
+    finally:
+        index.cleanup()
+    embeddings.save()
+
+    return {
+        "benchmark": "context",
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {"chunker": args.chunker, "k": args.k, "fetch_k": args.fetch_k, "mmr_lambda": args.mmr_lambda,
+                   "budgets": args.budgets, "embeddings": args.embeddings, "questions": len(questions),
+                   "llm": args.model if args.llm else None},
+        "chunks": len(docs),
+        "results": results,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="RAG 上下文组装基准")
+    parser.add_argument("--chunker", default="recursive:2000:200", help="分块配置，格式为 名称:块大小:重叠")
+    parser.add_argument("--k", type=int, default=3)
+    parser.add_argument("--fetch-k", type=int, default=8, help="MMR 的候选数量")
+    parser.add_argument("--mmr-lambda", type=float, default=0.7)
+    parser.add_argument("--budgets", default="2000", help="逗号分隔的 token 预算")
+    parser.add_argument("--embeddings", default="stub", choices=["stub", "dashscope"])
+    parser.add_argument("--questions", type=int, default=0, help="只使用前 N 个问题，0 表示全部")
+    parser.add_argument("--llm", action="store_true", help="把提示发送给对话模型，测量首个 token 延迟")
+    parser.add_argument("--model", default="qwen-turbo")
+    parser.add_argument("--output", default="")
+    args = parser.parse_args()
+    args.budgets = [int(v) for v in args.budgets.split(",") if v]
+
+    report = run(args)
+    output = args.output or os.path.join(
+        BACKEND_DIR, "bench", "results", f"context-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"结果已保存到 {output}")
+
+
+if __name__ == "__main__":
+    main()
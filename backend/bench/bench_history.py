@@ -0,0 +1,267 @@
+"""
+会话历史表示基准：字典列表与紧凑表示（history.py）的对比
+
+- 内存：构造 --conversations 个会话，每个会话 --messages 条消息，用 tracemalloc 统计两种表示的总内存，
+  以及扣除消息正文之后的结构开销，换算为每 1000 个会话的字节数
+- 单次请求的分配：按各接口原来的写法（请求历史转换成字典、messages.copy() 加筛选用户消息、
+  多模态接口取最近 10 条再转换）和现在的写法（直接使用 Message 对象、HistoryView）准备历史，
+  统计每次请求新分配的内存块数、字节数和耗时
+- 历史记录接口：--endpoint-messages 条消息的会话，对比原来返回全部消息（JSONResponse，标准库 json）、
+  全部消息改用 ORJSONResponse、按默认页大小分页和 ETag 未变化时 304 的响应字节数与生成响应的耗时
+
+用法（在 backend 目录下）:
+    python bench/bench_history.py
+    python bench/bench_history.py --conversations 1000 --messages 40
+"""
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional
+
+from fastapi.responses import JSONResponse, ORJSONResponse
+from pydantic import BaseModel
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import HISTORY_PAGE_DEFAULT  # noqa: E402
+from history import ASSISTANT, USER, Conversation  # noqa: E402
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SAMPLE_QUESTION = "我最近经常头痛，伴有恶心，应该做哪些检查？"
+SAMPLE_ANSWER = "## 可能的原因\n头痛伴恶心可能与多种因素有关，**建议尽快就医**。"
+
+
+class Message(BaseModel):
+    """与 main.Message 相同的请求消息模型（不导入 main，避免依赖 API 密钥和重量级依赖）"""
+    role: str
+    content: str
+    timestamp: Optional[str] = None
+    image_url: Optional[str] = None
+    truncated: Optional[bool] = None
+
+
+def _content(conversation: int, index: int) -> str:
+    base = SAMPLE_QUESTION if index % 2 == 0 else SAMPLE_ANSWER
+    return f"{base}（{conversation}-{index}）"
+
+
+def build_legacy(conversations: int, messages: int) -> Dict[str, Dict[str, List[Dict[str, Any]]]]:
+    store = {}
+    for c in range(conversations):
+        items = []
+        for i in range(messages):
+            items.append({
+                "role": "user" if i % 2 == 0 else "assistant",
+                "content": _content(c, i),
+                "timestamp": datetime.now().isoformat(),
+            })
+        store[str(c)] = {"messages": items}
+    return store
+
+
+def build_compact(conversations: int, messages: int) -> Dict[str, Conversation]:
+    store = {}
+    for c in range(conversations):
+        conversation = Conversation()
+        for i in range(messages):
+            conversation.append(USER if i % 2 == 0 else ASSISTANT, _content(c, i))
+        store[str(c)] = conversation
+    return store
+
+
+def _traced_bytes(build: Callable[[], Any]) -> int:
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    value = build()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del value
+    return used
+
+
+def measure_memory(conversations: int, messages: int) -> Dict[str, Any]:
+    content_bytes = _traced_bytes(
+        lambda: [_content(c, i) for c in range(conversations) for i in range(messages)])
+    per_1k = 1000 / conversations
+    results = {}
+    for name, build in (("legacy", build_legacy), ("compact", build_compact)):
+        total = _traced_bytes(lambda: build(conversations, messages))
+        results[name] = {
+            "bytes_per_1k_conversations": round(total * per_1k),
+            "overhead_bytes_per_1k_conversations": round((total - content_bytes) * per_1k),
+            "overhead_bytes_per_message": round((total - content_bytes) / (conversations * messages), 1),
+        }
+        print(f"{name:<8}{results[name]['bytes_per_1k_conversations'] / 2**20:>8.2f} MiB/1k 会话  "
+              f"结构开销 {results[name]['overhead_bytes_per_1k_conversations'] / 2**20:.2f} MiB/1k 会话，"
+              f"{results[name]['overhead_bytes_per_message']} 字节/消息")
+    return results
+
+
+# 原来各接口准备历史的写法
+def legacy_request_history(request_history: List[Message], stored: List[Dict[str, Any]]):
+    chat_history = []
+    for msg in request_history:
+        if isinstance(msg, dict):
+            chat_history.append(msg)
+        elif hasattr(msg, "role") and hasattr(msg, "content"):
+            chat_history.append({
+                "role": msg.role,
+                "content": msg.content,
+                "timestamp": msg.timestamp if hasattr(msg, "timestamp") else None
+            })
+    return chat_history or stored
+
+
+def legacy_stream_get(stored: List[Dict[str, Any]]):
+    chat_history = stored.copy()
+    user_messages = [msg for msg in stored if msg["role"] == "user"]
+    return chat_history, user_messages[-1]["content"]
+
+
+def legacy_multimodal(stored: List[Dict[str, Any]]):
+    model_history = []
+    for msg in stored[-10:]:
+        if msg["role"] in ["user", "assistant"]:
+            model_history.append({"role": msg["role"], "content": msg["content"]})
+    return model_history
+
+
+# 现在的写法
+def compact_request_history(request_history: List[Message], conversation: Conversation):
+    return request_history or conversation.view()
+
+
+def compact_stream_get(conversation: Conversation):
+    return conversation.view(), conversation.last_user_message().content
+
+
+def compact_multimodal(conversation: Conversation):
+    return conversation.view(10)
+
+
+def _allocations(fn: Callable[[], Any], repeat: int) -> Dict[str, float]:
+    """每次调用新分配并在调用结束时仍然存活的内存块数和字节数（保留返回值，模拟请求处理期间持有历史）"""
+    keep = [None] * repeat
+    gc.collect()
+    gc.disable()
+    tracemalloc.start()
+    blocks_before = sys.getallocatedblocks()
+    bytes_before = tracemalloc.get_traced_memory()[0]
+    for i in range(repeat):
+        keep[i] = fn()
+    used = tracemalloc.get_traced_memory()[0] - bytes_before
+    blocks = sys.getallocatedblocks() - blocks_before
+    tracemalloc.stop()
+    gc.enable()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    seconds = time.perf_counter() - start
+    return {
+        "blocks_per_request": round(blocks / repeat, 2),
+        "bytes_per_request": round(used / repeat, 1),
+        "us_per_request": round(seconds / repeat * 1e6, 2),
+    }
+
+
+def measure_requests(messages: int, repeat: int) -> Dict[str, Any]:
+    legacy = build_legacy(1, messages)["0"]["messages"]
+    compact = build_compact(1, messages)["0"]
+    request_history = [Message(**msg) for msg in legacy]
+    scenarios = {
+        "chat_request_history": (lambda: legacy_request_history(request_history, legacy),
+                                 lambda: compact_request_history(request_history, compact)),
+        "chat_stored_history": (lambda: legacy_request_history([], legacy),
+                                lambda: compact_request_history([], compact)),
+        "stream_get": (lambda: legacy_stream_get(legacy), lambda: compact_stream_get(compact)),
+        "multimodal": (lambda: legacy_multimodal(legacy), lambda: compact_multimodal(compact)),
+    }
+    results = {}
+    for name, (old, new) in scenarios.items():
+        results[name] = {"legacy": _allocations(old, repeat), "compact": _allocations(new, repeat)}
+        print(f"{name:<22}块数 {results[name]['legacy']['blocks_per_request']:>7} -> "
+              f"{results[name]['compact']['blocks_per_request']:<6}字节 {results[name]['legacy']['bytes_per_request']:>9} -> "
+              f"{results[name]['compact']['bytes_per_request']:<9}耗时 {results[name]['legacy']['us_per_request']}us -> "
+              f"{results[name]['compact']['us_per_request']}us")
+    return results
+
+
+def _response_time(fn: Callable[[], Any], repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return round((time.perf_counter() - start) / repeat * 1e6, 1)
+
+
+def measure_endpoint(sizes: List[int], page: int, repeat: int) -> Dict[str, Any]:
+    """按 /api/history 的写法生成响应体（304 只有响应头，不生成响应体）"""
+    results = {}
+    for messages in sizes:
+        conversation = build_compact(1, messages)["0"]
+
+        def body(start: int, stop: int) -> Dict[str, Any]:
+            return {"history": conversation.to_list(start, stop), "conversation_id": "0",
+                    "last_seq": conversation.last_seq, "has_more_before": start > 0,
+                    "has_more_after": stop < len(conversation)}
+
+        full = (0, len(conversation))
+        latest = conversation.page(limit=page)
+        variants = {
+            "full_json": lambda: JSONResponse(body(*full)).body,
+            "full_orjson": lambda: ORJSONResponse(body(*full)).body,
+            "page_orjson": lambda: ORJSONResponse(body(*latest)).body,
+            "not_modified": lambda: conversation.etag(limit=page).encode(),
+        }
+        n = max(1, repeat * 20 // max(messages, 20))
+        results[str(messages)] = {
+            name: {"bytes": len(fn()) if name != "not_modified" else 0, "us_per_request": _response_time(fn, n)}
+            for name, fn in variants.items()
+        }
+        print(f"{messages:>6} 条消息  " + "  ".join(
+            f"{name} {item['bytes']}B/{item['us_per_request']}us" for name, item in results[str(messages)].items()))
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="会话历史表示基准")
+    parser.add_argument("--conversations", type=int, default=1000)
+    parser.add_argument("--messages", type=int, default=20, help="每个会话的消息数")
+    parser.add_argument("--repeat", type=int, default=2000, help="单次请求分配统计的重复次数")
+    parser.add_argument("--endpoint-messages", default="20,200,2000", help="历史记录接口基准的会话消息数，逗号分隔")
+    parser.add_argument("--page", type=int, default=HISTORY_PAGE_DEFAULT, help="历史记录接口的页大小")
+    parser.add_argument("--output", default="")
+    args = parser.parse_args()
+
+    print(f"内存：{args.conversations} 个会话，每个会话 {args.messages} 条消息")
+    memory = measure_memory(args.conversations, args.messages)
+    print(f"单次请求准备历史（会话中 {args.messages} 条消息）")
+    requests = measure_requests(args.messages, args.repeat)
+    print(f"历史记录接口（页大小 {args.page}）")
+    endpoint = measure_endpoint([int(n) for n in args.endpoint_messages.split(",") if n.strip()], args.page,
+                                args.repeat)
+
+    report = {
+        "benchmark": "history",
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": vars(args),
+        "memory": memory,
+        "requests": requests,
+        "endpoint": endpoint,
+    }
+    output = args.output or os.path.join(
+        BACKEND_DIR, "bench", "results", f"history-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"结果已保存到 {output}")
+
+
+if __name__ == "__main__":
+    main()
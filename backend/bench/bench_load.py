@@ -0,0 +1,372 @@
+"""
+压测脚本
+
+启动本地 DashScope 替身服务和后端应用（后端通过 DASHSCOPE_HTTP_BASE_URL 指向替身服务），
+按设定的并发度依次压测各个端点，统计延迟分位数、首字延迟（TTFT）、吞吐量和后端进程内存，
+结果以 JSON 保存，便于比较不同版本。
+
+用法（在 backend 目录下）:
+    python bench/bench_load.py --concurrency 1,8,32 --requests 64
+    python bench/bench_load.py --scenarios chat,stream --latency 0.5 --token-rate 30 --error-rate 0.05
+    python bench/bench_load.py --compare bench/results/load-旧.json bench/results/load-新.json
+"""
+import argparse
+import asyncio
+import base64
+import io
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import uuid
+from typing import Any, Dict, List, Optional
+
+import aiohttp
+from PIL import Image
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FAKE_SERVER = os.path.join(BACKEND_DIR, "bench", "fake_dashscope.py")
+
+SCENARIOS = ["chat", "stream", "multimodal", "multimodal_json", "text2image"]
+
+QUESTIONS = [
+    "你好",
+    "感冒了应该注意什么？",
+    "布洛芬和对乙酰氨基酚有什么区别？分别适合什么情况？",
+    "我最近经常头痛，伴有恶心和视物模糊，应该做哪些检查？需要注意什么？请详细分析可能的原因。",
+]
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _rss_bytes(pid: int) -> Optional[int]:
+    """读取进程常驻内存，优先使用 psutil，否则读取 /proc"""
+    try:
+        import psutil
+        return psutil.Process(pid).memory_info().rss
+    except ImportError:
+        pass
+    except Exception:
+        return None
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+def _percentiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {}
+    ordered = sorted(values)
+
+    def pick(q: float) -> float:
+        return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+    return {
+        "p50": round(pick(0.50) * 1000, 1),
+        "p95": round(pick(0.95) * 1000, 1),
+        "p99": round(pick(0.99) * 1000, 1),
+        "mean": round(statistics.fmean(ordered) * 1000, 1),
+        "max": round(ordered[-1] * 1000, 1),
+    }
+
+
+def _sample_image() -> bytes:
+    image = Image.new("RGB", (256, 256), (200, 120, 120))
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG")
+    return buffer.getvalue()
+
+
+class RequestResult:
+    __slots__ = ("ok", "status", "latency", "ttft", "error")
+
+    def __init__(self, ok: bool, status: int, latency: float, ttft: Optional[float] = None, error: str = ""):
+        self.ok = ok
+        self.status = status
+        self.latency = latency
+        self.ttft = ttft
+        self.error = error
+
+
+class LoadTester:
+    """对运行中的后端发起请求"""
+
+    def __init__(self, base_url: str, timeout: float):
+        self.base_url = base_url
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.image = _sample_image()
+        self.image_b64 = "data:image/jpeg;base64," + base64.b64encode(self.image).decode()
+
+    @staticmethod
+    def _conversation() -> str:
+        # 每个请求使用独立会话，避免同一会话串行执行影响并发测量
+        return f"load-{uuid.uuid4().hex}"
+
+    async def chat(self, session: aiohttp.ClientSession, index: int) -> RequestResult:
+        url = f"{self.base_url}/api/chat?conversation_id={self._conversation()}"
+        return await self._json_request(session, url, json={"message": QUESTIONS[index % len(QUESTIONS)]})
+
+    async def stream(self, session: aiohttp.ClientSession, index: int) -> RequestResult:
+        url = f"{self.base_url}/api/chat/stream?conversation_id={self._conversation()}"
+        start = time.perf_counter()
+        ttft = None
+        try:
+            async with session.post(url, json={"message": QUESTIONS[index % len(QUESTIONS)]}) as response:
+                if response.status != 200:
+                    await response.read()
+                    return RequestResult(False, response.status, time.perf_counter() - start)
+                event = None
+                completed = False
+                async for raw in response.content:
+                    line = raw.decode("utf-8").rstrip("\r\n")
+                    if line.startswith("event:"):
+                        event = line[6:].strip()
+                    elif line.startswith("data:"):
+                        if event == "message" and ttft is None:
+                            ttft = time.perf_counter() - start
+                        elif event == "done":
+                            completed = True
+                        elif event == "error":
+                            return RequestResult(False, 200, time.perf_counter() - start, ttft, line[5:].strip())
+                return RequestResult(completed, 200, time.perf_counter() - start, ttft, "" if completed else "incomplete")
+        except Exception as e:
+            return RequestResult(False, 0, time.perf_counter() - start, ttft, type(e).__name__)
+
+    async def multimodal(self, session: aiohttp.ClientSession, index: int) -> RequestResult:
+        url = f"{self.base_url}/api/chat/multimodal?conversation_id={self._conversation()}"
+        form = aiohttp.FormData()
+        form.add_field("message", "这张图片显示的是什么情况？")
+        form.add_field("file", self.image, filename="sample.jpg", content_type="image/jpeg")
+        return await self._json_request(session, url, data=form)
+
+    async def multimodal_json(self, session: aiohttp.ClientSession, index: int) -> RequestResult:
+        url = f"{self.base_url}/api/chat/multimodal-json?conversation_id={self._conversation()}"
+        return await self._json_request(session, url, json={"message": "请分析这张图片", "image_data": self.image_b64})
+
+    async def text2image(self, session: aiohttp.ClientSession, index: int) -> RequestResult:
+        url = f"{self.base_url}/api/text2image?conversation_id={self._conversation()}"
+        return await self._json_request(session, url, json={"prompt": "一张健康饮食的插画", "n": 1})
+
+    async def _json_request(self, session: aiohttp.ClientSession, url: str, **kwargs: Any) -> RequestResult:
+        start = time.perf_counter()
+        try:
+            async with session.post(url, **kwargs) as response:
+                body = await response.read()
+                latency = time.perf_counter() - start
+                if response.status != 200:
+                    return RequestResult(False, response.status, latency, error=body[:200].decode("utf-8", "replace"))
+                return RequestResult(True, 200, latency)
+        except Exception as e:
+            return RequestResult(False, 0, time.perf_counter() - start, error=type(e).__name__)
+
+    async def run_level(self, scenario: str, concurrency: int, total: int, pid: Optional[int]) -> Dict[str, Any]:
+        """以固定并发度发送 total 个请求"""
+        send = getattr(self, scenario)
+        results: List[RequestResult] = []
+        counter = iter(range(total))
+        rss_samples = []
+        stop = asyncio.Event()
+
+        async def sample_rss() -> None:
+            while not stop.is_set():
+                if pid:
+                    rss = _rss_bytes(pid)
+                    if rss:
+                        rss_samples.append(rss)
+                try:
+                    await asyncio.wait_for(stop.wait(), timeout=0.2)
+                except asyncio.TimeoutError:
+                    pass
+
+        connector = aiohttp.TCPConnector(limit=concurrency)
+        async with aiohttp.ClientSession(connector=connector, timeout=self.timeout) as session:
+            async def worker() -> None:
+                for index in counter:
+                    results.append(await send(session, index))
+
+            sampler = asyncio.ensure_future(sample_rss())
+            start = time.perf_counter()
+            await asyncio.gather(*(worker() for _ in range(concurrency)))
+            elapsed = time.perf_counter() - start
+            stop.set()
+            await sampler
+
+        ok = [r for r in results if r.ok]
+        statuses: Dict[str, int] = {}
+        for r in results:
+            statuses[str(r.status)] = statuses.get(str(r.status), 0) + 1
+        errors = sorted({r.error for r in results if r.error})[:5]
+        report = {
+            "scenario": scenario,
+            "concurrency": concurrency,
+            "requests": len(results),
+            "succeeded": len(ok),
+            "error_rate": round(1 - len(ok) / len(results), 4) if results else 0.0,
+            "status_counts": statuses,
+            "seconds": round(elapsed, 3),
+            "throughput_rps": round(len(ok) / elapsed, 2) if elapsed else 0.0,
+            "latency_ms": _percentiles([r.latency for r in ok]),
+            "sample_errors": errors,
+        }
+        ttfts = [r.ttft for r in ok if r.ttft is not None]
+        if ttfts:
+            report["ttft_ms"] = _percentiles(ttfts)
+        if rss_samples:
+            report["rss_mb"] = {
+                "start": round(rss_samples[0] / 2 ** 20, 1),
+                "max": round(max(rss_samples) / 2 ** 20, 1),
+                "end": round(rss_samples[-1] / 2 ** 20, 1),
+            }
+        return report
+
+
+def _start_process(args: List[str], env: Dict[str, str]) -> subprocess.Popen:
+    return subprocess.Popen(args, cwd=BACKEND_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+
+async def _wait_ready(url: str, process: subprocess.Popen, timeout: float = 60.0) -> None:
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f"进程提前退出: {process.stderr.read().decode('utf-8', 'replace')[-2000:]}")
+            try:
+                async with session.get(url) as response:
+                    if response.status < 500:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"等待服务启动超时: {url}")
+
+
+def _compare(old_path: str, new_path: str) -> None:
+    """对比两次压测结果中相同场景和并发度的 p95 延迟和吞吐量"""
+    with open(old_path, encoding="utf-8") as f:
+        old = {(r["scenario"], r["concurrency"]): r for r in json.load(f)["results"]}
+    with open(new_path, encoding="utf-8") as f:
+        new = {(r["scenario"], r["concurrency"]): r for r in json.load(f)["results"]}
+    print(f"{'场景':<18}{'并发':>6}{'p95(旧)':>12}{'p95(新)':>12}{'rps(旧)':>10}{'rps(新)':>10}")
+    for key in sorted(set(old) & set(new)):
+        o, n = old[key], new[key]
+        print(f"{key[0]:<18}{key[1]:>6}{o['latency_ms'].get('p95', '-'):>12}{n['latency_ms'].get('p95', '-'):>12}"
+              f"{o['throughput_rps']:>10}{n['throughput_rps']:>10}")
+
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    fake_port = args.fake_port or _free_port()
+    app_port = args.app_port or _free_port()
+    env = dict(os.environ)
+
+    fake = _start_process([
+        sys.executable, FAKE_SERVER, "--port", str(fake_port),
+        "--latency", str(args.latency), "--token-rate", str(args.token_rate),
+        "--reply-chars", str(args.reply_chars), "--error-rate", str(args.error_rate),
+        "--throttle-rate", str(args.throttle_rate), "--multimodal-latency", str(args.multimodal_latency),
+        "--image-latency", str(args.image_latency),
+    ], env)
+    env.update({
+        "DASHSCOPE_HTTP_BASE_URL": f"http://127.0.0.1:{fake_port}/api/v1",
+        "DASHSCOPE_API_KEY": env.get("LOADTEST_API_KEY", "sk-loadtest"),
+        "LOG_LEVEL": env.get("LOG_LEVEL", "WARNING"),
+    })
+    app = _start_process([
+        sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(app_port),
+        "--log-level", "warning",
+    ], env)
+
+    try:
+        await _wait_ready(f"http://127.0.0.1:{fake_port}/stats", fake)
+        await _wait_ready(f"http://127.0.0.1:{app_port}/", app)
+        tester = LoadTester(f"http://127.0.0.1:{app_port}", args.timeout)
+        idle_rss = _rss_bytes(app.pid)
+        results = []
+        for scenario in args.scenarios:
+            for concurrency in args.concurrency:
+                report = await tester.run_level(scenario, concurrency, max(args.requests, concurrency), app.pid)
+                results.append(report)
+                latency = report["latency_ms"]
+                ttft = report.get("ttft_ms", {}).get("p50", "-")
+                print(f"{scenario:<16}c={concurrency:<4} ok={report['succeeded']}/{report['requests']:<5}"
+                      f"p50={latency.get('p50', '-')}ms p95={latency.get('p95', '-')}ms p99={latency.get('p99', '-')}ms "
+                      f"ttft50={ttft}ms rps={report['throughput_rps']} rss={report.get('rss_mb', {}).get('max', '-')}MB")
+    finally:
+        for process in (app, fake):
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    return {
+        "benchmark": "load",
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {
+            "scenarios": args.scenarios,
+            "concurrency": args.concurrency,
+            "requests_per_level": args.requests,
+            "fake": {
+                "latency": args.latency,
+                "token_rate": args.token_rate,
+                "reply_chars": args.reply_chars,
+                "error_rate": args.error_rate,
+                "throttle_rate": args.throttle_rate,
+                "multimodal_latency": args.multimodal_latency,
+                "image_latency": args.image_latency,
+            },
+        },
+        "idle_rss_mb": round(idle_rss / 2 ** 20, 1) if idle_rss else None,
+        "results": results,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="后端压测（使用本地 DashScope 替身服务）")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help=f"逗号分隔，可选: {','.join(SCENARIOS)}")
+    parser.add_argument("--concurrency", default="1,4,16", help="逗号分隔的并发度")
+    parser.add_argument("--requests", type=int, default=32, help="每个并发度发送的请求数")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--latency", type=float, default=0.3)
+    parser.add_argument("--token-rate", type=float, default=50.0)
+    parser.add_argument("--reply-chars", type=int, default=400)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--multimodal-latency", type=float, default=1.0)
+    parser.add_argument("--image-latency", type=float, default=2.0)
+    parser.add_argument("--fake-port", type=int, default=0)
+    parser.add_argument("--app-port", type=int, default=0)
+    parser.add_argument("--output", default=None, help="结果文件，默认 bench/results/load-<时间>.json")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="对比两个结果文件后退出")
+    args = parser.parse_args()
+
+    if args.compare:
+        _compare(*args.compare)
+        return
+
+    args.scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"未知场景: {','.join(sorted(unknown))}")
+    args.concurrency = [int(c) for c in args.concurrency.split(",") if c.strip()]
+
+    report = asyncio.run(run(args))
+    output = args.output or os.path.join(
+        BACKEND_DIR, "bench", "results", f"load-{time.strftime('%Y%m%d-%H%M%S')}.json"
+    )
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"结果已写入 {output}")
+
+
+if __name__ == "__main__":
+    main()
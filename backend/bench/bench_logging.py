@@ -0,0 +1,156 @@
+"""
+日志吞吐基准：同步 print 与队列化结构化日志的对比
+
+模拟多个请求线程在热路径上记录日志（请求消息、回答摘要、流式进度），
+比较请求线程一侧的吞吐量和单次调用延迟。输出写到临时文件，每次 flush 额外等待
+--sink-latency-us 微秒，模拟终端、管道或容器日志驱动的写入开销（设为 0 即纯文件写入）。
+
+用法（在 backend 目录下）:
+    python bench/bench_logging.py --threads 8 --events 20000 --sink-latency-us 50
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+SAMPLE_MESSAGE = "我最近经常头痛，伴有恶心和视物模糊，应该做哪些检查？需要注意什么？" * 2
+SAMPLE_ANSWER = "## 可能的原因\n头痛伴恶心可能与多种因素有关，**建议尽快就医**。" * 20
+
+
+class SlowSink:
+    """包装输出文件，每次 flush 模拟一次较慢的系统调用"""
+
+    def __init__(self, out, latency: float):
+        self._out = out
+        self._latency = latency
+
+    def write(self, text: str) -> int:
+        return self._out.write(text)
+
+    def flush(self) -> None:
+        self._out.flush()
+        if self._latency:
+            time.sleep(self._latency)
+
+
+def _run_threads(threads: int, events: int, emit) -> dict:
+    latencies = [[] for _ in range(threads)]
+    barrier = threading.Barrier(threads + 1)
+
+    def worker(index: int) -> None:
+        barrier.wait()
+        record = latencies[index]
+        for i in range(events):
+            start = time.perf_counter()
+            emit(index, i)
+            record.append(time.perf_counter() - start)
+
+    workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    for w in workers:
+        w.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for w in workers:
+        w.join()
+    elapsed = time.perf_counter() - start
+
+    merged = sorted(lat for per_thread in latencies for lat in per_thread)
+    total = threads * events
+    return {
+        "events": total,
+        "seconds": round(elapsed, 4),
+        "events_per_second": round(total / elapsed),
+        "p50_us": round(merged[len(merged) // 2] * 1e6, 2),
+        "p99_us": round(merged[int(len(merged) * 0.99)] * 1e6, 2),
+        "mean_us": round(statistics.fmean(merged) * 1e6, 2),
+    }
+
+
+def bench_print(threads: int, events: int, path: str, latency: float) -> dict:
+    """基线：与改造前相同的同步 print，输出重定向到文件"""
+    with open(path, "w", encoding="utf-8") as raw:
+        out = SlowSink(raw, latency)
+        def emit(index: int, i: int) -> None:
+            if i % 3 == 0:
+                print(f"非流式请求 - 消息: '{SAMPLE_MESSAGE}', 会话ID: {index}", file=out, flush=True)
+            elif i % 3 == 1:
+                print(f"生成的回答: '{SAMPLE_ANSWER[:50]}...'(长度:{len(SAMPLE_ANSWER)})", file=out, flush=True)
+            else:
+                print(f"已发送 {i} 个字符...", file=out, flush=True)
+        return _run_threads(threads, events, emit)
+
+
+def bench_structured(threads: int, events: int, path: str, latency: float) -> dict:
+    """改造后：结构化事件入队，由后台线程格式化并写出"""
+    # 队列足够容纳全部事件，保证两种方案输出的日志条数相同
+    os.environ["LOG_QUEUE_SIZE"] = str(threads * events + 1)
+    os.environ.setdefault("LOG_LEVEL", "DEBUG")
+    import logger as log_module
+
+    with open(path, "w", encoding="utf-8") as raw:
+        log_module.setup_logging(stream=SlowSink(raw, latency))
+        chat_logger = log_module.get_logger("chat")
+        stream_logger = log_module.get_logger("stream")
+
+        def emit(index: int, i: int) -> None:
+            if i % 3 == 0:
+                chat_logger.info("收到聊天请求", conversation_id=index, message=SAMPLE_MESSAGE)
+            elif i % 3 == 1:
+                chat_logger.info("聊天回答完成", conversation_id=index, answer_chars=len(SAMPLE_ANSWER))
+            else:
+                stream_logger.debug("流式进度", chars=i)
+
+        result = _run_threads(threads, events, emit)
+        drain_start = time.perf_counter()
+        log_module.shutdown_logging()
+        result["drain_seconds"] = round(time.perf_counter() - drain_start, 4)
+        # 包括后台线程把队列全部写完的端到端吞吐
+        result["end_to_end_events_per_second"] = round(
+            result["events"] / (result["seconds"] + result["drain_seconds"])
+        )
+        result["dropped"] = log_module.dropped_count()
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="日志吞吐基准")
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--events", type=int, default=20000, help="每个线程记录的事件数")
+    parser.add_argument("--sink-latency-us", type=float, default=50, help="每次写出的模拟延迟（微秒）")
+    parser.add_argument("--output", default=os.path.join(os.path.dirname(__file__), "results", "logging.json"))
+    args = parser.parse_args()
+
+    latency = args.sink_latency_us / 1e6
+    with tempfile.TemporaryDirectory() as tmp:
+        baseline = bench_print(args.threads, args.events, os.path.join(tmp, "print.log"), latency)
+        structured = bench_structured(args.threads, args.events, os.path.join(tmp, "structured.log"), latency)
+
+    report = {
+        "benchmark": "logging",
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "threads": args.threads,
+        "events_per_thread": args.events,
+        "sink_latency_us": args.sink_latency_us,
+        "print": baseline,
+        "structured_queue": structured,
+        "speedup": round(structured["events_per_second"] / baseline["events_per_second"], 2),
+    }
+    os.makedirs(os.path.dirname(args.output), exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+    print(f"{'方案':<18}{'事件/秒':>12}{'p50(us)':>10}{'p99(us)':>10}")
+    for name in ("print", "structured_queue"):
+        r = report[name]
+        print(f"{name:<18}{r['events_per_second']:>12}{r['p50_us']:>10}{r['p99_us']:>10}")
+    print(f"吞吐提升: {report['speedup']}x，结果已写入 {args.output}")
+
+
+if __name__ == "__main__":
+    main()
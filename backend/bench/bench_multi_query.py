@@ -0,0 +1,194 @@
+"""
+多查询检索基准
+
+比较追问（bench/data/followup_questions.json，每个问题带前几轮用户提问）的几种检索方式：
+- literal: 只按当前问题的字面检索（原来的做法）
+- multi_query: multi_query.build_query_variants 生成查询变体，并发检索后用 RRF 合并
+- standalone: 按人工改写的完整问题检索，作为参考上限
+
+同时在标注问题集（bench/data/retrieval_questions.json）上确认 multi_query 不改变独立问题的结果：不带历史，
+以及带上一段无关的历史（multi_query+history）。另外检查 SHORT_STANDALONE 中不依赖前文的短问题带上历史时
+只生成一个查询变体，不满足时以非零状态退出。
+指标：命中率（标注原文出现在返回的分块中）、平均嵌入调用次数和检索延迟。--embed-latency-ms 为每次嵌入调用
+增加的等待时间，模拟远程嵌入接口的耗时；各个变体与 main 中一样在线程中并发检索。
+
+用法（在 backend 目录下）:
+    python bench/bench_multi_query.py
+    python bench/bench_multi_query.py --embeddings dashscope --embed-latency-ms 0
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import time
+from typing import Any, Dict, List, Tuple
+
+from bench_retrieval import (BACKEND_DIR, CHUNKERS, CORPUS_PATH, QUESTIONS_PATH, _build_artifact, _is_hit,
+                             _ms_percentile, _relevant_spans, make_embeddings, parse_chunker)
+
+import rag  # noqa: E402
+from langchain_core.embeddings import Embeddings  # noqa: E402
+from multi_query import build_query_variants, reciprocal_rank_fusion  # noqa: E402
+
+FOLLOWUP_PATH = os.path.join(BACKEND_DIR, "bench", "data", "followup_questions.json")
+ASSISTANT_PLACEHOLDER = "根据药品说明书，相关信息如下，具体请遵医嘱。"
+# 与前文无关的历史，以及本身完整的短问题（带上历史也只应检索原问题）
+UNRELATED_HISTORY = ["司库奇尤单抗的推荐剂量是多少？", "那化脓性汗腺炎呢？"]
+SHORT_STANDALONE = ["感冒吃什么药", "高血压怎么办", "头痛怎么办？", "布洛芬的用法", "糖尿病能治愈吗",
+                    "孩子发烧怎么处理", "失眠吃什么好"]
+
+
+class SlowEmbeddings(Embeddings):
+    """在每次查询嵌入前等待固定时间，并统计调用次数"""
+
+    def __init__(self, inner: Embeddings, latency: float):
+        self.inner = inner
+        self.latency = latency
+        self.calls = 0
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.inner.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return self.inner.embed_query(text)
+
+
+def _history(turns: List[str]) -> List[Dict[str, str]]:
+    history = []
+    for turn in turns:
+        history.append({"role": "user", "content": turn})
+        history.append({"role": "assistant", "content": ASSISTANT_PLACEHOLDER})
+    return history
+
+
+async def _multi_query(retriever, question: str, history, variants: int, rrf_k: int):
+    queries = build_query_variants(question, history, variants)
+    if len(queries) == 1:
+        return await asyncio.to_thread(retriever.invoke, question), 1
+    results = await asyncio.gather(*(asyncio.to_thread(retriever.invoke, query) for query in queries))
+    return reciprocal_rank_fusion(results, rrf_k), len(queries)
+
+
+def evaluate(name: str, retriever, embeddings: SlowEmbeddings, items: List[Tuple[str, List, Any]],
+             args: argparse.Namespace) -> Dict[str, Any]:
+    hits, latencies, calls, docs_count = 0, [], [], []
+    for question, history, spans in items:
+        before = embeddings.calls
+        start = time.perf_counter()
+        if name == "multi_query":
+            docs, _ = asyncio.run(_multi_query(retriever, question, history, args.variants, args.rrf_k))
+        else:
+            docs = retriever.invoke(question)
+        latencies.append(time.perf_counter() - start)
+        calls.append(embeddings.calls - before)
+        docs_count.append(len(docs))
+        hits += any(_is_hit(doc, spans) for doc in docs)
+    return {
+        "hit_rate": round(hits / len(items), 4),
+        "mean_docs": round(statistics.fmean(docs_count), 2),
+        "embedding_calls": round(statistics.fmean(calls), 2),
+        "latency_ms": {"p50": _ms_percentile(latencies, 0.5), "p95": _ms_percentile(latencies, 0.95)},
+    }
+
+
+def _print(dataset: str, name: str, result: Dict[str, Any]) -> None:
+    print(f"{dataset:<12}{name:<14}hit={result['hit_rate']:<8}docs={result['mean_docs']:<6}"
+          f"embed_calls={result['embedding_calls']:<6}p50={result['latency_ms']['p50']}ms "
+          f"p95={result['latency_ms']['p95']}ms")
+
+
+def check_short_standalone(variants: int) -> Dict[str, List[str]]:
+    """返回带上历史后生成了多个查询变体的短问题"""
+    history = _history(UNRELATED_HISTORY)
+    failures = {}
+    for question in SHORT_STANDALONE:
+        queries = build_query_variants(question, history, variants)
+        if len(queries) != 1:
+            failures[question] = queries
+    return failures
+
+
+def run(args: argparse.Namespace) -> Dict[str, Any]:
+    with open(CORPUS_PATH, encoding="utf-8") as f:
+        text = f.read()
+    with open(FOLLOWUP_PATH, encoding="utf-8") as f:
+        followups = json.load(f)
+    with open(QUESTIONS_PATH, encoding="utf-8") as f:
+        questions = json.load(f)
+    cached = make_embeddings(args.embeddings)
+    name, size, overlap = parse_chunker(args.chunker)
+    docs = CHUNKERS[name](text, size, overlap)
+    dim = len(cached.embed_query(docs[0].page_content))
+    index = _build_artifact("float32")(docs, cached, dim)
+    embeddings = SlowEmbeddings(cached, args.embed_latency_ms / 1000)
+    retriever = rag.IndexRetriever(index=index.make_retriever(args.k).index, embeddings=embeddings, k=args.k,
+                                   fetch_k=args.fetch_k)
+
+    followup_items = {
+        "literal": [(q["question"], _history(q["history"]), _relevant_spans(text, q["relevant"])) for q in followups],
+        "standalone": [(q["standalone"], [], _relevant_spans(text, q["relevant"])) for q in followups],
+    }
+    followup_items["multi_query"] = followup_items["literal"]
+    standalone_items = [(q["question"], [], _relevant_spans(text, q["relevant"])) for q in questions]
+    standalone_with_history = [(question, _history(UNRELATED_HISTORY), spans)
+                               for question, _, spans in standalone_items]
+
+    results: Dict[str, Dict[str, Any]] = {"followup": {}, "standalone_questions": {}}
+    try:
+        for mode in ("literal", "multi_query", "standalone"):
+            results["followup"][mode] = evaluate(mode, retriever, embeddings, followup_items[mode], args)
+            _print("followup", mode, results["followup"][mode])
+        for mode in ("literal", "multi_query"):
+            results["standalone_questions"][mode] = evaluate(mode, retriever, embeddings, standalone_items, args)
+            _print("standalone", mode, results["standalone_questions"][mode])
+        results["standalone_questions"]["multi_query+history"] = evaluate(
+            "multi_query", retriever, embeddings, standalone_with_history, args)
+        _print("standalone", "mq+history", results["standalone_questions"]["multi_query+history"])
+    finally:
+        index.cleanup()
+    cached.save()
+    short_failures = check_short_standalone(args.variants)
+    print(f"独立短问题带历史时只生成一个查询变体: {len(SHORT_STANDALONE) - len(short_failures)}/{len(SHORT_STANDALONE)}")
+    for question, queries in short_failures.items():
+        print(f"  {question} -> {queries}")
+
+    return {
+        "benchmark": "multi_query",
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {"chunker": args.chunker, "k": args.k, "fetch_k": args.fetch_k, "variants": args.variants,
+                   "rrf_k": args.rrf_k, "embeddings": args.embeddings, "embed_latency_ms": args.embed_latency_ms,
+                   "followups": len(followups), "questions": len(questions)},
+        "results": results,
+        "short_standalone_failures": short_failures,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="多查询检索基准")
+    parser.add_argument("--chunker", default="recursive:2000:200", help="分块配置，格式为 名称:块大小:重叠")
+    parser.add_argument("--k", type=int, default=3)
+    parser.add_argument("--fetch-k", type=int, default=8, help="MMR 的候选数量，0 表示不使用 MMR")
+    parser.add_argument("--variants", type=int, default=3, help="查询变体数量上限")
+    parser.add_argument("--rrf-k", type=int, default=60)
+    parser.add_argument("--embed-latency-ms", type=float, default=50.0, help="每次嵌入调用增加的等待时间")
+    parser.add_argument("--embeddings", default="stub", choices=["stub", "dashscope"])
+    parser.add_argument("--output", default="")
+    args = parser.parse_args()
+
+    report = run(args)
+    output = args.output or os.path.join(
+        BACKEND_DIR, "bench", "results", f"multi-query-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"结果已保存到 {output}")
+    if report["short_standalone_failures"]:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""
+知识库规范化基准
+
+对比原始 full1.md 和 kb_normalize 规范化后的文本（默认配置，以及 --drop-sections 指定的章节也去掉时）：
+- 字符数、分块数、嵌入的总字符数和估算 token 数（含分块重叠），以及构建索引时的嵌入接口调用次数（每次最多 25 条）
+- 在 bench/data/retrieval_questions.json 上的 recall@k、MRR，以及每次检索返回的上下文字符数和估算 token 数
+  （context.estimate_tokens，发给模型的参考资料长度）
+
+标注原文按同样的规则清理（kb_normalize.clean_fragment）后在规范化文本中定位，与原始文本上的评估口径一致。
+
+用法（在 backend 目录下）:
+    python bench/bench_normalize.py
+    python bench/bench_normalize.py --chunkers recursive:2000:200,markdown:800:100 --k 3,5 --embeddings dashscope
+"""
+import argparse
+import json
+import os
+import statistics
+import time
+from typing import Any, Dict, List, Tuple
+
+from bench_retrieval import (BACKEND_DIR, CHUNKERS, CORPUS_PATH, QUESTIONS_PATH, ENGINES, _relevant_spans, evaluate,
+                             make_embeddings, parse_chunker)
+
+import kb_normalize  # noqa: E402
+from context import estimate_tokens  # noqa: E402
+import rag  # noqa: E402
+
+DEFAULT_DROP_SECTIONS = "修订日期,执行标准,批准文号,上市许可持有人,生产企业,境内联系人/境内责任人"
+
+
+def variants(text: str, drop_sections: List[str], dedupe_min_chars: int) -> Dict[str, Tuple[str, Dict[str, Any]]]:
+    raw = rag.normalize_text(text)
+    result = {"raw": (raw, None), "normalized": kb_normalize.normalize_knowledge(raw, (), dedupe_min_chars)}
+    if drop_sections:
+        result["normalized+drop"] = kb_normalize.normalize_knowledge(raw, drop_sections, dedupe_min_chars)
+    return result
+
+
+def _context_tokens(retriever, questions: List[Dict[str, Any]]) -> float:
+    tokens = [estimate_tokens("\n\n".join(doc.page_content for doc in retriever.invoke(q["question"])))
+              for q in questions]
+    return round(statistics.fmean(tokens), 1)
+
+
+def run(args: argparse.Namespace) -> Dict[str, Any]:
+    with open(CORPUS_PATH, encoding="utf-8") as f:
+        text = f.read()
+    with open(QUESTIONS_PATH, encoding="utf-8") as f:
+        questions = json.load(f)
+    embeddings = make_embeddings(args.embeddings)
+    drop_sections = [name.strip() for name in args.drop_sections.split(",") if name.strip()]
+
+    corpora = {}
+    for name, (corpus, stats) in variants(text, drop_sections, args.dedupe_min_chars).items():
+        phrases = {q["id"]: q["relevant"] if name == "raw" else [kb_normalize.clean_fragment(p) for p in q["relevant"]]
+                   for q in questions}
+        corpora[name] = {
+            "text": corpus,
+            "stats": stats,
+            "spans": {qid: _relevant_spans(corpus, items) for qid, items in phrases.items()},
+        }
+        print(f"{name:<18}{len(corpus)} 字符" + (f"  {stats}" if stats else ""))
+
+    runs = []
+    for chunker_spec in args.chunkers:
+        chunker, size, overlap = parse_chunker(chunker_spec)
+        for name, corpus in corpora.items():
+            docs = CHUNKERS[chunker](corpus["text"], size, overlap)
+            embeddings.embed_documents([doc.page_content for doc in docs])
+            dim = len(embeddings.embed_query(docs[0].page_content))
+            index = ENGINES[args.engine](docs, embeddings, dim)
+            for k in args.k:
+                retriever = index.make_retriever(k)
+                result = evaluate(retriever, questions, corpus["spans"], k, repeat=1)
+                report = {
+                    "corpus": name,
+                    "chunker": chunker_spec,
+                    "k": k,
+                    "chars": len(corpus["text"]),
+                    "chunks": len(docs),
+                    "embedded_chars": sum(len(doc.page_content) for doc in docs),
+                    "embedded_tokens": sum(estimate_tokens(doc.page_content) for doc in docs),
+                    "embedding_calls": rag.embedding_calls(len(docs)),
+                    f"recall_at_{k}": result[f"recall_at_{k}"],
+                    "mrr": result["mrr"],
+                    "context_chars": result["context_chars"],
+                    "context_tokens": _context_tokens(retriever, questions),
+                    "misses": result["misses"],
+                }
+                runs.append(report)
+                print(f"{chunker_spec:<20}{name:<18}k={k:<3}chars={report['chars']:<7}chunks={len(docs):<5}"
+                      f"embed_calls={report['embedding_calls']:<4}recall@{k}={report[f'recall_at_{k}']:<7}"
+                      f"mrr={report['mrr']:<7}ctx={result['context_chars']['mean']}字符/{report['context_tokens']}token "
+                      f"embed_tokens={report['embedded_tokens']}")
+            index.cleanup()
+    embeddings.save()
+
+    return {
+        "benchmark": "normalize",
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {"chunkers": args.chunkers, "k": args.k, "engine": args.engine, "embeddings": args.embeddings,
+                   "dedupe_min_chars": args.dedupe_min_chars, "drop_sections": drop_sections,
+                   "questions": len(questions)},
+        "normalization": {name: corpus["stats"] for name, corpus in corpora.items() if corpus["stats"]},
+        "mean_context_tokens": {
+            name: round(statistics.fmean(r["context_tokens"] for r in runs if r["corpus"] == name), 1)
+            for name in corpora
+        },
+        "runs": runs,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="知识库规范化基准")
+    parser.add_argument("--chunkers", default="recursive:2000:200,recursive:800:100,markdown:800:100",
+                        help="逗号分隔，格式为 名称:块大小:重叠")
+    parser.add_argument("--k", default="3", help="逗号分隔的 k 值")
+    parser.add_argument("--engine", default="numpy", choices=sorted(ENGINES))
+    parser.add_argument("--embeddings", default="stub", choices=["stub", "dashscope"])
+    parser.add_argument("--dedupe-min-chars", type=int, default=40)
+    parser.add_argument("--drop-sections", default=DEFAULT_DROP_SECTIONS,
+                        help="额外评估去掉这些章节后的效果，逗号分隔，为空时不评估")
+    parser.add_argument("--output", default="")
+    args = parser.parse_args()
+    args.chunkers = [c.strip() for c in args.chunkers.split(",") if c.strip()]
+    args.k = [int(k) for k in args.k.split(",") if k.strip()]
+
+    report = run(args)
+    output = args.output or os.path.join(
+        BACKEND_DIR, "bench", "results", f"normalize-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"结果已保存到 {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""
+输入时预取基准
+
+模拟用户在输入框中输入问题：每次停顿时发出一个草稿（问题的前 --drafts 比例部分，例如 0.6、0.8 和完整问题），
+停顿 --pause-ms 后继续输入，最后一个草稿之后 --think-ms 点击发送，问题末尾可以再加上“？”等字符。
+对比发送后拿到检索结果的等待时间：
+- baseline: 发送后才检索（原来的做法）
+- prefetch: 草稿经 prefetch.PrefetchCache 提前检索，发送时与草稿匹配则直接使用结果，检索仍在进行时等待它完成
+
+同时统计命中率、每个问题的嵌入调用次数（含被取消或没用上的预取）以及使用预取结果时与直接检索的结果是否相同。
+--embed-latency-ms 为每次嵌入调用增加的等待时间，模拟远程嵌入接口的耗时。
+
+用法（在 backend 目录下）:
+    python bench/bench_prefetch.py
+    python bench/bench_prefetch.py --embed-latency-ms 150 --think-ms 100 --suffix ""
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import time
+from typing import Any, Dict, List
+
+from bench_multi_query import SlowEmbeddings
+from bench_retrieval import BACKEND_DIR, CHUNKERS, CORPUS_PATH, QUESTIONS_PATH, _build_artifact, _ms_percentile, \
+    make_embeddings, parse_chunker
+
+import rag  # noqa: E402
+from config import PREFETCH_DEBOUNCE, PREFETCH_SIMILARITY  # noqa: E402
+from multi_query import build_query_variants, reciprocal_rank_fusion  # noqa: E402
+from prefetch import PrefetchCache  # noqa: E402
+
+
+def _search(retriever):
+    async def search(queries: List[str]) -> List[Any]:
+        if len(queries) == 1:
+            return await asyncio.to_thread(retriever.invoke, queries[0])
+        results = await asyncio.gather(*(asyncio.to_thread(retriever.invoke, q) for q in queries))
+        return reciprocal_rank_fusion(results)
+    return search
+
+
+async def _ask(question: str, retriever, embeddings: SlowEmbeddings, args: argparse.Namespace,
+               use_prefetch: bool) -> Dict[str, Any]:
+    search = _search(retriever)
+    cache = PrefetchCache(ttl=30, debounce=args.debounce_ms / 1000, threshold=args.similarity)
+    before = embeddings.calls
+    if use_prefetch:
+        for fraction in args.drafts:
+            draft = question[:max(1, round(len(question) * fraction))]
+            if len(draft) >= args.min_chars:
+                cache.schedule("bench", build_query_variants(draft), search)
+            await asyncio.sleep(args.pause_ms / 1000 if fraction < 1 else args.think_ms / 1000)
+    else:
+        await asyncio.sleep(args.pause_ms / 1000 * (len(args.drafts) - 1) + args.think_ms / 1000)
+
+    final = question + args.suffix
+    queries = build_query_variants(final)
+    start = time.perf_counter()
+    docs = await cache.claim("bench", queries) if use_prefetch else None
+    hit = docs is not None
+    if docs is None:
+        docs = await search(queries)
+    wait = time.perf_counter() - start
+    # 等待没用上的预取结束，计入嵌入调用
+    await asyncio.sleep(args.debounce_ms / 1000 + args.embed_latency_ms / 1000 + 0.05)
+    return {"wait": wait, "hit": hit, "calls": embeddings.calls - before, "docs": [d.page_content for d in docs]}
+
+
+def run(args: argparse.Namespace) -> Dict[str, Any]:
+    with open(CORPUS_PATH, encoding="utf-8") as f:
+        text = f.read()
+    with open(QUESTIONS_PATH, encoding="utf-8") as f:
+        questions = json.load(f)
+    cached = make_embeddings(args.embeddings)
+    name, size, overlap = parse_chunker(args.chunker)
+    docs = CHUNKERS[name](text, size, overlap)
+    dim = len(cached.embed_query(docs[0].page_content))
+    index = _build_artifact("float32")(docs, cached, dim)
+    embeddings = SlowEmbeddings(cached, args.embed_latency_ms / 1000)
+    retriever = rag.IndexRetriever(index=index.make_retriever(args.k).index, embeddings=embeddings, k=args.k,
+                                   fetch_k=args.fetch_k)
+
+    results: Dict[str, Any] = {}
+    try:
+        runs = {mode: [asyncio.run(_ask(q["question"], retriever, embeddings, args, mode == "prefetch"))
+                       for q in questions] for mode in ("baseline", "prefetch")}
+    finally:
+        index.cleanup()
+    cached.save()
+    for mode, items in runs.items():
+        waits = [item["wait"] for item in items]
+        results[mode] = {
+            "hit_rate": round(sum(item["hit"] for item in items) / len(items), 4),
+            "wait_ms": {"p50": _ms_percentile(waits, 0.5), "p95": _ms_percentile(waits, 0.95),
+                        "mean": round(statistics.fmean(waits) * 1000, 3)},
+            "embedding_calls": round(statistics.fmean(item["calls"] for item in items), 2),
+        }
+        print(f"{mode:<10}hit={results[mode]['hit_rate']:<8}wait p50={results[mode]['wait_ms']['p50']}ms "
+              f"p95={results[mode]['wait_ms']['p95']}ms embed_calls={results[mode]['embedding_calls']}")
+    same = sum(a["docs"] == b["docs"] for a, b in zip(runs["baseline"], runs["prefetch"]))
+    results["same_docs_rate"] = round(same / len(questions), 4)
+    print(f"预取与直接检索结果相同的比例: {results['same_docs_rate']}")
+
+    return {
+        "benchmark": "prefetch",
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {key: value for key, value in vars(args).items() if key != "output"},
+        "questions": len(questions),
+        "results": results,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="输入时预取基准")
+    parser.add_argument("--chunker", default="recursive:2000:200", help="分块配置，格式为 名称:块大小:重叠")
+    parser.add_argument("--k", type=int, default=3)
+    parser.add_argument("--fetch-k", type=int, default=8)
+    parser.add_argument("--drafts", default="0.6,0.8,1.0", help="逗号分隔，每次停顿时已输入的比例")
+    parser.add_argument("--pause-ms", type=float, default=500.0, help="两次草稿之间的停顿")
+    parser.add_argument("--think-ms", type=float, default=300.0, help="最后一个草稿到点击发送的时间")
+    parser.add_argument("--debounce-ms", type=float, default=PREFETCH_DEBOUNCE * 1000, help="服务端防抖时间（PREFETCH_DEBOUNCE）")
+    parser.add_argument("--similarity", type=float, default=PREFETCH_SIMILARITY, help="PREFETCH_SIMILARITY")
+    parser.add_argument("--min-chars", type=int, default=4)
+    parser.add_argument("--suffix", default="？", help="发送时在问题末尾追加的字符")
+    parser.add_argument("--embed-latency-ms", type=float, default=80.0, help="每次嵌入调用增加的等待时间")
+    parser.add_argument("--embeddings", default="stub", choices=["stub", "dashscope"])
+    parser.add_argument("--output", default="")
+    args = parser.parse_args()
+    args.drafts = sorted(float(x) for x in args.drafts.split(",") if x.strip())
+
+    report = run(args)
+    output = args.output or os.path.join(
+        BACKEND_DIR, "bench", "results", f"prefetch-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"结果已保存到 {output}")
+
+
+if __name__ == "__main__":
+    main()
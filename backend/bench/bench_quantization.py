@@ -0,0 +1,209 @@
+"""
+低精度向量索引基准
+
+用合成的聚类向量（模拟成千上万个药品说明书分块）比较不同的向量存储：
+- chroma: 当前的 Chroma 向量库（float32 + HNSW）
+- float32: 内存映射的 float32 矩阵，精确检索
+- float16 / int8: 在低精度副本上粗筛 N 个候选，再用 float32 向量重新打分（coarse 表示不重新打分）
+
+指标：检索需要常驻的向量数据大小、构建并检索后进程 RSS 的增长、单次检索延迟（p50/p95），
+以及相对 float32 精确检索的 recall@k（低精度和 HNSW 带来的召回损失）。
+
+用法（在 backend 目录下）:
+    python bench/bench_quantization.py --sizes 5000,50000 --candidates 10,50,200
+    python bench/bench_quantization.py --sizes 20000 --no-chroma
+"""
+import argparse
+import gc
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+from typing import Any, Dict, List
+
+import numpy as np
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+os.environ.setdefault("ANONYMIZED_TELEMETRY", "False")
+
+import rag  # noqa: E402
+from langchain_core.documents import Document  # noqa: E402
+
+
+def _rss_bytes() -> int:
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def make_corpus(size: int, dim: int, clusters: int, seed: int) -> np.ndarray:
+    """生成按主题聚类的单位向量：同一药品的分块彼此相近，不同药品之间区分明显"""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dim)).astype(np.float32)
+    assignments = rng.integers(0, clusters, size)
+    vectors = centers[assignments] + 0.8 * rng.standard_normal((size, dim)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors
+
+
+def make_queries(corpus: np.ndarray, count: int, seed: int) -> np.ndarray:
+    """在随机选取的分块向量上加噪声作为查询，查询与若干分块相关而不是完全相同"""
+    rng = np.random.default_rng(seed + 1)
+    picks = corpus[rng.integers(0, len(corpus), count)]
+    queries = picks + 0.05 * rng.standard_normal(picks.shape).astype(np.float32)
+    return queries / np.linalg.norm(queries, axis=1, keepdims=True)
+
+
+def _percentiles_ms(values: List[float]) -> Dict[str, float]:
+    ordered = sorted(values)
+    pick = lambda q: round(ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))] * 1000, 3)
+    return {"p50": pick(0.5), "p95": pick(0.95)}
+
+
+def _recall(found: List[np.ndarray], truth: List[np.ndarray], k: int) -> float:
+    return round(float(np.mean([len(set(f[:k].tolist()) & set(t[:k].tolist())) / k for f, t in zip(found, truth)])), 4)
+
+
+def _run_queries(search, queries: np.ndarray, k: int) -> Dict[str, Any]:
+    search(queries[0], k)  # 预热
+    latencies, found = [], []
+    for query in queries:
+        start = time.perf_counter()
+        found.append(np.asarray(search(query, k)))
+        latencies.append(time.perf_counter() - start)
+    return {"found": found, "latency_ms": _percentiles_ms(latencies)}
+
+
+def bench_index(path: str, precision: str, candidates: int, queries: np.ndarray, k: int) -> Dict[str, Any]:
+    gc.collect()
+    rss_before = _rss_bytes()
+    index = rag.load_index(path, precision=precision, candidates=candidates)
+    result = _run_queries(lambda q, n: index.search(q, n)[0], queries, k)
+    result.update({
+        "resident_mb": round(index.compact_bytes / 2 ** 20, 2),
+        "rss_delta_mb": round((_rss_bytes() - rss_before) / 2 ** 20, 1),
+    })
+    index.close()
+    del index
+    gc.collect()
+    return result
+
+
+def bench_chroma(vectors: np.ndarray, queries: np.ndarray, k: int) -> Dict[str, Any]:
+    import chromadb
+    gc.collect()
+    rss_before = _rss_bytes()
+    start = time.perf_counter()
+    client = chromadb.EphemeralClient()
+    collection = client.create_collection(f"bench-{uuid.uuid4().hex[:8]}", metadata={"hnsw:space": "cosine"})
+    ids = [str(i) for i in range(len(vectors))]
+    for begin in range(0, len(vectors), 5000):
+        collection.add(ids=ids[begin:begin + 5000], embeddings=vectors[begin:begin + 5000].tolist())
+    build_seconds = time.perf_counter() - start
+
+    def search(query: np.ndarray, n: int) -> np.ndarray:
+        result = collection.query(query_embeddings=[query.tolist()], n_results=n)
+        return np.array([int(i) for i in result["ids"][0]])
+
+    result = _run_queries(search, queries, k)
+    result.update({
+        "resident_mb": round(vectors.nbytes / 2 ** 20, 2),
+        "rss_delta_mb": round((_rss_bytes() - rss_before) / 2 ** 20, 1),
+        "build_seconds": round(build_seconds, 2),
+    })
+    client.delete_collection(collection.name)
+    return result
+
+
+def run(args: argparse.Namespace) -> Dict[str, Any]:
+    results = []
+    for size in args.sizes:
+        corpus = make_corpus(size, args.dim, max(1, size // 50), args.seed)
+        queries = make_queries(corpus, args.queries, args.seed)
+        truth = [np.argsort(-(corpus @ q))[:args.k] for q in queries]
+
+        workdir = tempfile.mkdtemp(prefix="bench-quant-")
+        try:
+            source = os.path.join(workdir, "source.md")
+            with open(source, "w", encoding="utf-8") as f:
+                f.write(f"synthetic {size}")
+            chunks = [Document(page_content=str(i)) for i in range(size)]
+            path = rag.write_index(workdir, source, chunks, corpus, "bench")
+            del chunks
+            gc.collect()
+
+            # 候选数等于 k 时重新打分不改变结果集合，相当于只用低精度分数检索
+            configs = [(precision, n) for precision in ("int8", "float16") for n in [args.k] + args.candidates]
+            configs.append(("float32", 0))
+            for precision, candidates in configs:
+                result = bench_index(path, precision, candidates, queries, args.k)
+                if precision == "float32":
+                    name = precision
+                elif candidates == args.k:
+                    name = f"{precision}/coarse"
+                else:
+                    name = f"{precision}/rescore{candidates}"
+                results.append(_report(size, name, result, truth, args.k))
+            if args.chroma:
+                results.append(_report(size, "chroma", bench_chroma(corpus, queries, args.k), truth, args.k))
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "benchmark": "quantization",
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {"sizes": args.sizes, "dim": args.dim, "k": args.k, "queries": args.queries,
+                   "candidates": args.candidates, "seed": args.seed},
+        "results": results,
+    }
+
+
+def _report(size: int, name: str, result: Dict[str, Any], truth: List[np.ndarray], k: int) -> Dict[str, Any]:
+    report = {
+        "size": size,
+        "store": name,
+        f"recall_at_{k}": _recall(result["found"], truth, k),
+        "latency_ms": result["latency_ms"],
+        "resident_mb": result["resident_mb"],
+        "rss_delta_mb": result["rss_delta_mb"],
+    }
+    if "build_seconds" in result:
+        report["build_seconds"] = result["build_seconds"]
+    print(f"n={size:<7}{name:<20}recall@{k}={report[f'recall_at_{k}']:<8}"
+          f"p50={report['latency_ms']['p50']}ms p95={report['latency_ms']['p95']}ms "
+          f"vectors={report['resident_mb']}MB rss+={report['rss_delta_mb']}MB")
+    return report
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="低精度向量索引基准")
+    parser.add_argument("--sizes", default="5000,50000", help="逗号分隔的分块数量")
+    parser.add_argument("--dim", type=int, default=1536, help="向量维度（text-embedding-v1 为 1536）")
+    parser.add_argument("--k", type=int, default=3)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--candidates", default="10,50,200", help="低精度粗筛保留的候选数量，逗号分隔")
+    parser.add_argument("--no-chroma", dest="chroma", action="store_false", help="跳过 Chroma 对照")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="")
+    args = parser.parse_args()
+    args.sizes = [int(v) for v in args.sizes.split(",") if v]
+    args.candidates = [int(v) for v in args.candidates.split(",") if v]
+
+    report = run(args)
+    output = args.output or os.path.join(
+        BACKEND_DIR, "bench", "results", f"quantization-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"结果已保存到 {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,407 @@
+"""
+检索基准：在药品说明书知识库上评估检索延迟和质量
+
+用 full1.md 构建检索栈，把带标注的问题集（bench/data/retrieval_questions.json）逐条交给
+retriever.invoke，统计 recall@k、MRR、每次检索返回的上下文字符数、查询延迟 p50/p95 和索引内存。
+分块方式、k 和索引引擎的每种组合是一次独立、可复现的运行。
+
+默认使用本地的字符 n-gram 哈希向量（--embeddings stub），完全离线运行，适合比较不同配置的相对效果；
+--embeddings dashscope 使用真实的嵌入模型，向量缓存在 bench/cache/ 中，之后的运行同样可以离线。
+
+问题的标注是说明书原文中的一段文字，检索结果中与这段原文有重叠的分块即视为命中。
+
+用法（在 backend 目录下）:
+    python bench/bench_retrieval.py
+    python bench/bench_retrieval.py --chunkers recursive:2000:200,recursive:800:100,markdown:800:100 --k 1,3,5
+    python bench/bench_retrieval.py --engines chroma,numpy --embeddings dashscope
+    python bench/bench_retrieval.py --engines index-float32,index-int8   # 服务端的离线索引产物
+"""
+import argparse
+import gc
+import hashlib
+import json
+import os
+import re
+import statistics
+import sys
+import time
+import uuid
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+# 关闭 Chroma 的匿名统计，避免离线运行时输出上报失败的信息
+os.environ.setdefault("ANONYMIZED_TELEMETRY", "False")
+
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.retrievers import BaseRetriever
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+CORPUS_PATH = os.path.join(BACKEND_DIR, "full1.md")
+QUESTIONS_PATH = os.path.join(BACKEND_DIR, "bench", "data", "retrieval_questions.json")
+CACHE_DIR = os.path.join(BACKEND_DIR, "bench", "cache")
+HEADER_PATTERN = re.compile(r"^#{1,6} ", re.MULTILINE)
+
+
+# ---------------------------------------------------------------- 嵌入
+
+
+class HashingEmbeddings(Embeddings):
+    """
+    离线的确定性嵌入：字符一元和二元组哈希到固定维度后做 L2 归一化
+
+    只反映字面重叠，语义能力远不如真实模型，用于在不同配置之间做相对比较。
+    """
+
+    def __init__(self, dim: int = 1024):
+        self.dim = dim
+
+    def _embed(self, text: str) -> List[float]:
+        vector = np.zeros(self.dim, dtype=np.float32)
+        chars = [ch for ch in text if not ch.isspace()]
+        grams = chars + [a + b for a, b in zip(chars, chars[1:])]
+        for gram in grams:
+            digest = hashlib.blake2b(gram.encode("utf-8"), digest_size=8).digest()
+            value = int.from_bytes(digest, "little")
+            vector[value % self.dim] += 1.0 if (value >> 63) else -1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed(text)
+
+
+class CachedEmbeddings(Embeddings):
+    """按文本哈希缓存向量，指定 path 时保存到 .npz 文件，重复运行时不再调用嵌入模型"""
+
+    def __init__(self, inner: Embeddings, path: Optional[str] = None):
+        self.inner = inner
+        self.path = path
+        self.vectors: Dict[str, np.ndarray] = {}
+        self.misses = 0
+        if path and os.path.exists(path):
+            with np.load(path) as data:
+                self.vectors = {key: data[key] for key in data.files}
+
+    @staticmethod
+    def _key(text: str) -> str:
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [self._key(text) for text in texts]
+        missing = [i for i, key in enumerate(keys) if key not in self.vectors]
+        if missing:
+            self.misses += len(missing)
+            for i, vector in zip(missing, self.inner.embed_documents([texts[i] for i in missing])):
+                self.vectors[keys[i]] = np.asarray(vector, dtype=np.float32)
+        return [self.vectors[key].tolist() for key in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        key = self._key(text)
+        if key not in self.vectors:
+            self.misses += 1
+            self.vectors[key] = np.asarray(self.inner.embed_query(text), dtype=np.float32)
+        return self.vectors[key].tolist()
+
+    def save(self) -> None:
+        if not self.path:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        np.savez(self.path, **self.vectors)
+
+
+def make_embeddings(kind: str) -> CachedEmbeddings:
+    if kind == "stub":
+        # 本地计算很快，只在内存中缓存
+        return CachedEmbeddings(HashingEmbeddings())
+    if kind == "dashscope":
+        from langchain_community.embeddings.dashscope import DashScopeEmbeddings
+        return CachedEmbeddings(
+            DashScopeEmbeddings(model="text-embedding-v1"),
+            os.path.join(CACHE_DIR, "embeddings-text-embedding-v1.npz"),
+        )
+    raise ValueError(f"未知的嵌入类型: {kind}")
+
+
+# ---------------------------------------------------------------- 分块
+
+
+def _recursive(text: str, size: int, overlap: int, offset: int = 0) -> List[Document]:
+    splitter = RecursiveCharacterTextSplitter(chunk_size=size, chunk_overlap=overlap, add_start_index=True)
+    docs = splitter.create_documents([text])
+    for doc in docs:
+        doc.metadata["start_index"] += offset
+    return docs
+
+
+def _markdown(text: str, size: int, overlap: int) -> List[Document]:
+    """先按 Markdown 标题切成小节，再对过长的小节做递归切分"""
+    starts = [m.start() for m in HEADER_PATTERN.finditer(text)]
+    if not starts or starts[0] != 0:
+        starts.insert(0, 0)
+    starts.append(len(text))
+    docs = []
+    for begin, end in zip(starts, starts[1:]):
+        section = text[begin:end]
+        if section.strip():
+            docs.extend(_recursive(section, size, overlap, offset=begin))
+    return docs
+
+
+CHUNKERS: Dict[str, Callable[[str, int, int], List[Document]]] = {
+    "recursive": _recursive,
+    "markdown": _markdown,
+}
+
+
+def parse_chunker(spec: str) -> Tuple[str, int, int]:
+    """解析 "recursive:2000:200" 形式的分块配置"""
+    parts = spec.split(":")
+    name = parts[0]
+    if name not in CHUNKERS:
+        raise ValueError(f"未知的分块方式: {name}")
+    size = int(parts[1]) if len(parts) > 1 else 2000
+    overlap = int(parts[2]) if len(parts) > 2 else 200
+    return name, size, overlap
+
+
+# ---------------------------------------------------------------- 索引引擎
+
+
+class NumpyRetriever(BaseRetriever):
+    """暴力余弦相似度检索，作为不依赖向量数据库的对照"""
+
+    embeddings: Any
+    docs: List[Document]
+    matrix: Any
+    k: int = 3
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        query_vector = np.asarray(self.embeddings.embed_query(query), dtype=np.float32)
+        scores = self.matrix @ query_vector
+        k = min(self.k, len(self.docs))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [self.docs[i] for i in top]
+
+
+class Index:
+    """构建好的索引，可以按不同的 k 生成检索器"""
+
+    def __init__(self, make_retriever: Callable[[int], BaseRetriever], vectors_bytes: int,
+                 cleanup: Optional[Callable[[], None]] = None):
+        self.make_retriever = make_retriever
+        self.vectors_bytes = vectors_bytes
+        self.cleanup = cleanup or (lambda: None)
+
+
+def _build_chroma(docs: List[Document], embeddings: Embeddings, dim: int) -> Index:
+    from langchain_chroma import Chroma
+    store = Chroma.from_documents(documents=docs, embedding=embeddings, collection_name=f"bench-{uuid.uuid4().hex[:8]}")
+    return Index(
+        lambda k: store.as_retriever(search_kwargs={"k": k}),
+        len(docs) * dim * 4,
+        cleanup=store.delete_collection,
+    )
+
+
+def _build_numpy(docs: List[Document], embeddings: Embeddings, dim: int) -> Index:
+    matrix = np.asarray(embeddings.embed_documents([doc.page_content for doc in docs]), dtype=np.float32)
+    matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+    return Index(
+        lambda k: NumpyRetriever(embeddings=embeddings, docs=docs, matrix=matrix, k=k),
+        matrix.nbytes,
+    )
+
+
+def _build_artifact(precision: str) -> Callable[[List[Document], Embeddings, int], Index]:
+    """服务端使用的离线索引产物（rag.write_index / load_index），按指定精度检索"""
+
+    def build(docs: List[Document], embeddings: Embeddings, dim: int) -> Index:
+        import shutil
+        import tempfile
+        import rag
+        matrix = np.asarray(embeddings.embed_documents([doc.page_content for doc in docs]), dtype=np.float32)
+        workdir = tempfile.mkdtemp(prefix="bench-index-")
+        index = rag.load_index(rag.write_index(workdir, CORPUS_PATH, docs, matrix, "bench"), precision=precision)
+        return Index(
+            lambda k: rag.IndexRetriever(index=index, embeddings=embeddings, k=k),
+            index.compact_bytes,
+            cleanup=lambda: shutil.rmtree(workdir, ignore_errors=True),
+        )
+
+    return build
+
+
+ENGINES: Dict[str, Callable[[List[Document], Embeddings, int], Index]] = {
+    "chroma": _build_chroma,
+    "numpy": _build_numpy,
+    "index-float32": _build_artifact("float32"),
+    "index-float16": _build_artifact("float16"),
+    "index-int8": _build_artifact("int8"),
+}
+
+
+# ---------------------------------------------------------------- 评估
+
+
+def _rss_bytes() -> int:
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def _relevant_spans(text: str, phrases: List[str]) -> List[Tuple[int, int]]:
+    spans = []
+    for phrase in phrases:
+        start = text.find(phrase)
+        while start != -1:
+            spans.append((start, start + len(phrase)))
+            start = text.find(phrase, start + 1)
+    return spans
+
+
+def _is_hit(doc: Document, spans: List[Tuple[int, int]]) -> bool:
+    start = doc.metadata.get("start_index", -1)
+    end = start + len(doc.page_content)
+    return any(start < span_end and span_start < end for span_start, span_end in spans)
+
+
+def _ms_percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))] * 1000, 3)
+
+
+def evaluate(retriever: BaseRetriever, questions: List[Dict[str, Any]], spans: Dict[str, List[Tuple[int, int]]],
+             k: int, repeat: int) -> Dict[str, Any]:
+    latencies = []
+    reciprocal_ranks = []
+    hits = 0
+    context_chars = []
+    misses = []
+    for question in questions:
+        docs = retriever.invoke(question["question"])
+        for _ in range(repeat):
+            start = time.perf_counter()
+            retriever.invoke(question["question"])
+            latencies.append(time.perf_counter() - start)
+        rank = next((i + 1 for i, doc in enumerate(docs) if _is_hit(doc, spans[question["id"]])), None)
+        if rank is not None:
+            hits += 1
+            reciprocal_ranks.append(1.0 / rank)
+        else:
+            reciprocal_ranks.append(0.0)
+            misses.append(question["id"])
+        context_chars.append(len("\n\n".join(doc.page_content for doc in docs)))
+    return {
+        f"recall_at_{k}": round(hits / len(questions), 4),
+        "mrr": round(statistics.fmean(reciprocal_ranks), 4),
+        "context_chars": {
+            "mean": round(statistics.fmean(context_chars), 1),
+            "max": max(context_chars),
+        },
+        "latency_ms": {"p50": _ms_percentile(latencies, 0.5), "p95": _ms_percentile(latencies, 0.95)},
+        "misses": misses,
+    }
+
+
+def run(args: argparse.Namespace) -> Dict[str, Any]:
+    with open(CORPUS_PATH, encoding="utf-8") as f:
+        text = f.read()
+    with open(QUESTIONS_PATH, encoding="utf-8") as f:
+        questions = json.load(f)
+    spans = {q["id"]: _relevant_spans(text, q["relevant"]) for q in questions}
+    embeddings = make_embeddings(args.embeddings)
+
+    runs = []
+    for chunker_spec in args.chunkers:
+        name, size, overlap = parse_chunker(chunker_spec)
+        docs = CHUNKERS[name](text, size, overlap)
+        # 预先计算分块向量，索引构建时间不受嵌入模型速度影响
+        embeddings.embed_documents([doc.page_content for doc in docs])
+        dim = len(embeddings.embed_query(docs[0].page_content))
+        for engine in args.engines:
+            gc.collect()
+            rss_before = _rss_bytes()
+            build_start = time.perf_counter()
+            index = ENGINES[engine](docs, embeddings, dim)
+            build_seconds = time.perf_counter() - build_start
+            gc.collect()
+            rss_delta = _rss_bytes() - rss_before
+            for k in args.k:
+                result = evaluate(index.make_retriever(k), questions, spans, k, args.repeat)
+                report = {
+                    "config": {
+                        "chunker": name,
+                        "chunk_size": size,
+                        "chunk_overlap": overlap,
+                        "k": k,
+                        "engine": engine,
+                        "embeddings": args.embeddings,
+                    },
+                    "chunks": len(docs),
+                    "mean_chunk_chars": round(statistics.fmean(len(doc.page_content) for doc in docs), 1),
+                    "build_seconds": round(build_seconds, 3),
+                    "index_memory_mb": {
+                        "vectors": round(index.vectors_bytes / 2 ** 20, 2),
+                        "rss_delta": round(rss_delta / 2 ** 20, 2),
+                    },
+                    **result,
+                }
+                runs.append(report)
+                print(f"{chunker_spec:<22}{engine:<15}k={k:<3}chunks={len(docs):<5}"
+                      f"recall@{k}={result[f'recall_at_{k}']:<7}mrr={result['mrr']:<7}"
+                      f"ctx={result['context_chars']['mean']:<9}p50={result['latency_ms']['p50']}ms "
+                      f"p95={result['latency_ms']['p95']}ms mem={report['index_memory_mb']['vectors']}MB")
+            index.cleanup()
+    embeddings.save()
+
+    return {
+        "benchmark": "retrieval",
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "corpus": {"path": os.path.basename(CORPUS_PATH), "chars": len(text)},
+        "questions": len(questions),
+        "repeat": args.repeat,
+        "runs": runs,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="检索延迟和质量基准")
+    parser.add_argument("--chunkers", default="recursive:2000:200,recursive:800:100,markdown:800:100",
+                        help="逗号分隔，格式为 名称:块大小:重叠，可选名称: " + ",".join(CHUNKERS))
+    parser.add_argument("--k", default="3", help="逗号分隔的 k 值")
+    parser.add_argument("--engines", default="chroma,numpy", help="逗号分隔，可选: " + ",".join(ENGINES))
+    parser.add_argument("--embeddings", default="stub", choices=["stub", "dashscope"])
+    parser.add_argument("--repeat", type=int, default=5, help="每个问题计时的重复次数")
+    parser.add_argument("--output", default=None, help="结果文件，默认 bench/results/retrieval-<时间>.json")
+    args = parser.parse_args()
+    args.chunkers = [c.strip() for c in args.chunkers.split(",") if c.strip()]
+    args.k = [int(k) for k in args.k.split(",") if k.strip()]
+    args.engines = [e.strip() for e in args.engines.split(",") if e.strip()]
+    unknown = set(args.engines) - set(ENGINES)
+    if unknown:
+        parser.error(f"未知引擎: {','.join(sorted(unknown))}")
+
+    report = run(args)
+    output = args.output or os.path.join(
+        BACKEND_DIR, "bench", "results", f"retrieval-{time.strftime('%Y%m%d-%H%M%S')}.json"
+    )
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"结果已写入 {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+"""
+冷启动基准
+
+测量后端从进程启动到可以服务请求的时间：
+- import: 在全新解释器中导入 main 模块的耗时（也就是 uvicorn 加载应用的主要开销）
+- first_response: 从启动 uvicorn 进程到健康检查端点 / 首次返回的时间
+- rag_ready: 从启动进程到 / 返回的 rag_status 不再是 building 的时间（知识库在后台构建）
+
+嵌入模型调用走本地 DashScope 替身服务，不访问付费 API。
+
+用法（在 backend 目录下）:
+    python bench/bench_startup.py --repeat 5
+    python bench/bench_startup.py --importtime 15   # 同时列出导入最慢的模块
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from typing import Any, Dict, List, Optional
+
+import aiohttp
+
+from bench_load import BACKEND_DIR, FAKE_SERVER, _free_port, _rss_bytes, _start_process
+
+IMPORT_SNIPPET = "import time; start = time.perf_counter(); import main; print(time.perf_counter() - start)"
+
+
+def _env(fake_port: int) -> Dict[str, str]:
+    env = dict(os.environ)
+    env.update({
+        "DASHSCOPE_HTTP_BASE_URL": f"http://127.0.0.1:{fake_port}/api/v1",
+        "DASHSCOPE_API_KEY": env.get("LOADTEST_API_KEY", "sk-loadtest"),
+        "LOG_LEVEL": env.get("LOG_LEVEL", "WARNING"),
+        "ANONYMIZED_TELEMETRY": "False",
+    })
+    return env
+
+
+def measure_import(env: Dict[str, str]) -> Dict[str, float]:
+    """在新进程中导入 main，返回进程总耗时和模块导入耗时（秒）"""
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-c", IMPORT_SNIPPET], cwd=BACKEND_DIR, env=env,
+        capture_output=True, text=True, check=True,
+    )
+    return {
+        "process": time.perf_counter() - start,
+        "import": float(result.stdout.strip().splitlines()[-1]),
+    }
+
+
+def slowest_imports(env: Dict[str, str], top: int) -> List[Dict[str, Any]]:
+    """用 -X importtime 找出累计耗时最长的顶层包"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"], cwd=BACKEND_DIR, env=env,
+        capture_output=True, text=True, check=True,
+    )
+    packages: Dict[str, int] = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        parts = line[len("import time:"):].split("|")
+        try:
+            cumulative = int(parts[1])
+        except ValueError:
+            continue
+        name = parts[2].strip()
+        # 只统计 main 直接导入的模块（缩进一层），累计时间已经包含子模块
+        if parts[2].startswith("   ") and not parts[2].startswith("    "):
+            package = name.split(".")[0]
+            packages[package] = packages.get(package, 0) + cumulative
+    ranked = sorted(packages.items(), key=lambda item: item[1], reverse=True)[:top]
+    return [{"package": name, "ms": round(us / 1000, 1)} for name, us in ranked]
+
+
+async def measure_server(env: Dict[str, str], timeout: float) -> Dict[str, Optional[float]]:
+    """启动 uvicorn，记录首次响应和知识库就绪的时间"""
+    port = _free_port()
+    url = f"http://127.0.0.1:{port}/"
+    start = time.perf_counter()
+    process = _start_process([
+        sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+        "--log-level", "warning",
+    ], env)
+    first_response = rag_ready = None
+    rag_status = None
+    rss = None
+    try:
+        async with aiohttp.ClientSession() as session:
+            while time.perf_counter() - start < timeout:
+                if process.poll() is not None:
+                    raise RuntimeError(f"进程提前退出: {process.stderr.read().decode('utf-8', 'replace')[-2000:]}")
+                try:
+                    async with session.get(url) as response:
+                        body = await response.json()
+                except aiohttp.ClientError:
+                    await asyncio.sleep(0.02)
+                    continue
+                now = time.perf_counter() - start
+                if first_response is None:
+                    first_response = now
+                rag_status = body.get("rag_status")
+                if rag_status != "building":
+                    rag_ready = now
+                    break
+                await asyncio.sleep(0.05)
+        rss = _rss_bytes(process.pid)
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+    return {
+        "first_response": first_response,
+        "rag_ready": rag_ready,
+        "rag_status": rag_status,
+        "rss_mb": round(rss / 2 ** 20, 1) if rss else None,
+    }
+
+
+def _median_ms(values: List[Optional[float]]) -> Optional[float]:
+    values = [v for v in values if v is not None]
+    return round(statistics.median(values) * 1000, 1) if values else None
+
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    fake_port = _free_port()
+    fake = _start_process([
+        sys.executable, FAKE_SERVER, "--port", str(fake_port),
+        "--embedding-latency", str(args.embedding_latency),
+    ], dict(os.environ))
+    env = _env(fake_port)
+    imports, servers = [], []
+    try:
+        # 等待替身服务可用
+        for _ in range(100):
+            try:
+                async with aiohttp.ClientSession() as session:
+                    async with session.get(f"http://127.0.0.1:{fake_port}/stats"):
+                        break
+            except aiohttp.ClientError:
+                await asyncio.sleep(0.1)
+        for index in range(args.repeat):
+            imported = measure_import(env)
+            server = await measure_server(env, args.timeout)
+            imports.append(imported)
+            servers.append(server)
+            print(f"#{index + 1} import={imported['import'] * 1000:.0f}ms process={imported['process'] * 1000:.0f}ms "
+                  f"first_response={(server['first_response'] or 0) * 1000:.0f}ms "
+                  f"rag_ready={(server['rag_ready'] or 0) * 1000:.0f}ms rag_status={server['rag_status']} "
+                  f"rss={server['rss_mb']}MB")
+        slowest = slowest_imports(env, args.importtime) if args.importtime else []
+    finally:
+        fake.terminate()
+        fake.wait(timeout=10)
+
+    for item in slowest:
+        print(f"  {item['package']:<28}{item['ms']:>10.1f}ms")
+    return {
+        "benchmark": "startup",
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {"repeat": args.repeat, "embedding_latency": args.embedding_latency},
+        "median_ms": {
+            "import": _median_ms([i["import"] for i in imports]),
+            "import_process": _median_ms([i["process"] for i in imports]),
+            "first_response": _median_ms([s["first_response"] for s in servers]),
+            "rag_ready": _median_ms([s["rag_ready"] for s in servers]),
+        },
+        "rag_status": servers[-1]["rag_status"] if servers else None,
+        "rss_mb": servers[-1]["rss_mb"] if servers else None,
+        "slowest_imports": slowest,
+        "runs": {"import": imports, "server": servers},
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="后端冷启动基准")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--timeout", type=float, default=120.0, help="等待知识库就绪的最长时间（秒）")
+    parser.add_argument("--embedding-latency", type=float, default=0.05, help="替身服务每次嵌入调用的延迟（秒）")
+    parser.add_argument("--importtime", type=int, default=0, help="列出导入最慢的前 N 个包")
+    parser.add_argument("--output", default="")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    print(json.dumps(report["median_ms"], ensure_ascii=False))
+    output = args.output or os.path.join(
+        BACKEND_DIR, "bench", "results", f"startup-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"结果已保存到 {output}")
+
+
+if __name__ == "__main__":
+    main()
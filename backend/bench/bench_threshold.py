@@ -0,0 +1,130 @@
+"""
+检索分数阈值基准
+
+比较固定 k 与按相似度阈值自适应 k（rag.adaptive_k）时的回答路径和参考资料质量：
+- fixed: 每次取前 k 个分块（原来的做法，任何问题都会带上参考资料）
+- threshold: 使用 rag.calibrate_threshold 校准的阈值，最高分低于阈值时不检索参考资料
+- threshold+gap: 在阈值的基础上，相邻分块的分数差超过 --gap 时截断
+
+相关问题为带标注的问题集（bench/data/retrieval_questions.json），无关问题为寒暄、闲聊和常识问题
+（bench/data/offtopic_questions.json，与校准用的探测问题不重复）。
+指标：相关问题走 RAG 路径的比例和命中率、无关问题走普通对话路径的比例、平均分块数和上下文字符数。
+
+用法（在 backend 目录下）:
+    python bench/bench_threshold.py
+    python bench/bench_threshold.py --embeddings dashscope --gap 0.05
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import tempfile
+import time
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+
+from bench_retrieval import (BACKEND_DIR, CHUNKERS, CORPUS_PATH, QUESTIONS_PATH, _is_hit, _relevant_spans,
+                             make_embeddings, parse_chunker)
+
+import rag  # noqa: E402
+
+OFFTOPIC_PATH = os.path.join(BACKEND_DIR, "bench", "data", "offtopic_questions.json")
+
+
+def evaluate(name: str, retriever: rag.IndexRetriever, questions: List[Dict[str, Any]],
+             spans: Dict[str, List[Tuple[int, int]]], offtopic: List[str]) -> Dict[str, Any]:
+    rag_path = hits = 0
+    counts, chars = [], []
+    for question in questions:
+        docs = retriever.invoke(question["question"])
+        counts.append(len(docs))
+        chars.append(sum(len(doc.page_content) for doc in docs))
+        rag_path += bool(docs)
+        hits += any(_is_hit(doc, spans[question["id"]]) for doc in docs)
+    lean = 0
+    for question in offtopic:
+        docs = retriever.invoke(question)
+        counts.append(len(docs))
+        chars.append(sum(len(doc.page_content) for doc in docs))
+        lean += not docs
+    result = {
+        "name": name,
+        "threshold": retriever.score_threshold,
+        "gap": retriever.score_gap,
+        "on_topic_rag_rate": round(rag_path / len(questions), 4),
+        "on_topic_hit_rate": round(hits / len(questions), 4),
+        "off_topic_lean_rate": round(lean / len(offtopic), 4),
+        "mean_docs": round(statistics.fmean(counts), 2),
+        "mean_context_chars": round(statistics.fmean(chars), 1),
+    }
+    print(f"{name:<16}threshold={result['threshold']:<8}on_topic_rag={result['on_topic_rag_rate']:<8}"
+          f"hit={result['on_topic_hit_rate']:<8}off_topic_lean={result['off_topic_lean_rate']:<8}"
+          f"docs={result['mean_docs']:<6}chars={result['mean_context_chars']}")
+    return result
+
+
+def run(args: argparse.Namespace) -> Dict[str, Any]:
+    with open(CORPUS_PATH, encoding="utf-8") as f:
+        text = f.read()
+    with open(QUESTIONS_PATH, encoding="utf-8") as f:
+        questions = json.load(f)
+    with open(OFFTOPIC_PATH, encoding="utf-8") as f:
+        offtopic = json.load(f)
+    spans = {q["id"]: _relevant_spans(text, q["relevant"]) for q in questions}
+    embeddings = make_embeddings(args.embeddings)
+    name, size, overlap = parse_chunker(args.chunker)
+    docs = CHUNKERS[name](text, size, overlap)
+
+    vectors = np.asarray(embeddings.embed_documents([doc.page_content for doc in docs]), dtype=np.float32)
+    vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    calibration = rag.calibrate_threshold(vectors, embeddings, rag.on_topic_probes(text))
+    print(f"校准结果: {json.dumps(calibration, ensure_ascii=False)}")
+
+    workdir = tempfile.mkdtemp(prefix="bench-threshold-")
+    try:
+        index = rag.load_index(rag.write_index(workdir, CORPUS_PATH, docs, vectors, "bench", calibration))
+        threshold = rag.resolve_score_threshold(index, "auto")
+        configs = [("fixed", 0.0, 0.0), ("threshold", threshold, 0.0), ("threshold+gap", threshold, args.gap)]
+        results = [
+            evaluate(label, rag.IndexRetriever(index=index, embeddings=embeddings, k=args.k, fetch_k=args.fetch_k,
+                                               score_threshold=t, score_gap=gap), questions, spans, offtopic)
+            for label, t, gap in configs
+        ]
+        index.close()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    embeddings.save()
+
+    return {
+        "benchmark": "threshold",
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {"chunker": args.chunker, "k": args.k, "fetch_k": args.fetch_k, "gap": args.gap,
+                   "embeddings": args.embeddings, "on_topic": len(questions), "off_topic": len(offtopic)},
+        "calibration": calibration,
+        "results": results,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="检索分数阈值基准")
+    parser.add_argument("--chunker", default="recursive:2000:200", help="分块配置，格式为 名称:块大小:重叠")
+    parser.add_argument("--k", type=int, default=3, help="分块数量上限")
+    parser.add_argument("--fetch-k", type=int, default=0, help="MMR 的候选数量，0 表示不使用 MMR")
+    parser.add_argument("--gap", type=float, default=0.1, help="相邻分块分数差的截断值")
+    parser.add_argument("--embeddings", default="stub", choices=["stub", "dashscope"])
+    parser.add_argument("--output", default="")
+    args = parser.parse_args()
+
+    report = run(args)
+    output = args.output or os.path.join(
+        BACKEND_DIR, "bench", "results", f"threshold-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"结果已保存到 {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,245 @@
+"""
+本地 DashScope 替身服务
+
+按 DashScope HTTP 协议模拟后端用到的四类接口，供压测和基准测试在不访问付费 API 的情况下使用：
+- 文本生成（ChatTongyi / Generation，支持 SSE 流式输出）
+- 文本嵌入（text-embedding-v1，返回按文本哈希生成的确定性向量）
+- 多模态对话（MultiModalConversation）
+- 文生图（ImageSynthesis，异步任务 + 轮询）
+
+延迟、输出速率和错误率都可以配置。让后端使用替身服务：
+    DASHSCOPE_HTTP_BASE_URL=http://127.0.0.1:8900/api/v1 uvicorn main:app
+
+用法（在 backend 目录下）:
+    python bench/fake_dashscope.py --port 8900 --latency 0.3 --token-rate 50 --error-rate 0.02
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import time
+import uuid
+from typing import Any, Dict, List
+
+import numpy as np
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+DEFAULT_REPLY = (
+    "## 建议\n根据您的描述，这类症状常见于多种情况，**建议尽快就医**明确原因。\n"
+    "> 本回答由本地替身服务生成，仅用于性能测试。\n"
+)
+
+
+class FakeConfig:
+    """替身服务的行为参数"""
+
+    def __init__(
+        self,
+        latency: float = 0.3,
+        token_rate: float = 50.0,
+        reply_chars: int = 400,
+        error_rate: float = 0.0,
+        throttle_rate: float = 0.0,
+        embedding_latency: float = 0.05,
+        embedding_dim: int = 1536,
+        multimodal_latency: float = 1.0,
+        image_latency: float = 2.0,
+        seed: int = 0,
+    ):
+        self.latency = latency
+        self.token_rate = token_rate
+        self.reply_chars = reply_chars
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.embedding_latency = embedding_latency
+        self.embedding_dim = embedding_dim
+        self.multimodal_latency = multimodal_latency
+        self.image_latency = image_latency
+        self.random = random.Random(seed)
+        self.calls: Dict[str, int] = {}
+
+    def reply(self) -> str:
+        text = DEFAULT_REPLY
+        while len(text) < self.reply_chars:
+            text += DEFAULT_REPLY
+        return text[:self.reply_chars]
+
+
+def _request_id() -> str:
+    return str(uuid.uuid4())
+
+
+def _usage(text: str) -> Dict[str, int]:
+    # 中文大约每个字符一个token
+    return {"input_tokens": 50, "output_tokens": len(text), "total_tokens": 50 + len(text)}
+
+
+def _embedding(text: str, dim: int) -> List[float]:
+    """按文本内容生成确定性的单位向量，相同文本得到相同结果"""
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+    vector = np.random.default_rng(seed).standard_normal(dim).astype(np.float32)
+    vector /= np.linalg.norm(vector)
+    return vector.tolist()
+
+
+def create_app(config: FakeConfig) -> FastAPI:
+    app = FastAPI(title="DashScope 替身服务")
+    tasks: Dict[str, Dict[str, Any]] = {}
+
+    def injected_error():
+        """按配置的概率返回限流或服务端错误"""
+        roll = config.random.random()
+        if roll < config.throttle_rate:
+            return JSONResponse(status_code=429, content={
+                "code": "Throttling.RateQuota", "message": "Requests rate limit exceeded", "request_id": _request_id()})
+        if roll < config.throttle_rate + config.error_rate:
+            return JSONResponse(status_code=500, content={
+                "code": "InternalError", "message": "Injected failure", "request_id": _request_id()})
+        return None
+
+    def count(name: str) -> None:
+        config.calls[name] = config.calls.get(name, 0) + 1
+
+    async def stream_text(reply: str, request_id: str, message_content: Any):
+        """按 token_rate 逐段输出增量内容（每个分片约2个字符）"""
+        interval = 1.0 / config.token_rate if config.token_rate > 0 else 0.0
+        for index in range(0, len(reply), 2):
+            piece = reply[index:index + 2]
+            finished = index + 2 >= len(reply)
+            payload = {
+                "output": {"choices": [{
+                    "message": {"role": "assistant", "content": message_content(piece)},
+                    "finish_reason": "stop" if finished else "null",
+                }]},
+                "usage": _usage(reply[:index + 2]),
+                "request_id": request_id,
+            }
+            yield f"id:{index // 2 + 1}\nevent:result\n:HTTP_STATUS/200\ndata:{json.dumps(payload, ensure_ascii=False)}\n\n"
+            if interval:
+                await asyncio.sleep(interval)
+
+    async def generation(body: Dict[str, Any], stream: bool, multimodal: bool):
+        error = injected_error()
+        if error is not None:
+            return error
+        await asyncio.sleep(config.multimodal_latency if multimodal else config.latency)
+        reply = config.reply()
+        request_id = _request_id()
+
+        def content(text: str):
+            return [{"text": text}] if multimodal else text
+
+        if stream:
+            return StreamingResponse(stream_text(reply, request_id, content), media_type="text/event-stream")
+        # 非流式调用也按输出速率计算生成耗时
+        if config.token_rate > 0:
+            await asyncio.sleep(len(reply) / 2 / config.token_rate)
+        return {
+            "output": {"choices": [{
+                "message": {"role": "assistant", "content": content(reply)},
+                "finish_reason": "stop",
+            }]},
+            "usage": _usage(reply),
+            "request_id": request_id,
+        }
+
+    @app.post("/api/v1/services/{task_group}/{task}/{function}")
+    async def services(task_group: str, task: str, function: str, request: Request):
+        body = await request.json()
+        count(task)
+        stream = "text/event-stream" in request.headers.get("accept", "") or \
+            request.headers.get("x-dashscope-sse") == "enable"
+
+        if task == "text-generation":
+            return await generation(body, stream, multimodal=False)
+        if task == "multimodal-generation":
+            return await generation(body, stream, multimodal=True)
+        if task == "text-embedding":
+            error = injected_error()
+            if error is not None:
+                return error
+            await asyncio.sleep(config.embedding_latency)
+            texts = body.get("input", {}).get("texts", [])
+            if isinstance(texts, str):
+                texts = [texts]
+            return {
+                "output": {"embeddings": [
+                    {"text_index": i, "embedding": _embedding(text, config.embedding_dim)}
+                    for i, text in enumerate(texts)
+                ]},
+                "usage": {"total_tokens": sum(len(text) for text in texts)},
+                "request_id": _request_id(),
+            }
+        if task == "text2image":
+            error = injected_error()
+            if error is not None:
+                return error
+            task_id = str(uuid.uuid4())
+            n = int(body.get("parameters", {}).get("n", 1) or 1)
+            tasks[task_id] = {"ready_at": time.monotonic() + config.image_latency, "n": n}
+            return {"output": {"task_id": task_id, "task_status": "PENDING"}, "request_id": _request_id()}
+        return JSONResponse(status_code=404, content={"code": "NotFound", "message": f"unknown task {task}"})
+
+    @app.get("/api/v1/tasks/{task_id}")
+    async def task_status(task_id: str):
+        task = tasks.get(task_id)
+        if task is None:
+            return JSONResponse(status_code=404, content={"code": "NotFound", "message": "task not found"})
+        # 轮询时等到任务完成再返回，避免SDK的轮询间隔放大测得的耗时
+        wait = task["ready_at"] - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        tasks.pop(task_id, None)
+        return {
+            "output": {
+                "task_id": task_id,
+                "task_status": "SUCCEEDED",
+                "results": [{"url": f"https://example.com/fake/{task_id}/{i}.png"} for i in range(task["n"])],
+            },
+            "usage": {"image_count": task["n"]},
+            "request_id": _request_id(),
+        }
+
+    @app.get("/stats")
+    async def stats():
+        return {"calls": config.calls, "pending_tasks": len(tasks)}
+
+    return app
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="本地 DashScope 替身服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--latency", type=float, default=0.3, help="文本生成首个分片前的延迟（秒）")
+    parser.add_argument("--token-rate", type=float, default=50.0, help="每秒输出的分片数（每片约2个字符），0 表示不限速")
+    parser.add_argument("--reply-chars", type=int, default=400, help="回答长度（字符）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="返回500错误的概率")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="返回429限流的概率")
+    parser.add_argument("--embedding-latency", type=float, default=0.05)
+    parser.add_argument("--embedding-dim", type=int, default=1536)
+    parser.add_argument("--multimodal-latency", type=float, default=1.0)
+    parser.add_argument("--image-latency", type=float, default=2.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    config = FakeConfig(
+        latency=args.latency,
+        token_rate=args.token_rate,
+        reply_chars=args.reply_chars,
+        error_rate=args.error_rate,
+        throttle_rate=args.throttle_rate,
+        embedding_latency=args.embedding_latency,
+        embedding_dim=args.embedding_dim,
+        multimodal_latency=args.multimodal_latency,
+        image_latency=args.image_latency,
+        seed=args.seed,
+    )
+    uvicorn.run(create_app(config), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+离线构建知识库索引产物
+
+在构建环境中执行加载、规范化（见 kb_normalize）、分割和嵌入，把结果写成带版本号的索引产物，
+生产节点启动时只需以内存映射方式加载，不再调用嵌入模型处理整个知识库。
+
+用法（在 backend 目录下）:
+    python build_index.py                        # 输出到 RAG_INDEX_DIR（默认 ./indexes）并更新 current
+    python build_index.py --source full1.md --output-dir /srv/medical/indexes
+    python build_index.py --verify               # 校验 current 指向的产物
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+import rag
+from config import RAG_INDEX_DIR
+
+
+def build(source: str, output_dir: str, force: bool = False) -> str:
+    version = rag.index_version(rag.sha256_file(source))
+    target = os.path.join(output_dir, version)
+    if not force and os.path.isfile(os.path.join(target, rag.MANIFEST_FILE)):
+        rag.set_current_version(output_dir, version)
+        print(f"索引 {version} 已存在，跳过构建（--force 强制重建）")
+        return target
+
+    start = time.perf_counter()
+    documents = rag.load_documents(source, normalize=False)
+    raw_chars = sum(len(d.page_content) for d in documents)
+    raw_chunks = len(rag.split_documents(documents))
+    report = rag.normalize_documents(documents)
+    chunks = rag.split_documents(documents)
+    if not chunks:
+        raise SystemExit("知识库分割后内容为空")
+    chars = sum(len(d.page_content) for d in documents)
+    print(f"已加载 {source}：{chars} 字符，{len(chunks)} 个分块")
+    normalization = None
+    if report is not None:
+        normalization = {
+            "settings": rag.normalization_settings(),
+            "stats": report,
+            "chars": [raw_chars, chars],
+            "chunks": [raw_chunks, len(chunks)],
+            "embedding_calls": [rag.embedding_calls(raw_chunks), rag.embedding_calls(len(chunks))],
+        }
+        print(f"规范化：字符 {raw_chars} -> {chars}（-{1 - chars / raw_chars:.1%}），分块 {raw_chunks} -> {len(chunks)}，"
+              f"嵌入调用 {normalization['embedding_calls'][0]} -> {normalization['embedding_calls'][1]}；"
+              f"去掉 LaTeX {report['latex_spans']} 处、图片 {report['images']} 张、HTML 表格 {report['tables']} 个、"
+              f"重复段落 {report['duplicate_blocks']} 个，章节 {report['dropped_sections'] or '无'}")
+
+    embeddings = rag.create_embeddings()
+    if embeddings is None:
+        raise SystemExit("嵌入模型不可用")
+    embed_start = time.perf_counter()
+    vectors = np.asarray(embeddings.embed_documents([chunk.page_content for chunk in chunks]), dtype=np.float32)
+    print(f"嵌入完成：{vectors.shape[0]} x {vectors.shape[1]}，耗时 {time.perf_counter() - embed_start:.1f}s")
+
+    # 用相关和无关的探测问题校准检索的相似度阈值
+    normalized = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    calibration = rag.calibrate_threshold(
+        normalized, embeddings, rag.on_topic_probes("\n".join(d.page_content for d in documents)))
+    if calibration:
+        print(f"相似度阈值校准为 {calibration['threshold']}（相关问题最低分 {calibration['on_topic']['min']}，"
+              f"无关问题最高分 {calibration['off_topic']['max']}）")
+
+    os.makedirs(output_dir, exist_ok=True)
+    target = rag.write_index(output_dir, source, chunks, vectors, version, calibration, normalization)
+    size = sum(os.path.getsize(os.path.join(target, name)) for name in os.listdir(target))
+    print(f"索引 {version} 已写入 {target}（{size / 2 ** 20:.2f} MB，总耗时 {time.perf_counter() - start:.1f}s）")
+    return target
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="离线构建知识库索引产物")
+    parser.add_argument("--source", default=rag.find_knowledge_file(), help="知识库 Markdown 文件")
+    parser.add_argument("--output-dir", default=RAG_INDEX_DIR)
+    parser.add_argument("--force", action="store_true", help="即使同版本产物已存在也重新构建")
+    parser.add_argument("--verify", action="store_true", help="只校验 current 指向的产物")
+    args = parser.parse_args()
+
+    if args.verify:
+        path = rag.find_index(args.output_dir, "")
+        if not path:
+            sys.exit(f"{args.output_dir} 下没有可用的索引产物")
+        try:
+            index = rag.load_index(path, verify=True)
+        except rag.IndexLoadError as e:
+            sys.exit(str(e))
+        print(f"索引 {index.version} 校验通过：{len(index)} 个分块，维度 {index.vectors.shape[1]}")
+        return
+
+    if not args.source or not os.path.exists(args.source):
+        sys.exit("未找到知识库文件")
+    build(args.source, args.output_dir, args.force)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+"""
+准入控制与背压
+
+为文本对话、多模态和文生图分别设置并发上限和有界等待队列：
+- 队列已满时立即拒绝（429），等待超时时拒绝（503），两者都带 Retry-After 建议
+- 同一会话内会写入历史的请求串行执行，避免交错写入会话历史
+- 批量问答等后台请求以低优先级申请准入：交互请求排队时先让出，被拒绝时等待后重试
+"""
+import asyncio
+import math
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Dict, Optional, Sequence
+
+from config import ADMISSION_LIMITS, ADMISSION_QUEUE_SIZES, ADMISSION_QUEUE_TIMEOUT
+import metrics
+
+
+class AdmissionRejected(Exception):
+    """请求未被准入时抛出，携带应返回给客户端的状态码和重试建议"""
+
+    def __init__(self, lane: str, status_code: int, retry_after: int, reason: str):
+        super().__init__(reason)
+        self.lane = lane
+        self.status_code = status_code
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class Lane:
+    """单一类别请求的并发通道：固定数量的执行槽位加一个有界等待队列"""
+
+    def __init__(self, name: str, limit: int, queue_size: int, queue_timeout: float):
+        self.name = name
+        self.limit = max(1, limit)
+        self.queue_size = max(0, queue_size)
+        self.queue_timeout = queue_timeout
+        self._semaphore = asyncio.Semaphore(self.limit)
+        self.active = 0
+        self.waiting = 0
+        # 统计信息
+        self.admitted = 0
+        self.rejected_queue_full = 0
+        self.rejected_timeout = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.total_service = 0.0
+        self.completed = 0
+
+    def retry_after(self) -> int:
+        """根据平均处理时长和当前排队长度估算客户端应等待的秒数"""
+        avg_service = self.total_service / self.completed if self.completed else 1.0
+        backlog = self.waiting + self.active
+        return max(1, math.ceil(avg_service * backlog / self.limit))
+
+    async def acquire(self) -> float:
+        """获取一个执行槽位，返回排队等待的秒数"""
+        start = time.monotonic()
+        if not self._semaphore.locked():
+            # 有空闲槽位时直接获取，不会挂起
+            await self._semaphore.acquire()
+        else:
+            if self.waiting >= self.queue_size:
+                self.rejected_queue_full += 1
+                metrics.ADMISSION_REJECTIONS.inc(lane=self.name, reason="queue_full")
+                raise AdmissionRejected(self.name, 429, self.retry_after(), f"{self.name} 请求队列已满")
+
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(), timeout=self.queue_timeout)
+            except asyncio.TimeoutError:
+                self.rejected_timeout += 1
+                metrics.ADMISSION_REJECTIONS.inc(lane=self.name, reason="timeout")
+                raise AdmissionRejected(self.name, 503, self.retry_after(), f"{self.name} 请求排队超时")
+            finally:
+                self.waiting -= 1
+
+        waited = time.monotonic() - start
+        self.active += 1
+        self.admitted += 1
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+        return waited
+
+    def release(self, service_time: float) -> None:
+        """释放执行槽位并记录处理时长"""
+        self.active -= 1
+        self.completed += 1
+        self.total_service += service_time
+        self._semaphore.release()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "limit": self.limit,
+            "queue_size": self.queue_size,
+            "active": self.active,
+            "queue_depth": self.waiting,
+            "admitted": self.admitted,
+            "rejected_queue_full": self.rejected_queue_full,
+            "rejected_timeout": self.rejected_timeout,
+            "avg_wait_seconds": round(self.total_wait / self.admitted, 4) if self.admitted else 0.0,
+            "max_wait_seconds": round(self.max_wait, 4),
+            "avg_service_seconds": round(self.total_service / self.completed, 4) if self.completed else 0.0,
+        }
+
+
+class ConversationLocks:
+    """按会话ID分配的互斥锁，没有请求持有或等待时自动回收"""
+
+    def __init__(self):
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._refs: Dict[str, int] = {}
+
+    async def acquire(self, conversation_id: str, timeout: float) -> None:
+        lock = self._locks.get(conversation_id)
+        if lock is None:
+            lock = self._locks[conversation_id] = asyncio.Lock()
+        self._refs[conversation_id] = self._refs.get(conversation_id, 0) + 1
+        try:
+            if lock.locked():
+                await asyncio.wait_for(lock.acquire(), timeout=timeout)
+            else:
+                await lock.acquire()
+        except BaseException:
+            self._unref(conversation_id)
+            raise
+
+    def release(self, conversation_id: str) -> None:
+        self._locks[conversation_id].release()
+        self._unref(conversation_id)
+
+    def _unref(self, conversation_id: str) -> None:
+        self._refs[conversation_id] -= 1
+        if self._refs[conversation_id] <= 0:
+            del self._refs[conversation_id]
+            del self._locks[conversation_id]
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+
+class Ticket:
+    """一次准入的凭证，release 可以重复调用"""
+
+    def __init__(self, governor: "ConcurrencyGovernor", lane: Lane, conversation_id: Optional[str], waited: float):
+        self._governor = governor
+        self.lane = lane
+        self.conversation_id = conversation_id
+        self.waited = waited
+        self.admitted_at = time.monotonic()
+        self._released = False
+
+    def release(self) -> None:
+        if self._released:
+            return
+        self._released = True
+        self.lane.release(time.monotonic() - self.admitted_at)
+        if self.conversation_id is not None:
+            self._governor.conversation_locks.release(self.conversation_id)
+
+
+class ConcurrencyGovernor:
+    """管理所有请求通道以及会话级串行化"""
+
+    def __init__(self, limits: Dict[str, int], queue_sizes: Dict[str, int], queue_timeout: float):
+        self.queue_timeout = queue_timeout
+        self.lanes = {
+            name: Lane(name, limit, queue_sizes.get(name, 0), queue_timeout)
+            for name, limit in limits.items()
+        }
+        self.conversation_locks = ConversationLocks()
+
+    async def acquire(self, lane_name: str, conversation_id: Optional[str] = None) -> Ticket:
+        """
+        申请准入
+
+        Args:
+            lane_name: 请求类别（chat/multimodal/text2image）
+            conversation_id: 需要串行写入历史的会话ID；只读请求传 None
+
+        Raises:
+            AdmissionRejected: 队列已满或等待超时
+        """
+        lane = self.lanes[lane_name]
+        start = time.monotonic()
+        if conversation_id is not None:
+            try:
+                await self.conversation_locks.acquire(conversation_id, self.queue_timeout)
+            except asyncio.TimeoutError:
+                lane.rejected_timeout += 1
+                metrics.ADMISSION_REJECTIONS.inc(lane=lane_name, reason="conversation_busy")
+                raise AdmissionRejected(lane_name, 503, lane.retry_after(), "同一会话的上一个请求尚未完成")
+        try:
+            await lane.acquire()
+        except BaseException:
+            if conversation_id is not None:
+                self.conversation_locks.release(conversation_id)
+            raise
+        waited = time.monotonic() - start
+        metrics.ADMISSION_WAIT_SECONDS.observe(waited, lane=lane_name)
+        return Ticket(self, lane, conversation_id, waited)
+
+    async def acquire_background(self, lane_name: str, yield_to: Sequence[str] = ("chat",),
+                                 poll: float = 0.05) -> Ticket:
+        """
+        低优先级地申请准入（批量问答）
+
+        yield_to 中的通道有请求排队时先等待，不与交互请求争抢上游；队列已满或排队超时时按 Retry-After 等待后重试，
+        不把拒绝传给调用方。
+        """
+        while True:
+            while any(self.lanes[name].waiting for name in yield_to if name in self.lanes):
+                await asyncio.sleep(poll)
+            try:
+                return await self.acquire(lane_name)
+            except AdmissionRejected as e:
+                await asyncio.sleep(e.retry_after)
+
+    @asynccontextmanager
+    async def admit(self, lane_name: str, conversation_id: Optional[str] = None):
+        """以上下文管理器形式申请准入，退出时自动释放"""
+        ticket = await self.acquire(lane_name, conversation_id)
+        try:
+            yield ticket
+        finally:
+            ticket.release()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "lanes": {name: lane.stats() for name, lane in self.lanes.items()},
+            "locked_conversations": len(self.conversation_locks),
+        }
+
+
+governor = ConcurrencyGovernor(ADMISSION_LIMITS, ADMISSION_QUEUE_SIZES, ADMISSION_QUEUE_TIMEOUT)
+metrics.ADMISSION_ACTIVE.set_function(lambda: {(name,): lane.active for name, lane in governor.lanes.items()})
+metrics.ADMISSION_QUEUE_DEPTH.set_function(lambda: {(name,): lane.waiting for name, lane in governor.lanes.items()})
+metrics.ADMISSION_LIMIT.set_function(lambda: {(name,): lane.limit for name, lane in governor.lanes.items()})
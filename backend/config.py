@@ -0,0 +1,234 @@
+"""
+服务运行参数
+
+所有可调参数都通过环境变量配置（同样支持写在 .env 文件中），这里统一读取并给出默认值。
+"""
+import logging
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+_logger = logging.getLogger("medical.config")
+
+
+def env_int(name: str, default: int) -> int:
+    """读取整数类型的环境变量，无法解析时使用默认值"""
+    value = os.getenv(name)
+    if value is None or value.strip() == "":
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        _logger.warning("环境变量 %s=%r 不是有效的整数，使用默认值 %s", name, value, default)
+        return default
+
+
+def env_float(name: str, default: float) -> float:
+    """读取浮点类型的环境变量，无法解析时使用默认值"""
+    value = os.getenv(name)
+    if value is None or value.strip() == "":
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        _logger.warning("环境变量 %s=%r 不是有效的数字，使用默认值 %s", name, value, default)
+        return default
+
+
+def env_bool(name: str, default: bool) -> bool:
+    """读取布尔类型的环境变量（1/true/yes/on 视为真）"""
+    value = os.getenv(name)
+    if value is None or value.strip() == "":
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+# 准入控制：每类请求同时占用上游的最大数量，以及排队等待的上限
+# batch 为批量问答的低优先级通道：chat 通道有请求排队时先让出，队列满或排队超时时等待重试而不失败
+ADMISSION_LIMITS = {
+    "chat": env_int("ADMISSION_CHAT_LIMIT", 8),
+    "multimodal": env_int("ADMISSION_MULTIMODAL_LIMIT", 4),
+    "text2image": env_int("ADMISSION_TEXT2IMAGE_LIMIT", 2),
+    "batch": env_int("ADMISSION_BATCH_LIMIT", 2),
+}
+ADMISSION_QUEUE_SIZES = {
+    "chat": env_int("ADMISSION_CHAT_QUEUE", 32),
+    "multimodal": env_int("ADMISSION_MULTIMODAL_QUEUE", 16),
+    "text2image": env_int("ADMISSION_TEXT2IMAGE_QUEUE", 8),
+    "batch": env_int("ADMISSION_BATCH_QUEUE", 16),
+}
+# 排队等待的最长时间（秒），超时返回503
+ADMISSION_QUEUE_TIMEOUT = env_float("ADMISSION_QUEUE_TIMEOUT", 10.0)
+
+# 上游限流：与 DashScope API 配额一致的令牌桶（所有模型共享同一API Key的配额）
+UPSTREAM_RATE_PER_SECOND = env_float("UPSTREAM_RATE_PER_SECOND", 10.0)
+UPSTREAM_BURST = env_int("UPSTREAM_BURST", 20)
+# 等待令牌的最长时间（秒），超过则直接走后备回答
+UPSTREAM_RATE_MAX_WAIT = env_float("UPSTREAM_RATE_MAX_WAIT", 2.0)
+
+# 熔断器：连续失败多少次后打开，打开多久后进入半开状态，半开时允许的探测请求数
+BREAKER_FAILURE_THRESHOLD = env_int("BREAKER_FAILURE_THRESHOLD", 5)
+BREAKER_OPEN_SECONDS = env_float("BREAKER_OPEN_SECONDS", 30.0)
+BREAKER_HALF_OPEN_PROBES = env_int("BREAKER_HALF_OPEN_PROBES", 1)
+
+# 端到端截止时间（秒）：每个请求在检索、生成和后备之间分配的总预算
+DEADLINE_DEFAULTS = {
+    "chat": env_float("DEADLINE_CHAT", 30.0),
+    "chat_stream": env_float("DEADLINE_CHAT_STREAM", 30.0),
+    "multimodal": env_float("DEADLINE_MULTIMODAL", 60.0),
+    "text2image": env_float("DEADLINE_TEXT2IMAGE", 90.0),
+}
+# 客户端可以通过 X-Request-Deadline-Ms 请求头缩短或延长预算，但不超过该上限
+DEADLINE_MAX = env_float("DEADLINE_MAX", 120.0)
+# 各阶段值得尝试的最短剩余时间，不足时直接跳过该阶段
+DEADLINE_MIN_RETRIEVAL = env_float("DEADLINE_MIN_RETRIEVAL", 0.5)
+DEADLINE_MIN_GENERATION = env_float("DEADLINE_MIN_GENERATION", 2.0)
+# 检索和首次生成最多占用剩余预算的比例，其余留给后续阶段
+DEADLINE_RETRIEVAL_SHARE = env_float("DEADLINE_RETRIEVAL_SHARE", 0.2)
+DEADLINE_GENERATION_SHARE = env_float("DEADLINE_GENERATION_SHARE", 0.75)
+# 对冲重试：生成调用超过该时间仍未返回且预算充足时，再并行发起一次相同调用
+DEADLINE_HEDGE_ENABLED = env_bool("DEADLINE_HEDGE_ENABLED", False)
+DEADLINE_HEDGE_DELAY = env_float("DEADLINE_HEDGE_DELAY", 4.0)
+
+# 模型路由：按请求复杂度选择模型档位和输出长度上限
+MODEL_ROUTING_ENABLED = env_bool("MODEL_ROUTING_ENABLED", True)
+TEXT_MODEL_TIERS = {
+    "fast": {
+        "model": os.getenv("MODEL_TIER_FAST", "qwen-turbo"),
+        "max_tokens": env_int("MODEL_TIER_FAST_MAX_TOKENS", 1000),
+    },
+    "standard": {
+        "model": os.getenv("MODEL_TIER_STANDARD", "qwen-plus"),
+        "max_tokens": env_int("MODEL_TIER_STANDARD_MAX_TOKENS", 1500),
+    },
+    "heavy": {
+        "model": os.getenv("MODEL_TIER_HEAVY", "qwen-max"),
+        "max_tokens": env_int("MODEL_TIER_HEAVY_MAX_TOKENS", 2000),
+    },
+}
+MULTIMODAL_MODEL_TIERS = {
+    "fast": {
+        "model": os.getenv("MULTIMODAL_TIER_FAST", "qwen-vl-plus"),
+        "max_tokens": env_int("MULTIMODAL_TIER_FAST_MAX_TOKENS", 600),
+    },
+    "standard": {
+        "model": os.getenv("MULTIMODAL_TIER_STANDARD", "qwen-vl-plus"),
+        "max_tokens": env_int("MULTIMODAL_TIER_STANDARD_MAX_TOKENS", 1000),
+    },
+    "heavy": {
+        "model": os.getenv("MULTIMODAL_TIER_HEAVY", "qwen-vl-max"),
+        "max_tokens": env_int("MULTIMODAL_TIER_HEAVY_MAX_TOKENS", 1500),
+    },
+}
+
+# 日志：级别、是否脱敏、按类别采样（例如 "stream=0.1,chat=1"，只对 DEBUG/INFO 生效）
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_REDACT = env_bool("LOG_REDACT", True)
+LOG_SAMPLING = os.getenv("LOG_SAMPLING", "")
+# 日志队列长度上限，队列满时丢弃新日志而不是阻塞请求
+LOG_QUEUE_SIZE = env_int("LOG_QUEUE_SIZE", 10000)
+
+# 链路追踪：每个请求生成 trace ID 并通过响应头返回，记录各阶段耗时
+TRACE_ENABLED = env_bool("TRACE_ENABLED", True)
+# 对请求做墙钟采样剖析的概率（0~1）
+TRACE_PROFILE_SAMPLE_RATE = env_float("TRACE_PROFILE_SAMPLE_RATE", 0.0)
+# 是否接受请求头 X-Trace-Profile 单独开启剖析（默认关闭，任何客户端都能发送该请求头）；
+# TRACE_PROFILE_TOKEN 不为空时请求头的值必须等于它
+TRACE_PROFILE_HEADER_ENABLED = env_bool("TRACE_PROFILE_HEADER_ENABLED", False)
+TRACE_PROFILE_TOKEN = os.getenv("TRACE_PROFILE_TOKEN", "")
+# 最多保留的剖析结果数，超出时删除最早的结果
+TRACE_PROFILE_MAX_FILES = env_int("TRACE_PROFILE_MAX_FILES", 50)
+# 采样间隔（秒）和剖析结果保存目录
+TRACE_PROFILE_INTERVAL = env_float("TRACE_PROFILE_INTERVAL", 0.005)
+TRACE_PROFILE_DIR = os.getenv(
+    "TRACE_PROFILE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "profiles")
+)
+# 耗时超过该值（秒）的请求以 INFO 级别记录追踪摘要，其余为 DEBUG
+TRACE_SLOW_REQUEST_SECONDS = env_float("TRACE_SLOW_REQUEST_SECONDS", 5.0)
+
+# 知识库文件的候选路径（使用第一个存在的文件）
+KNOWLEDGE_FILES = [
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "full1.md"),
+    "./full1.md",
+]
+# 知识库规范化：分块之前去掉 OCR 留下的 LaTeX 包装、图片引用、表格标签、拆开的数字和多余空白（更改后需要重新构建索引）。
+# 长度不少于 KB_DEDUPE_MIN_CHARS 的段落重复出现时只保留第一次（0 表示不去重）；
+# KB_DROP_SECTIONS 为逗号分隔的章节名称（如 批准文号,执行标准,修订日期），这些章节不参与向量检索，仍可通过说明书字段直查回答
+KB_NORMALIZE = env_bool("KB_NORMALIZE", True)
+KB_DEDUPE_MIN_CHARS = env_int("KB_DEDUPE_MIN_CHARS", 40)
+KB_DROP_SECTIONS = [name.strip() for name in os.getenv("KB_DROP_SECTIONS", "").split(",") if name.strip()]
+
+# 知识库检索（RAG）：是否在启动后于后台构建知识库索引，构建完成前请求直接由模型回答
+RAG_ENABLED = env_bool("RAG_ENABLED", True)
+# 离线构建的索引产物目录（build_index.py 的输出），以及使用的版本（为空时使用目录下 current 指向的版本）
+RAG_INDEX_DIR = os.getenv(
+    "RAG_INDEX_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "indexes")
+)
+RAG_INDEX_VERSION = os.getenv("RAG_INDEX_VERSION", "")
+# 找不到索引产物时是否在启动时调用嵌入模型现场构建。默认关闭：生产节点只加载离线产物，
+# 找不到时直接由模型回答，不会每个 worker 各自付费嵌入整个知识库；仅在开发环境按需开启
+RAG_BUILD_ON_STARTUP = env_bool("RAG_BUILD_ON_STARTUP", False)
+# 检索时使用的向量精度：float32（精确检索）、float16 或 int8（按向量缩放），
+# 低精度时先在紧凑矩阵上粗筛 RAG_RESCORE_CANDIDATES 个候选，再用 float32 向量重新打分
+RAG_INDEX_PRECISION = os.getenv("RAG_INDEX_PRECISION", "float32").strip().lower()
+RAG_RESCORE_CANDIDATES = env_int("RAG_RESCORE_CANDIDATES", 50)
+# 检索的分块数量（上限）；RAG_FETCH_K 大于它时先取 RAG_FETCH_K 个候选，再用最大边际相关性（MMR）选出相关且互不重复的分块，
+# RAG_MMR_LAMBDA 越接近 1 越看重相关性，越接近 0 越看重多样性
+RAG_TOP_K = env_int("RAG_TOP_K", 3)
+RAG_FETCH_K = env_int("RAG_FETCH_K", 8)
+RAG_MMR_LAMBDA = env_float("RAG_MMR_LAMBDA", 0.7)
+# 相似度阈值：最高分低于阈值时不使用参考资料，直接由模型回答；auto 表示使用 build_index.py 构建索引时校准的阈值。
+# 返回的分块数量在 0 到 RAG_TOP_K 之间自适应，相邻分块的分数差超过 RAG_SCORE_GAP 时截断（0 表示不按分差截断）
+RAG_SCORE_THRESHOLD = os.getenv("RAG_SCORE_THRESHOLD", "auto")
+RAG_SCORE_GAP = env_float("RAG_SCORE_GAP", 0.1)
+# 上下文组装：去掉分块之间重叠的文字，并按 token 预算截断（0 表示不限制）；关闭时按原样拼接分块
+RAG_CONTEXT_ASSEMBLY = env_bool("RAG_CONTEXT_ASSEMBLY", True)
+RAG_CONTEXT_TOKEN_BUDGET = env_int("RAG_CONTEXT_TOKEN_BUDGET", 3000)
+# 多查询检索：追问（如“那副作用呢？”）时结合最近几轮提问在本地生成最多 RAG_MULTI_QUERY_VARIANTS 个查询变体，
+# 并发检索后用倒数排名融合（RRF）合并，RAG_RRF_K 越大排名靠后的结果权重下降越慢
+RAG_MULTI_QUERY = env_bool("RAG_MULTI_QUERY", True)
+RAG_MULTI_QUERY_VARIANTS = env_int("RAG_MULTI_QUERY_VARIANTS", 3)
+RAG_RRF_K = env_int("RAG_RRF_K", 60)
+# 使用阿里云提供的文本嵌入模型（更换后需要重新构建索引，查询向量缓存会自动清空）
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-v1")
+# 查询向量缓存：按（嵌入模型, 规范化后的问题）缓存检索时的查询向量，
+# 内存中保留最近使用的 EMBEDDING_CACHE_SIZE 条，磁盘上用 SQLite 持久化并由同一台机器上的 worker 共享（路径为空时只用内存）
+EMBEDDING_CACHE_ENABLED = env_bool("EMBEDDING_CACHE_ENABLED", True)
+EMBEDDING_CACHE_SIZE = env_int("EMBEDDING_CACHE_SIZE", 4096)
+EMBEDDING_CACHE_PATH = os.getenv(
+    "EMBEDDING_CACHE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache", "query_embeddings.sqlite3")
+)
+EMBEDDING_CACHE_MAX_ENTRIES = env_int("EMBEDDING_CACHE_MAX_ENTRIES", 200000)
+# 说明书字段直查：直接询问某个说明书章节（如“用法用量是什么”）的问题以该章节原文作为参考资料，
+# 不调用嵌入接口也不做向量检索；命中章节的总长度超过 LABEL_LOOKUP_MAX_CHARS 时仍走向量检索
+LABEL_LOOKUP_ENABLED = env_bool("LABEL_LOOKUP_ENABLED", True)
+LABEL_LOOKUP_MAX_CHARS = env_int("LABEL_LOOKUP_MAX_CHARS", 4000)
+# 批量问答：所有批次同时处理的问题数上限（也是单个批次的默认并发度）、每批次的速率上限（每秒问题数，0 表示不限速）、
+# 每批次最多的问题数，以及已完成结果的保留时间（秒）和保留的批次数（用于断线后续跑）
+BATCH_CONCURRENCY = env_int("BATCH_CONCURRENCY", 4)
+BATCH_RATE_LIMIT = env_float("BATCH_RATE_LIMIT", 0.0)
+BATCH_MAX_ITEMS = env_int("BATCH_MAX_ITEMS", 5000)
+BATCH_RESULT_TTL = env_float("BATCH_RESULT_TTL", 3600.0)
+BATCH_STORE_SIZE = env_int("BATCH_STORE_SIZE", 64)
+# WebSocket 多路复用连接：空闲时发送心跳的间隔、超过多久没有收到客户端的任何帧就关闭连接（秒），
+# 同一连接上同时进行的请求数上限，以及等待发送的帧数上限（客户端读取太慢、积压超过上限时关闭连接）
+WS_HEARTBEAT_INTERVAL = env_float("WS_HEARTBEAT_INTERVAL", 20.0)
+WS_IDLE_TIMEOUT = env_float("WS_IDLE_TIMEOUT", 60.0)
+WS_MAX_INFLIGHT = env_int("WS_MAX_INFLIGHT", 8)
+WS_SEND_QUEUE_SIZE = env_int("WS_SEND_QUEUE_SIZE", 1000)
+# 输入时预取：前端把输入框中的草稿发到 /api/chat/prefetch，后台提前检索并按会话保存 PREFETCH_TTL 秒；
+# 正式问题与草稿相同或相似度不低于 PREFETCH_SIMILARITY 时直接使用预取的结果。
+# 草稿先等待 PREFETCH_DEBOUNCE 秒再检索（前端已经在停止输入后才发送，这里只合并过快的草稿），少于 PREFETCH_MIN_CHARS 个字的草稿不预取，
+# 同时进行的预取检索不超过 PREFETCH_MAX_CONCURRENCY 个，最多保存 PREFETCH_MAX_ENTRIES 个会话的结果
+PREFETCH_ENABLED = env_bool("PREFETCH_ENABLED", True)
+PREFETCH_TTL = env_float("PREFETCH_TTL", 30.0)
+PREFETCH_SIMILARITY = env_float("PREFETCH_SIMILARITY", 0.85)
+PREFETCH_DEBOUNCE = env_float("PREFETCH_DEBOUNCE", 0.1)
+PREFETCH_MIN_CHARS = env_int("PREFETCH_MIN_CHARS", 4)
+PREFETCH_MAX_CONCURRENCY = env_int("PREFETCH_MAX_CONCURRENCY", 4)
+PREFETCH_MAX_ENTRIES = env_int("PREFETCH_MAX_ENTRIES", 1024)
+# 历史记录分页：/api/history 不带 limit 时返回最近 HISTORY_PAGE_DEFAULT 条消息，limit 最大为 HISTORY_PAGE_MAX
+HISTORY_PAGE_DEFAULT = env_int("HISTORY_PAGE_DEFAULT", 100)
+HISTORY_PAGE_MAX = env_int("HISTORY_PAGE_MAX", 500)
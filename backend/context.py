@@ -0,0 +1,117 @@
+"""
+RAG 上下文组装
+
+检索得到的分块直接拼接会带来两类浪费：相邻分块之间按 chunk_overlap 重复的文字，
+以及超出模型需要的长度（提示越长，首个 token 之前的预填充越慢）。
+这里在拼接前去掉分块之间重叠的文字，再按 token 预算依次装入分块，放不下的分块在段落或句子边界截断。
+
+只依赖标准库，分块对象只需要有 page_content 属性（LangChain 的 Document）。
+"""
+import re
+from typing import Any, Dict, List, Sequence, Tuple
+
+# 分块之间至少重叠这么多字符才视为重复内容，避免误删常见的短句
+MIN_OVERLAP_CHARS = 20
+# 只在分块边界处寻找重叠，长度上限略大于分割器的 chunk_overlap
+MAX_OVERLAP_CHARS = 400
+# 截断后剩余不足这么多 token 的片段不再装入
+MIN_FRAGMENT_TOKENS = 80
+
+_ASCII_RUN = re.compile(r"[\x00-\x7f]+")
+# 截断时优先在段落、换行和句末标点处断开
+_BREAKS = ("\n\n", "\n", "。", "；", "！", "？", ". ")
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    粗略估计 token 数：中文等非 ASCII 字符按每字 1 个 token，ASCII 文本按每 4 个字符 1 个 token
+
+    通义千问的分词器对中文约为每字 0.6~1 个 token，这里取偏保守的估计，保证不超出预算
+    """
+    ascii_chars = sum(len(run) for run in _ASCII_RUN.findall(text))
+    return len(text) - ascii_chars + (ascii_chars + 3) // 4
+
+
+def _boundary_overlap(left: str, right: str) -> int:
+    """left 的结尾与 right 的开头重叠的最大长度（小于 MIN_OVERLAP_CHARS 时返回 0）"""
+    for size in range(min(len(left), len(right), MAX_OVERLAP_CHARS), MIN_OVERLAP_CHARS - 1, -1):
+        if left.endswith(right[:size]):
+            return size
+    return 0
+
+
+def strip_overlaps(texts: Sequence[str]) -> List[str]:
+    """
+    按顺序去掉每个分块中与排在它前面的分块重复的边界文字
+
+    分割器产生的重叠总是出现在分块边界：前一块的结尾与后一块的开头相同，
+    检索结果的顺序可能与原文相反，所以两个方向都要检查。完全包含在已选分块中的分块被整个去掉。
+    """
+    kept: List[str] = []
+    for text in texts:
+        for previous in kept:
+            if not text:
+                break
+            if text in previous:
+                text = ""
+                break
+            head = _boundary_overlap(previous, text)
+            if head:
+                text = text[head:]
+            tail = _boundary_overlap(text, previous)
+            if tail:
+                text = text[:-tail]
+        kept.append(text.strip())
+    return kept
+
+
+def _truncate(text: str, token_budget: int) -> str:
+    """把文本截断到预算以内，尽量在段落或句子边界断开"""
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if estimate_tokens(text[:middle]) <= token_budget:
+            low = middle
+        else:
+            high = middle - 1
+    cut = text[:low]
+    for separator in _BREAKS:
+        position = cut.rfind(separator)
+        if position >= len(cut) // 2:
+            return cut[:position + len(separator)].rstrip()
+    return cut.rstrip()
+
+
+def assemble_context(docs: Sequence[Any], token_budget: int) -> Tuple[str, Dict[str, int]]:
+    """
+    去重并按 token 预算拼接分块，返回（上下文文本, 统计信息）
+
+    docs 按相关性从高到低排列；token_budget <= 0 表示不限制长度。
+    """
+    raw = [doc.page_content for doc in docs]
+    texts = strip_overlaps(raw)
+    parts: List[str] = []
+    used = 0
+    truncated = 0
+    for text in texts:
+        if not text:
+            continue
+        tokens = estimate_tokens(text)
+        if token_budget > 0 and used + tokens > token_budget:
+            remaining = token_budget - used
+            if remaining < MIN_FRAGMENT_TOKENS:
+                break
+            text = _truncate(text, remaining)
+            tokens = estimate_tokens(text)
+            truncated += 1
+        parts.append(text)
+        used += tokens
+    context = "\n\n".join(parts)
+    return context, {
+        "docs": len(raw),
+        "used_docs": len(parts),
+        "truncated_docs": truncated,
+        "raw_chars": sum(len(text) for text in raw) + 2 * max(len(raw) - 1, 0),
+        "context_chars": len(context),
+        "context_tokens": used,
+    }
@@ -0,0 +1,191 @@
+"""
+端到端截止时间预算
+
+每个请求携带一个 Deadline，检索、生成和后备调用按剩余时间分配超时；
+剩余时间不足以完成某个阶段时直接跳过，而不是等到超时再失败。
+请求被取消（例如客户端断开）时也通过 Deadline 通知正在执行的上游调用停止。
+阶段超时、对冲请求落选或等待的任务被取消时，只有这一次尝试的上游调用会被通知停止（见 Deadline.stopped），
+停止原因记录在 resilience.AttemptStop 中，阶段超时计入熔断。
+"""
+import asyncio
+import threading
+import time
+from typing import Any, Awaitable, Callable, List, Optional, Tuple
+
+from config import (
+    DEADLINE_DEFAULTS,
+    DEADLINE_MAX,
+    DEADLINE_MIN_RETRIEVAL,
+    DEADLINE_MIN_GENERATION,
+    DEADLINE_HEDGE_ENABLED,
+    DEADLINE_HEDGE_DELAY,
+)
+from resilience import AttemptStop, GenerationCancelled, current_attempt
+from logger import get_logger
+
+logger = get_logger("deadline")
+
+# 各阶段值得尝试的最短剩余时间
+STAGE_MIN_SECONDS = {
+    "retrieval": DEADLINE_MIN_RETRIEVAL,
+    "generation": DEADLINE_MIN_GENERATION,
+}
+
+DEADLINE_HEADER = "X-Request-Deadline-Ms"
+
+
+class DeadlineExceeded(Exception):
+    """剩余预算不足以执行某个阶段，或阶段执行超时"""
+
+    def __init__(self, stage: str, remaining: float):
+        super().__init__(f"{stage} 阶段预算不足（剩余 {remaining:.2f}s）")
+        self.stage = stage
+        self.remaining = remaining
+
+
+class Deadline:
+    """一个请求的截止时间"""
+
+    def __init__(self, seconds: float, clock: Callable[[], float] = time.monotonic):
+        self._clock = clock
+        self.budget = seconds
+        self.expires_at = clock() + seconds
+        # 线程安全的取消标志，工作线程中的上游调用也能检查
+        self._cancelled = threading.Event()
+
+    @classmethod
+    def for_endpoint(cls, endpoint: str, header_value: Optional[str] = None) -> "Deadline":
+        """按端点默认值创建截止时间，请求头中的毫秒数可以覆盖默认值"""
+        seconds = DEADLINE_DEFAULTS.get(endpoint, DEADLINE_DEFAULTS["chat"])
+        if header_value:
+            try:
+                seconds = float(header_value) / 1000
+            except ValueError:
+                logger.warning("无效的截止时间请求头", header=DEADLINE_HEADER, value=header_value)
+        return cls(min(max(seconds, 0.0), DEADLINE_MAX))
+
+    def cancel(self) -> None:
+        """取消请求，之后的阶段不再执行，正在读取的上游流式响应会尽快停止"""
+        self._cancelled.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - self._clock())
+
+    def stopped(self) -> bool:
+        """请求已取消、截止时间已到，或当前这次阶段尝试已被放弃（阶段超时、对冲落选）"""
+        attempt = current_attempt.get()
+        return self.cancelled or self.remaining() <= 0 or (attempt is not None and attempt.is_set())
+
+    def allows(self, stage: str, reserve: float = 0.0) -> bool:
+        """剩余时间（扣除为后续阶段保留的部分后）是否足够执行该阶段"""
+        return self.remaining() - reserve >= STAGE_MIN_SECONDS.get(stage, 0.0)
+
+    def timeout_for(self, stage: str, share: float = 1.0, reserve: float = 0.0) -> float:
+        """
+        计算该阶段可用的超时时间
+
+        最多使用剩余时间的 share 比例并保留 reserve 秒给后续阶段；
+        如果留下的时间本来就不够后续阶段使用，则把剩余时间全部给当前阶段。
+        """
+        remaining = self.remaining()
+        timeout = min(remaining * share, remaining - reserve)
+        if remaining - timeout < STAGE_MIN_SECONDS["generation"]:
+            timeout = remaining
+        return max(0.0, timeout)
+
+    async def run(
+        self,
+        stage: str,
+        factory: Callable[[], Awaitable[Any]],
+        share: float = 1.0,
+        reserve: float = 0.0,
+        hedge: bool = False,
+    ) -> Any:
+        """
+        在预算内执行一个阶段
+
+        Args:
+            stage: 阶段名称（retrieval/generation）
+            factory: 每次调用返回一个新的协程，对冲重试时会被调用两次
+            share: 最多占用剩余预算的比例
+            reserve: 为后续阶段保留的秒数
+            hedge: 是否允许对冲重试
+
+        Raises:
+            DeadlineExceeded: 预算不足或阶段超时
+            GenerationCancelled: 请求已被取消
+        """
+        if self.cancelled:
+            raise GenerationCancelled(stage)
+        if not self.allows(stage, reserve):
+            raise DeadlineExceeded(stage, self.remaining())
+        timeout = self.timeout_for(stage, share, reserve)
+        hedge_delay = DEADLINE_HEDGE_DELAY if hedge and DEADLINE_HEDGE_ENABLED else None
+        # 只有在对冲请求仍有足够时间完成时才值得发起
+        if hedge_delay is not None and timeout - hedge_delay < STAGE_MIN_SECONDS.get(stage, 0.0):
+            hedge_delay = None
+        attempts: List[Tuple[AttemptStop, "asyncio.Future[Any]"]] = []
+
+        def start() -> "asyncio.Future[Any]":
+            stop = AttemptStop()
+            task = asyncio.ensure_future(_attempt(factory, stop))
+            attempts.append((stop, task))
+            return task
+
+        # 先记录停止原因再取消未完成的尝试，上游调用据此区分阶段超时和取消
+        reason = AttemptStop.CANCELLED
+        try:
+            if hedge_delay is None:
+                done, _ = await asyncio.wait([start()], timeout=timeout)
+                if not done:
+                    raise asyncio.TimeoutError()
+                result = done.pop().result()
+            else:
+                result = await _hedged(start, hedge_delay, timeout)
+            reason = AttemptStop.SUPERSEDED
+            return result
+        except asyncio.TimeoutError:
+            reason = AttemptStop.TIMEOUT
+            raise DeadlineExceeded(stage, self.remaining())
+        finally:
+            # 超时、落选或被取消的尝试在工作线程中停止读取上游，已完成的尝试不受影响
+            for stop, task in attempts:
+                stop.stop(reason)
+                task.cancel()
+
+
+async def _attempt(factory: Callable[[], Awaitable[Any]], stop: AttemptStop) -> Any:
+    """在独立的任务中执行一次阶段尝试，尝试内的上游调用通过 Deadline.stopped 检查 stop"""
+    current_attempt.set(stop)
+    return await factory()
+
+
+async def _hedged(start: Callable[[], "asyncio.Future[Any]"], delay: float, timeout: float) -> Any:
+    """先发起一次调用，超过 delay 仍未完成时再发起一次，返回先成功的结果；未完成的调用由调用方停止"""
+    loop = asyncio.get_running_loop()
+    end = loop.time() + timeout
+    pending = {start()}
+    hedged = False
+    last_error: Optional[BaseException] = None
+    while pending:
+        now = loop.time()
+        if now >= end:
+            raise asyncio.TimeoutError()
+        wait = end - now if hedged else min(end - now, delay)
+        done, pending = await asyncio.wait(pending, timeout=wait, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            if task.exception() is None:
+                return task.result()
+            last_error = task.exception()
+        if not done and not hedged:
+            logger.info("发起对冲请求", hedge_delay=delay)
+            pending.add(start())
+            hedged = True
+        elif not pending and not hedged:
+            # 首次调用在对冲前就失败了，交给调用方的后备逻辑处理
+            break
+    raise last_error
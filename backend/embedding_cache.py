@@ -0,0 +1,251 @@
+"""
+查询向量缓存
+
+同一个问题每次检索都要调用一次嵌入接口，而常见问题会被反复提出。这里按（嵌入模型, 规范化后的问题文本）
+缓存查询向量，分两层：
+- 内存层：每个进程内的 LRU，命中时不需要任何 I/O
+- 磁盘层：SQLite 文件（WAL 模式），服务重启后仍然有效，同一台机器上的多个 worker 共享
+
+磁盘中记录了写入时使用的嵌入模型，打开时发现模型已更换就清空旧的向量；键中同样包含模型名称，
+不同模型的向量不会混用。磁盘不可用时（只读文件系统、文件损坏等）退化为只使用内存层。
+
+只依赖标准库，向量以 float32 字节保存。
+"""
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from array import array
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+from config import (
+    EMBEDDING_CACHE_ENABLED,
+    EMBEDDING_CACHE_SIZE,
+    EMBEDDING_CACHE_PATH,
+    EMBEDDING_CACHE_MAX_ENTRIES,
+    EMBEDDING_MODEL,
+)
+from logger import get_logger
+import metrics
+
+cache_logger = get_logger("rag")
+
+# 规范化规则变化时递增，旧规则生成的键自然失效
+KEY_VERSION = 1
+# 每写入这么多条检查一次磁盘条目数，超出上限时删除最久未使用的条目
+PRUNE_INTERVAL = 256
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_query(text: str) -> str:
+    """规范化问题文本：统一全角/半角（NFKC）、合并连续空白并去掉首尾空白"""
+    return _WHITESPACE.sub(" ", unicodedata.normalize("NFKC", text)).strip()
+
+
+class QueryEmbeddingCache:
+    """两层查询向量缓存，所有方法都是线程安全的"""
+
+    def __init__(self, model: str, capacity: int, path: str = "", max_entries: int = 0):
+        self.model = model
+        self.capacity = max(0, capacity)
+        self.path = path
+        self.max_entries = max_entries
+        self._memory: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        self._writes = 0
+        # 统计信息
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.disk_errors = 0
+        if path:
+            self._open(path)
+
+    def _open(self, path: str) -> None:
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            db = sqlite3.connect(path, timeout=5.0, check_same_thread=False, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS query_embeddings ("
+                "key TEXT PRIMARY KEY, model TEXT NOT NULL, dim INTEGER NOT NULL, "
+                "vector BLOB NOT NULL, last_used REAL NOT NULL)"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS query_embeddings_last_used ON query_embeddings (last_used)")
+            row = db.execute("SELECT value FROM meta WHERE name = 'model'").fetchone()
+            if row is None or row[0] != self.model:
+                # 嵌入模型更换后旧向量与新模型的向量空间不同，全部作废
+                removed = db.execute("DELETE FROM query_embeddings WHERE model != ?", (self.model,)).rowcount
+                db.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('model', ?)", (self.model,))
+                if row is not None:
+                    cache_logger.info("嵌入模型已更换，清空查询向量缓存",
+                                      previous=row[0], model=self.model, removed=removed)
+            self._db = db
+        except sqlite3.Error as e:
+            cache_logger.warning("查询向量磁盘缓存不可用，只使用内存缓存", path=path, error=str(e))
+            self._db = None
+
+    def key(self, text: str) -> str:
+        raw = f"{KEY_VERSION}\0{self.model}\0{normalize_query(text)}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, text: str) -> Optional[List[float]]:
+        key = self.key(text)
+        with self._lock:
+            vector = self._memory.get(key)
+            if vector is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                metrics.CACHE_HITS.inc(cache="query_embedding_memory")
+                return vector
+            vector = self._disk_get(key)
+            if vector is not None:
+                self._remember(key, vector)
+                self.disk_hits += 1
+                metrics.CACHE_HITS.inc(cache="query_embedding_disk")
+                return vector
+            self.misses += 1
+            metrics.CACHE_MISSES.inc(cache="query_embedding")
+            return None
+
+    def in_memory(self, text: str) -> bool:
+        """内存层是否已有该问题的向量（不计入命中统计，不访问磁盘）"""
+        key = self.key(text)
+        with self._lock:
+            return key in self._memory
+
+    def put(self, text: str, vector: List[float]) -> None:
+        key = self.key(text)
+        with self._lock:
+            self._remember(key, vector)
+            self._disk_put(key, vector)
+
+    def _remember(self, key: str, vector: List[float]) -> None:
+        if self.capacity <= 0:
+            return
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.capacity:
+            self._memory.popitem(last=False)
+
+    def _disk_get(self, key: str) -> Optional[List[float]]:
+        if self._db is None:
+            return None
+        try:
+            row = self._db.execute(
+                "SELECT dim, vector FROM query_embeddings WHERE key = ? AND model = ?", (key, self.model)
+            ).fetchone()
+            if row is None:
+                return None
+            self._db.execute("UPDATE query_embeddings SET last_used = ? WHERE key = ?", (time.time(), key))
+        except sqlite3.Error as e:
+            self._disk_failed(e)
+            return None
+        vector = array("f")
+        vector.frombytes(row[1])
+        if len(vector) != row[0]:
+            return None
+        return vector.tolist()
+
+    def _disk_put(self, key: str, vector: List[float]) -> None:
+        if self._db is None:
+            return
+        try:
+            self._db.execute(
+                "INSERT OR REPLACE INTO query_embeddings (key, model, dim, vector, last_used) VALUES (?, ?, ?, ?, ?)",
+                (key, self.model, len(vector), array("f", vector).tobytes(), time.time()),
+            )
+            self._writes += 1
+            if self.max_entries > 0 and self._writes % PRUNE_INTERVAL == 0:
+                self._prune()
+        except sqlite3.Error as e:
+            self._disk_failed(e)
+
+    def _prune(self) -> None:
+        count = self._db.execute("SELECT COUNT(*) FROM query_embeddings").fetchone()[0]
+        if count > self.max_entries:
+            self._db.execute(
+                "DELETE FROM query_embeddings WHERE key IN "
+                "(SELECT key FROM query_embeddings ORDER BY last_used LIMIT ?)",
+                (count - self.max_entries,),
+            )
+
+    def _disk_failed(self, error: Exception) -> None:
+        # 磁盘错误不影响检索，只计数并记录日志（例如其他进程长时间持有写锁）
+        self.disk_errors += 1
+        cache_logger.warning("查询向量磁盘缓存读写失败", error=str(error))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._memory.clear()
+            if self._db is not None:
+                try:
+                    self._db.execute("DELETE FROM query_embeddings")
+                except sqlite3.Error as e:
+                    self._disk_failed(e)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            disk_entries = None
+            if self._db is not None:
+                try:
+                    disk_entries = self._db.execute("SELECT COUNT(*) FROM query_embeddings").fetchone()[0]
+                except sqlite3.Error:
+                    pass
+            return {
+                "model": self.model,
+                "memory_entries": len(self._memory),
+                "memory_capacity": self.capacity,
+                "disk_path": self.path if self._db is not None else None,
+                "disk_entries": disk_entries,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "disk_errors": self.disk_errors,
+                "hit_rate": round((self.memory_hits + self.disk_hits) / lookups, 4) if lookups else None,
+            }
+
+
+_cache: Optional[QueryEmbeddingCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_cache() -> Optional[QueryEmbeddingCache]:
+    """进程内共享的查询向量缓存，关闭缓存时返回 None"""
+    global _cache
+    if not EMBEDDING_CACHE_ENABLED:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = QueryEmbeddingCache(EMBEDDING_MODEL, EMBEDDING_CACHE_SIZE, EMBEDDING_CACHE_PATH,
+                                         EMBEDDING_CACHE_MAX_ENTRIES)
+        return _cache
+
+
+def stats() -> Dict[str, Any]:
+    if not EMBEDDING_CACHE_ENABLED:
+        return {"enabled": False}
+    # 尚未创建时不为了查询统计而打开数据库
+    if _cache is None:
+        return {"enabled": True, "created": False}
+    return {"enabled": True, "created": True, **_cache.stats()}
+
+
+def close() -> None:
+    if _cache is not None:
+        _cache.close()
@@ -0,0 +1,166 @@
+"""
+会话历史的紧凑表示
+
+原来每条消息是一个包含 4~5 个字符串键的字典，时间戳是格式化好的 ISO 字符串；各个接口每次请求还要把历史
+复制成新的字典列表（messages.copy()、聊天历史转换循环）。这里改为：
+- ChatMessage：带 __slots__ 的记录，角色字符串驻留（sys.intern），时间戳为 epoch 浮点数
+- Conversation：每个会话一个只追加的消息数组
+- HistoryView：数组某一段的只读视图，切片仍是视图，不复制消息。smart_answer 和 call_dashscope_multimodal
+  直接接收视图；由于数组只追加，视图创建后追加的新消息不会出现在视图中
+
+只在返回给客户端时（/api/history）才把消息转换成原来的字典格式，时间戳仍为 ISO 字符串。
+消息在数组中的下标就是它的序号（seq），只追加不会改变，/api/history 按序号分页，并用会话的
+创建时刻和消息数生成 ETag。
+"""
+import sys
+import time
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
+USER = sys.intern("user")
+ASSISTANT = sys.intern("assistant")
+
+
+class ChatMessage:
+    """会话中的一条消息"""
+
+    __slots__ = ("role", "content", "timestamp", "image_url", "truncated")
+
+    def __init__(self, role: str, content: str, timestamp: Optional[float] = None,
+                 image_url: Optional[str] = None, truncated: bool = False):
+        self.role = sys.intern(role)
+        self.content = content
+        self.timestamp = time.time() if timestamp is None else timestamp
+        self.image_url = image_url
+        self.truncated = truncated
+
+    def to_dict(self, seq: Optional[int] = None) -> Dict[str, Any]:
+        """转换成接口返回的字典格式，没有图片和未截断时不输出对应的键，给出 seq 时带上消息序号"""
+        message: Dict[str, Any] = {
+            "role": self.role,
+            "content": self.content,
+            "timestamp": datetime.fromtimestamp(self.timestamp).isoformat(),
+        }
+        if self.image_url is not None:
+            message["image_url"] = self.image_url
+        if self.truncated:
+            message["truncated"] = True
+        if seq is not None:
+            message["seq"] = seq
+        return message
+
+
+class HistoryView(Sequence):
+    """消息数组中 [start, stop) 一段的只读视图"""
+
+    __slots__ = ("_items", "_start", "_stop")
+
+    def __init__(self, items: List[Any], start: int = 0, stop: Optional[int] = None):
+        self._items = items
+        self._start = start
+        self._stop = len(items) if stop is None else stop
+
+    def __len__(self) -> int:
+        return self._stop - self._start
+
+    def __getitem__(self, index: Union[int, slice]) -> Any:
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+            return HistoryView(self._items, self._start + start, self._start + max(start, stop))
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("history index out of range")
+        return self._items[self._start + index]
+
+    def __iter__(self) -> Iterator[Any]:
+        items = self._items
+        for i in range(self._start, self._stop):
+            yield items[i]
+
+    def __reversed__(self) -> Iterator[Any]:
+        items = self._items
+        for i in range(self._stop - 1, self._start - 1, -1):
+            yield items[i]
+
+    def __repr__(self) -> str:
+        return f"HistoryView({len(self)} messages)"
+
+
+class Conversation:
+    """一个会话的只追加消息数组"""
+
+    __slots__ = ("messages", "created")
+
+    def __init__(self):
+        self.messages: List[ChatMessage] = []
+        # 创建时刻（纳秒），服务重启后以相同 ID 重新创建的会话 ETag 不同
+        self.created = time.time_ns()
+
+    def __len__(self) -> int:
+        return len(self.messages)
+
+    def append(self, role: str, content: str, image_url: Optional[str] = None,
+               truncated: bool = False, timestamp: Optional[float] = None) -> ChatMessage:
+        message = ChatMessage(role, content, timestamp, image_url, truncated)
+        self.messages.append(message)
+        return message
+
+    def view(self, last: int = 0) -> HistoryView:
+        """当前全部消息（last > 0 时为最近 last 条）的视图"""
+        stop = len(self.messages)
+        start = max(0, stop - last) if last > 0 else 0
+        return HistoryView(self.messages, start, stop)
+
+    def last_user_message(self) -> Optional[ChatMessage]:
+        for message in reversed(self.messages):
+            if message.role == USER:
+                return message
+        return None
+
+    @property
+    def last_seq(self) -> int:
+        """最后一条消息的序号，没有消息时为 -1"""
+        return len(self.messages) - 1
+
+    def etag(self, before: Optional[int] = None, after: Optional[int] = None, limit: int = 0) -> str:
+        """
+        弱 ETag：消息只追加，创建时刻和最后一条消息的序号相同时历史没有变化；
+        分页参数也计入，不同页的响应不会共用同一个 ETag
+        """
+        page = f"{'' if before is None else before}:{'' if after is None else after}:{limit}"
+        return f'W/"{self.created:x}-{self.last_seq + 1}-{page}"'
+
+    def page(self, before: Optional[int] = None, after: Optional[int] = None, limit: int = 0) -> Tuple[int, int]:
+        """
+        按序号分页，返回消息数组中 [start, stop) 的范围，before 和 after 都不包含在内
+
+        只给 after 时取 after 之后最早的 limit 条（拉取新消息），否则取范围内最近的 limit 条（向前翻页）；
+        limit <= 0 时不限制条数。
+        """
+        total = len(self.messages)
+        start = 0 if after is None else max(0, min(total, after + 1))
+        stop = total if before is None else max(start, min(total, before))
+        if 0 < limit < stop - start:
+            if after is not None and before is None:
+                stop = start + limit
+            else:
+                start = stop - limit
+        return start, stop
+
+    def to_list(self, start: int = 0, stop: Optional[int] = None) -> List[Dict[str, Any]]:
+        """[start, stop) 范围内的消息，每条带上序号"""
+        messages = self.messages
+        stop = len(messages) if stop is None else stop
+        return [messages[seq].to_dict(seq) for seq in range(start, stop)]
+
+
+def role_and_content(message: Any) -> Optional[Tuple[str, str]]:
+    """读取消息的角色和内容，支持 ChatMessage、请求中的 Message 模型和字典，无法识别时返回 None"""
+    if isinstance(message, dict):
+        return message.get("role", ""), message.get("content", "")
+    if hasattr(message, "role") and hasattr(message, "content"):
+        return message.role, message.content
+    return None
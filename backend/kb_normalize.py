@@ -0,0 +1,186 @@
+"""
+知识库文本规范化
+
+full1.md 由说明书 PDF 经 OCR 转换而来，带有大量对检索和回答都没有用的字符：
+- 拆开的数字：“2 0 2 2   年  1 0   月”
+- LaTeX 公式包装：“$300\\mathrm{mg}$”、“$\\geq50\\mathrm{kg}$”
+- 图片引用：“![](images/<64 位哈希>.jpg)”
+- HTML 表格标签：“<html><body><table><tr><td rowspan="2">”
+- 连续的空格、全角标点前的空格和多余的空行
+这些字符原来都会被嵌入，检索命中后又作为参考资料发给大模型。rag.load_documents 在分块之前调用
+normalize_knowledge 清理它们，并可以：
+- 去掉重复出现的段落（OCR 时重复的说明文字、多份说明书共有的提示语），只保留第一次出现的位置
+- 按章节名称去掉不需要检索的章节（KB_DROP_SECTIONS，例如【批准文号】、修订日期），
+  这些章节仍然可以通过说明书字段直查（label_fields）回答
+
+clean_fragment 只做不依赖上下文的逐行清理，说明书字段索引和基准中的标注原文使用它，与分块得到相同的文字。
+
+只依赖标准库。
+"""
+import re
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+# 说明书标题之前的核准日期和修改日期（不是【】章节），label_fields 中也以这个名称作为字段
+REVISION_SECTION = "修订日期"
+
+_INLINE_MATH = re.compile(r"\$([^$\n]+)\$")
+# 只保留参数的格式命令，例如 \mathrm{mg} -> mg
+_STYLE_COMMAND = re.compile(
+    r"\\(?:mathrm|mathbf|mathsf|mathtt|mathfrak|mathit|textrm|textbf|text|boldsymbol|pmb|underline|"
+    r"widetilde|tilde|hat|ddot|bar|smash|ensuremath|operatorname)\s*\{([^{}]*)\}"
+)
+# 整个去掉的命令
+_DROP_COMMAND = re.compile(r"\\phantom\s*\{[^{}]*\}|\\(?:left|right|bf|rm|it|scriptstyle|small|displaystyle)\b")
+# 转换成对应字符的符号命令，其余命令去掉反斜杠保留名称
+SYMBOLS = {
+    "geq": "≥", "geqslant": "≥", "ge": "≥", "leq": "≤", "leqslant": "≤", "le": "≤",
+    "pm": "±", "times": "×", "cdot": "·", "bullet": "•", "circ": "°", "sim": "~", "ast": "*",
+    "mu": "μ", "upmu": "μ", "upmug": "μg", "alpha": "α", "upalpha": "α", "beta": "β", "upbeta": "β",
+    "gamma": "γ", "kappa": "κ", "rho": "ρ", "tau": "τ", "zeta": "ζ", "Psi": "Ψ", "Phi": "Φ",
+    "Omega": "Ω", "varLambda": "Λ", "Lambda": "Λ", "sum": "∑", "lor": "∨", "AA": "Å", "jmath": "j",
+    "%": "%", ",": "", ";": "", "!": "", " ": " ",
+}
+_SYMBOL_COMMAND = re.compile(r"\\([A-Za-z]+|[%,;! ])")
+_IMAGE = re.compile(r"!\[[^\]\n]*\]\([^)\n]*\)")
+_TABLE = re.compile(r"(?:<html>\s*<body>\s*)?<table>(.*?)</table>(?:\s*</body>\s*</html>)?", re.DOTALL)
+_ROW = re.compile(r"<tr>(.*?)</tr>", re.DOTALL)
+_CELL = re.compile(r"<t[dh][^>]*>(.*?)</t[dh]>", re.DOTALL)
+# 被空格拆开的单个数字：“2 0 2 2” -> “2022”，不处理 “6.1 6.5” 这类用空格分隔的小数
+_SPACED_DIGITS = re.compile(r"(?<![\d.])\d(?: +\d)+(?![\d.])")
+_SPACES = re.compile(r"[ \t\u3000\xa0]+")
+# 全角标点前后的空格（左括号只去掉后面的空格，保留 “# 【章节】” 标题中 # 后的空格）
+_SPACE_AROUND_CJK_PUNCT = re.compile(r" *([，。；：、！？）】」]) *|([（【「]) +")
+_BLANK_LINES = re.compile(r"\n{3,}")
+_HEADING = re.compile(r"^#{1,6}\s")
+_SECTION_HEADING = re.compile(r"^#\s*【(.+?)】", re.MULTILINE)
+_TITLE = re.compile(r"^#\s*.+?说明书\s*$", re.MULTILINE)
+
+
+def _strip_math(match: "re.Match[str]", stats: Dict[str, int]) -> str:
+    stats["latex_spans"] += 1
+    body = match.group(1)
+    for _ in range(3):  # 嵌套的 \mathbf{\mathrm{...}}
+        body = _STYLE_COMMAND.sub(r"\1", body)
+    body = _DROP_COMMAND.sub("", body)
+    body = _SYMBOL_COMMAND.sub(lambda m: SYMBOLS.get(m.group(1), m.group(1)), body)
+    body = re.sub(r"[{}^_]", "", body).replace("~", " ")
+    return body.strip()
+
+
+def _flatten_table(match: "re.Match[str]", stats: Dict[str, int]) -> str:
+    """HTML 表格改为每行一条、单元格以 | 分隔的文字"""
+    stats["tables"] += 1
+    rows = []
+    for row in _ROW.findall(match.group(1)):
+        cells = [_SPACES.sub(" ", cell).strip() for cell in _CELL.findall(row)]
+        if any(cells):
+            rows.append(" | ".join(cells))
+    return "\n".join(rows)
+
+
+def _clean(text: str, stats: Dict[str, int]) -> str:
+    text = text.replace("\r\n", "\n").replace("\r", "\n")
+    text = _INLINE_MATH.sub(lambda m: _strip_math(m, stats), text)
+
+    def drop_image(match: "re.Match[str]") -> str:
+        stats["images"] += 1
+        return ""
+
+    text = _IMAGE.sub(drop_image, text)
+    text = _TABLE.sub(lambda m: _flatten_table(m, stats), text)
+
+    def join_digits(match: "re.Match[str]") -> str:
+        stats["spaced_numbers"] += 1
+        return match.group(0).replace(" ", "")
+
+    text = _SPACED_DIGITS.sub(join_digits, text)
+    lines = []
+    for line in text.split("\n"):
+        line = _SPACES.sub(" ", line).strip()
+        line = _SPACE_AROUND_CJK_PUNCT.sub(lambda m: m.group(1) or m.group(2), line)
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def _new_stats() -> Dict[str, int]:
+    return {"latex_spans": 0, "images": 0, "tables": 0, "spaced_numbers": 0}
+
+
+def clean_fragment(text: str) -> str:
+    """逐行清理一段文字（LaTeX、图片引用、表格标签、拆开的数字和多余空白），不去重也不删章节"""
+    return _clean(text, _new_stats())
+
+
+def _drop_sections(text: str, names: Sequence[str]) -> Tuple[str, List[str]]:
+    """去掉指定名称的【章节】（到下一个【章节】标题为止）；REVISION_SECTION 指说明书标题之前的修订日期"""
+    wanted = {name.strip() for name in names if name.strip()}
+    if not wanted:
+        return text, []
+    dropped: List[str] = []
+    spans: List[Tuple[int, int]] = []
+    title = _TITLE.search(text)
+    if REVISION_SECTION in wanted and title and text[:title.start()].strip():
+        spans.append((0, title.start()))
+        dropped.append(REVISION_SECTION)
+    headings = list(_SECTION_HEADING.finditer(text))
+    for heading, following in zip(headings, headings[1:] + [None]):
+        name = heading.group(1).strip()
+        if name in wanted:
+            spans.append((heading.start(), following.start() if following else len(text)))
+            dropped.append(name)
+    parts, position = [], 0
+    for start, end in spans:
+        parts.append(text[position:start])
+        position = end
+    parts.append(text[position:])
+    return "".join(parts), dropped
+
+
+def _dedupe_blocks(text: str, min_chars: int) -> Tuple[str, int]:
+    """去掉重复出现的段落（按空行分隔，标题和短段落除外），保留第一次出现的位置"""
+    if min_chars <= 0:
+        return text, 0
+    seen = set()
+    kept, removed = [], 0
+    for block in text.split("\n\n"):
+        key = block.strip()
+        if len(key) >= min_chars and not _HEADING.match(key):
+            if key in seen:
+                removed += 1
+                continue
+            seen.add(key)
+        kept.append(block)
+    return "\n\n".join(kept), removed
+
+
+def normalize_knowledge(text: str, drop_sections: Sequence[str] = (),
+                        dedupe_min_chars: int = 40) -> Tuple[str, Dict[str, Any]]:
+    """
+    规范化一份知识库文本，返回（规范化后的文本, 统计）
+
+    统计包含规范化前后的字符数和各个步骤处理的数量，写入索引清单并由 build_index.py 输出。
+    """
+    stats: Dict[str, Any] = _new_stats()
+    chars_before = len(text)
+    text = _clean(text, stats)
+    text, stats["dropped_sections"] = _drop_sections(text, drop_sections)
+    text = _BLANK_LINES.sub("\n\n", text)
+    text, stats["duplicate_blocks"] = _dedupe_blocks(text, dedupe_min_chars)
+    text = _BLANK_LINES.sub("\n\n", text).strip() + "\n"
+    stats["chars_before"] = chars_before
+    stats["chars_after"] = len(text)
+    return text, stats
+
+
+def merge_stats(items: Sequence[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """合并多份文档的统计"""
+    if not items:
+        return None
+    merged: Dict[str, Any] = {}
+    for stats in items:
+        for key, value in stats.items():
+            if isinstance(value, list):
+                merged.setdefault(key, []).extend(value)
+            else:
+                merged[key] = merged.get(key, 0) + value
+    return merged
@@ -0,0 +1,210 @@
+"""
+药品说明书字段索引
+
+知识库中的说明书按【用法用量】、【不良反应】等章节组织。这里把说明书解析成按（药品, 章节）索引的字段，
+并用关键词规则识别直接询问某个章节的问题（例如“用法用量是什么”）：命中时把该章节原文作为唯一的参考资料，
+不需要调用嵌入接口，也不需要向量检索。
+
+规则只在意图明确时命中，避免把一般健康问题或其他药品的问题当成说明书查询：
+- 问题提到了药品（通用名、商品名、英文名或“这个药”、“说明书”等指代）时，章节名称和口语化的说法（如“怎么用”）都可以命中
+- 没有提到药品时，只接受只由章节名称和“是什么”、“有哪些”之类的虚词组成的问题，例如“用法用量是什么”、“孕妇可以用吗”
+没有命中、命中的章节过长（如【临床试验】）或同时提到多个药品时返回空列表，由向量检索处理。
+
+只依赖标准库。
+"""
+import os
+import re
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from config import LABEL_LOOKUP_MAX_CHARS, KB_NORMALIZE
+from kb_normalize import REVISION_SECTION, clean_fragment
+from logger import get_logger
+
+label_logger = get_logger("rag")
+
+# 章节 -> (明确的说法, 需要同时提到药品名称的口语化说法)
+SECTION_INTENTS: Dict[str, Tuple[Tuple[str, ...], Tuple[str, ...]]] = {
+    "药品名称": (("药品名称", "通用名", "商品名", "英文名"), ("叫什么",)),
+    "成份": (("成份", "成分", "辅料"), ("含有什么", "含什么")),
+    "性状": (("性状",), ("外观", "什么颜色")),
+    "适应症": (("适应症", "适应证", "主治"), ("治疗什么", "治什么", "用于什么", "治哪些")),
+    "规格": (("规格",), ("多少毫克", "一支多少")),
+    "用法用量": (("用法用量", "用法", "用量", "剂量", "给药"), ("怎么用", "如何使用", "怎么打", "多久打一次", "打几针")),
+    "不良反应": (("不良反应", "副作用"), ()),
+    "禁忌": (("禁忌", "禁用"), ("不能用", "不能使用")),
+    "注意事项": (("注意事项",), ("注意什么", "要注意")),
+    "孕妇及哺乳期妇女用药": (("孕妇", "怀孕", "妊娠", "哺乳", "备孕"), ()),
+    "儿童用药": (("儿童用药",), ("小孩能用", "儿童能用", "孩子能用")),
+    "老年用药": (("老年用药", "老年患者", "老年人"), ()),
+    "药物相互作用": (("相互作用", "合用", "联用"), ("一起用", "同时使用")),
+    "药物过量": (("药物过量", "用药过量"), ("过量",)),
+    "药理毒理": (("药理毒理", "药理作用", "作用机制", "毒理"), ()),
+    "药代动力学": (("药代动力学", "药动学", "半衰期"), ()),
+    "贮藏": (("贮藏", "储存", "储藏"), ("保存", "冷藏", "怎么放", "放冰箱")),
+    "有效期": (("有效期", "保质期"), ()),
+    "执行标准": (("执行标准",), ()),
+    "批准文号": (("批准文号", "国药准字"), ()),
+    "上市许可持有人": (("上市许可持有人",), ()),
+    "生产企业": (("生产企业", "生产厂家", "厂家"), ("哪里生产",)),
+    "境内联系人/境内责任人": (("境内联系人", "境内责任人"), ()),
+    REVISION_SECTION: (("修订", "修改日期", "核准日期", "更新日期"), ("最新版本",)),
+}
+
+_SECTION_HEADING = re.compile(r"^#\s*【(.+?)】(.*)$", re.MULTILINE)
+_TITLE = re.compile(r"^#\s*(.+?说明书)\s*$", re.MULTILINE)
+_LATEX_COMMAND = re.compile(r"\\[a-zA-Z]+\{([^{}]*)\}")
+_DIGIT_SPACES = re.compile(r"(?<=\d) +(?=\d)")
+_BRAND_NAMES = re.compile(r"商品名称：(.*?)(?:英文名称|汉语拼音|$)", re.MULTILINE)
+_ENGLISH_NAME = re.compile(r"英文名称：\s*([A-Za-z]+)")
+_NAME_SEPARATORS = re.compile(r"[®™，,、；;\s]+")
+# 指代当前药品的说法
+DEICTIC_WORDS = ("这个药", "这药", "该药", "此药", "本品", "本药", "说明书")
+# 没有提到药品时，问题除章节关键词外只能包含这些虚词
+_FILLER = re.compile(
+    r"请问|请|告诉我|介绍一下|介绍|说一下|一下|有哪些|有什么|是什么|是多少|是哪些|怎么样|如何|多少|什么|哪些|"
+    r"多长时间|多久|条件|要求|情况|怎么|哪里|可以|能否|能不能|能|吗|呢|吧|啊|的|和|与|及|用|是|有|[？?。！!，,、\s]"
+)
+
+
+class LabelField:
+    """说明书中的一个字段"""
+
+    __slots__ = ("drug", "section", "title", "text")
+
+    def __init__(self, drug: str, section: str, title: str, text: str):
+        self.drug = drug
+        self.section = section
+        self.title = title
+        self.text = text
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+def _clean_heading(text: str) -> str:
+    """去掉标题中的 LaTeX 标记，例如 $\\mathbf{300}\\mathbf{mg}$ -> 300mg"""
+    text = _LATEX_COMMAND.sub(r"\1", text).replace("$", "")
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def parse_label(text: str) -> List[LabelField]:
+    """把一份 Markdown 格式的说明书解析成字段列表，找不到“XX说明书”标题时返回空列表"""
+    title = _TITLE.search(text)
+    if not title:
+        return []
+    drug = title.group(1)[:-len("说明书")].strip()
+    fields = []
+    header = text[:title.start()].strip()
+    if header:
+        header = _DIGIT_SPACES.sub("", _LATEX_COMMAND.sub(r"\1", header).replace("$", ""))
+        fields.append(LabelField(drug, REVISION_SECTION, REVISION_SECTION, header))
+
+    headings = list(_SECTION_HEADING.finditer(text))
+    for heading, following in zip(headings, headings[1:] + [None]):
+        body = text[heading.end():following.start() if following else len(text)].strip()
+        # 【药理毒理】药理作用：标题后面的文字属于正文
+        rest = heading.group(2).strip()
+        if rest:
+            body = f"{rest}\n{body}"
+        section = _clean_heading(heading.group(1))
+        fields.append(LabelField(drug, section, f"【{section}】", body))
+    return fields
+
+
+class FieldIndex:
+    """按（药品, 章节）索引的说明书字段，以及识别直接询问某个章节的问题的规则"""
+
+    def __init__(self, fields: Sequence[LabelField], max_chars: int = LABEL_LOOKUP_MAX_CHARS):
+        self.max_chars = max_chars
+        self.fields: Dict[Tuple[str, str], LabelField] = {}
+        # 药品名称及其别名（商品名、英文名、去掉剂型后的通用名）
+        self.aliases: Dict[str, str] = {}
+        for field in fields:
+            self.fields[(field.drug, field.section)] = field
+            self.aliases[field.drug] = field.drug
+            for suffix in ("注射液", "注射剂", "片", "胶囊", "颗粒"):
+                if field.drug.endswith(suffix) and len(field.drug) > len(suffix) + 1:
+                    self.aliases[field.drug[:-len(suffix)]] = field.drug
+            if field.section == "药品名称":
+                brands = _BRAND_NAMES.search(field.text)
+                english = _ENGLISH_NAME.search(field.text)
+                names = _NAME_SEPARATORS.split(brands.group(1)) if brands else []
+                names += [english.group(1)] if english else []
+                for name in names:
+                    if len(name) >= 2:
+                        self.aliases[name.lower()] = field.drug
+        self.drugs = sorted(set(self.aliases.values()))
+
+    def __len__(self) -> int:
+        return len(self.fields)
+
+    def get(self, drug: str, section: str) -> Optional[LabelField]:
+        return self.fields.get((drug, section))
+
+    def _drugs_in(self, question: str) -> List[str]:
+        lowered = question.lower()
+        return sorted({drug for alias, drug in self.aliases.items() if alias.lower() in lowered})
+
+    def match(self, question: str) -> List[LabelField]:
+        """返回问题直接询问的说明书字段，没有明确命中时返回空列表"""
+        mentioned = self._drugs_in(question)
+        if len(mentioned) > 1:
+            return []
+        if mentioned:
+            drug = mentioned[0]
+        elif len(self.drugs) == 1:
+            drug = self.drugs[0]
+        else:
+            return []
+        referenced = bool(mentioned) or any(word in question for word in DEICTIC_WORDS)
+
+        sections, keywords = [], []
+        for section, (explicit, colloquial) in SECTION_INTENTS.items():
+            words = [w for w in explicit if w in question]
+            if referenced:
+                words += [w for w in colloquial if w in question]
+            if words:
+                sections.append(section)
+                keywords.extend(words)
+        if not sections:
+            return []
+        if not referenced:
+            # 去掉章节关键词和虚词后还剩其他内容，说明问的可能是别的药品或具体情况
+            rest = question
+            for word in sorted(keywords, key=len, reverse=True):
+                rest = rest.replace(word, "")
+            if _FILLER.sub("", rest):
+                return []
+
+        fields = [self.fields[(drug, section)] for section in sections if (drug, section) in self.fields]
+        # 同时问多个章节时一并提供，总长度超过上限时交给向量检索
+        if not fields or sum(len(field.text) for field in fields) > self.max_chars:
+            return []
+        return fields
+
+
+def format_fields(fields: Sequence[LabelField]) -> str:
+    """把字段拼成参考资料文本"""
+    return "\n\n".join(f"{field.drug}说明书{field.title}\n{field.text}" for field in fields)
+
+
+def load_field_index(paths: Sequence[str]) -> FieldIndex:
+    """解析候选路径中第一个存在的知识库文件，构建字段索引"""
+    fields: List[LabelField] = []
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        with open(path, encoding="utf-8") as f:
+            parsed = parse_label(f.read().replace("\r\n", "\n"))
+        if not parsed:
+            label_logger.warning("知识库文件中没有找到说明书标题，跳过字段解析", path=path)
+            continue
+        if KB_NORMALIZE:
+            # 与向量检索的分块一样去掉 LaTeX、图片引用和表格标签，减少发给模型的字符
+            for field in parsed:
+                field.text = clean_fragment(field.text)
+        fields.extend(parsed)
+        break
+    index = FieldIndex(fields)
+    label_logger.info("说明书字段索引已建立", fields=len(index), drugs=index.drugs)
+    return index
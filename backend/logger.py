@@ -0,0 +1,189 @@
+"""
+结构化日志
+
+请求路径上的日志统一写成紧凑的 key=value 事件，通过队列交给后台线程格式化和输出，
+避免在请求处理中同步写标准输出。支持：
+- 日志级别（LOG_LEVEL）
+- 按类别采样（LOG_SAMPLING，例如 "stream=0.1"），只作用于 DEBUG/INFO，警告和错误始终输出
+- 字段脱敏（LOG_REDACT），用户问题、回答等医疗文本只记录长度
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+from typing import Any, Dict, Optional
+
+from config import LOG_LEVEL, LOG_REDACT, LOG_SAMPLING, LOG_QUEUE_SIZE
+
+# 可能包含用户医疗信息的字段，脱敏时只保留长度
+REDACTED_FIELDS = {
+    "message", "content", "question", "answer", "response", "prompt",
+    "negative_prompt", "text", "history", "draft", "queries",
+}
+
+ROOT_LOGGER = "medical"
+
+
+def _parse_sampling(spec: str) -> Dict[str, float]:
+    """解析 "stream=0.1,chat=1" 形式的采样配置"""
+    rates = {}
+    for item in spec.split(","):
+        if "=" not in item:
+            continue
+        category, _, rate = item.partition("=")
+        try:
+            rates[category.strip()] = min(1.0, max(0.0, float(rate)))
+        except ValueError:
+            continue
+    return rates
+
+
+SAMPLING_RATES = _parse_sampling(LOG_SAMPLING)
+
+
+def redact(fields: Dict[str, Any]) -> Dict[str, Any]:
+    """把敏感字段替换为长度描述，数值（例如消息条数）保持不变"""
+    if not LOG_REDACT:
+        return fields
+    for key in REDACTED_FIELDS.intersection(fields):
+        value = fields[key]
+        if isinstance(value, str):
+            fields[key] = f"<{len(value)} chars>"
+        elif value is not None and not isinstance(value, (int, float)):
+            fields[key] = "<redacted>"
+    return fields
+
+
+def _format_value(value: Any) -> str:
+    if isinstance(value, float):
+        return f"{value:.4g}"
+    text = str(value)
+    if not text or any(ch in text for ch in ' ="\n'):
+        return json.dumps(text, ensure_ascii=False)
+    return text
+
+
+class KeyValueFormatter(logging.Formatter):
+    """格式化为 `时间 级别 类别 event=事件名 key=value ...`"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        category = record.name[len(ROOT_LOGGER) + 1:] if record.name.startswith(ROOT_LOGGER + ".") else record.name
+        parts = [
+            f"{self.formatTime(record, '%Y-%m-%dT%H:%M:%S')}.{int(record.msecs):03d}",
+            record.levelname,
+            category,
+            f"event={_format_value(record.getMessage())}",
+        ]
+        fields = getattr(record, "fields", None)
+        if fields:
+            parts.extend(f"{key}={_format_value(value)}" for key, value in fields.items())
+        line = " ".join(parts)
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    把日志记录原样放入有界队列
+
+    标准 QueueHandler 会在调用线程中格式化消息，这里推迟到后台线程；
+    队列已满时丢弃日志并计数，请求路径永远不会因为日志而阻塞。
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class _Listener(logging.handlers.QueueListener):
+    """停止时阻塞等待放入结束标记，队列已满时也能把剩余日志全部输出"""
+
+    def enqueue_sentinel(self) -> None:
+        self.queue.put(self._sentinel)
+
+
+_listener: Optional[_Listener] = None
+_queue_handler: Optional[DeferredQueueHandler] = None
+
+
+def setup_logging(stream=None) -> None:
+    """配置根日志器：请求线程只负责入队，后台线程负责格式化和写出（可重复调用）"""
+    global _listener, _queue_handler
+    if _listener is not None:
+        return
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(KeyValueFormatter())
+    _queue_handler = DeferredQueueHandler(queue.Queue(maxsize=LOG_QUEUE_SIZE))
+
+    root = logging.getLogger(ROOT_LOGGER)
+    root.setLevel(getattr(logging, LOG_LEVEL, logging.INFO))
+    root.addHandler(_queue_handler)
+    root.propagate = False
+
+    _listener = _Listener(_queue_handler.queue, output, respect_handler_level=False)
+    _listener.start()
+    atexit.register(shutdown_logging)
+
+
+def shutdown_logging() -> None:
+    """停止后台线程并输出队列中剩余的日志"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+        logging.getLogger(ROOT_LOGGER).removeHandler(_queue_handler)
+
+
+def dropped_count() -> int:
+    """因队列已满被丢弃的日志条数"""
+    return _queue_handler.dropped if _queue_handler else 0
+
+
+class EventLogger:
+    """按类别记录结构化事件"""
+
+    def __init__(self, category: str):
+        self.category = category
+        self._logger = logging.getLogger(f"{ROOT_LOGGER}.{category}")
+        self._sample_rate = SAMPLING_RATES.get(category, 1.0)
+
+    def _log(self, level: int, event: str, fields: Dict[str, Any], exc_info: bool = False) -> None:
+        if not self._logger.isEnabledFor(level):
+            return
+        if level < logging.WARNING and self._sample_rate < 1.0 and random.random() >= self._sample_rate:
+            return
+        self._logger.log(level, event, extra={"fields": redact(fields)}, exc_info=exc_info)
+
+    def debug(self, event: str, **fields: Any) -> None:
+        self._log(logging.DEBUG, event, fields)
+
+    def info(self, event: str, **fields: Any) -> None:
+        self._log(logging.INFO, event, fields)
+
+    def warning(self, event: str, **fields: Any) -> None:
+        self._log(logging.WARNING, event, fields)
+
+    def error(self, event: str, **fields: Any) -> None:
+        self._log(logging.ERROR, event, fields)
+
+    def exception(self, event: str, **fields: Any) -> None:
+        """记录错误并附带当前异常的堆栈"""
+        self._log(logging.ERROR, event, fields, exc_info=True)
+
+
+def get_logger(category: str) -> EventLogger:
+    setup_logging()
+    return EventLogger(category)
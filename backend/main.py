@@ -1,32 +1,68 @@
-from fastapi import FastAPI, Request, Depends, status, File, UploadFile, Form
+from fastapi import FastAPI, Request, Depends, status, File, UploadFile, Form, WebSocket
 from fastapi.middleware.cors import CORSMiddleware
 from sse_starlette.sse import EventSourceResponse
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel
+from fastapi.responses import JSONResponse, ORJSONResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
+from pydantic import BaseModel, Field, ValidationError, field_validator
 import os
 import json
 import asyncio
 import uuid
 import base64
-from PIL import Image
 import io
 import aiofiles
-import numpy as np
-import requests
-from typing import List, Dict, Any, Optional, Union
+import time
+from contextlib import asynccontextmanager
+from typing import List, Dict, Any, Optional, Sequence, Union
 from datetime import datetime
 from dotenv import load_dotenv
-from dashscope import ImageSynthesis
-
-# LangChain导入
-from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
-from langchain_community.chat_models import ChatTongyi
-from langchain.document_loaders import TextLoader
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_community.embeddings.dashscope import DashScopeEmbeddings
-from langchain_chroma import Chroma
-from langchain_core.output_parsers import StrOutputParser
-from langchain_core.prompts import ChatPromptTemplate
+
+# LangChain、dashscope、chromadb、PIL 等较重的依赖在首次使用时才导入（见 _warm_up_imports），
+# 知识库索引在启动后由后台任务构建，服务启动不需要等待
+
+from concurrency import governor, AdmissionRejected
+from resilience import upstream, UpstreamUnavailable, GenerationCancelled
+from deadline import Deadline, DeadlineExceeded, DEADLINE_HEADER
+from router import router
+from history import Conversation, role_and_content, USER, ASSISTANT
+from websocket_session import WebSocketSession, RequestError, token_sink
+from batch import batch_runner, parse_items, parse_file, batch_id_for, BatchInputError
+from config import (
+    DEADLINE_RETRIEVAL_SHARE,
+    DEADLINE_GENERATION_SHARE,
+    DEADLINE_MIN_GENERATION,
+    RAG_ENABLED,
+    KNOWLEDGE_FILES,
+    LABEL_LOOKUP_ENABLED,
+    RAG_TOP_K,
+    RAG_CONTEXT_ASSEMBLY,
+    RAG_CONTEXT_TOKEN_BUDGET,
+    RAG_MULTI_QUERY,
+    RAG_MULTI_QUERY_VARIANTS,
+    RAG_RRF_K,
+    EMBEDDING_MODEL,
+    PREFETCH_ENABLED,
+    PREFETCH_MIN_CHARS,
+    HISTORY_PAGE_DEFAULT,
+    HISTORY_PAGE_MAX,
+)
+from context import assemble_context
+from label_fields import load_field_index, format_fields
+from multi_query import build_query_variants, reciprocal_rank_fusion
+from prefetch import prefetch_cache
+import embedding_cache
+from logger import get_logger
+import metrics
+from tracing import tracer, TracingMiddleware, span, record_span, traced, TRACE_HEADER, PROFILE_HEADER
+
+# 按类别划分的结构化日志
+logger = get_logger("app")
+rag_logger = get_logger("rag")
+chat_logger = get_logger("chat")
+stream_logger = get_logger("stream")
+multimodal_logger = get_logger("multimodal")
+image_logger = get_logger("text2image")
+admission_logger = get_logger("admission")
 
 # 加载环境变量
 load_dotenv()
@@ -35,24 +71,132 @@ load_dotenv()
 DASHSCOPE_API_KEY = os.getenv("DASHSCOPE_API_KEY")
 # 设置API密钥
 os.environ["DASHSCOPE_API_KEY"] = DASHSCOPE_API_KEY
-print(f"使用DashScope API Key: {DASHSCOPE_API_KEY[:8]}...（已隐藏部分）")
+logger.info("使用DashScope API Key", key_prefix=f"{DASHSCOPE_API_KEY[:4]}****")
 
 # 创建图片存储目录
 UPLOAD_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "uploads")
 os.makedirs(UPLOAD_DIR, exist_ok=True)
-print(f"图片上传目录: {UPLOAD_DIR}")
+logger.info("图片上传目录", path=UPLOAD_DIR)
 
-try:
-    embeddings = DashScopeEmbeddings(
-        model="text-embedding-v1",  # 使用阿里云提供的文本嵌入模型
-    )
-    print("DashScope嵌入模型初始化成功")
-except Exception as e:
-    print(f"DashScope嵌入模型初始化失败: {str(e)}")
-    embeddings = None
+# 预先导入处理请求要用到的模块，避免第一个请求承担导入开销（在工作线程中执行）
+def _warm_up_imports():
+    import dashscope  # noqa: F401
+    from PIL import Image  # noqa: F401
+    from langchain_core.messages import HumanMessage  # noqa: F401
+    from langchain_core.output_parsers import StrOutputParser  # noqa: F401
+    from langchain_core.prompts import ChatPromptTemplate  # noqa: F401
+    from langchain_community.chat_models import ChatTongyi  # noqa: F401
+
+class Warmup:
+    """
+    启动后的后台预热：先导入较重的依赖，再构建知识库检索器
+
+    知识库状态依次为 building -> ready / failed；RAG_ENABLED 关闭时为 disabled。
+    检索器就绪之前 retriever 为 None，请求直接由模型回答。
+    说明书字段索引（fields）只需解析知识库文件，在构建检索器之前就绪。
+    """
+
+    def __init__(self, rag_enabled: bool):
+        self.rag_enabled = rag_enabled
+        self.rag_status = "building" if rag_enabled else "disabled"
+        self.retriever = None
+        self.fields = None
+        self.error: Optional[str] = None
+        self.started_at: Optional[float] = None
+        self.imports_seconds: Optional[float] = None
+        self.rag_seconds: Optional[float] = None
+        self._imports_done = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        """在当前事件循环中启动后台预热任务"""
+        self.started_at = time.time()
+        self._task = asyncio.create_task(self._run())
+
+    async def imports_ready(self) -> None:
+        """
+        等待依赖预热完成
+
+        请求处理中的延迟导入如果与预热线程同时导入同一批模块，可能触发导入锁死锁，
+        因此处理请求前先等待预热完成（没有启动预热时直接返回）
+        """
+        if self._task is not None:
+            await self._imports_done.wait()
+
+    async def _run(self) -> None:
+        start = time.perf_counter()
+        try:
+            await asyncio.to_thread(_warm_up_imports)
+            logger.info("依赖预热完成", seconds=round(time.perf_counter() - start, 3))
+        except Exception as e:
+            logger.warning("依赖预热失败", error=str(e))
+        finally:
+            self.imports_seconds = time.perf_counter() - start
+            self._imports_done.set()
+        if not self.rag_enabled:
+            return
+        if LABEL_LOOKUP_ENABLED:
+            try:
+                self.fields = await asyncio.to_thread(load_field_index, KNOWLEDGE_FILES)
+            except Exception as e:
+                rag_logger.warning("说明书字段解析失败", error=str(e))
+        try:
+            retriever = await asyncio.to_thread(self._build_rag)
+        except Exception as e:
+            retriever = None
+            self.error = str(e)
+            rag_logger.exception("初始化RAG组件失败", error=str(e))
+        self.rag_seconds = time.perf_counter() - start
+        if retriever is None:
+            self.rag_status = "failed"
+            rag_logger.warning("知识库不可用，请求将直接由模型回答", seconds=round(self.rag_seconds, 3))
+            return
+        self.retriever = retriever
+        self.rag_status = "ready"
+        rag_logger.info("知识库检索器就绪", seconds=round(self.rag_seconds, 3))
+
+    @staticmethod
+    def _build_rag():
+        # 优先加载离线构建的索引产物（内存映射），没有时按配置现场构建
+        import rag
+        return rag.create_retriever(k=RAG_TOP_K)
+
+    async def stop(self) -> None:
+        if self._task and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    def stats(self) -> Dict[str, Any]:
+        def seconds(value: Optional[float]) -> Optional[float]:
+            return round(value, 3) if value is not None else None
+        return {
+            "rag_status": self.rag_status,
+            "error": self.error,
+            "started_at": self.started_at,
+            "imports_seconds": seconds(self.imports_seconds),
+            "rag_seconds": seconds(self.rag_seconds),
+            # 使用离线索引产物时为产物版本，现场构建时为 None
+            "index_version": getattr(getattr(self.retriever, "index", None), "version", None),
+            "index_precision": getattr(getattr(self.retriever, "index", None), "precision", None),
+            "score_threshold": getattr(self.retriever, "score_threshold", None),
+            "label_fields": len(self.fields) if self.fields is not None else None,
+        }
+
+warmup = Warmup(RAG_ENABLED)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 启动后立即开始接收请求，知识库在后台构建
+    warmup.start()
+    yield
+    await warmup.stop()
+    embedding_cache.close()
 
 # 初始化FastAPI应用
-app = FastAPI(title="AI医疗助手")
+app = FastAPI(title="AI医疗助手", lifespan=lifespan)
 
 # 添加CORS中间件
 app.add_middleware(
@@ -61,19 +205,39 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[TRACE_HEADER, PROFILE_HEADER],  # 前端可以读取 trace ID
 )
 
+# 为每个请求创建 trace，并在响应头中返回 trace ID
+app.add_middleware(TracingMiddleware)
+
 # 数据模型
 class Message(BaseModel):
     role: str
     content: str
     timestamp: Optional[str] = None
     image_url: Optional[str] = None  # 添加图片URL字段
+    truncated: Optional[bool] = None  # 回答因客户端断开而不完整
 
 class ChatRequest(BaseModel):
     message: str
     chat_history: Optional[List[Message]] = []
 
+class BatchRequest(BaseModel):
+    # 问题字符串，或 {"id": ..., "question": ..., "chat_history": [...]}
+    items: List[Union[str, Dict[str, Any]]]
+    # 同一批次 ID 再次提交时只处理尚未成功的问题；为空时由问题内容计算
+    batch_id: Optional[str] = None
+    concurrency: Optional[int] = None
+    # 每秒处理的问题数上限，为空或 0 时使用服务端配置
+    rate: Optional[float] = None
+
+class ClientDisconnected(Exception):
+    """流式响应过程中客户端已断开连接"""
+
+# 生成回答期间检查客户端连接状态的间隔（秒）
+DISCONNECT_POLL_INTERVAL = 0.5
+
 class MultiModalRequest(BaseModel):
     message: str
     chat_history: Optional[List[Message]] = []
@@ -99,70 +263,12 @@ class StreamingCallbackHandler:
         await self.queue.put(f"Error: {str(error)}")
         self.done.set()
 
-# 内存存储对话历史
-conversation_store = {}
-
-# 初始化RAG组件
-def initialize_rag():
-    # 如果嵌入模型初始化失败，则不初始化RAG
-    if embeddings is None:
-        print("由于嵌入模型初始化失败，RAG组件无法初始化")
-        return None
-        
-    # 加载本地 Markdown 文件
-    try:
-        # 尝试找到文件路径
-        possible_file_paths = [
-            os.path.join(os.path.dirname(os.path.abspath(__file__)), "full1.md"),
-            "./full1.md",
-        ]
-        
-        file_path = None
-        for path in possible_file_paths:
-            if os.path.exists(path):
-                file_path = path
-                break
-                
-        if not file_path:
-            print(f"错误: 未找到知识库文件")
-            return None
-            
-        print(f"找到知识库文件: {file_path}")
-        
-        # 加载文档
-        loader = TextLoader(file_path, encoding='utf-8')
-        documents = loader.load()
-        
-        if not documents or len(documents) == 0:
-            print("警告: 文档加载成功但内容为空")
-            return None
-            
-        print(f"成功加载文档，共有 {len(documents)} 个文档段落")
-        
-        # 分割文档
-        text_splitter = RecursiveCharacterTextSplitter(chunk_size=2000, chunk_overlap=200)
-        all_splits = text_splitter.split_documents(documents)
-        
-        if not all_splits or len(all_splits) == 0:
-            print("警告: 文档分割后内容为空")
-            return None
-            
-        print(f"文档分割完成，共有 {len(all_splits)} 个文本块")
-        
-        # 创建向量存储
-        try:
-            vectorstore = Chroma.from_documents(documents=all_splits, embedding=embeddings)
-            print("成功创建向量存储")
-            return vectorstore
-        except Exception as e:
-            print(f"创建向量存储失败: {str(e)}")
-            return None
-            
-    except Exception as e:
-        print(f"初始化RAG组件失败: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        return None
+# 内存存储对话历史，每个会话是一个只追加的消息数组（见 history.py）
+conversation_store: Dict[str, Conversation] = {}
+metrics.CONVERSATIONS.set_function(lambda: len(conversation_store))
+metrics.CONVERSATION_MESSAGES.set_function(
+    lambda: sum(len(conversation) for conversation in list(conversation_store.values()))
+)
 
 # 格式化文档
 def format_docs(docs):
@@ -170,6 +276,19 @@ def format_docs(docs):
         return ""
     return "\n\n".join(doc.page_content for doc in docs)
 
+# 组装RAG上下文：去掉分块之间重叠的文字并按 token 预算截断，关闭时按原样拼接
+def build_context(docs) -> str:
+    if not RAG_CONTEXT_ASSEMBLY:
+        context = format_docs(docs)
+        metrics.RAG_CONTEXT_CHARS.observe(len(context), stage="raw")
+        metrics.RAG_CONTEXT_CHARS.observe(len(context), stage="assembled")
+        return context
+    context, stats = assemble_context(docs, RAG_CONTEXT_TOKEN_BUDGET)
+    metrics.RAG_CONTEXT_CHARS.observe(stats["raw_chars"], stage="raw")
+    metrics.RAG_CONTEXT_CHARS.observe(stats["context_chars"], stage="assembled")
+    chat_logger.debug("上下文组装", **stats)
+    return context
+
 # 修改用于RAG的提示模板，增强Markdown支持和添加历史上下文
 RAG_TEMPLATE = """你是一位专业的AI医疗助手，会提供准确、有帮助的医疗健康信息。
 请基于以下参考信息、聊天历史（如果有的话）以及你的专业知识回答用户的问题：
@@ -233,30 +352,212 @@ SYSTEM_PROMPT = """你是一位专业的AI医疗助手，提供准确、科学
 
 始终保持专业、准确和有帮助的态度。"""
 
-general_prompt = ChatPromptTemplate.from_template(DEFAULT_TEMPLATE)
-rag_prompt = ChatPromptTemplate.from_template(RAG_TEMPLATE)
+# 提示模板在第一次使用时创建
+_prompts: Dict[str, Any] = {}
+
+# 检索一个查询
+async def _search(retriever, query: str):
+    query_cache = embedding_cache.get_cache()
+    if query_cache is not None and query_cache.in_memory(query):
+        # 查询向量已在缓存中，检索不调用嵌入接口，不占用上游配额
+        return await asyncio.to_thread(retriever.invoke, query)
+    return await upstream.call(EMBEDDING_MODEL, retriever.invoke, query)
+
+def _query_variants(question: str, chat_history) -> List[str]:
+    return build_query_variants(question, chat_history, RAG_MULTI_QUERY_VARIANTS) if RAG_MULTI_QUERY else [question]
+
+# 检索一组查询变体（第一个为原问题）：并发检索，用倒数排名融合合并结果
+async def _search_queries(retriever, queries: List[str]) -> list:
+    if len(queries) == 1:
+        return await _search(retriever, queries[0])
+    chat_logger.debug("多查询检索", queries=queries)
+    results = await asyncio.gather(*(_search(retriever, query) for query in queries), return_exceptions=True)
+    # 部分变体失败时使用其余结果；原问题也失败时按检索失败处理
+    if isinstance(results[0], BaseException):
+        raise results[0]
+    return reciprocal_rank_fusion([r for r in results if not isinstance(r, BaseException)], RAG_RRF_K)
+
+# 检索参考资料：追问时结合对话历史生成多个查询变体；会话有与问题匹配的预取结果（见 prefetch.py）时直接使用
+async def _retrieve(retriever, question: str, chat_history, conversation_id: Optional[str] = None) -> list:
+    queries = _query_variants(question, chat_history)
+    metrics.RAG_QUERY_VARIANTS.inc(variants=str(len(queries)))
+    if PREFETCH_ENABLED and conversation_id:
+        docs = await prefetch_cache.claim(conversation_id, queries)
+        if docs is not None:
+            return docs
+    return await _search_queries(retriever, queries)
+
+def get_prompt(template: str):
+    prompt = _prompts.get(template)
+    if prompt is None:
+        from langchain_core.prompts import ChatPromptTemplate
+        prompt = _prompts[template] = ChatPromptTemplate.from_template(template)
+    return prompt
+
+# 按（模型名称, 输出长度上限）缓存的模型实例，避免每个请求重新创建
+_chat_models: Dict[tuple, Any] = {}
+
+def get_chat_model(model_name: str, max_tokens: int):
+    key = (model_name, max_tokens)
+    model = _chat_models.get(key)
+    if model is None:
+        metrics.CACHE_MISSES.inc(cache="chat_model")
+        from langchain_community.chat_models import ChatTongyi
+        model = ChatTongyi(model_name=model_name, model_kwargs={"max_tokens": max_tokens})
+        _chat_models[key] = model
+    else:
+        metrics.CACHE_HITS.inc(cache="chat_model")
+    return model
+
+# 模型在熔断器中的分组名称
+def _model_key(model) -> str:
+    return getattr(model, "model_name", None) or type(model).__name__
+
+# DashScope 原生SDK响应是否表示上游故障（限流和服务端错误计入熔断，客户端错误不计入）
+def _is_upstream_failure(response) -> bool:
+    status_code = getattr(response, "status_code", 200)
+    return status_code == 429 or status_code >= 500
+
+# 以流式方式调用模型并拼接完整回答（在工作线程中执行）
+# 请求被取消、超出截止时间或本次阶段尝试被放弃（阶段超时、对冲落选）后停止读取并关闭上游连接，上游不再继续生成
+# WebSocket 请求中同时把每个增量转发给客户端（见 websocket_session.TokenSink）
+def _collect_stream(stream_fn, payload, deadline: Deadline) -> str:
+    start = time.perf_counter()
+    sink = token_sink.get()
+    owner = sink.claim() if sink is not None else None
+    completed = False
+    stream = stream_fn(payload)
+    parts = []
+    try:
+        for chunk in stream:
+            if deadline.stopped():
+                raise GenerationCancelled("generation")
+            if not parts:
+                metrics.TIME_TO_FIRST_TOKEN_SECONDS.observe(time.perf_counter() - start, source="upstream")
+            parts.append(chunk if isinstance(chunk, str) else chunk.content)
+            if sink is not None:
+                sink.push(owner, parts[-1])
+        completed = True
+    finally:
+        close = getattr(stream, "close", None)
+        if close:
+            close()
+        if sink is not None:
+            sink.release(owner, completed)
+    return "".join(parts)
+
+# 在截止时间预算内、经过限流和熔断保护调用语言模型
+# 上游故障时立即抛出 UpstreamUnavailable，预算不足时抛出 DeadlineExceeded
+async def _invoke_model(model, messages, deadline: Deadline, share: float = 1.0) -> str:
+    return await _timed_generation(
+        _model_key(model), "direct", deadline, model.stream, messages, share
+    )
+
+# 执行一次生成调用并按模型、回答路径和结果记录耗时
+async def _timed_generation(model_key: str, path: str, deadline: Deadline, stream_fn, payload, share: float) -> str:
+    with span("llm.generation", model=model_key, path=path), \
+            metrics.LLM_GENERATION_SECONDS.time(model=model_key, path=path, outcome="error") as labels:
+        result = await deadline.run(
+            "generation",
+            lambda: upstream.call(model_key, _collect_stream, stream_fn, payload, deadline),
+            share=share,
+            hedge=True,
+        )
+        labels["outcome"] = "ok"
+        return result
+
+# 用参考资料和聊天历史生成回答（RAG 提示），失败时退回不带参考资料的直接回答
+async def _rag_generate(question, context, chat_history, messages, resolve_model, deadline: Deadline) -> str:
+    from langchain_core.messages import HumanMessage
+    prompt_start = time.perf_counter()
+    # 构建带有历史上下文的提示
+    history_context = ""
+    if chat_history and len(chat_history) > 0:
+        # 创建历史上下文字符串
+        history_context = "\n\n聊天历史:\n"
+        # 只使用最近的5条消息作为上下文
+        recent_history = chat_history[-5:] if len(chat_history) > 5 else chat_history
+        for msg in recent_history:
+            # 会话消息、请求中的Message对象或字典（批量问答），跳过无法处理的消息
+            pair = role_and_content(msg)
+            if pair is None:
+                continue
+            role, content = pair
+            role_name = "用户" if role == "user" else "AI医疗助手"
+            history_context += f"{role_name}: {content}\n"
+    record_span("smart_answer.prompt", prompt_start, context_chars=len(context))
+    
+    # 组合上下文和历史到RAG提示
+    try:
+        from langchain_core.output_parsers import StrOutputParser
+        rag_model = resolve_model(context)
+        rag_chain = (
+            get_prompt(RAG_TEMPLATE) 
+            | rag_model 
+            | StrOutputParser()
+        )
+        # RAG生成只占用部分预算，失败时还有时间直接调用模型
+        rag_input = {
+            "context": context, 
+            "question": question,
+            "history_context": history_context
+        }
+        return await _timed_generation(
+            _model_key(rag_model), "rag", deadline, rag_chain.stream, rag_input, DEADLINE_GENERATION_SHARE
+        )
+    except Exception as e:
+        chat_logger.warning("RAG生成失败", error=str(e))
+        metrics.ANSWER_PATH.inc(path="direct", reason="rag_failed")
+        # 如果RAG链失败，尝试直接使用模型
+        messages.append(HumanMessage(content=question))
+        try:
+            return await _invoke_model(resolve_model(), messages, deadline)
+        except Exception as e2:
+            chat_logger.warning("模型调用失败", error=str(e2))
+            raise AnswerUnavailable(f"模型调用失败: {e2}") from e2
 
-# 初始化智能问答组件
-# vectorstore = initialize_rag()
-vectorstore = None
-if vectorstore:
-    retriever = vectorstore.as_retriever(search_kwargs={"k": 3})
-else:
-    retriever = None
+# smart_answer 无法生成回答（上游故障、预算耗尽等），fallback=False 时抛出，否则返回后备回答
+class AnswerUnavailable(Exception):
+    pass
 
 # 智能回答函数
-async def smart_answer(question, model, chat_history=None):
+@traced("smart_answer")
+async def smart_answer(question, model=None, chat_history=None, deadline: Optional[Deadline] = None,
+                       conversation_id: Optional[str] = None, fallback: bool = True):
     """
     根据问题和聊天历史生成智能回答
     
     Args:
         question: 用户的当前问题
-        model: 要使用的语言模型
-        chat_history: 可选的聊天历史记录列表
+        model: 要使用的语言模型，为 None 时由模型路由根据问题复杂度选择
+        chat_history: 可选的聊天历史记录序列（会话历史的 HistoryView、Message 对象列表或字典列表），只读
+        deadline: 可选的截止时间，检索、生成和后备调用共享这一预算
+        conversation_id: 可选的会话ID，有该会话输入时预取的检索结果且与问题匹配时直接使用
+        fallback: 无法生成回答时是否返回后备回答；为 False 时抛出 AnswerUnavailable（批量问答据此记为失败）
         
     Returns:
         生成的回答文本
     """
+    if deadline is None:
+        deadline = Deadline.for_endpoint("chat")
+    await warmup.imports_ready()
+    from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
+    # 知识库仍在后台构建或构建失败时为 None
+    retriever = warmup.retriever
+    
+    # 未指定模型时，根据问题、历史深度和检索到的参考资料选择模型档位；
+    # 每个请求只路由一次，RAG 生成失败后的直接回答沿用同一个模型
+    routed_model = None
+
+    def resolve_model(context: str = ""):
+        nonlocal routed_model
+        if model is not None:
+            return model
+        if routed_model is None:
+            decision = router.route_text(question, chat_history, context)
+            routed_model = get_chat_model(decision.model, decision.max_tokens)
+        return routed_model
+    
     try:
         # 准备消息列表，始终以系统提示开始
         messages = [
@@ -264,115 +565,95 @@ async def smart_answer(question, model, chat_history=None):
         ]
         
         # 添加聊天历史到消息列表
+        history_start = time.perf_counter()
         if chat_history:
             # 限制历史消息数量，保留最近的10条
             recent_history = chat_history[-10:] if len(chat_history) > 10 else chat_history
             for msg in recent_history:
-                # 处理不同类型的消息对象
-                if isinstance(msg, dict):
-                    # 如果是字典类型（来自JSON）
-                    role = msg.get("role", "")
-                    content = msg.get("content", "")
-                elif hasattr(msg, "role") and hasattr(msg, "content"):
-                    # 如果是Message类对象
-                    role = msg.role
-                    content = msg.content
-                else:
+                # 会话消息、请求中的Message对象或字典（批量问答）
+                pair = role_and_content(msg)
+                if pair is None:
                     # 跳过无法处理的消息
-                    print(f"警告: 无法处理的消息类型: {type(msg)}")
+                    chat_logger.warning("无法处理的历史消息类型", type=type(msg).__name__)
                     continue
+                role, content = pair
                 
                 # 根据角色添加适当的消息
                 if role == "user":
                     messages.append(HumanMessage(content=content))
                 elif role == "assistant":
                     messages.append(AIMessage(content=content))
+        record_span("smart_answer.history", history_start, messages=len(messages) - 1)
         
+        # 直接询问说明书某个章节的问题以该章节原文作为参考资料，不调用嵌入接口也不做向量检索
+        fields = warmup.fields.match(question) if warmup.fields is not None else []
+        if fields:
+            context = format_fields(fields)
+            sections = [field.section for field in fields]
+            chat_logger.debug("回答路径", path="field", sections=sections, context_chars=len(context))
+            metrics.ANSWER_PATH.inc(path="field", reason="section_match")
+            return await _rag_generate(question, context, chat_history, messages, resolve_model, deadline)
+
         # 如果没有成功初始化检索器，则只使用模型直接回答
         if not retriever:
             # 添加当前问题
             messages.append(HumanMessage(content=question))
-            print(f"无RAG，使用历史记录生成回答，历史消息数量: {len(messages)-1}")
+            chat_logger.debug("回答路径", path="direct", reason="no_retriever", rag_status=warmup.rag_status, history=len(messages) - 1)
+            metrics.ANSWER_PATH.inc(path="direct", reason="no_retriever")
             try:
-                return model.invoke(messages).content
+                return await _invoke_model(resolve_model(), messages, deadline)
             except Exception as e:
-                print(f"模型调用失败: {str(e)}")
-                return _generate_fallback_response(question, chat_history)
+                chat_logger.warning("模型调用失败", error=str(e))
+                raise AnswerUnavailable(f"模型调用失败: {e}") from e
         
         # 尝试检索相关文档
         try:
-            docs = retriever.invoke(question)
+            # 检索最多占用部分预算，并为生成阶段保留最短所需时间；预算不足时跳过检索
+            with span("smart_answer.retrieval"), metrics.RETRIEVAL_SECONDS.time(outcome="error") as retrieval_labels:
+                docs = await deadline.run(
+                    "retrieval",
+                    lambda: _retrieve(retriever, question, chat_history, conversation_id),
+                    share=DEADLINE_RETRIEVAL_SHARE,
+                    reserve=DEADLINE_MIN_GENERATION,
+                )
+                retrieval_labels["outcome"] = "ok"
+            metrics.RAG_SELECTED_DOCS.inc(k=str(len(docs)))
         except Exception as e:
-            print(f"检索器调用失败: {str(e)}")
+            chat_logger.warning("检索失败", error=str(e))
+            metrics.ANSWER_PATH.inc(path="direct", reason="retrieval_failed")
             # 添加当前问题
             messages.append(HumanMessage(content=question))
             try:
-                return model.invoke(messages).content
+                return await _invoke_model(resolve_model(), messages, deadline)
             except Exception as e2:
-                print(f"模型调用失败: {str(e2)}")
-                return _generate_fallback_response(question, chat_history)
+                chat_logger.warning("模型调用失败", error=str(e2))
+                raise AnswerUnavailable(f"模型调用失败: {e2}") from e2
         
         if docs:
             # 如果找到相关文档，准备上下文
-            context = format_docs(docs)
-            print(f"找到相关文档，使用RAG模板生成回答，文档数量: {len(docs)}")
-            
-            # 构建带有历史上下文的提示
-            history_context = ""
-            if chat_history and len(chat_history) > 0:
-                # 创建历史上下文字符串
-                history_context = "\n\n聊天历史:\n"
-                # 只使用最近的5条消息作为上下文
-                recent_history = chat_history[-5:] if len(chat_history) > 5 else chat_history
-                for msg in recent_history:
-                    # 处理不同类型的消息对象
-                    if isinstance(msg, dict):
-                        # 如果是字典类型（来自JSON）
-                        role = msg.get("role", "")
-                        content = msg.get("content", "")
-                    elif hasattr(msg, "role") and hasattr(msg, "content"):
-                        # 如果是Message类对象
-                        role = msg.role
-                        content = msg.content
-                    else:
-                        # 跳过无法处理的消息
-                        continue
-                        
-                    role_name = "用户" if role == "user" else "AI医疗助手"
-                    history_context += f"{role_name}: {content}\n"
-            
-            # 组合上下文和历史到RAG提示
-            rag_chain = (
-                rag_prompt 
-                | model 
-                | StrOutputParser()
-            )
-            try:
-                return rag_chain.invoke({
-                    "context": context, 
-                    "question": question,
-                    "history_context": history_context
-                })
-            except Exception as e:
-                print(f"RAG链调用失败: {str(e)}")
-                # 如果RAG链失败，尝试直接使用模型
-                messages.append(HumanMessage(content=question))
-                try:
-                    return model.invoke(messages).content
-                except Exception as e2:
-                    print(f"模型调用失败: {str(e2)}")
-                    return _generate_fallback_response(question, chat_history)
+            context = build_context(docs)
+            chat_logger.debug("回答路径", path="rag", docs=len(docs), context_chars=len(context))
+            metrics.ANSWER_PATH.inc(path="rag", reason="docs_found")
+            return await _rag_generate(question, context, chat_history, messages, resolve_model, deadline)
         else:
-            # 如果没有找到相关文档，添加当前问题到消息列表
+            # 如果没有找到相关文档（或相似度都低于阈值），不带参考资料，按普通对话回答
             messages.append(HumanMessage(content=question))
-            print(f"无相关文档，使用历史记录生成回答，历史消息数量: {len(messages)-1}")
+            reason = "below_threshold" if getattr(retriever, "score_threshold", 0) > 0 else "no_docs"
+            chat_logger.debug("回答路径", path="direct", reason=reason, history=len(messages) - 1)
+            metrics.ANSWER_PATH.inc(path="direct", reason=reason)
             try:
-                return model.invoke(messages).content
+                return await _invoke_model(resolve_model(), messages, deadline)
             except Exception as e:
-                print(f"模型调用失败: {str(e)}")
-                return _generate_fallback_response(question, chat_history)
+                chat_logger.warning("模型调用失败", error=str(e))
+                raise AnswerUnavailable(f"模型调用失败: {e}") from e
+    except AnswerUnavailable:
+        if not fallback:
+            raise
+        return _generate_fallback_response(question, chat_history)
     except Exception as e:
-        print(f"智能回答生成出错: {str(e)}")
+        chat_logger.error("智能回答生成出错", error=str(e))
+        if not fallback:
+            raise AnswerUnavailable(f"智能回答生成出错: {e}") from e
         return _generate_fallback_response(question, chat_history)
 
 # 后备回答生成函数
@@ -386,22 +667,21 @@ def _generate_fallback_response(question, chat_history=None):
         # 尝试从历史记录中提取最近的1-2条用户消息
         recent_user_msgs = []
         for msg in reversed(chat_history):
-            if isinstance(msg, dict) and msg.get("role") == "user":
-                content = msg.get("content", "")
-                recent_user_msgs.append(content)
-            elif hasattr(msg, "role") and msg.role == "user":
-                content = msg.content
-                recent_user_msgs.append(content)
+            pair = role_and_content(msg)
+            if pair is not None and pair[0] == "user":
+                recent_user_msgs.append(pair[1])
             if len(recent_user_msgs) >= 2:
                 break
         
         if recent_user_msgs:
+            metrics.FALLBACK_RESPONSES.inc(kind="history")
             history_summary = "、".join(recent_user_msgs[:2][::-1])
             return f"""根据我的记忆，您之前问了关于"{history_summary}"的问题。
 
 很抱歉，我目前遇到了一些技术问题，无法提供完整的回答。请稍后再试，或者重新表述您的问题，我会尽力帮助您。"""
     
     # 通用后备回答
+    metrics.FALLBACK_RESPONSES.inc(kind="generic")
     return """很抱歉，我目前遇到了一些技术问题，无法处理您的请求。这可能是由于以下原因：
 
 1. 服务器负载过高
@@ -413,28 +693,41 @@ def _generate_fallback_response(question, chat_history=None):
 感谢您的理解。"""
 
 # 获取对话ID的依赖
+@traced("get_conversation_id")
 def get_conversation_id(request: Request) -> str:
     """从请求中获取会话ID, 如果没有则创建新的"""
-    # 先尝试从查询参数获取会话ID
-    conversation_id = request.query_params.get("conversation_id")
-    
-    # 如果查询参数中没有，再尝试从头部获取
-    if not conversation_id:
-        conversation_id = request.headers.get("X-Conversation-ID")
-    
-    # 如果没有找到会话ID，生成一个新的
+    return _ensure_conversation(_requested_conversation_id(request))
+
+# 请求指定的会话ID：先尝试查询参数，再尝试请求头，都没有时为 None
+def _requested_conversation_id(request: Request) -> Optional[str]:
+    return request.query_params.get("conversation_id") or request.headers.get("X-Conversation-ID") or None
+
+# 没有会话ID时生成一个新的，新的会话ID初始化空的会话历史
+def _ensure_conversation(conversation_id: Optional[str]) -> str:
     if not conversation_id:
         conversation_id = str(datetime.now().timestamp())
     
-    # 如果是新的会话ID，初始化
     if conversation_id not in conversation_store:
-        print(f"创建新会话: {conversation_id}")
-        conversation_store[conversation_id] = {
-            "messages": []
-        }
+        chat_logger.debug("创建新会话", conversation_id=conversation_id)
+        conversation_store[conversation_id] = Conversation()
     
     return conversation_id
 
+# 根据端点默认值和请求头创建截止时间
+def _request_deadline(request_raw: Optional[Request], endpoint: str) -> Deadline:
+    header_value = request_raw.headers.get(DEADLINE_HEADER) if request_raw else None
+    return Deadline.for_endpoint(endpoint, header_value)
+
+# 准入被拒绝时的响应
+def _admission_rejected_response(error: AdmissionRejected) -> JSONResponse:
+    """把准入拒绝转换为带 Retry-After 的快速失败响应"""
+    admission_logger.warning("请求未被准入", lane=error.lane, status=error.status_code, reason=error.reason, retry_after=error.retry_after)
+    return JSONResponse(
+        status_code=error.status_code,
+        content={"error": error.reason, "retry_after": error.retry_after},
+        headers={"Retry-After": str(error.retry_after)}
+    )
+
 @app.get("/")
 async def root():
     """健康检查端点"""
@@ -443,10 +736,45 @@ async def root():
         "status": "ok", 
         "message": "AI医疗助手系统正在运行",
         "version": "1.0.0",
-        "rag_status": "enabled" if retriever else "disabled",
+        "rag_status": warmup.rag_status,
         "timestamp": current_time
     }
 
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Prometheus 文本格式的指标"""
+    return Response(content=metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+@app.get("/api/traces")
+async def trace_stats():
+    """链路追踪：最近请求的各阶段耗时和已保存的剖析结果数"""
+    return tracer.stats()
+
+@app.get("/api/warmup/stats")
+async def warmup_stats():
+    """后台预热和知识库构建状态"""
+    return warmup.stats()
+
+@app.get("/api/embedding-cache/stats")
+async def embedding_cache_stats():
+    """查询向量缓存：内存层和磁盘层的条目数、命中次数和命中率"""
+    return embedding_cache.stats()
+
+@app.get("/api/admission/stats")
+async def admission_stats():
+    """准入控制状态：各类请求的并发数、排队深度和等待时间"""
+    return governor.stats()
+
+@app.get("/api/router/stats")
+async def router_stats():
+    """模型路由状态：各档位命中次数和最近的路由决策"""
+    return router.stats()
+
+@app.get("/api/upstream/stats")
+async def upstream_stats():
+    """上游保护状态：剩余令牌数和各模型熔断器状态"""
+    return upstream.stats()
+
 @app.post("/api/chat")
 async def chat(
     request: ChatRequest, 
@@ -454,62 +782,31 @@ async def chat(
     request_raw: Request = None
 ):
     """非流式聊天API端点"""
+    # 截止时间从收到请求开始计算，包含排队时间
+    deadline = _request_deadline(request_raw, "chat")
+    
+    # 申请准入，同一会话的请求串行执行
     try:
-        # 打印接收到的请求信息
-        print(f"非流式请求 - 消息: '{request.message}', 会话ID: {conversation_id}")
-        
-        try:
-            model = ChatTongyi(model_name="qwen-turbo")
-        except Exception as e:
-            print(f"模型初始化失败: {str(e)}")
-            # 返回错误响应
-            return {
-                "response": _generate_fallback_response(request.message, request.chat_history),
-                "conversation_id": conversation_id,
-                "error": f"模型初始化失败: {str(e)}"
-            }
-        
-        # 处理聊天历史，可能是Pydantic模型或已经是字典列表
-        chat_history = []
-        if request.chat_history:
-            # 转换Message对象为字典
-            for msg in request.chat_history:
-                if isinstance(msg, dict):
-                    chat_history.append(msg)
-                elif hasattr(msg, "role") and hasattr(msg, "content"):
-                    chat_history.append({
-                        "role": msg.role,
-                        "content": msg.content,
-                        "timestamp": msg.timestamp if hasattr(msg, "timestamp") else None
-                    })
-        
-        # 如果是新的会话，获取聊天历史
-        current_chat_history = []
-        if conversation_id in conversation_store:
-            current_chat_history = conversation_store[conversation_id]["messages"]
-        
-        # 合并当前会话历史和请求中的历史 - 优先使用请求中的历史，如果没有则使用服务器存储的历史
-        if not chat_history and current_chat_history:
-            chat_history = current_chat_history
+        ticket = await governor.acquire("chat", conversation_id)
+    except AdmissionRejected as e:
+        return _admission_rejected_response(e)
+
+    try:
+        # 记录接收到的请求信息
+        chat_logger.info("收到聊天请求", conversation_id=conversation_id, message=request.message)
         
-        # 打印历史长度
-        print(f"使用的历史消息数量: {len(chat_history)}")
+        # 优先使用请求中的历史（Message对象直接传给 smart_answer，不再转换成字典），
+        # 没有时使用服务器存储的历史的视图，不复制消息
+        conversation = conversation_store[conversation_id]
+        chat_history = request.chat_history or conversation.view()
         
-        # 使用智能回答函数处理请求
-        response_content = await smart_answer(request.message, model, chat_history)
-        print(f"生成的回答: '{response_content[:50]}...'(长度:{len(response_content)})")
+        # 使用智能回答函数处理请求，由模型路由选择模型
+        response_content = await smart_answer(request.message, None, chat_history, deadline, conversation_id)
+        chat_logger.info("聊天回答完成", conversation_id=conversation_id, history=len(chat_history), answer_chars=len(response_content))
         
         # 更新会话消息列表
-        conversation_store[conversation_id]["messages"].append({
-            "role": "user",
-            "content": request.message,
-            "timestamp": datetime.now().isoformat()
-        })
-        conversation_store[conversation_id]["messages"].append({
-            "role": "assistant",
-            "content": response_content,
-            "timestamp": datetime.now().isoformat()
-        })
+        conversation.append(USER, request.message)
+        conversation.append(ASSISTANT, response_content)
         
         return {
             "response": response_content,
@@ -517,13 +814,102 @@ async def chat(
         }
         
     except Exception as e:
-        error_msg = f"聊天API端点错误: {str(e)}"
-        print(error_msg)
-        print(f"错误详情: {type(e).__name__}, {e.__traceback__.tb_lineno}")
+        chat_logger.exception("聊天API端点错误", conversation_id=conversation_id, error=str(e))
         return JSONResponse(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             content={"error": str(e)}
         )
+    finally:
+        ticket.release()
+
+# 批量问答的单个问题：经低优先级的 batch 通道准入，不写入会话历史，准入后开始计算独立的截止时间
+# 无法生成回答时抛出 AnswerUnavailable 而不是返回后备回答，该问题记为失败，不作为已完成结果保存
+async def _answer_batch_item(item) -> str:
+    ticket = await governor.acquire_background("batch")
+    try:
+        return await smart_answer(item.question, None, item.chat_history, Deadline.for_endpoint("chat"),
+                                  fallback=False)
+    finally:
+        ticket.release()
+
+# 以 NDJSON 流式返回批量问答结果，每完成一个问题输出一行
+def _batch_response(items, batch_id: Optional[str], concurrency: Optional[int], rate: Optional[float]):
+    batch_id = batch_id or batch_id_for(items)
+    chat_logger.info("收到批量问答请求", batch_id=batch_id, items=len(items), concurrency=concurrency, rate=rate)
+
+    async def lines():
+        async for record in batch_runner.run(batch_id, items, _answer_batch_item, concurrency, rate):
+            yield json.dumps(record, ensure_ascii=False) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson", headers={"X-Batch-ID": batch_id})
+
+@app.post("/api/chat/batch")
+async def chat_batch(request: BatchRequest):
+    """批量问答：并发处理一组问题，以 NDJSON 流式返回每个问题的结果"""
+    try:
+        items = parse_items(request.items)
+    except BatchInputError as e:
+        return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content={"error": str(e)})
+    return _batch_response(items, request.batch_id, request.concurrency, request.rate)
+
+@app.post("/api/chat/batch/upload")
+async def chat_batch_upload(
+    file: UploadFile = File(...),
+    batch_id: Optional[str] = Form(None),
+    concurrency: Optional[int] = Form(None),
+    rate: Optional[float] = Form(None),
+):
+    """批量问答（上传文件版本）：支持 JSON 数组、JSON Lines 和每行一个问题的纯文本"""
+    try:
+        items = parse_file(file.filename, await file.read())
+    except BatchInputError as e:
+        return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content={"error": str(e)})
+    return _batch_response(items, batch_id, concurrency, rate)
+
+@app.get("/api/chat/batch/stats")
+async def chat_batch_stats():
+    """批量问答状态：运行中的批次和问题数、累计完成和失败数"""
+    return batch_runner.stats()
+
+class PrefetchRequest(BaseModel):
+    message: str
+    chat_history: Optional[List[Message]] = []
+
+@app.post("/api/chat/prefetch", status_code=status.HTTP_202_ACCEPTED)
+async def chat_prefetch(request: PrefetchRequest, request_raw: Request):
+    """
+    输入时预取：前端在用户停止输入后发送草稿，后台提前检索，发送问题时直接使用结果（见 prefetch.py）
+
+    必须指定会话ID（预取结果按会话保存），不会为预取创建会话。chat_history 应与随后发送问题时的历史相同，
+    查询变体才能与正式请求匹配。
+    """
+    conversation_id = _requested_conversation_id(request_raw)
+    if conversation_id is None:
+        metrics.PREFETCH_REQUESTS.inc(outcome="no_conversation")
+        return JSONResponse(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            content={"error": "预取需要 conversation_id"}
+        )
+    draft = request.message.strip()
+    retriever = warmup.retriever
+    if not PREFETCH_ENABLED or retriever is None or len(draft) < PREFETCH_MIN_CHARS:
+        outcome = "skipped"
+    elif warmup.fields is not None and warmup.fields.match(draft):
+        # 说明书章节问题直接使用字段原文，不需要检索
+        outcome = "skipped"
+    else:
+        # 与正式请求使用相同的规则：请求中的历史，没有时使用服务器存储的历史（会话还不存在时为空）
+        conversation = conversation_store.get(conversation_id)
+        chat_history = request.chat_history or (conversation.view() if conversation is not None else [])
+        queries = _query_variants(draft, chat_history)
+        outcome = prefetch_cache.schedule(conversation_id, queries, lambda qs: _search_queries(retriever, qs))
+    metrics.PREFETCH_REQUESTS.inc(outcome=outcome)
+    return {"status": outcome, "conversation_id": conversation_id}
+
+@app.get("/api/chat/prefetch/stats")
+async def chat_prefetch_stats():
+    """输入时预取状态：保存的会话数和正在进行的预取检索数"""
+    return prefetch_cache.stats()
 
 @app.post("/api/chat/stream")
 @app.get("/api/chat/stream")
@@ -533,56 +919,59 @@ async def chat_stream(
     request_raw: Request = None
 ):
     """流式聊天API端点 - 支持POST和GET请求"""
+    stream_start = time.perf_counter()
+    ticket = None
+    deadline = _request_deadline(request_raw, "chat_stream")
     try:
         # 如果是GET请求，尝试从查询参数获取消息，用于EventSource
         message = ""
         chat_history = []
+        conversation = conversation_store[conversation_id]
         
         if request_raw and request_raw.method == "GET":
             # 从会话ID尝试获取最后一条用户消息
-            if conversation_id in conversation_store and conversation_store[conversation_id]["messages"]:
-                messages = conversation_store[conversation_id]["messages"]
-                chat_history = messages.copy()  # 保存整个历史
-                user_messages = [msg for msg in messages if msg["role"] == "user"]
-                if user_messages:
-                    message = user_messages[-1]["content"]
-                    print(f"GET请求使用会话 {conversation_id} 的最后一条用户消息: '{message}'")
-                    print(f"聊天历史包含 {len(chat_history)} 条消息")
+            if conversation:
+                chat_history = conversation.view()  # 整个历史的视图
+                last_user = conversation.last_user_message()
+                if last_user is not None:
+                    message = last_user.content
+                    stream_logger.debug("GET请求使用最后一条用户消息", conversation_id=conversation_id, message=message, history=len(chat_history))
                 else:
-                    print(f"警告: 会话 {conversation_id} 没有用户消息")
+                    stream_logger.warning("会话没有用户消息", conversation_id=conversation_id)
             else:
-                print(f"警告: 未找到会话 {conversation_id} 或会话为空")
+                stream_logger.warning("会话不存在或为空", conversation_id=conversation_id)
         elif request:
             message = request.message
             
-            # 处理聊天历史，可能是Pydantic模型或已经是字典列表
+            # 请求中的历史（Message对象）直接传给 smart_answer
             if request.chat_history:
-                # 转换Message对象为字典
-                chat_history = []
-                for msg in request.chat_history:
-                    if isinstance(msg, dict):
-                        chat_history.append(msg)
-                    elif hasattr(msg, "role") and hasattr(msg, "content"):
-                        chat_history.append({
-                            "role": msg.role,
-                            "content": msg.content,
-                            "timestamp": msg.timestamp if hasattr(msg, "timestamp") else None
-                        })
+                chat_history = request.chat_history
             
-            print(f"POST请求接收到的消息: '{message}'")
-            print(f"消息历史长度: {len(chat_history)}")
         else:
-            print("警告: 未能获取到消息内容，使用空字符串")
+            stream_logger.warning("未能获取到消息内容")
         
-        # 打印接收到的请求信息
-        print(f"处理流式请求 - 消息: '{message}', 会话ID: {conversation_id}")
-        print(f"请求方法: {request_raw.method if request_raw else 'POST'}")
+        # 记录接收到的请求信息
+        stream_logger.info("收到流式请求", conversation_id=conversation_id, method=request_raw.method if request_raw else "POST", message=message, history=len(chat_history))
+        
+        # 申请准入；只有POST请求会写入会话历史，因此只对POST请求按会话串行
+        writes_history = bool(request_raw and request_raw.method == "POST")
+        try:
+            ticket = await governor.acquire("chat", conversation_id if writes_history else None)
+        except AdmissionRejected as e:
+            return _admission_rejected_response(e)
         
         # 创建一个异步生成器来流式传输聊天响应
         async def event_generator():
             # 在生成器内部声明非局部变量，确保可以访问外部作用域的变量
             nonlocal message, chat_history, conversation_id
             
+            # 已发送给客户端的字符，断开连接时作为不完整的回答记录
+            sent_chars = []
+            user_recorded = False
+            answer_task = None
+            stream_outcome = "error"
+            metrics.ACTIVE_STREAMS.inc()
+            
             try:
                 if not message:
                     # 如果没有消息，发送简单提示
@@ -626,79 +1015,32 @@ async def chat_stream(
                         "event": "done",
                         "data": json.dumps({"message": "Stream completed", "conversation_id": conversation_id})
                     }
+                    stream_outcome = "empty"
                     return
                 
-                print(f"开始处理流式响应...")
-                try:
-                    model = ChatTongyi(model_name="qwen-turbo")
-                    print("模型初始化成功")
-                except Exception as e:
-                    # 如果模型初始化失败，发送错误信息
-                    error_msg = f"模型初始化失败: {str(e)}"
-                    print(error_msg)
-                    
-                    # 生成后备回答
-                    fallback_response = _generate_fallback_response(message, chat_history)
-                    
-                    # 模拟流式输出后备回答
-                    for char in fallback_response:
-                        yield {
-                            "event": "message",
-                            "data": char
-                        }
-                        await asyncio.sleep(0.01)
-                    
-                    # 发送完成事件
-                    yield {
-                        "event": "done",
-                        "data": json.dumps({"message": "Stream completed with fallback", "conversation_id": conversation_id})
-                    }
-                    
-                    # 更新会话记录（如果是POST请求）
-                    if request_raw and request_raw.method == "POST" and message:
-                        # 记录用户消息
-                        conversation_store[conversation_id]["messages"].append({
-                            "role": "user",
-                            "content": message,
-                            "timestamp": datetime.now().isoformat()
-                        })
-                        # 记录助手消息
-                        conversation_store[conversation_id]["messages"].append({
-                            "role": "assistant", 
-                            "content": fallback_response,
-                            "timestamp": datetime.now().isoformat()
-                        })
-                    
-                    return
-                
-                # 如果是新的会话，获取聊天历史
-                current_chat_history = []
-                if conversation_id in conversation_store:
-                    current_chat_history = conversation_store[conversation_id]["messages"]
-                
-                # 合并当前会话历史和请求中的历史 - 优先使用请求中的历史，如果没有则使用服务器存储的历史
-                if not chat_history and current_chat_history:
-                    chat_history = current_chat_history
-                
-                # 打印历史长度
-                print(f"使用的历史消息数量: {len(chat_history)}")
+                # 优先使用请求中的历史，如果没有则使用服务器存储的历史的视图
+                if not chat_history:
+                    chat_history = conversation.view()
                 
                 # 获取完整回答
-                print(f"调用smart_answer生成回答...")
-                full_response = await smart_answer(message, model, chat_history)
-                print(f"生成的完整回答: '{full_response[:50]}...'(长度:{len(full_response)})")
+                # 模型由路由根据问题复杂度选择；模型不可用时 smart_answer 会返回后备回答
+                # 生成期间定期检查客户端是否已断开，断开后立即取消上游调用
+                answer_task = asyncio.ensure_future(smart_answer(message, None, chat_history, deadline, conversation_id))
+                while not answer_task.done():
+                    await asyncio.wait({answer_task}, timeout=DISCONNECT_POLL_INTERVAL)
+                    if not answer_task.done() and request_raw and await request_raw.is_disconnected():
+                        raise ClientDisconnected()
+                full_response = answer_task.result()
+                stream_logger.debug("回答生成完成", conversation_id=conversation_id, history=len(chat_history), answer_chars=len(full_response))
                 
                 # 只有POST请求才记录聊天历史
                 if request_raw and request_raw.method == "POST":
                     # 记录用户消息
-                    conversation_store[conversation_id]["messages"].append({
-                        "role": "user",
-                        "content": message,
-                        "timestamp": datetime.now().isoformat()
-                    })
+                    conversation.append(USER, message)
+                    user_recorded = True
                 
                 # 模拟流式输出 - 将整个回答按字符分割
-                print(f"开始发送流式响应字符...")
+                emit_start = time.perf_counter()
                 char_count = 0
                 for char in full_response:
                     # 直接发送字符，不包装在JSON对象中
@@ -706,23 +1048,24 @@ async def chat_stream(
                         "event": "message",
                         "data": char
                     }
+                    if not sent_chars:
+                        metrics.TIME_TO_FIRST_TOKEN_SECONDS.observe(time.perf_counter() - stream_start, source="sse")
+                    sent_chars.append(char)
                     char_count += 1
-                    # 每100个字符打印一次状态
+                    # 每100个字符确认一次客户端仍在连接
                     if char_count % 100 == 0:
-                        print(f"已发送 {char_count} 个字符...")
+                        if request_raw and await request_raw.is_disconnected():
+                            raise ClientDisconnected()
                     # 添加小延迟使效果更自然
                     await asyncio.sleep(0.01)
                 
-                print(f"字符发送完成，共 {char_count} 个字符")
+                
+                record_span("sse.emit", emit_start, chars=char_count)
                 
                 # 只有POST请求才记录聊天历史
                 if request_raw and request_raw.method == "POST":
                     # 更新会话消息列表
-                    conversation_store[conversation_id]["messages"].append({
-                        "role": "assistant",
-                        "content": full_response,
-                        "timestamp": datetime.now().isoformat()
-                    })
+                    conversation.append(ASSISTANT, full_response)
                 
                 # 发送完成事件，包含会话ID
                 completion_data = {
@@ -733,19 +1076,36 @@ async def chat_stream(
                     "event": "done",
                     "data": json.dumps(completion_data)
                 }
-                print(f"发送完成事件: {completion_data}")
+                stream_logger.info("流式响应完成", conversation_id=conversation_id, chars=char_count)
+                stream_outcome = "completed"
                 
+            except (ClientDisconnected, asyncio.CancelledError, GeneratorExit) as e:
+                # 客户端断开连接：停止上游生成，把已发送的部分作为不完整的回答记录
+                stream_logger.info("客户端断开连接", conversation_id=conversation_id, sent_chars=len(sent_chars))
+                stream_outcome = "disconnected"
+                deadline.cancel()
+                if answer_task and not answer_task.done():
+                    answer_task.cancel()
+                if request_raw and request_raw.method == "POST" and message:
+                    if not user_recorded:
+                        conversation.append(USER, message)
+                    conversation.append(ASSISTANT, "".join(sent_chars), truncated=True)
+                # 由服务器框架发起的取消需要继续向上传递
+                if not isinstance(e, ClientDisconnected):
+                    raise
             except Exception as e:
-                error_msg = f"流式响应错误: {str(e)}"
-                print(error_msg)
-                print(f"错误详情: {type(e).__name__}, {e.__traceback__.tb_lineno}")
+                stream_logger.exception("流式响应错误", conversation_id=conversation_id, error=str(e))
                 yield {
                     "event": "error",
                     "data": json.dumps({"error": str(e)})
                 }
+            finally:
+                # 流结束（包括客户端断开）时释放准入槽位
+                ticket.release()
+                metrics.ACTIVE_STREAMS.dec()
+                metrics.SSE_STREAM_SECONDS.observe(time.perf_counter() - stream_start, outcome=stream_outcome)
         
         # 使用EventSourceResponse正确构造SSE响应
-        print("创建EventSourceResponse...")
         response = EventSourceResponse(
             event_generator(),
             media_type="text/event-stream",
@@ -754,33 +1114,72 @@ async def chat_stream(
                 "Connection": "keep-alive", 
                 "X-Accel-Buffering": "no",  # 禁用Nginx缓冲
                 "Access-Control-Allow-Origin": "*",  # 允许跨域
-            }
+            },
+            # 生成器未被执行时（例如连接提前关闭）也保证释放准入槽位
+            background=BackgroundTask(ticket.release)
         )
-        print("返回EventSourceResponse")
         return response
         
     except Exception as e:
-        error_msg = f"流式聊天API端点错误: {str(e)}"
-        print(error_msg)
-        print(f"错误详情: {type(e).__name__}, {e.__traceback__.tb_lineno}")
+        if ticket:
+            ticket.release()
+        stream_logger.exception("流式聊天API端点错误", conversation_id=conversation_id, error=str(e))
         return JSONResponse(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             content={"error": str(e)}
         )
 
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """If-None-Match 中有与 etag 弱比较相等的值（或为 *）"""
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag.removeprefix("W/") in (tag.removeprefix("W/") for tag in tags)
+
+
 @app.get("/api/history/{conversation_id}")
-async def get_history(conversation_id: str):
-    """获取特定会话的历史记录"""
-    if conversation_id not in conversation_store:
+async def get_history(conversation_id: str, http_request: Request, before: Optional[int] = None,
+                      after: Optional[int] = None, limit: Optional[int] = None):
+    """
+    获取特定会话的历史记录，按消息序号分页
+
+    - before / after: 只返回序号小于 before / 大于 after 的消息；只给 after 时返回其后最早的 limit 条，
+      否则返回最近的 limit 条
+    - limit: 最多返回的条数，默认 HISTORY_PAGE_DEFAULT，不超过 HISTORY_PAGE_MAX
+
+    响应带 ETag（由会话创建时刻、最后一条消息的序号和分页参数生成），请求带相同的 If-None-Match 时
+    这一页没有变化，返回 304 且没有响应体。响应体用 orjson 序列化。
+    """
+    conversation = conversation_store.get(conversation_id)
+    if conversation is None:
+        metrics.HISTORY_REQUESTS.inc(outcome="not_found")
         return JSONResponse(
             status_code=status.HTTP_404_NOT_FOUND,
             content={"error": "Conversation not found"}
         )
-    
-    return {
-        "history": conversation_store[conversation_id]["messages"],
-        "conversation_id": conversation_id
-    }
+    if limit is None:
+        limit = HISTORY_PAGE_DEFAULT
+    if not 1 <= limit <= HISTORY_PAGE_MAX or (before is not None and before < 0) or (after is not None and after < -1):
+        return JSONResponse(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            content={"error": f"limit 应在 1~{HISTORY_PAGE_MAX} 之间，before 不能为负数，after 不能小于 -1"}
+        )
+
+    etag = conversation.etag(before, after, limit)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if _etag_matches(http_request.headers.get("if-none-match"), etag):
+        metrics.HISTORY_REQUESTS.inc(outcome="not_modified")
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    start, stop = conversation.page(before, after, limit)
+    metrics.HISTORY_REQUESTS.inc(outcome="ok")
+    return ORJSONResponse({
+        "history": conversation.to_list(start, stop),
+        "conversation_id": conversation_id,
+        "last_seq": conversation.last_seq,
+        "has_more_before": start > 0,
+        "has_more_after": stop < len(conversation),
+    }, headers=headers)
 
 # 保存上传的图片
 async def save_uploaded_file(file: UploadFile) -> str:
@@ -797,18 +1196,75 @@ async def save_uploaded_file(file: UploadFile) -> str:
     
     return file_path
 
+# 解码并保存base64图片（可以带 data URI 前缀），返回保存路径；数据无效时抛出 ValueError，消息可直接返回给客户端
+async def save_base64_image(image_data: str) -> str:
+    decode_start = time.perf_counter()
+    try:
+        # 处理 data URI 前缀
+        base64_data = image_data
+        
+        # 如果包含 data URI 格式，提取 base64 部分
+        if ';base64,' in base64_data:
+            base64_data = base64_data.split(';base64,')[1]
+        elif ',' in base64_data:  # 简单格式 data:,base64数据
+            base64_data = base64_data.split(',')[1]
+            
+        # 解码 base64 数据
+        try:
+            image_bytes = base64.b64decode(base64_data)
+        except Exception as decode_err:
+            multimodal_logger.warning("Base64解码失败", error=str(decode_err))
+            raise ValueError(f"Base64解码失败: {str(decode_err)}")
+        
+        # 验证解码后的数据是否为有效的图像
+        try:
+            await warmup.imports_ready()
+            from PIL import Image
+            image = Image.open(io.BytesIO(image_bytes))
+            image_format = image.format.lower() if image.format else "jpeg"
+            multimodal_logger.debug("图片信息", format=image_format, size=f"{image.size[0]}x{image.size[1]}")
+        except Exception as img_err:
+            multimodal_logger.warning("图片无效", error=str(img_err))
+            raise ValueError(f"提供的数据不是有效的图片: {str(img_err)}")
+        
+        # 生成唯一文件名并保存图片
+        file_name = f"{uuid.uuid4()}.{image_format}"
+        file_path = os.path.join(UPLOAD_DIR, file_name)
+        
+        # 保存图片
+        with open(file_path, 'wb') as f:
+            f.write(image_bytes)
+            
+        metrics.MULTIMODAL_PREPROCESS_SECONDS.observe(time.perf_counter() - decode_start, stage="decode")
+        multimodal_logger.debug("图片已保存", path=file_path)
+        return file_path
+    except ValueError:
+        raise
+    except Exception as e:
+        multimodal_logger.warning("保存图片失败", error=str(e))
+        raise ValueError(f"图片处理失败: {str(e)}")
+
 # 使用DashScope API进行多模态请求
-async def call_dashscope_multimodal(text: str, image_path: str, history: List[Dict[str, str]] = None) -> str:
+@traced("call_dashscope_multimodal")
+async def call_dashscope_multimodal(
+    text: str,
+    image_path: str,
+    history: Optional[Sequence[Any]] = None,
+    deadline: Optional[Deadline] = None
+) -> str:
+    if deadline is None:
+        deadline = Deadline.for_endpoint("multimodal")
     try:
-        print(f"开始处理多模态请求 - 文本: '{text}', 图片: '{image_path}'")
         
         # 直接使用 DashScope API 而不通过 LangChain
+        await warmup.imports_ready()
         import dashscope
         from dashscope import MultiModalConversation
         
         # 读取图片为base64
-        with open(image_path, "rb") as img_file:
-            image_content = base64.b64encode(img_file.read()).decode('utf-8')
+        with span("multimodal.encode"), metrics.MULTIMODAL_PREPROCESS_SECONDS.time(stage="encode"):
+            with open(image_path, "rb") as img_file:
+                image_content = base64.b64encode(img_file.read()).decode('utf-8')
         
         # 添加系统消息
         system_message = {
@@ -823,20 +1279,15 @@ async def call_dashscope_multimodal(text: str, image_path: str, history: List[Di
             ]
         }
         
-        # 转换历史消息格式
+        # 转换历史消息格式（会话历史的视图或请求中的Message对象），只保留文本，不添加图片
         formatted_history = []
         if history and len(history) > 0:
-            print(f"添加{len(history)}条历史消息")
             for msg in history:
-                if msg["role"] == "user":
-                    formatted_history.append({
-                        "role": "user",
-                        "content": [{"text": msg["content"]}]
-                    })
-                elif msg["role"] == "assistant":
+                pair = role_and_content(msg)
+                if pair is not None and pair[0] in ("user", "assistant"):
                     formatted_history.append({
-                        "role": "assistant",
-                        "content": [{"text": msg["content"]}]
+                        "role": pair[0],
+                        "content": [{"text": pair[1]}]
                     })
         
         # 构建当前请求的多模态消息
@@ -855,29 +1306,33 @@ async def call_dashscope_multimodal(text: str, image_path: str, history: List[Di
         # 如果有历史消息，添加当前消息到历史
         messages = [system_message] + formatted_history + [current_message]
         
-        print(f"准备的消息数量: {len(messages)}")
         
         # 设置API密钥
         dashscope.api_key = DASHSCOPE_API_KEY
         
-        # 调用多模态模型
-        response = MultiModalConversation.call(
-            model='qwen-vl-plus',
-            messages=messages,
-            stream=True,
-            result_format='message',  # 使用消息格式
-            temperature=0.7,
-            max_tokens=1000,
-        )
+        # 调用多模态模型（经过限流和熔断保护）
+        # 这里需要一次性拿到完整响应，stream=True 时SDK返回的是生成器，没有 status_code
+        # 根据问题复杂度选择多模态模型和输出长度上限
+        decision = router.route_multimodal(text, history)
+        with span("multimodal.generation", model=decision.model):
+            response = await deadline.run("generation", lambda: upstream.call(
+                decision.model,
+                MultiModalConversation.call,
+                model=decision.model,
+                messages=messages,
+                stream=False,
+                result_format='message',  # 使用消息格式
+                temperature=0.7,
+                max_tokens=decision.max_tokens,
+                is_failure=_is_upstream_failure,
+            ))
         
-        print(f"API调用状态码: {response.status_code}")
-        print(f"API调用请求ID: {response.request_id}")
+        multimodal_logger.debug("多模态API返回", status=response.status_code, request_id=response.request_id, messages=len(messages))
         
         # 检查响应
         if response.status_code == 200:
             # 提取文本内容
             response_message = response.output.choices[0].message
-            print(f"响应角色: {response_message.role}")
             
             # 检查内容类型
             if isinstance(response_message.content, list):
@@ -891,18 +1346,21 @@ async def call_dashscope_multimodal(text: str, image_path: str, history: List[Di
                 # 如果是字符串或其他类型
                 response_text = str(response_message.content)
             
-            print(f"多模态模型返回的响应: '{response_text[:100]}...' (长度: {len(response_text)})")
+            multimodal_logger.debug("多模态回答完成", answer_chars=len(response_text))
             return response_text
         else:
             error_msg = f"API调用失败: {response.status_code}, {response.message}"
-            print(error_msg)
+            multimodal_logger.warning("多模态API调用失败", status=response.status_code, error=response.message)
             return f"处理图片时出错: {error_msg}"
     
+    except UpstreamUnavailable as e:
+        multimodal_logger.warning("多模态模型暂不可用", reason=e.reason)
+        return "很抱歉，图片分析服务当前繁忙或暂时不可用，请稍后再试。"
+    except DeadlineExceeded as e:
+        multimodal_logger.warning("多模态请求超出时间预算", stage=e.stage, remaining=e.remaining)
+        return "很抱歉，图片分析耗时过长，请稍后再试。"
     except Exception as e:
-        error_msg = f"调用多模态API出错: {str(e)}"
-        print(error_msg)
-        import traceback
-        traceback.print_exc()
+        multimodal_logger.exception("调用多模态API出错", error=str(e))
         return f"处理图片时出错: {str(e)}"
 
 # 新增的多模态聊天API端点（上传表单版本）
@@ -910,57 +1368,35 @@ async def call_dashscope_multimodal(text: str, image_path: str, history: List[Di
 async def chat_multimodal(
     message: str = Form(...),
     file: UploadFile = File(...),
-    conversation_id: str = Depends(get_conversation_id)
+    conversation_id: str = Depends(get_conversation_id),
+    request_raw: Request = None
 ):
+    deadline = _request_deadline(request_raw, "multimodal")
+    # 申请准入，同一会话的请求串行执行
     try:
-        print(f"收到多模态表单请求 - 文本: '{message}', 图片: {file.filename}, 会话ID: {conversation_id}")
+        ticket = await governor.acquire("multimodal", conversation_id)
+    except AdmissionRejected as e:
+        return _admission_rejected_response(e)
+
+    try:
+        multimodal_logger.info("收到多模态表单请求", conversation_id=conversation_id, message=message)
         
         # 保存上传的图片
-        file_path = await save_uploaded_file(file)
-        print(f"图片已保存到: {file_path}")
-        
-        # 获取历史消息
-        history = []
-        if conversation_id in conversation_store:
-            # 获取最近的对话历史（最多10条）
-            history = conversation_store[conversation_id]["messages"][-10:]
-            print(f"获取到会话历史, 共{len(history)}条消息")
-        
-        # 转换为模型可用的格式
-        model_history = []
-        for msg in history:
-            if msg["role"] in ["user", "assistant"]:
-                # 只添加文本消息到历史记录，不添加图片
-                model_history.append({
-                    "role": msg["role"],
-                    "content": msg["content"]
-                })
+        with metrics.MULTIMODAL_PREPROCESS_SECONDS.time(stage="upload"):
+            file_path = await save_uploaded_file(file)
+        multimodal_logger.debug("图片已保存", path=file_path)
         
-        print(f"准备调用多模态模型, 文本: '{message}', 历史消息: {len(model_history)}条")
+        # 最近的对话历史（最多10条）的视图，由 call_dashscope_multimodal 转换成模型格式
+        conversation = conversation_store[conversation_id]
+        model_history = conversation.view(10)
         
         # 调用多模态模型
-        response_text = await call_dashscope_multimodal(message, file_path, model_history)
-        print(f"多模态响应: '{response_text[:100]}...' (长度: {len(response_text)})")
+        response_text = await call_dashscope_multimodal(message, file_path, model_history, deadline)
+        multimodal_logger.info("多模态回答完成", conversation_id=conversation_id, history=len(model_history), answer_chars=len(response_text))
         
-        # 记录消息到会话历史
-        current_time = datetime.now().isoformat()
-        
-        # 记录用户消息（带图片）
-        user_message = {
-            "role": "user",
-            "content": message,
-            "timestamp": current_time,
-            "image_url": file_path  # 存储图片路径
-        }
-        conversation_store[conversation_id]["messages"].append(user_message)
-        
-        # 记录助手响应
-        assistant_message = {
-            "role": "assistant",
-            "content": response_text,
-            "timestamp": datetime.now().isoformat()
-        }
-        conversation_store[conversation_id]["messages"].append(assistant_message)
+        # 记录用户消息（带图片路径）和助手响应到会话历史
+        conversation.append(USER, message, image_url=file_path)
+        conversation.append(ASSISTANT, response_text)
         
         return {
             "response": response_text,
@@ -968,22 +1404,30 @@ async def chat_multimodal(
         }
     
     except Exception as e:
-        print(f"多模态聊天错误: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        multimodal_logger.exception("多模态表单请求错误", conversation_id=conversation_id, error=str(e))
         return JSONResponse(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             content={"error": str(e)}
         )
+    finally:
+        ticket.release()
 
 # 新增的多模态聊天API端点（JSON版本，接受base64图片数据）
 @app.post("/api/chat/multimodal-json")
 async def chat_multimodal_json(
     request: MultiModalRequest,
-    conversation_id: str = Depends(get_conversation_id)
+    conversation_id: str = Depends(get_conversation_id),
+    request_raw: Request = None
 ):
+    deadline = _request_deadline(request_raw, "multimodal")
+    # 申请准入，同一会话的请求串行执行
+    try:
+        ticket = await governor.acquire("multimodal", conversation_id)
+    except AdmissionRejected as e:
+        return _admission_rejected_response(e)
+
     try:
-        print(f"收到多模态JSON请求 - 文本: '{request.message}', 会话ID: {conversation_id}")
+        multimodal_logger.info("收到多模态JSON请求", conversation_id=conversation_id, message=request.message)
         
         if not request.image_data:
             return JSONResponse(
@@ -993,109 +1437,24 @@ async def chat_multimodal_json(
         
         # 解码并保存base64图片
         try:
-            # 处理 data URI 前缀
-            base64_data = request.image_data
-            
-            # 如果包含 data URI 格式，提取 base64 部分
-            if ';base64,' in base64_data:
-                base64_data = base64_data.split(';base64,')[1]
-            elif ',' in base64_data:  # 简单格式 data:,base64数据
-                base64_data = base64_data.split(',')[1]
-                
-            # 解码 base64 数据
-            try:
-                image_bytes = base64.b64decode(base64_data)
-            except Exception as decode_err:
-                print(f"Base64解码失败: {str(decode_err)}")
-                return JSONResponse(
-                    status_code=status.HTTP_400_BAD_REQUEST,
-                    content={"error": f"Base64解码失败: {str(decode_err)}"}
-                )
-            
-            # 验证解码后的数据是否为有效的图像
-            try:
-                from PIL import Image
-                image = Image.open(io.BytesIO(image_bytes))
-                image_format = image.format.lower() if image.format else "jpeg"
-                print(f"图片格式: {image_format}, 尺寸: {image.size}")
-            except Exception as img_err:
-                print(f"图片无效: {str(img_err)}")
-                return JSONResponse(
-                    status_code=status.HTTP_400_BAD_REQUEST,
-                    content={"error": f"提供的数据不是有效的图片: {str(img_err)}"}
-                )
-            
-            # 生成唯一文件名并保存图片
-            file_name = f"{uuid.uuid4()}.{image_format}"
-            file_path = os.path.join(UPLOAD_DIR, file_name)
-            
-            # 保存图片
-            with open(file_path, 'wb') as f:
-                f.write(image_bytes)
-                
-            print(f"Base64图片已保存到: {file_path}")
-        except Exception as e:
-            print(f"保存base64图片失败: {str(e)}")
+            file_path = await save_base64_image(request.image_data)
+        except ValueError as e:
             return JSONResponse(
                 status_code=status.HTTP_400_BAD_REQUEST,
-                content={"error": f"图片处理失败: {str(e)}"}
+                content={"error": str(e)}
             )
         
-        # 处理聊天历史
-        chat_history = []
-        if request.chat_history:
-            # 安全地转换Message对象为字典
-            for msg in request.chat_history:
-                try:
-                    # 如果msg已经是字典
-                    if isinstance(msg, dict):
-                        # 确保有role和content字段
-                        if "role" in msg and "content" in msg:
-                            chat_history.append(msg)
-                        else:
-                            print(f"警告: 消息缺少必要字段 {msg}")
-                    # 如果msg是Pydantic模型
-                    elif hasattr(msg, "role") and hasattr(msg, "content"):
-                        chat_history.append({
-                            "role": msg.role,
-                            "content": msg.content,
-                            "timestamp": msg.timestamp if hasattr(msg, "timestamp") else datetime.now().isoformat()
-                        })
-                    else:
-                        print(f"警告: 无法识别的消息类型 {type(msg)}")
-                except Exception as msg_error:
-                    print(f"处理消息时出错: {str(msg_error)}")
-                    # 继续处理下一条消息
-        
-        # 如果请求的历史为空，获取服务器存储的历史
-        if not chat_history and conversation_id in conversation_store:
-            chat_history = conversation_store[conversation_id]["messages"][-10:]
-            print(f"使用服务器存储的历史记录, 共{len(chat_history)}条消息")
-        
-        # 转换为模型可用的格式
-        model_history = []
-        for msg in chat_history:
-            try:
-                if isinstance(msg, dict) and "role" in msg and "content" in msg:
-                    if msg["role"] in ["user", "assistant"]:
-                        # 只添加文本消息到历史记录，不添加图片
-                        model_history.append({
-                            "role": msg["role"],
-                            "content": msg["content"]
-                        })
-                else:
-                    print(f"跳过不符合格式的消息: {msg}")
-            except Exception as e:
-                print(f"处理历史消息时出错: {str(e)}")
-        
-        print(f"准备调用多模态模型, 文本: '{request.message}', 历史消息: {len(model_history)}条")
+        # 优先使用请求中的历史（Message对象），为空时使用服务器存储的最近10条历史的视图；
+        # 由 call_dashscope_multimodal 转换成模型格式，这里不复制消息
+        conversation = conversation_store[conversation_id]
+        model_history = request.chat_history or conversation.view(10)
         
         # 调用多模态模型 - 使用当前的请求消息
-        response_text = await call_dashscope_multimodal(request.message, file_path, model_history)
+        response_text = await call_dashscope_multimodal(request.message, file_path, model_history, deadline)
         
         # 确保响应是字符串格式
         if not isinstance(response_text, str):
-            print(f"警告: 响应不是字符串类型, 而是 {type(response_text)}")
+            multimodal_logger.warning("多模态响应不是字符串", type=type(response_text).__name__)
             if response_text is None:
                 response_text = "图像处理完成，但未能生成回复。"
             else:
@@ -1124,30 +1483,14 @@ async def chat_multimodal_json(
                     else:
                         response_text = str(response_text)
                 except Exception as text_err:
-                    print(f"转换响应为字符串时出错: {str(text_err)}")
+                    multimodal_logger.warning("转换多模态响应出错", error=str(text_err))
                     response_text = "收到响应，但格式无法处理。"
         
-        print(f"多模态响应: '{response_text[:100]}...' (长度: {len(response_text)})")
+        multimodal_logger.info("多模态回答完成", conversation_id=conversation_id, history=len(model_history), answer_chars=len(response_text))
         
-        # 记录消息到会话历史
-        current_time = datetime.now().isoformat()
-        
-        # 记录用户消息（带图片）
-        user_message = {
-            "role": "user",
-            "content": request.message,
-            "timestamp": current_time,
-            "image_url": file_path  # 存储图片路径
-        }
-        conversation_store[conversation_id]["messages"].append(user_message)
-        
-        # 记录助手响应
-        assistant_message = {
-            "role": "assistant",
-            "content": response_text,
-            "timestamp": datetime.now().isoformat()
-        }
-        conversation_store[conversation_id]["messages"].append(assistant_message)
+        # 记录用户消息（带图片路径）和助手响应到会话历史
+        conversation.append(USER, request.message, image_url=file_path)
+        conversation.append(ASSISTANT, response_text)
         
         return {
             "response": response_text,
@@ -1155,94 +1498,265 @@ async def chat_multimodal_json(
         }
     
     except Exception as e:
-        print(f"多模态JSON请求错误: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        multimodal_logger.exception("多模态JSON请求错误", conversation_id=conversation_id, error=str(e))
         return JSONResponse(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             content={"error": str(e)}
         )
+    finally:
+        ticket.release()
+
+# 文生图模型（wanx2.1-t2i-turbo）支持的图片数量和边长范围
+TEXT2IMAGE_MAX_IMAGES = 4
+TEXT2IMAGE_SIDE_RANGE = (512, 1440)
 
-# 定义文生图请求模型类
+# 定义文生图请求模型类（HTTP 接口和 WebSocket 的 text2image 帧共用同一校验）
 class TextToImageRequest(BaseModel):
     prompt: str  # 图像生成提示词
     negative_prompt: Optional[str] = None  # 负面提示词，可选
-    n: Optional[int] = 1  # 生成图片数量，默认1张
-    size: Optional[str] = "1024*1024"  # 图片尺寸，默认1024*1024
+    n: Optional[int] = Field(1, ge=1, le=TEXT2IMAGE_MAX_IMAGES)  # 生成图片数量，默认1张
+    size: Optional[str] = Field("1024*1024", pattern=r"^\d+\*\d+$")  # 图片尺寸“宽*高”，默认1024*1024
+
+    @field_validator("size")
+    @classmethod
+    def _check_size(cls, size: Optional[str]) -> Optional[str]:
+        low, high = TEXT2IMAGE_SIDE_RANGE
+        if size is not None and not all(low <= int(side) <= high for side in size.split("*")):
+            raise ValueError(f"图片宽和高应在 {low}~{high} 之间")
+        return size
+
+# 记录文生图请求和生成的第一张图片（直接使用大模型返回的URL）到会话历史
+def _record_images(conversation: Conversation, prompt: str, image_urls: List[str]) -> None:
+    conversation.append(USER, f"请根据以下描述生成图片: {prompt}")
+    if image_urls:
+        conversation.append(ASSISTANT, f"已根据您的描述生成图片: {prompt}", image_url=image_urls[0])
+
+class ImageSynthesisError(Exception):
+    """文生图接口返回了非200状态"""
+
+# 调用文生图API（经过限流和熔断保护），返回大模型生成的图片URL
+# 上游不可用时抛出 UpstreamUnavailable，超出预算时抛出 DeadlineExceeded，接口返回错误时抛出 ImageSynthesisError
+async def synthesize_images(prompt: str, negative_prompt: Optional[str], n: Optional[int], size: Optional[str],
+                            deadline: Deadline) -> List[str]:
+    image_start = time.perf_counter()
+    try:
+        await warmup.imports_ready()
+        from dashscope import ImageSynthesis
+        rsp = await deadline.run("generation", lambda: upstream.call(
+            "wanx2.1-t2i-turbo",
+            ImageSynthesis.call,
+            api_key=os.getenv("DASHSCOPE_API_KEY"),
+            model="wanx2.1-t2i-turbo",  # 使用wanx2.1-t2i-turbo模型
+            prompt=prompt,
+            negative_prompt=negative_prompt,
+            n=n,
+            size=size,
+            is_failure=_is_upstream_failure,
+        ))
+    except UpstreamUnavailable as e:
+        metrics.TEXT2IMAGE_SECONDS.observe(time.perf_counter() - image_start, outcome="unavailable")
+        image_logger.warning("文生图服务暂不可用", reason=e.reason)
+        raise
+    except DeadlineExceeded as e:
+        metrics.TEXT2IMAGE_SECONDS.observe(time.perf_counter() - image_start, outcome="timeout")
+        image_logger.warning("文生图请求超出时间预算", stage=e.stage, remaining=e.remaining)
+        raise
+    metrics.TEXT2IMAGE_SECONDS.observe(
+        time.perf_counter() - image_start, outcome="ok" if rsp.status_code == 200 else "error"
+    )
+    image_logger.debug("文生图API返回", status=rsp.status_code, request_id=getattr(rsp, "request_id", None))
+    
+    if rsp.status_code != 200:
+        image_logger.warning("文生图API调用失败", status=rsp.status_code, error=rsp.message)
+        raise ImageSynthesisError(f"文生图API调用失败: {rsp.status_code}, {rsp.message}")
+    # 直接使用大模型返回的原始图片URL
+    return [result.url for result in rsp.output.results]
 
 # 文生图API端点
 @app.post("/api/text2image")
 async def text2image(
     request: TextToImageRequest,
-    conversation_id: str = Depends(get_conversation_id)
+    conversation_id: str = Depends(get_conversation_id),
+    request_raw: Request = None
 ):
     """生成图像的API端点"""
+    deadline = _request_deadline(request_raw, "text2image")
+    # 申请准入，同一会话的请求串行执行
     try:
-        print(f"收到文生图请求 - 提示词: '{request.prompt}', 会话ID: {conversation_id}")
-        
-        # 调用文生图API
-        rsp = ImageSynthesis.call(
-            api_key=os.getenv("DASHSCOPE_API_KEY"),
-            model="wanx2.1-t2i-turbo",  # 使用wanx2.1-t2i-turbo模型
-            prompt=request.prompt,
-            negative_prompt=request.negative_prompt,
-            n=request.n,
-            size=request.size
-        )
-        print('文生图API响应:', rsp)
+        ticket = await governor.acquire("text2image", conversation_id)
+    except AdmissionRejected as e:
+        return _admission_rejected_response(e)
+
+    try:
+        image_logger.info("收到文生图请求", conversation_id=conversation_id, prompt=request.prompt, n=request.n, size=request.size)
         
-        # 处理响应
-        if rsp.status_code == 200:
-            # 收集大模型返回的原始图片URL
-            original_image_urls = []
-            
-            for result in rsp.output.results:
-                # 直接使用大模型返回的URL
-                original_image_urls.append(result.url)
-                print(f"大模型生成的图片URL: {result.url}")
-            
-            # 记录到会话历史
-            current_time = datetime.now().isoformat()
-            
-            # 记录用户请求
-            user_message = {
-                "role": "user",
-                "content": f"请根据以下描述生成图片: {request.prompt}",
-                "timestamp": current_time
-            }
-            conversation_store[conversation_id]["messages"].append(user_message)
-            
-            # 记录系统响应
-            if original_image_urls:
-                assistant_message = {
-                    "role": "assistant",
-                    "content": f"已根据您的描述生成图片: {request.prompt}",
-                    "timestamp": datetime.now().isoformat(),
-                    "image_url": original_image_urls[0]  # 直接使用大模型返回的URL
-                }
-                conversation_store[conversation_id]["messages"].append(assistant_message)
-            
-            # 返回结果
-            return {
-                "image_urls": original_image_urls,
-                "conversation_id": conversation_id
-            }
-        else:
-            error_msg = f"文生图API调用失败: {rsp.status_code}, {rsp.message}"
-            print(error_msg)
+        try:
+            original_image_urls = await synthesize_images(
+                request.prompt, request.negative_prompt, request.n, request.size, deadline
+            )
+        except UpstreamUnavailable as e:
+            return JSONResponse(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                content={"error": "文生图服务暂时不可用，请稍后再试"},
+                headers={"Retry-After": str(int(e.retry_after))}
+            )
+        except DeadlineExceeded:
+            return JSONResponse(
+                status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+                content={"error": "文生图请求超时，请稍后再试"}
+            )
+        except ImageSynthesisError as e:
             return JSONResponse(
                 status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                content={"error": error_msg}
+                content={"error": str(e)}
             )
+        
+        _record_images(conversation_store[conversation_id], request.prompt, original_image_urls)
+        
+        # 返回结果
+        return {
+            "image_urls": original_image_urls,
+            "conversation_id": conversation_id
+        }
             
     except Exception as e:
-        print(f"文生图API请求错误: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        image_logger.exception("文生图请求错误", conversation_id=conversation_id, error=str(e))
         return JSONResponse(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             content={"error": str(e)}
         )
+    finally:
+        ticket.release()
+
+# WebSocket 请求帧中的可选历史，格式与 HTTP 接口的 chat_history 相同
+def _ws_history(frame: Dict[str, Any]) -> Optional[List[Dict[str, Any]]]:
+    history = frame.get("chat_history")
+    if history is None:
+        return None
+    if not isinstance(history, list) or not all(
+            isinstance(m, dict) and isinstance(m.get("role"), str) and isinstance(m.get("content"), str) for m in history):
+        raise RequestError("chat_history 应为包含 role 和 content 的对象列表")
+    return history
+
+def _ws_text(frame: Dict[str, Any], field: str) -> str:
+    value = frame.get(field)
+    if not isinstance(value, str) or not value.strip():
+        raise RequestError(f"缺少 {field}")
+    return value
+
+# WebSocket 请求的截止时间：帧中的 deadline_ms 与 HTTP 请求头的作用相同
+def _ws_deadline(frame: Dict[str, Any], endpoint: str) -> Deadline:
+    deadline_ms = frame.get("deadline_ms")
+    return Deadline.for_endpoint(endpoint, str(deadline_ms) if deadline_ms is not None else None)
+
+# 与 HTTP 接口使用同一准入控制，被拒绝时以 error 帧返回
+async def _ws_admit(lane: str, conversation_id: str):
+    try:
+        return await governor.acquire(lane, conversation_id)
+    except AdmissionRejected as e:
+        admission_logger.warning("请求未被准入", lane=e.lane, status=e.status_code, reason=e.reason, retry_after=e.retry_after)
+        raise RequestError(e.reason, "overloaded", retry_after=e.retry_after)
+
+async def _ws_chat(session: WebSocketSession, request_id: str, frame: Dict[str, Any]) -> None:
+    """文字问答：模型输出的增量以 delta 帧推送，完成后发送带完整回答的 done 帧"""
+    message = _ws_text(frame, "message")
+    chat_history = _ws_history(frame)
+    conversation_id = _ensure_conversation(frame.get("conversation_id"))
+    conversation = conversation_store[conversation_id]
+    deadline = _ws_deadline(frame, "chat_stream")
+    ticket = await _ws_admit("chat", conversation_id)
+    sink = session.sink_for(request_id)
+    context_token = token_sink.set(sink)
+    try:
+        session.send({"type": "ack", "id": request_id, "conversation_id": conversation_id})
+        stream_logger.info("收到WebSocket聊天请求", conversation_id=conversation_id, request_id=request_id, message=message)
+        # 优先使用帧中的历史，没有时使用服务器存储的历史，客户端不需要每次重发
+        answer = await smart_answer(message, None, chat_history or conversation.view(), deadline, conversation_id)
+        sink.close()
+        conversation.append(USER, message)
+        conversation.append(ASSISTANT, answer)
+        session.send({"type": "done", "id": request_id, "conversation_id": conversation_id, "answer": answer})
+    except asyncio.CancelledError:
+        # 客户端取消或断开：停止上游生成，把已推送的部分作为不完整的回答记录
+        deadline.cancel()
+        sink.close()
+        stream_logger.info("WebSocket聊天请求已取消", conversation_id=conversation_id, request_id=request_id)
+        conversation.append(USER, message)
+        conversation.append(ASSISTANT, sink.text, truncated=True)
+        raise
+    finally:
+        token_sink.reset(context_token)
+        ticket.release()
+
+async def _ws_multimodal(session: WebSocketSession, request_id: str, frame: Dict[str, Any]) -> None:
+    """图片问答：image_data 为 base64 图片数据（可以带 data URI 前缀）"""
+    message = _ws_text(frame, "message")
+    image_data = _ws_text(frame, "image_data")
+    chat_history = _ws_history(frame)
+    conversation_id = _ensure_conversation(frame.get("conversation_id"))
+    conversation = conversation_store[conversation_id]
+    deadline = _ws_deadline(frame, "multimodal")
+    ticket = await _ws_admit("multimodal", conversation_id)
+    try:
+        session.send({"type": "ack", "id": request_id, "conversation_id": conversation_id})
+        multimodal_logger.info("收到WebSocket多模态请求", conversation_id=conversation_id, request_id=request_id, message=message)
+        try:
+            file_path = await save_base64_image(image_data)
+        except ValueError as e:
+            raise RequestError(str(e))
+        answer = await call_dashscope_multimodal(message, file_path, chat_history or conversation.view(10), deadline)
+        conversation.append(USER, message, image_url=file_path)
+        conversation.append(ASSISTANT, answer)
+        session.send({"type": "done", "id": request_id, "conversation_id": conversation_id, "answer": answer})
+    except asyncio.CancelledError:
+        deadline.cancel()
+        raise
+    finally:
+        ticket.release()
+
+async def _ws_text2image(session: WebSocketSession, request_id: str, frame: Dict[str, Any]) -> None:
+    """文生图：参数与 /api/text2image 相同并按同一请求模型校验，done 帧带 image_urls"""
+    prompt = _ws_text(frame, "prompt")
+    try:
+        request = TextToImageRequest.model_validate(
+            {name: frame[name] for name in TextToImageRequest.model_fields if name in frame})
+    except ValidationError as e:
+        raise RequestError("; ".join(
+            f"{'.'.join(str(part) for part in error['loc'])}: {error['msg']}" for error in e.errors()))
+    conversation_id = _ensure_conversation(frame.get("conversation_id"))
+    deadline = _ws_deadline(frame, "text2image")
+    ticket = await _ws_admit("text2image", conversation_id)
+    try:
+        session.send({"type": "ack", "id": request_id, "conversation_id": conversation_id})
+        image_logger.info("收到WebSocket文生图请求", conversation_id=conversation_id, request_id=request_id, prompt=prompt)
+        try:
+            image_urls = await synthesize_images(
+                prompt, request.negative_prompt, request.n, request.size, deadline
+            )
+        except UpstreamUnavailable as e:
+            raise RequestError("文生图服务暂时不可用，请稍后再试", "unavailable", retry_after=int(e.retry_after))
+        except DeadlineExceeded:
+            raise RequestError("文生图请求超时，请稍后再试", "timeout")
+        except ImageSynthesisError as e:
+            raise RequestError(str(e), "upstream_error")
+        _record_images(conversation_store[conversation_id], prompt, image_urls)
+        session.send({"type": "done", "id": request_id, "conversation_id": conversation_id, "image_urls": image_urls})
+    except asyncio.CancelledError:
+        deadline.cancel()
+        raise
+    finally:
+        ticket.release()
+
+WS_HANDLERS = {
+    "chat": _ws_chat,
+    "multimodal": _ws_multimodal,
+    "text2image": _ws_text2image,
+}
+
+@app.websocket("/ws/chat")
+async def websocket_endpoint(websocket: WebSocket):
+    """WebSocket 多路复用端点：一条连接上并发进行多个会话的聊天、多模态和文生图请求（协议见 websocket_session.py）"""
+    await WebSocketSession(websocket, WS_HANDLERS).run()
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,310 @@
+"""
+Prometheus 指标
+
+不依赖 prometheus_client，按 Prometheus 文本格式（0.0.4）输出计数器、仪表和直方图，
+由 /metrics 端点暴露。指标可以在事件循环和工作线程中同时更新。
+"""
+import bisect
+import threading
+from abc import ABC, abstractmethod
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# 本地处理阶段（检索、嵌入、预处理）的桶边界（秒）
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# 模型生成、流式响应和文生图等长耗时阶段的桶边界（秒）
+SLOW_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.0, 4.0, 8.0, 15.0, 30.0, 60.0, 120.0)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric(ABC):
+    """各类指标的公共部分：名称、说明、标签和更新时使用的锁"""
+
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def _header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+    @abstractmethod
+    def render(self) -> List[str]:
+        """按 Prometheus 文本格式输出该指标的所有行"""
+
+
+class Counter(_Metric):
+    """只增不减的计数器"""
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        lines = self._header()
+        lines.extend(
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_number(value)}"
+            for key, value in items
+        )
+        return lines
+
+
+class Gauge(_Metric):
+    """
+    可增可减的仪表，也可以在输出时通过回调函数取值
+
+    有标签时回调函数返回 {标签值元组: 值}，每个元素输出一个序列。
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 callback: Optional[Callable[[], Any]] = None):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._callback = callback
+
+    def set(self, value: float, **labels: str) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+    def set_function(self, callback: Callable[[], Any]) -> None:
+        self._callback = callback
+
+    def value(self, **labels: str) -> float:
+        if self._callback is not None:
+            value = self._callback()
+            return value.get(self._key(labels), 0.0) if self.labelnames else value
+        return self._values.get(self._key(labels), 0.0)
+
+    def render(self) -> List[str]:
+        lines = self._header()
+        if self._callback is not None and not self.labelnames:
+            try:
+                lines.append(f"{self.name} {_format_number(self._callback())}")
+            except Exception:
+                pass
+            return lines
+        if self._callback is not None:
+            try:
+                items = sorted((tuple(str(v) for v in key), value) for key, value in self._callback().items())
+            except Exception:
+                return lines
+        else:
+            with self._lock:
+                items = sorted(self._values.items())
+        lines.extend(
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_number(value)}"
+            for key, value in items
+        )
+        return lines
+
+
+class Histogram(_Metric):
+    """累积分桶的直方图"""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # 每组标签：各桶计数（不累积）、总和、总数
+        self._series: Dict[Tuple[str, ...], List] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[Dict[str, str]]:
+        """
+        记录代码块的耗时
+
+        返回的字典可以在代码块中修改，用于补充执行结束后才知道的标签（例如结果）
+        """
+        start = time.perf_counter()
+        late_labels = dict(labels)
+        try:
+            yield late_labels
+        finally:
+            self.observe(time.perf_counter() - start, **late_labels)
+
+    def count(self, **labels: str) -> int:
+        series = self._series.get(self._key(labels))
+        return series[2] if series else 0
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = sorted((key, [list(s[0]), s[1], s[2]]) for key, s in self._series.items())
+        lines = self._header()
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, ("le", _format_number(bound)))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_number(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Registry:
+    """指标注册表"""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"指标已存在: {metric.name}")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+def counter(name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+    return registry.register(Counter(name, documentation, labelnames))
+
+
+def gauge(name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+    return registry.register(Gauge(name, documentation, labelnames))
+
+
+def histogram(name: str, documentation: str, labelnames: Sequence[str] = (),
+              buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+    return registry.register(Histogram(name, documentation, labelnames, buckets))
+
+
+# 各阶段耗时
+RETRIEVAL_SECONDS = histogram(
+    "medical_retrieval_seconds", "知识库检索耗时（含查询嵌入）", ["outcome"])
+EMBEDDING_SECONDS = histogram(
+    "medical_embedding_seconds", "调用嵌入模型的耗时", ["operation"])
+LLM_GENERATION_SECONDS = histogram(
+    "medical_llm_generation_seconds", "语言模型生成完整回答的耗时", ["model", "path", "outcome"], SLOW_BUCKETS)
+TIME_TO_FIRST_TOKEN_SECONDS = histogram(
+    "medical_time_to_first_token_seconds",
+    "首个token的等待时间：upstream 为上游返回首个分片，sse 为客户端收到首个字符（从收到请求算起）",
+    ["source"], SLOW_BUCKETS)
+SSE_STREAM_SECONDS = histogram(
+    "medical_sse_stream_duration_seconds", "SSE流式响应的总时长", ["outcome"], SLOW_BUCKETS)
+MULTIMODAL_PREPROCESS_SECONDS = histogram(
+    "medical_multimodal_preprocess_seconds", "多模态请求的图片预处理耗时（解码、校验、保存、编码）", ["stage"])
+TEXT2IMAGE_SECONDS = histogram(
+    "medical_text2image_seconds", "文生图调用耗时", ["outcome"], SLOW_BUCKETS)
+RAG_CONTEXT_CHARS = histogram(
+    "medical_rag_context_chars", "RAG 提示中参考资料的字符数：raw 为检索结果直接拼接，assembled 为去重和截断之后",
+    ["stage"], (500, 1000, 1500, 2000, 3000, 4000, 5000, 6000, 8000, 12000))
+ADMISSION_WAIT_SECONDS = histogram(
+    "medical_admission_wait_seconds", "请求在准入通道中排队等待的时间（含会话串行等待，只统计被准入的请求）", ["lane"],
+    (0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0))
+PREFETCH_SECONDS = histogram(
+    "medical_prefetch_seconds", "输入时预取的检索耗时（防抖等待之后）", ["outcome"])
+
+# 计数器
+FALLBACK_RESPONSES = counter(
+    "medical_fallback_responses_total", "返回后备回答的次数", ["kind"])
+CACHE_HITS = counter(
+    "medical_cache_hits_total", "缓存命中次数", ["cache"])
+CACHE_MISSES = counter(
+    "medical_cache_misses_total", "缓存未命中次数", ["cache"])
+ANSWER_PATH = counter(
+    "medical_answer_path_total", "smart_answer 选择的回答路径（rag/field/direct）及原因", ["path", "reason"])
+RAG_SELECTED_DOCS = counter(
+    "medical_rag_selected_docs_total", "每次检索按相似度阈值选用的分块数量（0 表示没有相关分块）", ["k"])
+WEBSOCKET_FRAMES = counter(
+    "medical_websocket_frames_total", "WebSocket连接收到的客户端帧（按类型）和发出的错误帧（kind=error）", ["kind"])
+RAG_QUERY_VARIANTS = counter(
+    "medical_rag_query_variants_total", "每次检索使用的查询变体数量（1 表示只检索原问题）", ["variants"])
+PREFETCH_REQUESTS = counter(
+    "medical_prefetch_requests_total", "输入时预取请求的处理结果（scheduled/unchanged/busy/skipped/no_conversation）", ["outcome"])
+PREFETCH_LOOKUPS = counter(
+    "medical_prefetch_lookups_total", "smart_answer 检索前查找预取结果的结果（hit/pending_hit/mismatch/miss 等）", ["outcome"])
+ADMISSION_REJECTIONS = counter(
+    "medical_admission_rejections_total", "准入被拒绝的请求（queue_full/timeout/conversation_busy）", ["lane", "reason"])
+HISTORY_REQUESTS = counter(
+    "medical_history_requests_total", "历史记录请求的结果（ok/not_modified/not_found）", ["outcome"])
+
+# 仪表
+CONVERSATIONS = gauge(
+    "medical_conversations", "conversation_store 中的会话数")
+CONVERSATION_MESSAGES = gauge(
+    "medical_conversation_messages", "conversation_store 中的消息总数")
+ACTIVE_STREAMS = gauge(
+    "medical_active_streams", "正在进行的SSE流式响应数")
+ACTIVE_WEBSOCKETS = gauge(
+    "medical_active_websockets", "已建立的WebSocket连接数")
+ADMISSION_ACTIVE = gauge(
+    "medical_admission_active", "各准入通道中正在执行的请求数", ["lane"])
+ADMISSION_QUEUE_DEPTH = gauge(
+    "medical_admission_queue_depth", "各准入通道中排队等待的请求数", ["lane"])
+ADMISSION_LIMIT = gauge(
+    "medical_admission_limit", "各准入通道的并发上限", ["lane"])
+
+
+def render() -> str:
+    return registry.render()
@@ -0,0 +1,127 @@
+"""
+结合对话历史的多查询检索
+
+“那副作用呢？”这类追问只按字面检索时几乎找不到相关分块。这里在本地（不额外调用模型）根据当前问题和最近几轮
+用户提问生成几个查询变体：
+- 原问题本身
+- 追问时，把上一轮问题和去掉“那……呢”等虚词后的当前问题拼在一起
+- 再往前还有一轮问题时，把最近两轮问题和当前问题拼在一起
+
+main 并发检索各个变体，再用倒数排名融合（RRF）合并结果：每个分块的得分是它在各个结果列表中 1/(k + 排名) 之和，
+同时出现在多个列表中、排名靠前的分块排在前面。不是追问（问题本身完整）时只检索原问题，不增加嵌入调用。
+
+只依赖标准库。
+"""
+import copy
+import re
+from typing import Any, Dict, List, Optional, Sequence
+
+from history import role_and_content
+from embedding_cache import normalize_query
+
+# 追问常见的开头和结尾
+_FOLLOW_UP_PREFIX = re.compile(r"^(那么|那|还有|另外|再问一下|再问|如果是|如果|换成|对于|至于|请问)[，,、\s]*")
+_TRAILING = re.compile(r"[呢吗吧啊呀]*[？?。！!，,\s]*$")
+# 指代前文的说法
+FOLLOW_UP_REFERENCES = ("它", "这个药", "这药", "该药", "这种情况", "这样", "上述", "上面", "刚才", "前面")
+# 去掉虚词后不超过这么多字、并且省略了主语的问题通常承接前文提到的对象
+FOLLOW_UP_MAX_CHARS = 8
+# 省略主语的短问题以谓语或药品属性开头（“严重吗”“可以冷冻吗”“剂量要调整吗”）；以疾病、药品等名称开头的
+# 短问题（“感冒吃什么药”“高血压怎么办”）本身是完整的，只检索原问题
+_ELLIPTICAL_START = re.compile(
+    r"^(可不可以|可以|能不能|能否|能|会不会|会|要不要|要|需不需要|需要|是否|是不是|有没有|有什么|有哪些|"
+    r"多久|多长时间|多少|多大|怎么|怎样|如何|什么时候|何时|严重|危险|正常|常见|一般|"
+    r"一天|每天|每次|饭前|饭后|空腹|出现|发生|吃了|用了|漏服|过量|"
+    r"剂量|用法|用量|副作用|不良反应|禁忌|注意事项|疗程|效果|比例|保质期|有效期)"
+)
+# 短问题中表示与前文比较的说法（“活疫苗也可以吗”）
+_SHORT_REFERENCES = ("也",)
+# 往前查找用户提问时最多查看的消息数
+HISTORY_SCAN_MESSAGES = 6
+
+
+def _core(text: str) -> str:
+    """去掉追问开头的“那”“还有”和结尾的语气词、标点"""
+    return _TRAILING.sub("", _FOLLOW_UP_PREFIX.sub("", text.strip())).strip()
+
+
+def is_follow_up(question: str) -> bool:
+    """问题是否像依赖前文的追问"""
+    text = question.strip()
+    core = _core(text)
+    return (
+        bool(_FOLLOW_UP_PREFIX.match(text))
+        or re.search(r"呢[？?。！!\s]*$", text) is not None
+        or any(word in text for word in FOLLOW_UP_REFERENCES)
+        or (len(core) <= FOLLOW_UP_MAX_CHARS
+            and (_ELLIPTICAL_START.match(core) is not None or any(word in core for word in _SHORT_REFERENCES)))
+    )
+
+
+def _previous_questions(question: str, chat_history: Optional[Sequence[Any]], limit: int) -> List[str]:
+    """最近的用户提问（从近到远），跳过末尾与当前问题相同的消息（GET 流式请求的历史中已包含当前问题）"""
+    questions: List[str] = []
+    if not chat_history:
+        return questions
+    current = normalize_query(question)
+    for scanned, message in enumerate(reversed(chat_history)):
+        if scanned >= HISTORY_SCAN_MESSAGES or len(questions) >= limit:
+            break
+        pair = role_and_content(message)
+        if pair is None or pair[0] != "user" or not pair[1].strip():
+            continue
+        if not questions and scanned == 0 and normalize_query(pair[1]) == current:
+            continue
+        questions.append(pair[1])
+    return questions
+
+
+def build_query_variants(question: str, chat_history: Optional[Sequence[Any]] = None,
+                         max_variants: int = 3) -> List[str]:
+    """生成检索用的查询变体，第一个始终是原问题"""
+    variants = [question]
+    if max_variants > 1 and is_follow_up(question):
+        previous = [_core(text) for text in _previous_questions(question, chat_history, max_variants - 1)]
+        current = _core(question) or question.strip()
+        for depth in range(1, len(previous) + 1):
+            variants.append(" ".join(list(reversed(previous[:depth])) + [current]))
+
+    unique, seen = [], set()
+    for variant in variants:
+        key = normalize_query(variant)
+        if key and key not in seen:
+            seen.add(key)
+            unique.append(variant)
+    return unique[:max(1, max_variants)]
+
+
+def reciprocal_rank_fusion(result_lists: Sequence[Sequence[Any]], k: int = 60,
+                           limit: Optional[int] = None) -> List[Any]:
+    """
+    用倒数排名融合合并多个检索结果列表
+
+    按分块内容识别同一个分块，保留相似度最高的那个文档对象；返回的是它的浅拷贝，metadata 中多了 rrf_score。
+    传入的文档对象与检索器、预取缓存等共用，不做修改。
+    limit 为空时取各列表长度的最大值，保持按相似度阈值自适应的分块数量。
+    """
+    scores: Dict[str, float] = {}
+    best: Dict[str, Any] = {}
+    for docs in result_lists:
+        for rank, doc in enumerate(docs):
+            key = doc.page_content
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank + 1)
+            current = best.get(key)
+            if current is None or doc.metadata.get("score", 0.0) > current.metadata.get("score", 0.0):
+                best[key] = doc
+    if limit is None:
+        limit = max((len(docs) for docs in result_lists), default=0)
+    # 分数相同时保持首次出现的顺序（原问题的结果在前）
+    fused = sorted(best, key=lambda key: -scores[key])[:limit]
+    return [_with_metadata(best[key], rrf_score=round(scores[key], 6)) for key in fused]
+
+
+def _with_metadata(doc: Any, **extra: Any) -> Any:
+    """文档对象的浅拷贝，metadata 换成加上 extra 的新字典"""
+    fused = copy.copy(doc)
+    fused.metadata = {**doc.metadata, **extra}
+    return fused
@@ -0,0 +1,177 @@
+"""
+输入时预取检索结果
+
+问题的嵌入和向量检索原来在用户点击发送之后才开始，全部计入等待时间。前端在用户停止输入一小段时间后
+把草稿发到 /api/chat/prefetch，这里在后台提前生成查询变体并检索，把结果按会话保存很短的时间：
+- 每个会话只保留最新草稿的一份结果，新的草稿到来时取消旧草稿尚未完成的检索
+- 服务端再做一次防抖：草稿先等待 PREFETCH_DEBOUNCE 秒，期间被新草稿替换就不再检索
+- 同时进行的预取检索数不超过 PREFETCH_MAX_CONCURRENCY，超出时放弃本次预取，不与正式请求争抢嵌入配额
+
+smart_answer 检索前按会话取出预取结果（取出后即删除）：正式问题的查询变体与草稿的查询变体逐个相同或足够相似
+（规范化后的相似度不低于 PREFETCH_SIMILARITY）时直接使用预取的分块；检索仍在进行时等待它完成，
+不重新计算。查询变体包含了对话历史中的提问，历史变化后变体不再匹配，不会用到过期的结果。
+"""
+import asyncio
+import time
+from collections import OrderedDict
+from difflib import SequenceMatcher
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence
+
+from config import (PREFETCH_DEBOUNCE, PREFETCH_MAX_CONCURRENCY, PREFETCH_MAX_ENTRIES, PREFETCH_SIMILARITY,
+                    PREFETCH_TTL)
+from embedding_cache import normalize_query
+from logger import get_logger
+import metrics
+
+logger = get_logger("prefetch")
+
+Search = Callable[[List[str]], Awaitable[List[Any]]]
+
+
+def similar(draft: str, final: str, threshold: float = PREFETCH_SIMILARITY) -> bool:
+    """草稿和正式问题规范化后相同，或相似度不低于 threshold"""
+    a, b = normalize_query(draft), normalize_query(final)
+    if a == b:
+        return True
+    if not a or not b:
+        return False
+    return SequenceMatcher(None, a, b, autojunk=False).ratio() >= threshold
+
+
+def queries_match(draft: Sequence[str], final: Sequence[str], threshold: float = PREFETCH_SIMILARITY) -> bool:
+    """两组查询变体数量相同且逐个相似"""
+    return len(draft) == len(final) and all(similar(a, b, threshold) for a, b in zip(draft, final))
+
+
+def _finished_without_result(task: "asyncio.Task[Optional[List[Any]]]") -> bool:
+    """预取任务已经结束但没有可用的结果"""
+    return task.done() and (task.cancelled() or task.exception() is not None or task.result() is None)
+
+
+class PrefetchEntry:
+    """一个会话最新草稿的预取"""
+
+    __slots__ = ("queries", "task", "created", "started")
+
+    def __init__(self, queries: List[str]):
+        self.queries = queries
+        self.task: Optional["asyncio.Task[Optional[List[Any]]]"] = None
+        self.created = time.monotonic()
+        # 防抖结束、检索已经开始
+        self.started = False
+
+
+class PrefetchCache:
+    """按会话保存预取的检索结果，超过 ttl 秒或会话数超过上限时淘汰最早的结果"""
+
+    def __init__(self, ttl: float = PREFETCH_TTL, max_entries: int = PREFETCH_MAX_ENTRIES,
+                 debounce: float = PREFETCH_DEBOUNCE, max_concurrency: int = PREFETCH_MAX_CONCURRENCY,
+                 threshold: float = PREFETCH_SIMILARITY):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.debounce = debounce
+        self.max_concurrency = max(1, max_concurrency)
+        self.threshold = threshold
+        self._entries: "OrderedDict[str, PrefetchEntry]" = OrderedDict()
+        self._running = 0
+
+    def _drop(self, conversation_id: str) -> None:
+        entry = self._entries.pop(conversation_id, None)
+        if entry is not None and not entry.task.done():
+            entry.task.cancel()
+
+    def _evict(self) -> None:
+        now = time.monotonic()
+        for conversation_id in [c for c, entry in self._entries.items() if now - entry.created > self.ttl]:
+            self._drop(conversation_id)
+        while len(self._entries) > self.max_entries:
+            self._drop(next(iter(self._entries)))
+
+    def schedule(self, conversation_id: str, queries: List[str], search: Search) -> str:
+        """
+        为会话的草稿安排一次预取，返回 scheduled、unchanged（与已有的预取相同）或 busy（预取并发已满）
+
+        已有的预取已经结束但没有结果（检索失败、因并发已满而放弃或被取消）时视为过期，重新安排。
+        """
+        self._evict()
+        entry = self._entries.get(conversation_id)
+        if entry is not None and entry.queries == queries and not _finished_without_result(entry.task):
+            return "unchanged"
+        if self._running >= self.max_concurrency:
+            return "busy"
+        self._drop(conversation_id)
+        entry = PrefetchEntry(queries)
+        entry.task = asyncio.create_task(self._run(entry, search))
+        self._entries[conversation_id] = entry
+        return "scheduled"
+
+    async def _run(self, entry: PrefetchEntry, search: Search) -> Optional[List[Any]]:
+        await asyncio.sleep(self.debounce)
+        if self._running >= self.max_concurrency:
+            return None
+        entry.started = True
+        self._running += 1
+        start = time.perf_counter()
+        try:
+            docs = await search(entry.queries)
+            metrics.PREFETCH_SECONDS.observe(time.perf_counter() - start, outcome="ok")
+            return docs
+        except asyncio.CancelledError:
+            metrics.PREFETCH_SECONDS.observe(time.perf_counter() - start, outcome="cancelled")
+            raise
+        except Exception as e:
+            metrics.PREFETCH_SECONDS.observe(time.perf_counter() - start, outcome="error")
+            logger.warning("预取检索失败", error=str(e))
+            return None
+        finally:
+            self._running -= 1
+
+    async def claim(self, conversation_id: str, queries: Sequence[str]) -> Optional[List[Any]]:
+        """
+        取出会话的预取结果并删除；与正式问题的查询变体匹配时返回分块列表，否则返回 None
+
+        预取的检索仍在进行时等待它完成；防抖尚未结束（检索还没开始）时取消它，由调用方直接检索。
+        """
+        entry = self._entries.pop(conversation_id, None)
+        if entry is None:
+            metrics.PREFETCH_LOOKUPS.inc(outcome="miss")
+            return None
+        if time.monotonic() - entry.created > self.ttl:
+            outcome = "expired"
+        elif not queries_match(entry.queries, queries, self.threshold):
+            outcome = "mismatch"
+        elif not entry.started:
+            outcome = "not_started"
+        else:
+            outcome = None
+        if outcome is not None:
+            entry.task.cancel()
+            metrics.PREFETCH_LOOKUPS.inc(outcome=outcome)
+            return None
+
+        waited = not entry.task.done()
+        try:
+            await asyncio.wait({entry.task})
+        except asyncio.CancelledError:
+            entry.task.cancel()
+            raise
+        if _finished_without_result(entry.task):
+            metrics.PREFETCH_LOOKUPS.inc(outcome="failed")
+            return None
+        docs = entry.task.result()
+        metrics.PREFETCH_LOOKUPS.inc(outcome="pending_hit" if waited else "hit")
+        logger.debug("使用预取的检索结果", conversation_id=conversation_id, docs=len(docs), waited=waited,
+                     age=round(time.monotonic() - entry.created, 3))
+        return docs
+
+    def stats(self) -> Dict[str, Any]:
+        self._evict()
+        return {
+            "conversations": len(self._entries),
+            "running": self._running,
+            "ttl": self.ttl,
+            "debounce": self.debounce,
+        }
+
+
+prefetch_cache = PrefetchCache()
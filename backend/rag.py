@@ -0,0 +1,709 @@
+"""
+知识库检索组件
+
+加载本地 Markdown 知识库、分割文档、调用嵌入模型并建立向量索引。
+本模块会导入 LangChain、chromadb 和 dashscope，导入开销较大，由 main 在后台预热任务中首次使用时才导入，
+不影响服务启动时间。
+
+生产环境使用 build_index.py 离线构建的索引产物（见 write_index / load_index），
+服务启动时以内存映射方式加载，多个工作进程共享同一份向量数据的物理页，
+只有找不到索引产物时才在启动时调用嵌入模型现场构建。
+"""
+import hashlib
+import json
+import os
+import shutil
+import time
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from langchain.document_loaders import TextLoader
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+from langchain_community.embeddings.dashscope import DashScopeEmbeddings
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.retrievers import BaseRetriever
+
+from config import (
+    EMBEDDING_MODEL,
+    KNOWLEDGE_FILES,
+    KB_NORMALIZE,
+    KB_DEDUPE_MIN_CHARS,
+    KB_DROP_SECTIONS,
+    RAG_INDEX_DIR,
+    RAG_INDEX_VERSION,
+    RAG_BUILD_ON_STARTUP,
+    RAG_INDEX_PRECISION,
+    RAG_RESCORE_CANDIDATES,
+    RAG_FETCH_K,
+    RAG_MMR_LAMBDA,
+    RAG_SCORE_THRESHOLD,
+    RAG_SCORE_GAP,
+)
+from logger import get_logger
+import embedding_cache
+import kb_normalize
+import metrics
+
+rag_logger = get_logger("rag")
+
+# 文档分割参数
+CHUNK_SIZE = 2000
+CHUNK_OVERLAP = 200
+# DashScopeEmbeddings 每次请求最多嵌入的文本数，用于估算构建索引时的嵌入接口调用次数
+EMBEDDING_BATCH_SIZE = 25
+
+# 索引产物格式版本，格式不兼容时递增
+INDEX_FORMAT = 1
+MANIFEST_FILE = "manifest.json"
+CHUNKS_FILE = "chunks.jsonl"
+EMBEDDINGS_FILE = "embeddings.npy"
+# 低精度副本：float16 直接截断，int8 按每个向量的最大绝对值缩放（scales 为 float32）
+COMPACT_FILES = {
+    "float16": "embeddings.f16.npy",
+    "int8": "embeddings.i8.npy",
+}
+SCALES_FILE = "scales.i8.npy"
+PRECISIONS = ("float32",) + tuple(COMPACT_FILES)
+# 粗筛时每次转换成 float32 计算的行数：块足够小时转换结果留在 CPU 缓存中，int8 粗筛与 float32 全量计算耗时相当
+SEARCH_BLOCK_ROWS = 256
+# 索引目录下记录当前使用版本的文件
+CURRENT_FILE = "current"
+
+# 校准相似度阈值用的无关问题：寒暄、闲聊和与说明书无关的常识问题，它们的最高分应低于阈值
+OFF_TOPIC_PROBES = [
+    "你好", "您好，在吗？", "谢谢你", "再见", "你是谁？", "你能做什么？",
+    "今天天气怎么样？", "讲个笑话吧", "帮我写一首关于春天的诗", "北京有哪些好玩的地方？",
+    "Python 怎么读取文件？", "1 加 1 等于几？", "推荐几部好看的电影", "明天几点起床比较好？",
+    "怎样做红烧肉？", "如何提高英语口语？",
+]
+# 校准时至少让这么大比例的相关探测问题达到阈值
+CALIBRATION_ON_TOPIC_QUANTILE = 0.1
+# 说明书的【章节】标题，用来生成与知识库相关的校准问题
+SECTION_PATTERN = re.compile(r"^#\s*【(.+?)】", re.MULTILINE)
+TITLE_PATTERN = re.compile(r"^#\s*(.+?)\s*$", re.MULTILINE)
+
+
+class TimedEmbeddings(Embeddings):
+    """包装嵌入模型，记录每次调用嵌入接口的耗时"""
+
+    def __init__(self, inner: Embeddings):
+        self.inner = inner
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        with metrics.EMBEDDING_SECONDS.time(operation="documents"):
+            return self.inner.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        with metrics.EMBEDDING_SECONDS.time(operation="query"):
+            return self.inner.embed_query(text)
+
+
+class CachedQueryEmbeddings(Embeddings):
+    """查询向量先查缓存（见 embedding_cache），未命中时才调用嵌入接口；文档向量不缓存"""
+
+    def __init__(self, inner: Embeddings, cache: embedding_cache.QueryEmbeddingCache):
+        self.inner = inner
+        self.cache = cache
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.inner.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        vector = self.cache.get(text)
+        if vector is None:
+            vector = self.inner.embed_query(text)
+            self.cache.put(text, vector)
+        return vector
+
+
+def create_embeddings() -> Optional[Embeddings]:
+    """创建嵌入模型，失败时返回 None"""
+    try:
+        embeddings = TimedEmbeddings(DashScopeEmbeddings(
+            model=EMBEDDING_MODEL,
+        ))
+        cache = embedding_cache.get_cache()
+        if cache is not None:
+            embeddings = CachedQueryEmbeddings(embeddings, cache)
+        rag_logger.info("嵌入模型初始化成功", model=EMBEDDING_MODEL)
+        return embeddings
+    except Exception as e:
+        rag_logger.error("嵌入模型初始化失败", model=EMBEDDING_MODEL, error=str(e))
+        return None
+
+
+def find_knowledge_file() -> Optional[str]:
+    for path in KNOWLEDGE_FILES:
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def normalize_text(text: str) -> str:
+    """统一换行符并去掉行尾空白，使同一份知识库在不同平台上得到相同的分块"""
+    text = text.replace("\r\n", "\n").replace("\r", "\n")
+    return "\n".join(line.rstrip() for line in text.split("\n"))
+
+
+def normalization_settings() -> Optional[Dict[str, Any]]:
+    """知识库规范化的配置（关闭时为 None），参与索引版本号的计算"""
+    if not KB_NORMALIZE:
+        return None
+    return {"dedupe_min_chars": KB_DEDUPE_MIN_CHARS, "drop_sections": sorted(KB_DROP_SECTIONS)}
+
+
+def normalize_documents(documents: List[Document]) -> Optional[Dict[str, Any]]:
+    """按配置规范化文档内容（见 kb_normalize），返回合并后的统计；关闭时不做处理并返回 None"""
+    settings = normalization_settings()
+    if settings is None:
+        return None
+    reports = []
+    for document in documents:
+        document.page_content, report = kb_normalize.normalize_knowledge(
+            document.page_content, settings["drop_sections"], settings["dedupe_min_chars"])
+        reports.append(report)
+    return kb_normalize.merge_stats(reports)
+
+
+def load_documents(file_path: str, normalize: bool = True) -> List[Document]:
+    loader = TextLoader(file_path, encoding='utf-8')
+    documents = loader.load()
+    for document in documents:
+        document.page_content = normalize_text(document.page_content)
+    if normalize:
+        report = normalize_documents(documents)
+        if report:
+            rag_logger.info("知识库规范化完成", chars_before=report["chars_before"], chars_after=report["chars_after"],
+                            duplicate_blocks=report["duplicate_blocks"], dropped_sections=report["dropped_sections"])
+    return documents
+
+
+def embedding_calls(chunks: int) -> int:
+    """嵌入 chunks 个分块需要调用嵌入接口的次数"""
+    return -(-chunks // EMBEDDING_BATCH_SIZE)
+
+
+def split_documents(documents: List[Document]) -> List[Document]:
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
+    return text_splitter.split_documents(documents)
+
+
+# 初始化RAG组件
+def initialize_rag():
+    embeddings = create_embeddings()
+    # 如果嵌入模型初始化失败，则不初始化RAG
+    if embeddings is None:
+        rag_logger.warning("嵌入模型不可用，跳过RAG初始化")
+        return None
+
+    # 加载本地 Markdown 文件
+    try:
+        # 尝试找到文件路径
+        file_path = find_knowledge_file()
+        if not file_path:
+            rag_logger.error("未找到知识库文件")
+            return None
+
+        rag_logger.info("找到知识库文件", path=file_path)
+
+        # 加载文档
+        documents = load_documents(file_path)
+
+        if not documents or len(documents) == 0:
+            rag_logger.warning("知识库文档为空")
+            return None
+
+        rag_logger.info("知识库文档加载完成", documents=len(documents))
+
+        # 分割文档
+        all_splits = split_documents(documents)
+
+        if not all_splits or len(all_splits) == 0:
+            rag_logger.warning("文档分割后内容为空")
+            return None
+
+        rag_logger.info("文档分割完成", chunks=len(all_splits))
+
+        # 创建向量存储
+        try:
+            from langchain_chroma import Chroma
+            vectorstore = Chroma.from_documents(documents=all_splits, embedding=embeddings)
+            rag_logger.info("向量存储创建成功")
+            return vectorstore
+        except Exception as e:
+            rag_logger.error("向量存储创建失败", error=str(e))
+            return None
+
+    except Exception as e:
+        rag_logger.exception("初始化RAG组件失败", error=str(e))
+        return None
+
+
+def sha256_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def index_version(source_sha256: str) -> str:
+    """
+    索引版本号：由知识库内容、分割参数、嵌入模型和产物格式决定
+
+    输入不变时重复构建得到相同的版本号，可以直接复用已有产物
+    """
+    key = json.dumps({
+        "source": source_sha256,
+        "chunk_size": CHUNK_SIZE,
+        "chunk_overlap": CHUNK_OVERLAP,
+        "normalization": normalization_settings(),
+        "model": EMBEDDING_MODEL,
+        "format": INDEX_FORMAT,
+    }, sort_keys=True)
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:12]
+
+
+def quantize(vectors: np.ndarray, precision: str) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """把 float32 向量矩阵转换为低精度副本，返回（紧凑矩阵, 每行的缩放系数或 None）"""
+    if precision == "float16":
+        return vectors.astype(np.float16), None
+    if precision == "int8":
+        scales = np.abs(vectors).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        compact = np.clip(np.rint(vectors / scales[:, None]), -127, 127).astype(np.int8)
+        return compact, scales.astype(np.float32)
+    raise ValueError(f"不支持的向量精度: {precision}")
+
+
+def write_index(output_dir: str, source_path: str, chunks: List[Document], vectors: np.ndarray,
+                version: str, calibration: Optional[Dict[str, Any]] = None,
+                normalization: Optional[Dict[str, Any]] = None) -> str:
+    """
+    写入索引产物，返回产物目录
+
+    目录结构（<output_dir>/<version>/）:
+        manifest.json    版本、来源、分割参数、嵌入模型、维度、条数和各文件的校验和
+        chunks.jsonl     每行一个分块：{"text": ..., "metadata": {...}}，顺序与向量一致
+        embeddings.npy   float32 的 (条数, 维度) 矩阵，已按行归一化，内积即余弦相似度
+        embeddings.f16.npy / embeddings.i8.npy + scales.i8.npy   低精度副本，用于粗筛
+    calibration 为 calibrate_threshold 的结果，写入清单供检索时作为默认的相似度阈值；
+    normalization 为知识库规范化的配置和统计（字符、分块和嵌入调用次数的变化）。
+    先写入临时目录再重命名，构建中断不会留下不完整的版本；最后更新 current 指向新版本。
+    """
+    target = os.path.join(output_dir, version)
+    staging = os.path.join(output_dir, f".{version}.tmp-{os.getpid()}")
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    vectors = vectors / np.where(norms == 0, 1, norms)
+    np.save(os.path.join(staging, EMBEDDINGS_FILE), vectors)
+    for precision, name in COMPACT_FILES.items():
+        compact, scales = quantize(vectors, precision)
+        np.save(os.path.join(staging, name), compact)
+        if scales is not None:
+            np.save(os.path.join(staging, SCALES_FILE), scales)
+    with open(os.path.join(staging, CHUNKS_FILE), "w", encoding="utf-8") as f:
+        for chunk in chunks:
+            f.write(json.dumps({"text": chunk.page_content, "metadata": chunk.metadata}, ensure_ascii=False) + "\n")
+
+    manifest = {
+        "format": INDEX_FORMAT,
+        "version": version,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "source": {
+            "path": os.path.basename(source_path),
+            "sha256": sha256_file(source_path),
+        },
+        "chunking": {
+            "splitter": "RecursiveCharacterTextSplitter",
+            "chunk_size": CHUNK_SIZE,
+            "chunk_overlap": CHUNK_OVERLAP,
+        },
+        "normalization": normalization,
+        "embedding": {
+            "model": EMBEDDING_MODEL,
+            "dim": int(vectors.shape[1]),
+            "dtype": "float32",
+            "normalized": True,
+        },
+        "count": len(chunks),
+        "compact": {
+            "float16": {"file": COMPACT_FILES["float16"]},
+            "int8": {"file": COMPACT_FILES["int8"], "scales": SCALES_FILE},
+        },
+        "calibration": calibration,
+        "files": {
+            name: sha256_file(os.path.join(staging, name))
+            for name in (CHUNKS_FILE, EMBEDDINGS_FILE, *COMPACT_FILES.values(), SCALES_FILE)
+        },
+    }
+    with open(os.path.join(staging, MANIFEST_FILE), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+
+    shutil.rmtree(target, ignore_errors=True)
+    os.replace(staging, target)
+    set_current_version(output_dir, version)
+    return target
+
+
+def set_current_version(index_dir: str, version: str) -> None:
+    pointer = os.path.join(index_dir, CURRENT_FILE)
+    with open(pointer + ".tmp", "w", encoding="utf-8") as f:
+        f.write(version + "\n")
+    os.replace(pointer + ".tmp", pointer)
+
+
+def current_version(index_dir: str) -> Optional[str]:
+    try:
+        with open(os.path.join(index_dir, CURRENT_FILE), encoding="utf-8") as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+class VectorIndex:
+    """
+    以内存映射方式加载的向量索引
+
+    向量矩阵通过 np.load(mmap_mode="r") 只读映射，数据页由操作系统的页缓存提供，
+    同一台机器上的多个工作进程共享同一份物理内存；分块文本较小，直接读入内存。
+
+    提供低精度副本（compact）时，检索先在紧凑矩阵上算出近似分数并取 candidates 个候选，
+    再只读取这些候选的 float32 向量重新打分，常驻内存主要是紧凑矩阵。
+    候选向量用 os.pread 按行读取而不经过内存映射：映射缺页时内核会一次映射整个大页缓存页，
+    少量随机访问就会让整个 float32 矩阵计入进程常驻内存。
+    """
+
+    def __init__(self, path: str, manifest: Dict[str, Any], texts: List[str],
+                 metadatas: List[Dict[str, Any]], vectors: np.ndarray,
+                 compact: Optional[np.ndarray] = None, scales: Optional[np.ndarray] = None,
+                 precision: str = "float32", candidates: int = RAG_RESCORE_CANDIDATES):
+        self.path = path
+        self.manifest = manifest
+        self.texts = texts
+        self.metadatas = metadatas
+        self.vectors = vectors
+        self.compact = compact
+        self.scales = scales
+        self.precision = precision
+        self.candidates = candidates
+        self._fd: Optional[int] = None
+        if compact is not None and isinstance(vectors, np.memmap):
+            self._fd = os.open(vectors.filename, os.O_RDONLY)
+            self._offset = vectors.offset
+            self._row_bytes = vectors.shape[1] * vectors.itemsize
+
+    @property
+    def version(self) -> str:
+        return self.manifest["version"]
+
+    @property
+    def calibrated_threshold(self) -> Optional[float]:
+        """构建索引时校准的相似度阈值（旧版本产物没有校准结果时为 None）"""
+        calibration = self.manifest.get("calibration")
+        return calibration["threshold"] if calibration else None
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    @property
+    def compact_bytes(self) -> int:
+        """检索时需要常驻的向量数据大小（字节）"""
+        if self.compact is None:
+            return self.vectors.nbytes
+        return self.compact.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+    @staticmethod
+    def _top(scores: np.ndarray, k: int) -> np.ndarray:
+        top = np.argpartition(-scores, k - 1)[:k]
+        return top[np.argsort(-scores[top])]
+
+    def _coarse_scores(self, query: np.ndarray) -> np.ndarray:
+        """在紧凑矩阵上分块计算近似分数，每块转换到复用的 float32 缓冲区后做矩阵乘法"""
+        scores = np.empty(len(self.compact), dtype=np.float32)
+        buffer = np.empty((SEARCH_BLOCK_ROWS, self.compact.shape[1]), dtype=np.float32)
+        for start in range(0, len(self.compact), SEARCH_BLOCK_ROWS):
+            block = self.compact[start:start + SEARCH_BLOCK_ROWS]
+            rows = buffer[:len(block)]
+            np.copyto(rows, block, casting="unsafe")
+            scores[start:start + len(block)] = rows @ query
+        if self.scales is not None:
+            scores *= self.scales
+        return scores
+
+    def rows(self, indices: np.ndarray) -> np.ndarray:
+        """读取指定行的 float32 向量"""
+        if self._fd is None:
+            return self.vectors[indices]
+        data = b"".join(
+            os.pread(self._fd, self._row_bytes, self._offset + int(i) * self._row_bytes) for i in indices
+        )
+        return np.frombuffer(data, dtype=self.vectors.dtype).reshape(len(indices), -1)
+
+    def close(self) -> None:
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def search(self, query_vector, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """返回余弦相似度最高的 k 个分块的下标和分数（按分数降序，分数均为 float32 精度）"""
+        query = np.asarray(query_vector, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1.0)
+        k = min(k, len(self.vectors))
+        if k <= 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        if self.compact is None:
+            scores = self.vectors @ query
+            top = self._top(scores, k)
+            return top, scores[top]
+
+        # 粗筛候选后按下标顺序读取 float32 向量重新打分
+        candidates = np.sort(self._top(self._coarse_scores(query), min(max(self.candidates, k), len(self.vectors))))
+        scores = self.rows(candidates) @ query
+        top = self._top(scores, k)
+        return candidates[top], scores[top]
+
+    def document(self, i: int, score: Optional[float] = None) -> Document:
+        metadata = dict(self.metadatas[i])
+        if score is not None:
+            metadata["score"] = float(score)
+        return Document(page_content=self.texts[i], metadata=metadata)
+
+
+def mmr_select(query: np.ndarray, candidates: np.ndarray, k: int, lambda_mult: float) -> List[int]:
+    """
+    最大边际相关性选择：每一步选出与查询最相关、同时与已选分块最不相似的候选
+
+    candidates 为已归一化的候选向量（按相关性排序），返回选中候选的位置。
+    候选之间的相似度矩阵一次算好，每一步只用向量运算更新“与已选分块的最大相似度”。
+    """
+    k = min(k, len(candidates))
+    if k <= 0:
+        return []
+    relevance = candidates @ query
+    similarity = candidates @ candidates.T
+    selected = [int(np.argmax(relevance))]
+    max_similarity = similarity[selected[0]].copy()
+    for _ in range(k - 1):
+        scores = lambda_mult * relevance - (1 - lambda_mult) * max_similarity
+        scores[selected] = -np.inf
+        chosen = int(np.argmax(scores))
+        selected.append(chosen)
+        np.maximum(max_similarity, similarity[chosen], out=max_similarity)
+    return selected
+
+
+def on_topic_probes(text: str) -> List[str]:
+    """根据说明书的标题和【章节】标题生成与知识库相关的校准问题"""
+    title = TITLE_PATTERN.search(text)
+    drug = title.group(1).replace("说明书", "").strip() if title else ""
+    probes = []
+    for section in dict.fromkeys(SECTION_PATTERN.findall(text)):
+        probes.append(f"{drug}的{section}" if drug else section)
+        probes.append(f"{section}是什么？")
+    return probes
+
+
+def calibrate_threshold(vectors: np.ndarray, embeddings: Embeddings, on_topic: List[str],
+                        off_topic: List[str] = OFF_TOPIC_PROBES) -> Optional[Dict[str, Any]]:
+    """
+    用相关和无关的探测问题校准相似度阈值
+
+    分别计算每个探测问题在已归一化的 vectors 上的最高分。两组分数能分开时阈值取两者之间的中点；
+    有重叠时优先保证相关问题：阈值不超过相关问题分数的 CALIBRATION_ON_TOPIC_QUANTILE 分位数
+    （宁可给无关问题多带参考资料，也不漏掉相关内容）。
+    """
+    if not on_topic or not off_topic:
+        return None
+
+    def best_scores(queries: List[str]) -> np.ndarray:
+        # 与检索时一样按查询类型嵌入（DashScope 对查询和文档使用不同的 text_type）
+        probes = np.asarray([embeddings.embed_query(query) for query in queries], dtype=np.float32)
+        probes /= np.maximum(np.linalg.norm(probes, axis=1, keepdims=True), 1e-12)
+        return (probes @ np.asarray(vectors, dtype=np.float32).T).max(axis=1)
+
+    on, off = best_scores(on_topic), best_scores(off_topic)
+    if off.max() < on.min():
+        threshold = float(off.max() + on.min()) / 2
+    else:
+        threshold = min(float(np.quantile(on, CALIBRATION_ON_TOPIC_QUANTILE)), float(off.max()))
+    return {
+        "threshold": round(threshold, 4),
+        "on_topic": {"count": len(on), "min": round(float(on.min()), 4), "median": round(float(np.median(on)), 4)},
+        "off_topic": {"count": len(off), "max": round(float(off.max()), 4), "median": round(float(np.median(off)), 4)},
+    }
+
+
+def adaptive_k(scores: np.ndarray, max_k: int, threshold: float, gap: float) -> int:
+    """
+    按相似度分数决定使用多少个分块（0 到 max_k）
+
+    scores 按从高到低排列。低于阈值的分块不用；相邻两个分数之差超过 gap 时，
+    后面的分块与前面的相关程度明显不同，也不再使用。gap <= 0 表示不按分差截断。
+    """
+    count = 0
+    for i, score in enumerate(scores[:max_k]):
+        if score < threshold:
+            break
+        if i > 0 and gap > 0 and scores[i - 1] - score > gap:
+            break
+        count += 1
+    return count
+
+
+class IndexLoadError(Exception):
+    """索引产物缺失、损坏或与当前配置不兼容"""
+
+
+def load_index(path: str, verify: bool = False, precision: str = RAG_INDEX_PRECISION,
+               candidates: int = RAG_RESCORE_CANDIDATES) -> VectorIndex:
+    """
+    加载索引产物目录，verify 为真时校验各文件的 sha256
+
+    precision 为 float16/int8 时映射对应的低精度副本；产物中没有该副本（旧版本构建）时在内存中现场转换。
+    """
+    if precision not in PRECISIONS:
+        raise IndexLoadError(f"不支持的向量精度: {precision}，可选: {', '.join(PRECISIONS)}")
+    try:
+        with open(os.path.join(path, MANIFEST_FILE), encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError) as e:
+        raise IndexLoadError(f"无法读取索引清单: {e}") from e
+    if manifest.get("format") != INDEX_FORMAT:
+        raise IndexLoadError(f"不支持的索引格式: {manifest.get('format')}")
+    # 查询向量由当前配置的嵌入模型生成，模型不同的索引无法使用
+    if manifest["embedding"]["model"] != EMBEDDING_MODEL:
+        raise IndexLoadError(f"索引的嵌入模型 {manifest['embedding']['model']} 与当前配置 {EMBEDDING_MODEL} 不一致")
+    if verify:
+        for name, expected in manifest["files"].items():
+            if sha256_file(os.path.join(path, name)) != expected:
+                raise IndexLoadError(f"索引文件校验失败: {name}")
+
+    vectors = np.load(os.path.join(path, EMBEDDINGS_FILE), mmap_mode="r")
+    texts, metadatas = [], []
+    with open(os.path.join(path, CHUNKS_FILE), encoding="utf-8") as f:
+        for line in f:
+            chunk = json.loads(line)
+            texts.append(chunk["text"])
+            metadatas.append(chunk["metadata"])
+    if vectors.shape != (manifest["count"], manifest["embedding"]["dim"]) or len(texts) != manifest["count"]:
+        raise IndexLoadError(f"索引数据与清单不一致: vectors={vectors.shape} chunks={len(texts)}")
+
+    compact = scales = None
+    if precision != "float32":
+        entry = manifest.get("compact", {}).get(precision)
+        if entry:
+            compact = np.load(os.path.join(path, entry["file"]), mmap_mode="r")
+            if entry.get("scales"):
+                scales = np.load(os.path.join(path, entry["scales"]), mmap_mode="r")
+        else:
+            rag_logger.warning("索引产物中没有低精度副本，在内存中转换", path=path, precision=precision)
+            compact, scales = quantize(np.asarray(vectors), precision)
+        if compact.shape != vectors.shape:
+            raise IndexLoadError(f"低精度副本与向量矩阵形状不一致: {compact.shape} != {vectors.shape}")
+    return VectorIndex(path, manifest, texts, metadatas, vectors, compact, scales, precision, candidates)
+
+
+def find_index(index_dir: str = RAG_INDEX_DIR, version: str = RAG_INDEX_VERSION) -> Optional[str]:
+    """按配置的版本（未配置时使用 current 指向的版本）找到索引产物目录"""
+    version = version or current_version(index_dir)
+    if not version:
+        return None
+    path = os.path.join(index_dir, version)
+    return path if os.path.isdir(path) else None
+
+
+class IndexRetriever(BaseRetriever):
+    """
+    在 VectorIndex 上检索，返回的文档 metadata 中带有相似度分数 score
+
+    返回的分块数量在 0 到 k 之间自适应（见 adaptive_k）：最高分低于 score_threshold 时返回空列表，
+    调用方据此不使用参考资料直接回答。
+    fetch_k 大于 k 时先取 fetch_k 个候选，再用 MMR 从达到阈值的候选中选出分块，避免返回内容高度重复的相邻分块
+    """
+
+    index: Any
+    embeddings: Any
+    k: int = 3
+    fetch_k: int = 0
+    lambda_mult: float = RAG_MMR_LAMBDA
+    score_threshold: float = 0.0
+    score_gap: float = 0.0
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        query_vector = np.asarray(self.embeddings.embed_query(query), dtype=np.float32)
+        top, scores = self.index.search(query_vector, max(self.k, self.fetch_k))
+        count = adaptive_k(scores, self.k, self.score_threshold, self.score_gap)
+        if self.fetch_k <= self.k or count == 0:
+            return [self.index.document(int(i), score) for i, score in zip(top[:count], scores[:count])]
+
+        passing = int(np.count_nonzero(scores >= self.score_threshold))
+        chosen = mmr_select(
+            query_vector / (np.linalg.norm(query_vector) or 1.0),
+            self.index.rows(np.asarray(top[:passing])),
+            count,
+            self.lambda_mult,
+        )
+        return [self.index.document(int(top[i]), scores[i]) for i in chosen]
+
+
+def resolve_score_threshold(index: VectorIndex, setting: str = RAG_SCORE_THRESHOLD) -> float:
+    """RAG_SCORE_THRESHOLD 为 auto 时使用索引的校准阈值（没有时不设阈值），否则使用配置的数值"""
+    setting = setting.strip().lower()
+    if setting in ("", "auto"):
+        threshold = index.calibrated_threshold
+        if threshold is None:
+            rag_logger.warning("索引产物没有校准的相似度阈值，检索不按分数过滤（重新运行 build_index.py --force 可校准）",
+                               version=index.version)
+            return 0.0
+        return threshold
+    try:
+        return float(setting)
+    except ValueError:
+        rag_logger.warning("RAG_SCORE_THRESHOLD 不是有效的数字，检索不按分数过滤", value=setting)
+        return 0.0
+
+
+def create_retriever(k: int = 3, fetch_k: int = RAG_FETCH_K) -> Optional[BaseRetriever]:
+    """
+    创建知识库检索器
+
+    优先加载离线构建的索引产物；找不到时，若允许（RAG_BUILD_ON_STARTUP）则现场构建 Chroma 向量库。
+    """
+    path = find_index()
+    if path:
+        embeddings = create_embeddings()
+        if embeddings is None:
+            return None
+        start = time.perf_counter()
+        index = load_index(path)
+        rag_logger.info("知识库索引已加载", path=path, version=index.version, chunks=len(index),
+                        dim=index.vectors.shape[1], precision=index.precision,
+                        resident_mb=round(index.compact_bytes / 2 ** 20, 2),
+                        seconds=round(time.perf_counter() - start, 3))
+        threshold = resolve_score_threshold(index)
+        rag_logger.info("检索分数阈值", threshold=threshold, gap=RAG_SCORE_GAP, max_k=k)
+        return IndexRetriever(index=index, embeddings=embeddings, k=k, fetch_k=fetch_k,
+                              score_threshold=threshold, score_gap=RAG_SCORE_GAP)
+
+    if not RAG_BUILD_ON_STARTUP:
+        rag_logger.warning("未找到知识库索引产物，知识库检索不可用，请求直接由模型回答；"
+                           "请先运行 build_index.py，开发环境也可以设置 RAG_BUILD_ON_STARTUP=true 现场构建",
+                           index_dir=RAG_INDEX_DIR)
+        return None
+    rag_logger.warning("未找到知识库索引产物，启动时现场构建", index_dir=RAG_INDEX_DIR)
+    # 现场构建的 Chroma 向量库不返回可比较的相似度分数，不使用分数阈值和自适应 k
+    vectorstore = initialize_rag()
+    if vectorstore is None:
+        return None
+    if fetch_k > k:
+        return vectorstore.as_retriever(
+            search_type="mmr", search_kwargs={"k": k, "fetch_k": fetch_k, "lambda_mult": RAG_MMR_LAMBDA}
+        )
+    return vectorstore.as_retriever(search_kwargs={"k": k})
@@ -0,0 +1,296 @@
+"""
+上游调用保护：令牌桶限流 + 按模型熔断
+
+DashScope 出现故障时，熔断器在连续失败后打开，之后的请求不再等待超时，
+而是立即抛出 UpstreamUnavailable，由调用方直接使用后备回答；
+打开一段时间后进入半开状态，放行少量探测请求以判断上游是否恢复。
+上游调用在阶段超时内没有返回时同样计为失败（见 AttemptStop），上游挂起时熔断器也会打开。
+"""
+import asyncio
+import threading
+import time
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Optional
+
+from config import (
+    UPSTREAM_RATE_PER_SECOND,
+    UPSTREAM_BURST,
+    UPSTREAM_RATE_MAX_WAIT,
+    BREAKER_FAILURE_THRESHOLD,
+    BREAKER_OPEN_SECONDS,
+    BREAKER_HALF_OPEN_PROBES,
+)
+from logger import get_logger
+
+logger = get_logger("upstream")
+
+
+class UpstreamUnavailable(Exception):
+    """上游暂不可用，调用方应立即使用后备方案"""
+
+    def __init__(self, key: str, reason: str, retry_after: float = 1.0):
+        super().__init__(f"{key}: {reason}")
+        self.key = key
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class CircuitOpenError(UpstreamUnavailable):
+    """熔断器处于打开状态"""
+
+
+class RateLimitExceeded(UpstreamUnavailable):
+    """令牌桶在允许的等待时间内无法提供令牌"""
+
+
+class GenerationCancelled(Exception):
+    """请求已被取消（例如客户端断开连接），不计入上游故障"""
+
+
+class AttemptStop(threading.Event):
+    """
+    一次阶段尝试的停止标志，由 deadline.Deadline.run 为每次尝试创建，工作线程中的上游调用也能检查
+
+    reason 记录停止原因：阶段超时计入熔断，对冲落选和请求取消不计入。
+    """
+
+    TIMEOUT = "timeout"
+    SUPERSEDED = "superseded"
+    CANCELLED = "cancelled"
+
+    def __init__(self):
+        super().__init__()
+        self.reason: Optional[str] = None
+
+    def stop(self, reason: str) -> None:
+        """以 reason 停止尝试，已经停止的尝试保留最初的原因"""
+        if not self.is_set():
+            self.reason = reason
+            self.set()
+
+
+# 当前阶段尝试的停止标志；工作线程通过 asyncio.to_thread 继承上下文
+current_attempt: ContextVar[Optional[AttemptStop]] = ContextVar("upstream_attempt", default=None)
+
+
+class TokenBucket:
+    """令牌桶限流器：以固定速率补充令牌，允许一定的突发量"""
+
+    def __init__(self, rate: float, capacity: int, clock: Callable[[], float] = time.monotonic):
+        self.rate = rate
+        self.capacity = max(1, capacity)
+        self._clock = clock
+        self._tokens = float(self.capacity)
+        self._updated = clock()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = self._clock()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, max_wait: float) -> float:
+        """
+        获取一个令牌，返回等待的秒数
+
+        Raises:
+            RateLimitExceeded: 需要等待的时间超过 max_wait
+        """
+        if self.rate <= 0:
+            return 0.0
+        async with self._lock:
+            self._refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            wait = (1 - self._tokens) / self.rate
+            if wait > max_wait:
+                raise RateLimitExceeded("upstream", "超出API调用配额", retry_after=wait)
+            # 持锁等待，保证等待中的请求先到先得
+            await asyncio.sleep(wait)
+            self._refill()
+            self._tokens -= 1
+            return wait
+
+    @property
+    def tokens(self) -> float:
+        self._refill()
+        return self._tokens
+
+
+class CircuitBreaker:
+    """单个模型的熔断器：closed -> open -> half_open -> closed/open"""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(
+        self,
+        key: str,
+        failure_threshold: int,
+        open_seconds: float,
+        half_open_probes: int,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.key = key
+        self.failure_threshold = max(1, failure_threshold)
+        self.open_seconds = open_seconds
+        self.half_open_probes = max(1, half_open_probes)
+        self._clock = clock
+        self._state = self.CLOSED
+        self._consecutive_failures = 0
+        self._opened_at = 0.0
+        self._probes_in_flight = 0
+        # 统计信息
+        self.short_circuited = 0
+        self.times_opened = 0
+
+    @property
+    def state(self) -> str:
+        if self._state == self.OPEN and self._clock() - self._opened_at >= self.open_seconds:
+            self._state = self.HALF_OPEN
+            self._probes_in_flight = 0
+        return self._state
+
+    def before_call(self) -> bool:
+        """
+        调用前检查，返回本次调用是否为半开探测
+
+        Raises:
+            CircuitOpenError: 熔断器打开，或半开状态下探测名额已用完
+        """
+        state = self.state
+        if state == self.CLOSED:
+            return False
+        if state == self.HALF_OPEN and self._probes_in_flight < self.half_open_probes:
+            self._probes_in_flight += 1
+            return True
+        self.short_circuited += 1
+        retry_after = max(0.0, self.open_seconds - (self._clock() - self._opened_at))
+        raise CircuitOpenError(self.key, "熔断器已打开", retry_after=max(1.0, retry_after))
+
+    def cancel_probe(self) -> None:
+        """探测请求未真正发出（限流或被取消）时归还探测名额"""
+        self._probes_in_flight = max(0, self._probes_in_flight - 1)
+
+    def record_success(self, probe: bool) -> None:
+        if probe:
+            self._probes_in_flight -= 1
+            logger.info("熔断器探测成功", model=self.key, state=self.CLOSED)
+        self._state = self.CLOSED
+        self._consecutive_failures = 0
+
+    def record_failure(self, probe: bool) -> None:
+        if probe:
+            self._probes_in_flight -= 1
+            self._trip()
+            return
+        self._consecutive_failures += 1
+        if self._state == self.CLOSED and self._consecutive_failures >= self.failure_threshold:
+            self._trip()
+
+    def _trip(self) -> None:
+        self._state = self.OPEN
+        self._opened_at = self._clock()
+        self.times_opened += 1
+        logger.warning("熔断器打开", model=self.key, open_seconds=self.open_seconds)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            "consecutive_failures": self._consecutive_failures,
+            "short_circuited": self.short_circuited,
+            "times_opened": self.times_opened,
+        }
+
+
+class UpstreamGuard:
+    """组合令牌桶和按模型划分的熔断器，对同步的上游调用做保护并放到线程池中执行"""
+
+    def __init__(
+        self,
+        bucket: TokenBucket,
+        failure_threshold: int,
+        open_seconds: float,
+        half_open_probes: int,
+        max_wait: float,
+    ):
+        self.bucket = bucket
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.half_open_probes = half_open_probes
+        self.max_wait = max_wait
+        self.breakers: Dict[str, CircuitBreaker] = {}
+
+    def breaker(self, key: str) -> CircuitBreaker:
+        breaker = self.breakers.get(key)
+        if breaker is None:
+            breaker = self.breakers[key] = CircuitBreaker(
+                key, self.failure_threshold, self.open_seconds, self.half_open_probes
+            )
+        return breaker
+
+    async def call(
+        self,
+        key: str,
+        fn: Callable[..., Any],
+        *args: Any,
+        is_failure: Optional[Callable[[Any], bool]] = None,
+        **kwargs: Any,
+    ) -> Any:
+        """
+        经过限流和熔断检查后调用上游
+
+        Args:
+            key: 熔断器分组，一般是模型名称
+            fn: 实际的（同步）上游调用
+            is_failure: 可选，根据返回值判断调用是否失败（例如非200状态码）
+
+        Raises:
+            UpstreamUnavailable: 熔断器打开或超出配额，调用方应立即走后备逻辑
+        """
+        breaker = self.breaker(key)
+        probe = breaker.before_call()
+        try:
+            await self.bucket.acquire(self.max_wait)
+        except RateLimitExceeded as e:
+            # 限流不是上游故障，不计入熔断，但要归还探测名额
+            if probe:
+                breaker.cancel_probe()
+            raise RateLimitExceeded(key, e.reason, e.retry_after)
+
+        try:
+            result = await asyncio.to_thread(fn, *args, **kwargs)
+        except (asyncio.CancelledError, GenerationCancelled):
+            attempt = current_attempt.get()
+            if attempt is not None and attempt.reason == AttemptStop.TIMEOUT:
+                # 上游没有在阶段超时内返回，与报错一样计入熔断
+                breaker.record_failure(probe)
+            elif probe:
+                breaker.cancel_probe()
+            raise
+        except Exception:
+            breaker.record_failure(probe)
+            raise
+
+        if is_failure is not None and is_failure(result):
+            breaker.record_failure(probe)
+        else:
+            breaker.record_success(probe)
+        return result
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "tokens_available": round(self.bucket.tokens, 2),
+            "breakers": {key: breaker.stats() for key, breaker in self.breakers.items()},
+        }
+
+
+upstream = UpstreamGuard(
+    TokenBucket(UPSTREAM_RATE_PER_SECOND, UPSTREAM_BURST),
+    failure_threshold=BREAKER_FAILURE_THRESHOLD,
+    open_seconds=BREAKER_OPEN_SECONDS,
+    half_open_probes=BREAKER_HALF_OPEN_PROBES,
+    max_wait=UPSTREAM_RATE_MAX_WAIT,
+)
@@ -0,0 +1,152 @@
+"""
+模型路由
+
+用廉价的本地特征（问题长度、是否检索到参考资料、历史深度、关键词规则）给请求打分，
+再从配置表中选出模型档位和输出长度上限：简单的问候和常见问题走最快的模型，
+只有复杂的分析类问题才使用重量级模型。
+"""
+import re
+import time
+from collections import Counter, deque
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from config import MODEL_ROUTING_ENABLED, TEXT_MODEL_TIERS, MULTIMODAL_MODEL_TIERS
+from logger import get_logger
+
+logger = get_logger("router")
+
+# 问候、致谢等简单对话；整条消息（去掉标点和空白后）只由这些词和 SMALL_TALK_FILLERS 组成时才算简单对话
+SMALL_TALK_KEYWORDS = ["你好", "您好", "谢谢", "感谢", "多谢", "再见", "在吗", "好的", "hello", "hi", "thanks", "bye"]
+# 问候中常见的称呼和语气词
+SMALL_TALK_FILLERS = ["医生", "大夫", "啊", "呀", "哈", "呢", "了", "你", "您"]
+
+# 需要推理、比较或综合分析的问题
+HEAVY_KEYWORDS = [
+    "比较", "对比", "区别", "鉴别", "诊断", "分析", "为什么", "机制", "原理",
+    "方案", "治疗计划", "相互作用", "联合用药", "风险评估", "利弊", "详细",
+]
+
+
+class RoutingDecision:
+    """一次路由决策"""
+
+    __slots__ = ("kind", "tier", "model", "max_tokens", "score", "features", "reasons", "timestamp")
+
+    def __init__(self, kind: str, tier: str, model: str, max_tokens: int,
+                 score: int, features: Dict[str, Any], reasons: List[str]):
+        self.kind = kind
+        self.tier = tier
+        self.model = model
+        self.max_tokens = max_tokens
+        self.score = score
+        self.features = features
+        self.reasons = reasons
+        self.timestamp = time.time()
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+_SMALL_TALK_RE = re.compile("(?:{})+".format("|".join(
+    re.escape(word) for word in sorted(SMALL_TALK_KEYWORDS + SMALL_TALK_FILLERS, key=len, reverse=True))))
+_NON_WORD_RE = re.compile(r"[\W_]+")
+
+
+class ModelRouter:
+    """根据请求特征在模型档位之间路由，并记录最近的决策"""
+
+    def __init__(self, text_tiers: Dict[str, Dict[str, Any]], multimodal_tiers: Dict[str, Dict[str, Any]],
+                 enabled: bool = True, history_size: int = 200):
+        self.text_tiers = text_tiers
+        self.multimodal_tiers = multimodal_tiers
+        self.enabled = enabled
+        self.recent = deque(maxlen=history_size)
+        self.counts = Counter()
+
+    @staticmethod
+    def _score(question: str, history_depth: int, context_chars: int) -> Tuple[int, List[str]]:
+        """计算复杂度分数，返回分数和打分理由"""
+        score = 0
+        reasons = []
+        length = len(question)
+        if length > 200:
+            score += 2
+            reasons.append("长问题")
+        elif length > 60:
+            score += 1
+            reasons.append("中等长度问题")
+        if context_chars > 0:
+            score += 1
+            reasons.append("有参考资料")
+            if context_chars > 4000:
+                score += 1
+                reasons.append("参考资料较长")
+        if history_depth >= 6:
+            score += 1
+            reasons.append("多轮对话")
+        heavy_hits = [kw for kw in HEAVY_KEYWORDS if kw in question]
+        if heavy_hits:
+            score += 2
+            reasons.append(f"分析类关键词:{'/'.join(heavy_hits[:3])}")
+        return score, reasons
+
+    @staticmethod
+    def _is_small_talk(question: str) -> bool:
+        """整条消息只是问候或致谢；“你好，布洛芬一次吃几片”这类带问题的消息不算"""
+        text = _NON_WORD_RE.sub("", question.lower())
+        return 0 < len(text) <= 20 and _SMALL_TALK_RE.fullmatch(text) is not None
+
+    def _decide(self, kind: str, tiers: Dict[str, Dict[str, Any]], tier: str, score: int,
+                features: Dict[str, Any], reasons: List[str]) -> RoutingDecision:
+        entry = tiers[tier]
+        decision = RoutingDecision(kind, tier, entry["model"], entry["max_tokens"], score, features, reasons)
+        self.recent.append(decision)
+        self.counts[f"{kind}:{tier}"] += 1
+        # 每个请求一条，只在调试级别输出；各档位计数和最近的决策见 stats()（/api/router/stats）
+        logger.debug("模型路由", kind=kind, tier=tier, model=decision.model,
+                    max_tokens=decision.max_tokens, score=score, reasons=",".join(reasons) or "-")
+        return decision
+
+    def route_text(self, question: str, chat_history: Optional[Sequence[Any]] = None,
+                   context: str = "") -> RoutingDecision:
+        """为文本问答选择模型"""
+        history_depth = len(chat_history) if chat_history else 0
+        features = {
+            "question_chars": len(question),
+            "context_chars": len(context),
+            "history_depth": history_depth,
+        }
+        if not self.enabled:
+            return self._decide("text", self.text_tiers, "fast", 0, features, ["路由已关闭"])
+        if self._is_small_talk(question) and not context:
+            return self._decide("text", self.text_tiers, "fast", 0, features, ["简单对话"])
+
+        score, reasons = self._score(question, history_depth, len(context))
+        tier = "fast" if score <= 1 else "standard" if score <= 3 else "heavy"
+        return self._decide("text", self.text_tiers, tier, score, features, reasons)
+
+    def route_multimodal(self, question: str, history: Optional[Sequence[Any]] = None) -> RoutingDecision:
+        """为图片问答选择模型，图片本身输入量较大，只有很短且没有分析需求的问题才走快速档"""
+        history_depth = len(history) if history else 0
+        features = {"question_chars": len(question), "history_depth": history_depth}
+        if not self.enabled:
+            return self._decide("multimodal", self.multimodal_tiers, "standard", 0, features, ["路由已关闭"])
+
+        score, reasons = self._score(question, history_depth, 0)
+        if score == 0 and len(question) <= 20:
+            tier = "fast"
+        elif score <= 2:
+            tier = "standard"
+        else:
+            tier = "heavy"
+        return self._decide("multimodal", self.multimodal_tiers, tier, score, features, reasons)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "counts": dict(self.counts),
+            "recent": [decision.to_dict() for decision in list(self.recent)[-20:]],
+        }
+
+
+router = ModelRouter(TEXT_MODEL_TIERS, MULTIMODAL_MODEL_TIERS, enabled=MODEL_ROUTING_ENABLED)
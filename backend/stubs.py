@@ -0,0 +1,112 @@
+"""
+本地故障注入桩
+
+FaultInjectingModel 提供与 ChatTongyi 相同的 invoke/stream 接口，可以配置延迟和失败，
+用于在不访问 DashScope 的情况下验证限流、熔断和后备回答逻辑。
+
+直接运行本文件会演示熔断器的打开、快速失败、半开探测和恢复过程：
+    python stubs.py
+"""
+import asyncio
+import random
+import time
+from typing import Any, Optional
+
+
+class StubReply:
+    """模拟 LangChain 消息对象，只提供 content 属性"""
+
+    def __init__(self, content: str):
+        self.content = content
+
+
+class FaultInjectingModel:
+    """
+    可注入故障的模型桩
+
+    Args:
+        model_name: 模型名称，用作熔断器分组
+        latency: 每次调用的延迟（秒）
+        failure_rate: 随机失败的概率
+        reply: 成功时返回的内容
+    """
+
+    def __init__(
+        self,
+        model_name: str = "qwen-turbo",
+        latency: float = 0.0,
+        failure_rate: float = 0.0,
+        reply: str = "这是来自本地模型桩的回答。",
+        seed: Optional[int] = None,
+    ):
+        self.model_name = model_name
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.reply = reply
+        self.calls = 0
+        self._forced_failures = 0
+        self._random = random.Random(seed)
+
+    def fail_next(self, count: int) -> None:
+        """让接下来的 count 次调用必定失败"""
+        self._forced_failures = count
+
+    def heal(self) -> None:
+        """恢复正常"""
+        self._forced_failures = 0
+        self.failure_rate = 0.0
+
+    def invoke(self, messages: Any, **kwargs: Any) -> StubReply:
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self._forced_failures > 0:
+            self._forced_failures -= 1
+            raise ConnectionError(f"{self.model_name} 注入故障")
+        if self.failure_rate and self._random.random() < self.failure_rate:
+            raise ConnectionError(f"{self.model_name} 随机注入故障")
+        return StubReply(self.reply)
+
+    def stream(self, messages: Any, **kwargs: Any):
+        """按小段返回回答，模拟流式输出"""
+        reply = self.invoke(messages, **kwargs).content
+        for i in range(0, len(reply), 4):
+            yield StubReply(reply[i:i + 4])
+
+
+async def _demo() -> None:
+    from resilience import TokenBucket, UpstreamGuard, UpstreamUnavailable
+
+    guard = UpstreamGuard(
+        TokenBucket(rate=100, capacity=100),
+        failure_threshold=3,
+        open_seconds=0.5,
+        half_open_probes=1,
+        max_wait=0.1,
+    )
+    model = FaultInjectingModel(latency=0.2)
+    model.fail_next(3)
+
+    async def ask(label: str) -> None:
+        start = time.monotonic()
+        try:
+            reply = await guard.call(model.model_name, model.invoke, [])
+            outcome = f"成功: {reply.content}"
+        except UpstreamUnavailable as e:
+            outcome = f"快速失败: {e.reason}"
+        except Exception as e:
+            outcome = f"上游失败: {e}"
+        elapsed = (time.monotonic() - start) * 1000
+        print(f"{label:<10} {outcome:<28} 耗时 {elapsed:6.1f}ms  熔断器: {guard.breaker(model.model_name).state}")
+
+    for i in range(5):
+        await ask(f"请求{i + 1}")
+    print("等待熔断器进入半开状态...")
+    await asyncio.sleep(0.6)
+    await asyncio.gather(ask("探测"), ask("并发请求"))
+    await ask("恢复后")
+    print(f"上游实际被调用 {model.calls} 次")
+
+
+if __name__ == "__main__":
+    asyncio.run(_demo())
@@ -0,0 +1,19 @@
+"""倒数排名融合不修改传入的文档对象"""
+from langchain_core.documents import Document
+
+from multi_query import reciprocal_rank_fusion
+
+
+def test_fusion_leaves_input_documents_untouched():
+    first = Document(page_content="布洛芬用法", metadata={"score": 0.9})
+    second = Document(page_content="布洛芬不良反应", metadata={"score": 0.6})
+    fused = reciprocal_rank_fusion([[first, second], [second]])
+
+    assert [doc.page_content for doc in fused] == ["布洛芬不良反应", "布洛芬用法"]
+    assert all("rrf_score" in doc.metadata for doc in fused)
+    assert first.metadata == {"score": 0.9}
+    assert second.metadata == {"score": 0.6}
+
+    # 同一批文档再融合一次，得分不受上一次的影响
+    again = reciprocal_rank_fusion([[first]])
+    assert again[0].metadata["rrf_score"] == round(1 / 61, 6)
@@ -0,0 +1,52 @@
+"""输入时预取：没有结果的预取不阻止重试"""
+import asyncio
+
+from prefetch import PrefetchCache
+
+
+def test_failed_prefetch_is_rescheduled():
+    async def scenario():
+        cache = PrefetchCache(ttl=60, debounce=0)
+        calls = []
+
+        async def search(queries):
+            calls.append(queries)
+            if len(calls) == 1:
+                raise RuntimeError("embedding failed")
+            return ["doc"]
+
+        assert cache.schedule("c", ["布洛芬用法"], search) == "scheduled"
+        await asyncio.sleep(0.01)
+        # 第一次检索失败后，同一草稿重新安排而不是返回 unchanged
+        assert cache.schedule("c", ["布洛芬用法"], search) == "scheduled"
+        await asyncio.sleep(0.01)
+        assert cache.schedule("c", ["布洛芬用法"], search) == "unchanged"
+        assert await cache.claim("c", ["布洛芬用法"]) == ["doc"]
+        assert len(calls) == 2
+
+    asyncio.run(scenario())
+
+
+def test_prefetch_skipped_while_busy_is_rescheduled():
+    async def scenario():
+        cache = PrefetchCache(ttl=60, debounce=0, max_concurrency=1)
+        release = asyncio.Event()
+
+        async def slow_search(queries):
+            await release.wait()
+            return ["slow"]
+
+        async def search(queries):
+            return ["doc"]
+
+        # 两个会话同时安排预取，会话 b 的预取在防抖结束时并发已满，放弃检索
+        assert cache.schedule("a", ["头痛怎么办"], slow_search) == "scheduled"
+        assert cache.schedule("b", ["布洛芬用法"], search) == "scheduled"
+        await asyncio.sleep(0.01)
+        release.set()
+        await asyncio.sleep(0.01)
+        assert cache.schedule("b", ["布洛芬用法"], search) == "scheduled"
+        await asyncio.sleep(0.01)
+        assert await cache.claim("b", ["布洛芬用法"]) == ["doc"]
+
+    asyncio.run(scenario())
@@ -0,0 +1,87 @@
+"""熔断器对阶段超时和请求取消的计数"""
+import asyncio
+import threading
+
+import pytest
+
+from deadline import Deadline, DeadlineExceeded
+from resilience import CircuitBreaker, CircuitOpenError, TokenBucket, UpstreamGuard, current_attempt
+
+STAGE = "upstream_test"
+
+
+def make_guard(threshold: int = 3, open_seconds: float = 60.0) -> UpstreamGuard:
+    return UpstreamGuard(TokenBucket(0, 1), threshold, open_seconds, 1, max_wait=0.0)
+
+
+def hanging_upstream(stopped: threading.Event) -> str:
+    """挂起的上游：直到本次尝试被停止才返回"""
+    attempt = current_attempt.get()
+    attempt.wait(5)
+    stopped.set()
+    return "late"
+
+
+async def timed_out_call(guard: UpstreamGuard, stopped: threading.Event) -> None:
+    with pytest.raises(DeadlineExceeded):
+        await Deadline(0.05).run(STAGE, lambda: guard.call("model", hanging_upstream, stopped))
+    # 等待被取消的尝试完成熔断计数
+    await asyncio.sleep(0.01)
+
+
+def test_hanging_upstream_opens_breaker_after_threshold_timeouts():
+    async def scenario():
+        guard = make_guard(threshold=3)
+        stopped = threading.Event()
+        for _ in range(3):
+            await timed_out_call(guard, stopped)
+        breaker = guard.breaker("model")
+        assert breaker.state == CircuitBreaker.OPEN
+        assert stopped.wait(1)
+        with pytest.raises(CircuitOpenError):
+            await guard.call("model", lambda: "ok")
+
+    asyncio.run(scenario())
+
+
+def test_timeouts_below_threshold_keep_breaker_closed():
+    async def scenario():
+        guard = make_guard(threshold=3)
+        for _ in range(2):
+            await timed_out_call(guard, threading.Event())
+        assert guard.breaker("model").state == CircuitBreaker.CLOSED
+        assert await guard.call("model", lambda: "ok") == "ok"
+        assert guard.breaker("model").stats()["consecutive_failures"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_client_cancel_is_not_counted_as_failure():
+    async def scenario():
+        guard = make_guard(threshold=1)
+        stopped = threading.Event()
+        task = asyncio.ensure_future(
+            Deadline(5).run(STAGE, lambda: guard.call("model", hanging_upstream, stopped)))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        await asyncio.sleep(0.01)
+        assert stopped.wait(1)
+        assert guard.breaker("model").state == CircuitBreaker.CLOSED
+
+    asyncio.run(scenario())
+
+
+def test_half_open_probe_timeout_reopens_breaker():
+    async def scenario():
+        # open_seconds=0：打开后立即进入半开状态，下一次调用就是探测
+        guard = make_guard(threshold=1, open_seconds=0.0)
+        await timed_out_call(guard, threading.Event())
+        breaker = guard.breaker("model")
+        assert breaker.times_opened == 1
+        await timed_out_call(guard, threading.Event())
+        assert breaker.times_opened == 2
+        assert breaker.stats()["state"] == CircuitBreaker.HALF_OPEN
+
+    asyncio.run(scenario())
@@ -0,0 +1,41 @@
+"""模型路由：简单对话的判断和档位选择"""
+import pytest
+
+from config import MULTIMODAL_MODEL_TIERS, TEXT_MODEL_TIERS
+from router import ModelRouter
+
+
+@pytest.fixture
+def router() -> ModelRouter:
+    return ModelRouter(TEXT_MODEL_TIERS, MULTIMODAL_MODEL_TIERS)
+
+
+@pytest.mark.parametrize("question", ["你好", "您好！", "谢谢医生", "好的，谢谢", "Hi!", "hello", "thanks"])
+def test_whole_greetings_are_small_talk(router, question):
+    decision = router.route_text(question)
+    assert decision.tier == "fast"
+    assert decision.reasons == ["简单对话"]
+
+
+@pytest.mark.parametrize("question", [
+    "你好，布洛芬一次吃几片",
+    "谢谢，那孕妇能吃吗",
+    "which one is safer",
+    "this is too strong",
+    "hi, is it safe?",
+])
+def test_questions_with_greetings_are_not_small_talk(router, question):
+    assert not ModelRouter._is_small_talk(question)
+    assert router.route_text(question).reasons != ["简单对话"]
+
+
+@pytest.mark.parametrize("question", ["你好，布洛芬和阿司匹林的区别", "hi，比较一下这两种药"])
+def test_short_heavy_question_with_greeting_is_scored(router, question):
+    decision = router.route_text(question)
+    assert decision.tier == "standard"
+    assert any(reason.startswith("分析类关键词") for reason in decision.reasons)
+
+
+def test_small_talk_with_context_is_scored(router):
+    decision = router.route_text("你好", context="参考资料" * 10)
+    assert decision.reasons == ["有参考资料"]
@@ -0,0 +1,14 @@
+"""外部传入的 trace ID 校验"""
+import pytest
+
+from tracing import accepted_trace_id
+
+
+@pytest.mark.parametrize("value", ["abc123", "4bf92f35-77b3-4da6-a3ce-929d0e0e4736", "A" * 64])
+def test_ascii_trace_ids_are_accepted(value):
+    assert accepted_trace_id(value) == value
+
+
+@pytest.mark.parametrize("value", ["", "中文", "１２３", "abc²", "é1", "a" * 65, "abc\n", "a b", "a_b", "../x"])
+def test_other_trace_ids_are_rejected(value):
+    assert accepted_trace_id(value) is None
@@ -0,0 +1,113 @@
+"""WebSocket 多路复用会话：发送失败、发送积压、二进制帧和取消"""
+import asyncio
+import json
+from typing import Any, Dict, List, Optional
+
+from websocket_session import WebSocketSession
+
+
+class FakeWebSocket:
+    """按顺序交给会话的客户端帧；send_error 不为空时发送失败"""
+
+    def __init__(self, send_error: Optional[Exception] = None, send_delay: float = 0.0):
+        self.incoming: "asyncio.Queue[Dict[str, Any]]" = asyncio.Queue()
+        self.sent: List[Dict[str, Any]] = []
+        self.closed_with: Optional[int] = None
+        self.send_error = send_error
+        self.send_delay = send_delay
+
+    async def accept(self) -> None:
+        pass
+
+    async def receive(self) -> Dict[str, Any]:
+        return await self.incoming.get()
+
+    async def send_text(self, text: str) -> None:
+        if self.send_delay:
+            await asyncio.sleep(self.send_delay)
+        if self.send_error is not None:
+            raise self.send_error
+        self.sent.append(json.loads(text))
+
+    async def close(self, code: int = 1000) -> None:
+        self.closed_with = code
+
+    def client_sends(self, frame: Any) -> None:
+        if isinstance(frame, bytes):
+            self.incoming.put_nowait({"type": "websocket.receive", "bytes": frame})
+        else:
+            self.incoming.put_nowait({"type": "websocket.receive", "text": json.dumps(frame)})
+
+    def client_disconnects(self) -> None:
+        self.incoming.put_nowait({"type": "websocket.disconnect", "code": 1000})
+
+
+def make_session(websocket: FakeWebSocket, handlers, **kwargs) -> WebSocketSession:
+    return WebSocketSession(websocket, handlers, heartbeat=60, idle_timeout=60, **kwargs)
+
+
+async def hang(session: WebSocketSession, request_id: str, frame: Dict[str, Any]) -> None:
+    session.send({"type": "ack", "id": request_id})
+    await asyncio.sleep(60)
+
+
+def test_send_failure_ends_session_and_cancels_requests():
+    async def scenario():
+        websocket = FakeWebSocket(send_error=RuntimeError("peer gone"))
+        session = make_session(websocket, {"chat": hang})
+        websocket.client_sends({"type": "chat", "id": "a"})
+        await asyncio.wait_for(session.run(), 2)
+        assert session.tasks == {}
+        assert websocket.closed_with == 1011
+
+    asyncio.run(scenario())
+
+
+def test_send_queue_overflow_closes_connection():
+    async def flood(session: WebSocketSession, request_id: str, frame: Dict[str, Any]) -> None:
+        for i in range(50):
+            session.send({"type": "delta", "id": request_id, "text": str(i)})
+        await asyncio.sleep(60)
+
+    async def scenario():
+        websocket = FakeWebSocket(send_delay=0.5)
+        session = make_session(websocket, {"chat": flood}, send_queue_size=10)
+        websocket.client_sends({"type": "chat", "id": "a"})
+        await asyncio.wait_for(session.run(), 2)
+        assert websocket.closed_with == 1013
+        assert session.tasks == {}
+
+    asyncio.run(scenario())
+
+
+def test_binary_frame_is_rejected_without_closing():
+    async def scenario():
+        websocket = FakeWebSocket()
+        session = make_session(websocket, {})
+        runner = asyncio.ensure_future(session.run())
+        websocket.client_sends(b"\x00\x01")
+        websocket.client_sends({"type": "ping", "ts": 1})
+        await asyncio.sleep(0.05)
+        websocket.client_disconnects()
+        await asyncio.wait_for(runner, 2)
+        assert websocket.closed_with is None
+        assert [frame["type"] for frame in websocket.sent] == ["error", "pong"]
+        assert websocket.sent[0]["code"] == "bad_frame"
+
+    asyncio.run(scenario())
+
+
+def test_cancel_before_start_sends_cancelled_and_frees_id():
+    async def scenario():
+        websocket = FakeWebSocket()
+        session = make_session(websocket, {"chat": hang})
+        runner = asyncio.ensure_future(session.run())
+        websocket.client_sends({"type": "chat", "id": "a"})
+        websocket.client_sends({"type": "cancel", "id": "a"})
+        await asyncio.sleep(0.05)
+        assert session.tasks == {}
+        websocket.client_disconnects()
+        await asyncio.wait_for(runner, 2)
+        assert {"type": "cancelled", "id": "a"} in websocket.sent
+
+    asyncio.run(scenario())
@@ -0,0 +1,392 @@
+"""
+请求链路追踪与按需采样剖析
+
+每个 HTTP 请求生成一个 trace（ID 通过 X-Trace-ID 响应头返回），请求内的各阶段用 span 记录耗时：
+    with span("smart_answer.retrieval"):
+        ...
+
+按 TRACE_PROFILE_SAMPLE_RATE 随机选中（或开启 TRACE_PROFILE_HEADER_ENABLED 后带请求头 X-Trace-Profile）时，
+请求期间由后台线程对进程内所有线程做墙钟采样，请求结束后把 span 和折叠栈（flamegraph.pl / speedscope 可直接读取）
+保存到 TRACE_PROFILE_DIR，最多保留 TRACE_PROFILE_MAX_FILES 个结果。采样覆盖整个进程，同一时间只剖析一个请求，
+适合复现单个慢请求时使用。
+"""
+import asyncio
+import functools
+import glob
+import hmac
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from config import (
+    TRACE_ENABLED,
+    TRACE_PROFILE_SAMPLE_RATE,
+    TRACE_PROFILE_INTERVAL,
+    TRACE_PROFILE_DIR,
+    TRACE_PROFILE_HEADER_ENABLED,
+    TRACE_PROFILE_TOKEN,
+    TRACE_PROFILE_MAX_FILES,
+    TRACE_SLOW_REQUEST_SECONDS,
+)
+from logger import get_logger
+
+logger = get_logger("trace")
+
+TRACE_HEADER = "X-Trace-ID"
+PROFILE_HEADER = "X-Trace-Profile"
+
+# 单个请求最多记录的 span 数，防止异常循环撑爆内存
+MAX_SPANS = 500
+# 采样时保留的最大栈深度
+MAX_STACK_DEPTH = 64
+
+_current_trace: ContextVar[Optional["Trace"]] = ContextVar("trace", default=None)
+_current_span: ContextVar[Optional[int]] = ContextVar("span", default=None)
+
+
+class Span:
+    """一个阶段的耗时记录"""
+
+    __slots__ = ("name", "span_id", "parent_id", "start", "end", "attrs")
+
+    def __init__(self, name: str, span_id: int, parent_id: Optional[int], start: float, attrs: Dict[str, Any]):
+        self.name = name
+        self.span_id = span_id
+        self.parent_id = parent_id
+        self.start = start
+        self.end: Optional[float] = None
+        self.attrs = attrs
+
+    def to_dict(self, origin: float) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "id": self.span_id,
+            "parent": self.parent_id,
+            "start_ms": round((self.start - origin) * 1000, 3),
+            "duration_ms": round(((self.end or self.start) - self.start) * 1000, 3),
+            "attrs": self.attrs,
+        }
+
+
+class Trace:
+    """一个请求的追踪记录"""
+
+    def __init__(self, trace_id: str, method: str, path: str):
+        self.trace_id = trace_id
+        self.method = method
+        self.path = path
+        self.wall_start = time.time()
+        self.start = time.perf_counter()
+        self.end: Optional[float] = None
+        self.status: Optional[int] = None
+        self.spans: List[Span] = []
+        self.profiler: Optional["SamplingProfiler"] = None
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def open_span(self, name: str, parent_id: Optional[int], attrs: Dict[str, Any],
+                  start: Optional[float] = None) -> Optional[Span]:
+        with self._lock:
+            if len(self.spans) >= MAX_SPANS:
+                return None
+            self._next_id += 1
+            item = Span(name, self._next_id, parent_id, start or time.perf_counter(), attrs)
+            self.spans.append(item)
+        return item
+
+    @property
+    def duration(self) -> float:
+        return (self.end or time.perf_counter()) - self.start
+
+    def stage_totals(self) -> Dict[str, float]:
+        """按 span 名称汇总的耗时（毫秒）"""
+        totals: Dict[str, float] = {}
+        for item in self.spans:
+            if item.end is not None:
+                totals[item.name] = totals.get(item.name, 0.0) + (item.end - item.start) * 1000
+        return {name: round(ms, 2) for name, ms in totals.items()}
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "trace_id": self.trace_id,
+            "method": self.method,
+            "path": self.path,
+            "status": self.status,
+            "started_at": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.wall_start)),
+            "duration_ms": round(self.duration * 1000, 2),
+            "profiled": self.profiler is not None,
+            "spans": [item.to_dict(self.start) for item in list(self.spans)],
+        }
+
+
+def current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+
+def current_trace_id() -> Optional[str]:
+    trace = _current_trace.get()
+    return trace.trace_id if trace else None
+
+
+@contextmanager
+def span(name: str, **attrs: Any) -> Iterator[Optional[Span]]:
+    """
+    记录一个阶段的耗时，没有活动的 trace 时不做任何事
+
+    返回的 Span 可以在代码块中补充属性（span.attrs[...] = ...）
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        yield None
+        return
+    item = trace.open_span(name, _current_span.get(), attrs)
+    if item is None:
+        yield None
+        return
+    token = _current_span.set(item.span_id)
+    try:
+        yield item
+    except BaseException as e:
+        item.attrs["error"] = type(e).__name__
+        raise
+    finally:
+        item.end = time.perf_counter()
+        try:
+            _current_span.reset(token)
+        except ValueError:
+            # 在另一个上下文中结束（例如异步生成器被垃圾回收），直接恢复父 span
+            _current_span.set(item.parent_id)
+
+
+def record_span(name: str, start: float, **attrs: Any) -> None:
+    """记录一个已经结束的阶段（start 为 time.perf_counter() 时间），用于无法用 with 包裹的代码"""
+    trace = _current_trace.get()
+    if trace is None:
+        return
+    item = trace.open_span(name, _current_span.get(), attrs, start=start)
+    if item is not None:
+        item.end = time.perf_counter()
+
+
+def traced(name: str) -> Callable:
+    """把整个函数（同步或异步）记录为一个 span"""
+
+    def decorator(fn: Callable) -> Callable:
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args: Any, **kwargs: Any) -> Any:
+                with span(name):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+
+    return decorator
+
+
+class SamplingProfiler:
+    """
+    墙钟采样剖析器
+
+    后台线程按固定间隔读取所有线程的调用栈，统计折叠栈出现次数；
+    等待 I/O 或锁的时间同样会被采到，适合分析请求"慢在哪里"。
+    """
+
+    def __init__(self, interval: float):
+        self.interval = max(0.001, interval)
+        self.samples: Counter = Counter()
+        self.sample_count = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="trace-profiler", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join(timeout=1.0)
+
+    def _run(self) -> None:
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < MAX_STACK_DEPTH:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.samples[";".join(reversed(stack))] += 1
+            self.sample_count += 1
+
+    def folded(self) -> str:
+        """折叠栈格式：每行 `根;...;叶 次数`"""
+        return "\n".join(f"{stack} {count}" for stack, count in self.samples.most_common()) + "\n"
+
+
+class Tracer:
+    """创建请求 trace，决定是否剖析，并保留最近的追踪摘要"""
+
+    def __init__(self, enabled: bool, profile_rate: float, profile_interval: float,
+                 profile_dir: str, history_size: int = 100, max_profiles: int = TRACE_PROFILE_MAX_FILES):
+        self.enabled = enabled
+        self.profile_rate = profile_rate
+        self.profile_interval = profile_interval
+        self.profile_dir = profile_dir
+        self.max_profiles = max_profiles
+        self.recent = deque(maxlen=history_size)
+        self.profiles_saved = 0
+        # 采样覆盖整个进程，同一时间只剖析一个请求
+        self._profile_lock = threading.Lock()
+
+    def start(self, method: str, path: str, trace_id: Optional[str] = None,
+              profile_requested: bool = False) -> Trace:
+        trace = Trace(trace_id or uuid.uuid4().hex, method, path)
+        wants_profile = profile_requested or (self.profile_rate > 0 and random.random() < self.profile_rate)
+        if wants_profile:
+            if self._profile_lock.acquire(blocking=False):
+                trace.profiler = SamplingProfiler(self.profile_interval)
+                trace.profiler.start()
+            else:
+                logger.info("已有请求正在剖析，跳过", trace_id=trace.trace_id)
+        return trace
+
+    def finish(self, trace: Trace) -> Optional[str]:
+        """结束 trace，返回剖析结果文件路径（如有）"""
+        trace.end = time.perf_counter()
+        profile_path = None
+        if trace.profiler is not None:
+            trace.profiler.stop()
+            try:
+                profile_path = self._save_profile(trace)
+            except OSError as e:
+                logger.warning("保存剖析结果失败", trace_id=trace.trace_id, error=str(e))
+            finally:
+                self._profile_lock.release()
+
+        self.recent.append(trace)
+        slow = trace.duration >= TRACE_SLOW_REQUEST_SECONDS
+        log = logger.info if slow or profile_path else logger.debug
+        log("请求追踪", trace_id=trace.trace_id, method=trace.method, path=trace.path, status=trace.status,
+            duration_ms=round(trace.duration * 1000, 1),
+            stages=",".join(f"{name}:{ms}" for name, ms in trace.stage_totals().items()) or "-",
+            profile=profile_path or "-")
+        return profile_path
+
+    def _save_profile(self, trace: Trace) -> str:
+        os.makedirs(self.profile_dir, exist_ok=True)
+        stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(trace.wall_start))
+        base = os.path.join(self.profile_dir, f"{stamp}-{trace.trace_id}")
+        report = trace.to_dict()
+        report["profile"] = {
+            "interval_ms": trace.profiler.interval * 1000,
+            "samples": trace.profiler.sample_count,
+            "stacks": dict(trace.profiler.samples.most_common()),
+        }
+        with open(base + ".json", "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        with open(base + ".folded", "w", encoding="utf-8") as f:
+            f.write(trace.profiler.folded())
+        self.profiles_saved += 1
+        self._prune_profiles()
+        return base + ".json"
+
+    def _prune_profiles(self) -> None:
+        """只保留最新的 max_profiles 个剖析结果（.json 和 .folded 成对删除）"""
+        if self.max_profiles <= 0:
+            return
+        reports = sorted(glob.glob(os.path.join(self.profile_dir, "*.json")), key=os.path.getmtime)
+        for report in reports[:-self.max_profiles]:
+            for path in (report, report[:-len(".json")] + ".folded"):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "profile_rate": self.profile_rate,
+            "profiles_saved": self.profiles_saved,
+            "recent": [trace.to_dict() for trace in list(self.recent)[-20:]],
+        }
+
+
+tracer = Tracer(TRACE_ENABLED, TRACE_PROFILE_SAMPLE_RATE, TRACE_PROFILE_INTERVAL, TRACE_PROFILE_DIR)
+
+
+# 外部传入的 trace ID 只允许 ASCII 字母、数字和连字符，会写进响应头、日志和 profile 文件名
+_TRACE_ID_RE = re.compile(r"[0-9A-Za-z-]{1,64}")
+
+
+def accepted_trace_id(value: str) -> Optional[str]:
+    """请求头中的 trace ID 格式合法时返回它，否则返回 None（由 tracer 生成新的 ID）"""
+    return value if _TRACE_ID_RE.fullmatch(value) else None
+
+
+def profile_header_allowed(value: str) -> bool:
+    """X-Trace-Profile 请求头是否开启剖析：需要 TRACE_PROFILE_HEADER_ENABLED，设置了 TRACE_PROFILE_TOKEN 时值必须与之相同"""
+    if not TRACE_PROFILE_HEADER_ENABLED or not value:
+        return False
+    if TRACE_PROFILE_TOKEN:
+        return hmac.compare_digest(value.encode("utf-8"), TRACE_PROFILE_TOKEN.encode("utf-8"))
+    return value.lower() in ("1", "true", "yes")
+
+
+class TracingMiddleware:
+    """
+    ASGI 中间件：为每个 HTTP 请求创建 trace 并在响应头中返回 trace ID
+
+    用纯 ASGI 实现而不是 BaseHTTPMiddleware，这样流式响应全部发送完毕后才结束 trace，
+    SSE 的完整耗时也会被记录。
+    """
+
+    def __init__(self, app: Callable):
+        self.app = app
+
+    async def __call__(self, scope: Dict[str, Any], receive: Callable, send: Callable) -> None:
+        if scope["type"] != "http" or not tracer.enabled:
+            await self.app(scope, receive, send)
+            return
+
+        headers = {key.decode("latin-1").lower(): value.decode("latin-1") for key, value in scope.get("headers", [])}
+        trace_id = accepted_trace_id(headers.get(TRACE_HEADER.lower(), ""))
+        profile_requested = profile_header_allowed(headers.get(PROFILE_HEADER.lower(), ""))
+        trace = tracer.start(scope.get("method", ""), scope.get("path", ""), trace_id, profile_requested)
+        token = _current_trace.set(trace)
+
+        async def send_with_trace(message: Dict[str, Any]) -> None:
+            if message["type"] == "http.response.start":
+                trace.status = message.get("status")
+                response_headers = list(message.get("headers", []))
+                response_headers.append((TRACE_HEADER.encode("latin-1"), trace.trace_id.encode("latin-1")))
+                if trace.profiler is not None:
+                    response_headers.append((PROFILE_HEADER.encode("latin-1"), b"sampling"))
+                message = {**message, "headers": response_headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_trace)
+        finally:
+            _current_trace.reset(token)
+            if trace.profiler is not None:
+                # 保存文件放到线程中执行，不阻塞事件循环
+                await asyncio.to_thread(tracer.finish, trace)
+            else:
+                tracer.finish(trace)
@@ -0,0 +1,260 @@
+"""
+WebSocket 多路复用会话
+
+每个客户端只保持一条 WebSocket 连接，多个会话的请求以带 id 的 JSON 帧在同一条连接上并发进行，
+连接建立、请求头和跨域检查的开销每个客户端只付一次；历史默认使用服务器存储的会话历史，不需要每次重发。
+
+客户端发送的帧：
+- {"type": "chat" | "multimodal" | "text2image", "id": "请求ID", "conversation_id": ..., ...}
+- {"type": "cancel", "id": "请求ID"}：取消正在进行的请求
+- {"type": "ping", "ts": ...}：服务端回复 {"type": "pong", "ts": ...}
+
+服务端发送的帧（除心跳外都带请求 id）：
+- ack：请求已开始处理，带实际使用的 conversation_id
+- delta：模型输出的增量文本；reset：之前的增量作废（例如生成失败后改用其他模型重新生成）
+- done：请求完成，带完整结果，以它为准
+- cancelled / error：请求被取消或失败，error 带 code
+- ping：空闲时的心跳，超过空闲时间没有收到客户端的任何帧时关闭连接
+
+请求处理函数由 main 注册，与 HTTP 接口共用 smart_answer、多模态和文生图的实现。
+"""
+import asyncio
+import itertools
+import json
+import threading
+import time
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from starlette.websockets import WebSocket, WebSocketDisconnect
+
+from config import WS_HEARTBEAT_INTERVAL, WS_IDLE_TIMEOUT, WS_MAX_INFLIGHT, WS_SEND_QUEUE_SIZE
+from logger import get_logger
+import metrics
+
+ws_logger = get_logger("websocket")
+
+
+class RequestError(Exception):
+    """请求无法处理，以 error 帧返回给客户端"""
+
+    def __init__(self, message: str, code: str = "bad_request", **extra: Any):
+        super().__init__(message)
+        self.code = code
+        self.extra = extra
+
+
+class TokenSink:
+    """
+    把模型输出的增量从工作线程转发给事件循环
+
+    同一个请求可能先后或同时发起多次生成（对冲重试、RAG 失败后改为直接调用模型），
+    只有最先开始输出的那一次生成的增量会被转发；它中途失败时发送 reset，之后由下一次生成接管。
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, emit: Callable[[Dict[str, Any]], None]):
+        self._loop = loop
+        self._emit = emit
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._owner: Optional[int] = None
+        self._parts: List[str] = []
+        self._closed = False
+
+    def claim(self) -> Optional[int]:
+        """开始一次生成，没有其他生成在输出时取得转发权"""
+        with self._lock:
+            if self._closed or self._owner is not None:
+                return None
+            self._owner = next(self._ids)
+            return self._owner
+
+    def push(self, owner: Optional[int], text: str) -> None:
+        with self._lock:
+            if self._closed or owner is None or owner != self._owner or not text:
+                return
+            self._parts.append(text)
+        self._loop.call_soon_threadsafe(self._emit, {"type": "delta", "text": text})
+
+    def release(self, owner: Optional[int], completed: bool) -> None:
+        """生成结束；未正常完成时放弃转发权，已发送过增量则通知客户端作废"""
+        with self._lock:
+            if self._closed or owner is None or owner != self._owner or completed:
+                return
+            self._owner = None
+            reset = bool(self._parts)
+            self._parts = []
+        if reset:
+            self._loop.call_soon_threadsafe(self._emit, {"type": "reset"})
+
+    def close(self) -> None:
+        """请求结束后不再转发（例如对冲请求中落选的那次生成仍在读取）"""
+        with self._lock:
+            self._closed = True
+
+    @property
+    def text(self) -> str:
+        """已转发给客户端的文本"""
+        with self._lock:
+            return "".join(self._parts)
+
+
+# 当前请求的增量转发目标，HTTP 请求中为 None；工作线程通过 asyncio.to_thread 继承上下文
+token_sink: ContextVar[Optional[TokenSink]] = ContextVar("token_sink", default=None)
+
+Handler = Callable[["WebSocketSession", str, Dict[str, Any]], Awaitable[None]]
+
+
+class WebSocketSession:
+    """一条 WebSocket 连接：读取客户端帧、分发请求、串行发送服务端帧、发送心跳"""
+
+    def __init__(self, websocket: WebSocket, handlers: Dict[str, Handler],
+                 max_inflight: int = WS_MAX_INFLIGHT, heartbeat: float = WS_HEARTBEAT_INTERVAL,
+                 idle_timeout: float = WS_IDLE_TIMEOUT, send_queue_size: int = WS_SEND_QUEUE_SIZE):
+        self.websocket = websocket
+        self.handlers = handlers
+        self.max_inflight = max_inflight
+        self.heartbeat = heartbeat
+        self.idle_timeout = idle_timeout
+        self.tasks: Dict[str, asyncio.Task] = {}
+        self._outgoing: "asyncio.Queue[Dict[str, Any]]" = asyncio.Queue(maxsize=send_queue_size)
+        # 发送队列溢出时设置，run 随之结束连接
+        self._overflowed = asyncio.Event()
+        self._last_seen = time.monotonic()
+
+    def send(self, frame: Dict[str, Any]) -> None:
+        """发送一帧（在事件循环中调用，由发送任务按顺序写出）；积压超过上限时丢弃并关闭连接"""
+        if self._overflowed.is_set():
+            return
+        try:
+            self._outgoing.put_nowait(frame)
+        except asyncio.QueueFull:
+            ws_logger.warning("WebSocket 发送队列已满，关闭连接", queue_size=self._outgoing.maxsize,
+                              inflight=len(self.tasks))
+            self._overflowed.set()
+
+    def sink_for(self, request_id: str) -> TokenSink:
+        """为一个请求创建增量转发目标，转发的帧带上请求 id"""
+        loop = asyncio.get_running_loop()
+        return TokenSink(loop, lambda frame: self.send({**frame, "id": request_id}))
+
+    async def run(self) -> None:
+        await self.websocket.accept()
+        metrics.ACTIVE_WEBSOCKETS.inc()
+        reader = asyncio.create_task(self._reader())
+        sender = asyncio.create_task(self._sender())
+        heartbeat = asyncio.create_task(self._heartbeat())
+        overflow = asyncio.create_task(self._overflowed.wait())
+        try:
+            # 读取、发送、心跳任一结束（客户端断开、发送失败、空闲超时）或发送队列溢出时结束整个连接
+            done, _ = await asyncio.wait({reader, sender, heartbeat, overflow}, return_when=asyncio.FIRST_COMPLETED)
+            if reader in done:
+                error = reader.exception()
+                if not isinstance(error, WebSocketDisconnect):
+                    raise error
+                ws_logger.info("WebSocket 连接关闭", code=error.code, inflight=len(self.tasks))
+            elif sender in done:
+                ws_logger.warning("WebSocket 发送失败，关闭连接", error=str(sender.exception()), inflight=len(self.tasks))
+                await self._close(1011)
+            elif overflow in done:
+                await self._close(1013)
+        finally:
+            # 连接断开时取消所有进行中的请求，上游调用随之停止；之后的帧不再排队
+            self._overflowed.set()
+            tasks = list(self.tasks.values()) + [reader, sender, heartbeat, overflow]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            metrics.ACTIVE_WEBSOCKETS.dec()
+
+    async def _reader(self) -> None:
+        """读取客户端帧直到断开，断开时抛出 WebSocketDisconnect"""
+        while True:
+            message = await self.websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000), message.get("reason"))
+            self._last_seen = time.monotonic()
+            text = message.get("text")
+            if text is None:
+                # 二进制帧不断开连接，只回复错误
+                self._error(None, "只支持文本帧", "bad_frame")
+                continue
+            self._dispatch(text)
+
+    async def _close(self, code: int) -> None:
+        """主动关闭连接；连接可能已经不可用，关闭失败时忽略"""
+        try:
+            await self.websocket.close(code=code)
+        except Exception as e:
+            ws_logger.debug("关闭 WebSocket 连接失败", code=code, error=str(e))
+
+    async def _sender(self) -> None:
+        while True:
+            frame = await self._outgoing.get()
+            await self.websocket.send_text(json.dumps(frame, ensure_ascii=False))
+
+    async def _heartbeat(self) -> None:
+        while True:
+            await asyncio.sleep(self.heartbeat)
+            if time.monotonic() - self._last_seen > self.idle_timeout:
+                ws_logger.info("WebSocket 连接空闲超时", idle_timeout=self.idle_timeout)
+                await self.websocket.close(code=1001)
+                return
+            self.send({"type": "ping", "ts": time.time()})
+
+    def _error(self, request_id: Optional[str], message: str, code: str, **extra: Any) -> None:
+        metrics.WEBSOCKET_FRAMES.inc(kind="error")
+        self.send({"type": "error", "id": request_id, "code": code, "error": message, **extra})
+
+    def _dispatch(self, text: str) -> None:
+        try:
+            frame = json.loads(text)
+        except ValueError:
+            self._error(None, "帧不是有效的 JSON", "bad_frame")
+            return
+        if not isinstance(frame, dict):
+            self._error(None, "帧应为 JSON 对象", "bad_frame")
+            return
+        kind = frame.get("type")
+        request_id = frame.get("id")
+        request_id = str(request_id) if request_id is not None else None
+        metrics.WEBSOCKET_FRAMES.inc(kind=kind if kind in self.handlers or kind in ("ping", "pong", "cancel") else "unknown")
+
+        if kind == "ping":
+            self.send({"type": "pong", "ts": frame.get("ts")})
+        elif kind == "pong":
+            pass
+        elif kind == "cancel":
+            task = self.tasks.get(request_id)
+            if task is None:
+                self._error(request_id, "没有正在进行的该请求", "unknown_request")
+            else:
+                task.cancel()
+        elif kind not in self.handlers:
+            self._error(request_id, f"不支持的帧类型: {kind}", "bad_frame")
+        elif not request_id:
+            self._error(None, "请求帧缺少 id", "bad_frame")
+        elif request_id in self.tasks:
+            self._error(request_id, "该 id 的请求仍在进行", "duplicate_id")
+        elif len(self.tasks) >= self.max_inflight:
+            self._error(request_id, f"同一连接最多同时进行 {self.max_inflight} 个请求", "too_many_requests")
+        else:
+            task = asyncio.create_task(self._run_request(kind, request_id, frame))
+            task.add_done_callback(lambda t: self._request_done(request_id, t))
+            self.tasks[request_id] = task
+
+    async def _run_request(self, kind: str, request_id: str, frame: Dict[str, Any]) -> None:
+        # CancelledError 不在这里捕获，任务以取消状态结束，cancelled 帧由 _request_done 发送
+        try:
+            await self.handlers[kind](self, request_id, frame)
+        except RequestError as e:
+            self._error(request_id, str(e), e.code, **e.extra)
+        except Exception as e:
+            ws_logger.exception("WebSocket 请求处理出错", kind=kind, request_id=request_id, error=str(e))
+            self._error(request_id, str(e), "internal_error")
+
+    def _request_done(self, request_id: str, task: asyncio.Task) -> None:
+        """请求任务结束时的清理；任务在开始运行前就被取消时协程体不会执行，所以放在完成回调里"""
+        self.tasks.pop(request_id, None)
+        if task.cancelled():
+            self.send({"type": "cancelled", "id": request_id})
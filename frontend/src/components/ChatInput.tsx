@@ -1,12 +1,15 @@
 import React, { useState, FormEvent } from 'react';
+import { prefetchDraft, cancelPrefetch } from '../services/chatService';
 import './ChatInput.css';
 
 interface ChatInputProps {
   onSendMessage: (message: string) => void;
   disabled?: boolean;
+  conversationId?: string;  // 有会话ID时，输入停顿后预取检索结果
+  chatHistory?: any[];  // 发送问题时使用的聊天历史，预取时一并发送
 }
 
-const ChatInput: React.FC<ChatInputProps> = ({ onSendMessage, disabled = false }) => {
+const ChatInput: React.FC<ChatInputProps> = ({ onSendMessage, disabled = false, conversationId, chatHistory }) => {
   const [message, setMessage] = useState('');
   
   // 提交表单
@@ -14,6 +17,7 @@ const ChatInput: React.FC<ChatInputProps> = ({ onSendMessage, disabled = false }
     e.preventDefault();
     
     if (message.trim() && !disabled) {
+      cancelPrefetch();
       onSendMessage(message);
       setMessage('');
     }
@@ -34,7 +38,10 @@ const ChatInput: React.FC<ChatInputProps> = ({ onSendMessage, disabled = false }
           className="message-input"
           placeholder="请输入您的问题..."
           value={message}
-          onChange={(e) => setMessage(e.target.value)}
+          onChange={(e) => {
+            setMessage(e.target.value);
+            prefetchDraft(e.target.value, conversationId, chatHistory);
+          }}
           onKeyDown={handleKeyDown}
           disabled={disabled}
         />
@@ -4,7 +4,9 @@ import {
   Message,
   getChatHistory,
   sendMultiModalJsonMessage,
-  callTextToImage
+  callTextToImage,
+  prefetchDraft,
+  cancelPrefetch
 } from '../services/chatService'
 import ReactMarkdown from 'react-markdown'
 import rehypeSanitize from 'rehype-sanitize'
@@ -32,12 +34,20 @@ const ChatInterface: React.FC<ChatInterfaceProps> = () => {
   const [currentStreamContent, setCurrentStreamContent] = useState<string>('')
   const [selectedImage, setSelectedImage] = useState<File | null>(null)
   const [previewImage, setPreviewImage] = useState<string | null>(null)
+  // 服务器上还有更早的历史消息时，为已加载的最早一条消息的序号
+  const [olderCursor, setOlderCursor] = useState<number | undefined>(undefined)
   const messagesEndRef = useRef<HTMLDivElement>(null)
+  const skipScrollRef = useRef(false)
   const cleanupRef = useRef<(() => void) | null>(null)
   const fileInputRef = useRef<HTMLInputElement>(null)
 
   // 自动滚动到底部
   useEffect(() => {
+    // 加载更早的消息时保持当前位置
+    if (skipScrollRef.current) {
+      skipScrollRef.current = false
+      return
+    }
     // 使用setTimeout确保DOM已更新后再滚动
     setTimeout(() => {
       scrollToBottom()
@@ -138,23 +148,33 @@ const ChatInterface: React.FC<ChatInterfaceProps> = () => {
     })
   }
 
-  // 加载历史聊天记录
+  // 转换历史消息为我们应用的格式
+  const formatHistory = (history: any): Message[] =>
+    history.history.map((msg: any) => ({
+      role: msg.role,
+      content: msg.content,
+      timestamp: msg.timestamp,
+      image_url: msg.image_url,
+      seq: msg.seq
+    }))
+
+  const updateOlderCursor = (history: any, formattedMessages: Message[]) => {
+    setOlderCursor(
+      history.has_more_before && formattedMessages.length > 0
+        ? formattedMessages[0].seq
+        : undefined
+    )
+  }
+
+  // 加载历史聊天记录（最近一页）
   const loadChatHistory = async (conversationId: string) => {
     try {
       console.log(`加载会话历史: ${conversationId}`)
       const history = await getChatHistory(conversationId)
 
       if (history && history.history && history.history.length > 0) {
-        // 转换历史消息为我们应用的格式
-        const formattedMessages: Message[] = history.history.map(
-          (msg: any) => ({
-            role: msg.role,
-            content: msg.content,
-            timestamp: msg.timestamp,
-            image_url: msg.image_url
-          })
-        )
-
+        const formattedMessages = formatHistory(history)
+        updateOlderCursor(history, formattedMessages)
         setMessages(formattedMessages)
         console.log(`加载了 ${formattedMessages.length} 条历史消息`)
       } else {
@@ -181,6 +201,20 @@ const ChatInterface: React.FC<ChatInterfaceProps> = () => {
     }
   }
 
+  // 加载更早的一页历史消息，插入到消息列表前面
+  const loadOlderMessages = async () => {
+    if (!conversationId || olderCursor === undefined) return
+    try {
+      const history = await getChatHistory(conversationId, { before: olderCursor })
+      const formattedMessages = formatHistory(history)
+      updateOlderCursor(history, formattedMessages)
+      skipScrollRef.current = true
+      setMessages(prev => [...formattedMessages, ...prev])
+    } catch (error) {
+      console.error('加载更早的消息失败:', error)
+    }
+  }
+
   const scrollToBottom = () => {
     if (messagesEndRef.current) {
       messagesEndRef.current.scrollIntoView({
@@ -190,12 +224,24 @@ const ChatInterface: React.FC<ChatInterfaceProps> = () => {
     }
   }
 
+  // 准备聊天历史 - 仅包含文本消息，不包含系统消息和临时消息；发送问题和输入时预取使用同一份历史
+  const buildChatHistory = () =>
+    messages
+      .filter((msg) => msg.role !== 'system' && !msg.isTemporary)
+      .map((msg) => ({
+        role: msg.role,
+        content: msg.content,
+        timestamp: msg.timestamp,
+        ...(msg.image_url ? { image_url: msg.image_url } : {})
+      }))
+
   // 处理发送消息
   const handleSendMessage = async () => {
     // 如果正在加载或者消息为空，不处理
     if (isLoading || !input.trim()) return
 
     // 清除消息输入框并设置加载状态
+    cancelPrefetch()
     const messageContent = input.trim()
     setInput('')
     setIsLoading(true)
@@ -203,15 +249,7 @@ const ChatInterface: React.FC<ChatInterfaceProps> = () => {
     try {
       console.log('发送新消息:', messageContent)
 
-      // 准备聊天历史 - 仅包含文本消息，不包含系统消息和临时消息
-      const chatHistory = messages
-        .filter((msg) => msg.role !== 'system' && !msg.isTemporary)
-        .map((msg) => ({
-          role: msg.role,
-          content: msg.content,
-          timestamp: msg.timestamp,
-          ...(msg.image_url ? { image_url: msg.image_url } : {})
-        }))
+      const chatHistory = buildChatHistory()
 
       console.log(`准备聊天历史, 共 ${chatHistory.length} 条消息`)
 
@@ -682,6 +720,11 @@ const ChatInterface: React.FC<ChatInterfaceProps> = () => {
       </div>
 
       <div className="messages-container">
+        {olderCursor !== undefined && (
+          <button className="load-older-button" onClick={loadOlderMessages}>
+            加载更早的消息
+          </button>
+        )}
         {/* 显示之前的消息 */}
         {messages.map((message, index) => (
           <div key={index} className={`message ${message.role}`}>
@@ -766,7 +809,11 @@ const ChatInterface: React.FC<ChatInterfaceProps> = () => {
         <input
           type="text"
           value={input}
-          onChange={(e) => setInput(e.target.value)}
+          onChange={(e) => {
+            setInput(e.target.value)
+            // 带图片的问题走多模态接口，不预取知识库检索
+            if (!selectedImage) prefetchDraft(e.target.value, conversationId, buildChatHistory())
+          }}
           onKeyDown={(e) => e.key === 'Enter' && handleSendMessage()}
           placeholder="请输入您的健康问题..."
           disabled={isLoading}
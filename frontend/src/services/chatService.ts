@@ -7,6 +7,7 @@ export interface Message {
   timestamp?: string;
   image_url?: string;  // 添加图片URL字段
   isTemporary?: boolean; // 标记是否为临时消息
+  seq?: number; // 服务器历史中的消息序号
 }
 
 // API基础URL
@@ -378,9 +379,50 @@ export async function sendStreamMessage(
   });
 }
 
-// 获取对话历史
-export const getChatHistory = async (conversationId: string) => {
-  const response = await axios.get(`${API_BASE_URL}/history/${conversationId}`);
+// 输入时预取：用户停止输入 PREFETCH_DEBOUNCE_MS 后把草稿发给后端提前检索，发送问题时直接使用检索结果
+const PREFETCH_DEBOUNCE_MS = 400;
+const PREFETCH_MIN_CHARS = 4;
+let prefetchTimer: ReturnType<typeof setTimeout> | undefined;
+let lastPrefetchDraft = '';
+
+// 输入框内容变化时调用；只对已有会话预取，失败时忽略。
+// chatHistory 应与随后发送问题时的历史相同，服务端据此生成的查询变体才能与正式请求匹配
+export function prefetchDraft(draft: string, conversationId?: string, chatHistory?: any[]): void {
+  cancelPrefetch();
+  const text = draft.trim();
+  const key = `${conversationId}\n${chatHistory?.length || 0}\n${text}`;
+  if (!conversationId || text.length < PREFETCH_MIN_CHARS || key === lastPrefetchDraft) {
+    return;
+  }
+  prefetchTimer = setTimeout(() => {
+    lastPrefetchDraft = key;
+    axios.post(`${API_BASE_URL}/chat/prefetch`, { message: text, chat_history: chatHistory || [] }, {
+      params: { conversation_id: conversationId },
+      headers: { 'Content-Type': 'application/json' }
+    }).catch(error => {
+      console.debug('预取请求失败:', error);
+    });
+  }, PREFETCH_DEBOUNCE_MS);
+}
+
+// 发送消息时取消尚未发出的预取
+export function cancelPrefetch(): void {
+  if (prefetchTimer !== undefined) {
+    clearTimeout(prefetchTimer);
+    prefetchTimer = undefined;
+  }
+}
+
+// 获取对话历史：默认返回最近一页，before 向前翻页，after 拉取之后的新消息；
+// 服务端带 ETag，历史没有变化时浏览器用缓存的响应（304）
+export interface HistoryPageOptions {
+  before?: number;
+  after?: number;
+  limit?: number;
+}
+
+export const getChatHistory = async (conversationId: string, options: HistoryPageOptions = {}) => {
+  const response = await axios.get(`${API_BASE_URL}/history/${conversationId}`, { params: options });
   return response.data;
 };
 